@@ -13,19 +13,26 @@ from config import AVAILABLE_MODELS
 from config import RATE_LIMIT_WINDOW
 from utils.files.file_config import ATTACHMENT_TYPES, AttachmentType
 
-from initialization import app, db, mail, xai_client, deepseek_client,gemini_pool,siliconcloud_client,oaipro_client,yunwu_client
+from initialization import app, db, db_writer, mail, xai_client, deepseek_client,gemini_pool,siliconcloud_client,oaipro_client,yunwu_client
 
-from config import THINKING_MODELS_WITHOUT_CONTENT
-from config import MODELS_WITHOUT_TOOL_SUPPORT
-from config import THINKING_MODELS_WITH_THINKING_DEGREE
+from utils.model_registry import get_model_route
 from utils.user_model import User, DEFAULT_USER_SETTINGS
-from utils.conversation_model import Conversation
+from utils.conversation_model import Conversation, make_etag, parse_etag
+from utils.conversation_search import conversation_search
+from utils.message_codec import message_codec
+from utils.attachment_registry import attachment_registry
+from sqlalchemy.orm.exc import StaleDataError
 
-from utils.wrapper import login_required
+from utils.wrapper import login_required, admin_required
 from utils.email_vailder import check_rate_limit, generate_verification_code, send_verification_email
 
 from utils.files.file_config import MIME_TYPE_MAPPING, AttachmentType
 from utils.chat.message_processor import process_image_attachment, process_binary_attachment,process_video_attachment,process_image_attachment_by_ocr
+from utils.chat.attachment_pipeline import preprocess_messages
+from utils.chat.message_cache import processed_message_cache
+from utils.chat.chat_request import build_openai_params, extract_openai_usage, estimate_openai_tokens
+from utils.chat.chat_request import build_gemini_request, extract_gemini_usage, record_usage
+from utils.logger import get_logger, truncate
 
 # 导入工具相关模块
 from utils.tool_wrapper import get_registered_tools, execute_tool
@@ -38,11 +45,15 @@ from routes.user.settings import user_settings
 from routes.image import image_bp  # 添加这行
 from utils.price.tokenCounter import TokenCounter
 from utils.price.usage_model import Usage
+from utils.price.usage_writer import usage_writer
+from utils.price.budget import budget_tracker, BUDGET_MESSAGES
 from utils.attachment_handler.image_handler import delete_base64_file, save_base64_locally, get_base64_by_id
 from routes.upload_attachment_types import upload_attachment_types_bp
 from routes.text.text_routes import text_bp  # 添加这行
 from routes.generate_text import summary_bp  # 导入摘要生成蓝图
 from routes.models_get import models_get_bp, model_icons_bp  # 导入模型相关蓝图
+logger = get_logger(__name__)
+
 # 注册蓝图
 app.register_blueprint(user_profile)
 app.register_blueprint(user_settings)  # 注册用户设置蓝图
@@ -328,6 +339,7 @@ def upload_image():
             print("\n保存base64数据...")
             base64_id = save_base64_locally(base64_image, session['user_id'])
             print(f"base64_id: {base64_id}")
+            attachment_registry.register(file_path)
             
             return jsonify({
                 'message': '图片上传成功',
@@ -429,14 +441,11 @@ def chat():
     enable_ocr = user.get_setting('enable_ocr', DEFAULT_USER_SETTINGS['enable_ocr']) if user else DEFAULT_USER_SETTINGS['enable_ocr']
     enhanced_visual = user.get_setting('enhanced_visual', DEFAULT_USER_SETTINGS['enhanced_visual']) if user else DEFAULT_USER_SETTINGS['enhanced_visual']
 
-    print(f"\n=== 聊天请求信息 ===")
-    print(f"模型ID: {model_id}")
-    print(f"会话ID: {conversation_id}")
-    print(f"消息数量: {len(messages)}")
-    print(f"用户ID: {user_id}")
-    print(f"OCR功能: {'启用' if enable_ocr else '禁用'}")
-    print(f"思考力度: {reasoning_effort}")
-    print(f"工具调用: {'启用' if enable_tools else '禁用'}")  # 添加日志
+    logger.info(
+        "聊天请求: 模型=%s 会话=%s 消息数=%d 用户=%s OCR=%s 思考力度=%s 工具=%s",
+        model_id, conversation_id, len(messages), user_id,
+        '启用' if enable_ocr else '禁用', reasoning_effort, '启用' if enable_tools else '禁用'
+    )
     # 验证对话归属权
     if conversation_id:
         conversation = Conversation.query.filter_by(id=conversation_id, user_id=session['user_id']).first()
@@ -444,28 +453,25 @@ def chat():
             return jsonify({'error': '对话不存在或无权访问'}), 404
             
     # 获取模型类型和支持的附件类型
-    model_type = None
-    model_support_list = []
-    is_reasoner = False
-    for provider, config in AVAILABLE_MODELS.items():
-        for model in config['models']:
-            if model['id'] == model_id:
-                model_type = config['api_type']
-                model_support_list = model['available_attachments']
-                is_reasoner = model.get('reasoner', False)
-                print(f"模型类型: {model_type}")
-                print(f"支持的附件类型: {[str(t) for t in model_support_list]}")
-                break
-        if model_type:
-            break
-            
-    if not model_type:
+    route = get_model_route(model_id)
+    if not route:
         return jsonify({'error': '不支持的模型'}), 400
 
+    # 消费限额预检查，在调用模型之前拒绝
+    budget = budget_tracker.check_request(user_id, model_id, messages)
+    if not budget['allowed']:
+        return jsonify({'error': BUDGET_MESSAGES[budget['reason']], 'budget': budget}), 402
+
+    model_type = route.api_type
+    model_support_list = route.attachments
+    is_reasoner = route.reasoner
+    logger.debug("模型类型: %s", model_type)
+    logger.debug("支持的附件类型: %s", [str(t) for t in model_support_list])
+
     # 检查模型是否支持工具调用
-    supports_tools = model_id not in MODELS_WITHOUT_TOOL_SUPPORT
+    supports_tools = route.supports_tools
     if enable_tools and not supports_tools:
-        print(f"警告: 模型 {model_id} 不支持工具调用，已禁用工具功能")
+        logger.warning("警告: 模型 %s 不支持工具调用，已禁用工具功能", model_id)
         enable_tools = False
         
     # 获取可用工具
@@ -473,12 +479,12 @@ def chat():
     if enable_tools and supports_tools:
         # 不使用selected_tools参数，始终获取所有工具
         available_tools = get_tools(enable_tools)
-        print(f"可用工具数量: {len(available_tools)}")
+        logger.debug("可用工具数量: %s", len(available_tools))
         for tool in available_tools:
             if 'function' in tool and 'name' in tool['function']:
-                print(f"  - {tool['function']['name']}")
+                logger.debug("  - %s", tool['function']['name'])
             else:
-                print(f"  - {tool}")  # 工具格式可能不标准，直接打印
+                logger.debug("  - %s", truncate(tool))  # 工具格式可能不标准，直接打印
     
     # 移除消息历史转换逻辑，保持消息格式统一
     # 格式转换只在API调用前进行
@@ -487,245 +493,23 @@ def chat():
             if msg.get('reasoning_summary'):
                 msg['content'] = '<think>' + msg.get('reasoning_summary') + '</think>\n' + msg.get('content')
             
-    def process_message_with_attachments(message, model_type, model_support_list, user_id,enable_ocr,enhanced_visual):
-        # 从配置中获取支持的图片类型
-        from utils.files.file_config import MIME_TYPE_MAPPING, ATTACHMENT_TYPES, AttachmentType
-        from utils.attachment_handler.image_handler import get_base64_by_id
-        
-        image_ocr_tokens = (0.0,0.0)
-        # 创建新的消息对象，只复制必要的字段
-        processed_message = {
-            'role': message.get('role', ''),
-            'tool_results': message.get('tool_results', [])
-        }
-        
-        # 根据模型类型初始化消息格式
-        if model_type == 'openai':
-            processed_message['content'] = []
-            if message.get('content') and isinstance(message['content'], str):
-                processed_message['content'].append({
-                    "type": "text",
-                    "text": message['content']
-                })
-        elif model_type == 'google':
-            processed_message['parts'] = []
-            # 确保始终添加文本内容，即使是空字符串
-            text_content = message.get('content', '')
-            if isinstance(text_content, str):
-                if not text_content and 'attachments' in message:
-                    # 如果没有文本但有附件，添加默认文本
-                    text_content = "请分析以下附件内容："
-                processed_message['parts'].append({
-                    "text": text_content
-                })
-        
-        # 处理消息中的附件
-        if 'attachments' in message and message['attachments']:
-            attachments = message['attachments']
-            for attachment in attachments:
-                # 获取附件类型和MIME类型
-                attachment_type = attachment.get('type')
-                mime_type = attachment.get('mime_type')
-                file_path = attachment.get('file_path', '')
-                
-                # 优先使用attachment中的extension属性，如果没有再从文件路径提取
-                file_ext = attachment.get('extension', '')
-                if not file_ext and file_path:
-                    file_ext = os.path.splitext(file_path)[1].lower()
-                
-                print(f"\n=== 附件信息 ===")
-                print(f"附件类型: {attachment_type}")
-                print(f"MIME类型: {mime_type}")
-                print(f"文件路径: {file_path}")
-                print(f"文件扩展名: {file_ext}")
-                
-                # 验证MIME类型是否在支持列表中
-                if mime_type:
-                    supported_type = MIME_TYPE_MAPPING.get(mime_type)
-                    # 使用枚举的value_str属性输出更友好的字符串
-                    print(f"MIME类型映射结果: {supported_type.value_str if supported_type else '未找到映射'}")
-                    
-                    # 首先判断是否为图片类型
-                    is_image = (supported_type == AttachmentType.IMAGE and 
-                              file_ext in ATTACHMENT_TYPES[AttachmentType.IMAGE]['extensions'] and 
-                              mime_type in ATTACHMENT_TYPES[AttachmentType.IMAGE]['mime_types'])
-                    
-                    if is_image:
-                        print("检测到图片文件")
-                        # 检查模型是否支持图片处理
-                        if AttachmentType.IMAGE in model_support_list:
-                            print("模型支持图片处理，使用标准图片处理流程")
-                            if model_type == 'openai':
-                                # 获取 base64 数据
-                                base64_data = None
-                                if 'base64_id' in attachment:
-                                    try:
-                                        base64_data = get_base64_by_id(attachment['base64_id'], user_id)
-                                        print("成功获取base64数据")
-                                    except Exception as e:
-                                        print(f"获取base64数据失败: {e}")
-                                        continue
-                                    
-                                if base64_data:
-                                    processed_message['content'].append({
-                                        "type": "image_url",
-                                        "image_url": {
-                                            "url": f"data:{mime_type};base64,{base64_data}",
-                                            "detail": "high"
-                                        }
-                                    })
-                                    print(f"添加图片附件，MIME类型: {mime_type}")
-                            else:
-                                process_image_attachment(
-                                    attachment,
-                                    model_type,
-                                    processed_message,
-                                    AttachmentType.IMAGE,  # 使用枚举类型
-                                    mime_type,
-                                    user_id
-                                )
-                        else:
-                            print("模型不支持图片处理，使用OCR提取文本")
-                            image_ocr_tokens = process_image_attachment_by_ocr(
-                                attachment,
-                                model_type,
-                                processed_message,
-                                user_id,  # 传递用户ID
-                                enable_ocr,  # 传递OCR功能状态
-                                enhanced_visual  # 传递增强视觉分析状态
-                            )
-                        continue
-                        
-                    # 如果不是图片，再检查其他类型
-                    if not supported_type:
-                        supported_type = AttachmentType.BINARY
-                        print(f"未找到MIME类型映射，使用默认类型: {supported_type}")
-                        
-                    # 检查模型是否支持该类型的附件
-                    # 特殊处理视频类型：统一处理 VIDEO 和 GEMINI_VIDEO
-                    if supported_type == AttachmentType.VIDEO:
-                        if AttachmentType.VIDEO in model_support_list or AttachmentType.GEMINI_VIDEO in model_support_list:
-                            print("检测到视频类型，模型支持视频处理")
-                            # 如果是Gemini模型，将类型转换为GEMINI_VIDEO
-                            if model_type == 'google':
-                                supported_type = AttachmentType.GEMINI_VIDEO
-                        else:
-                            print(f"模型不支持视频类型，将作为二进制文件处理")
-                            supported_type = AttachmentType.BINARY
-                    elif supported_type not in model_support_list:
-                        # 使用枚举的value_str属性输出更友好的字符串
-                        print(f"模型不支持的附件类型: {supported_type.value_str if supported_type else '未知类型'}")
-                        # 将模型支持的类型转换为更易读的格式
-                        supported_types_str = [t.value_str for t in model_support_list]
-                        print(f"模型支持的类型: {supported_types_str}")
-                        supported_type = AttachmentType.BINARY
-                        
-                    # 处理视频附件（包括 VIDEO 和 GEMINI_VIDEO）
-                    if supported_type in [AttachmentType.VIDEO, AttachmentType.GEMINI_VIDEO]:
-                        print(f"处理视频附件: model_type={model_type}, file_ext={file_ext}, mime_type={mime_type}")
-                        # 如果是Google模型，使用GEMINI_VIDEO配置
-                        if model_type == 'google':
-                            print(f"检查Gemini视频支持: extensions={ATTACHMENT_TYPES[AttachmentType.GEMINI_VIDEO]['extensions']}, mime_types={ATTACHMENT_TYPES[AttachmentType.GEMINI_VIDEO]['mime_types']}")
-                            if (file_ext in ATTACHMENT_TYPES[AttachmentType.GEMINI_VIDEO]['extensions'] and 
-                                mime_type in ATTACHMENT_TYPES[AttachmentType.GEMINI_VIDEO]['mime_types']):
-                                print("视频格式符合Gemini要求，开始处理...")
-                                process_video_attachment(
-                                    attachment,
-                                    model_type,
-                                    processed_message,
-                                    AttachmentType.GEMINI_VIDEO,  # 使用枚举类型
-                                    mime_type
-                                )
-                            else:
-                                print(f"视频格式不受Gemini支持: {file_ext}, {mime_type}")
-                                process_binary_attachment(
-                                    attachment,
-                                    model_type,
-                                    processed_message,
-                                    AttachmentType.BINARY  # 使用枚举类型
-                                )
-                                if model_type == 'google':
-                                    processed_message['parts'].append({
-                                        "text": f"\n注意：该视频格式不受Gemini支持。\n支持的格式：{', '.join(ATTACHMENT_TYPES[AttachmentType.GEMINI_VIDEO]['extensions'])}"
-                                    })
-                        else:
-                            # 非Google模型的视频处理
-                            process_video_attachment(
-                                attachment,
-                                model_type,
-                                processed_message,
-                                AttachmentType.VIDEO,  # 使用枚举类型VIDEO
-                                mime_type
-                            )
-                    # 检查是否为文本附件
-                    elif supported_type == AttachmentType.TEXT:
-                        print(f"处理文本附件: model_type={model_type}, file_ext={file_ext}, mime_type={mime_type}")
-                        # 检查文件MIME类型是否符合文本文件要求
-                        # 注意：对文本类型优先使用MIME类型判断，因为文件路径可能没有扩展名
-                        if mime_type in ATTACHMENT_TYPES[AttachmentType.TEXT]['mime_types']:
-                            print("文本MIME类型符合要求，开始处理...")
-                            # 调用文本处理函数
-                            from utils.chat.message_processor import process_text_attachment
-                            process_text_attachment(
-                                attachment,
-                                model_type,
-                                processed_message,
-                                AttachmentType.TEXT,  # 使用枚举类型
-                                mime_type,
-                                user_id
-                            )
-                        else:
-                            print(f"文本MIME类型不符合要求: {mime_type}")
-                            process_binary_attachment(
-                                attachment,
-                                model_type,
-                                processed_message,
-                                AttachmentType.BINARY  # 使用枚举类型
-                            )
-                    # 其他类型的附件处理
-                    else:
-                        # 直接使用支持类型枚举值
-                        process_binary_attachment(
-                            attachment,
-                            model_type,
-                            processed_message,
-                            supported_type  # 使用枚举类型
-                        )
-        
-        # 如果是OpenAI模型且没有任何内容，添加一个空文本
-        if model_type == 'openai' and not processed_message['content']:
-            processed_message['content'].append({
-                "type": "text",
-                "text": ""
-            })
-            
-        # 如果是Google模型且没有任何内容，添加一个空文本
-        if model_type == 'google' and not processed_message['parts']:
-            processed_message['parts'].append({
-                "text": ""
-            })
-        
-        return processed_message,image_ocr_tokens
-
     def generate():
         total_image_ocr_tokens = [0.0,0.0]
         try:
             # 处理消息列表
-            processed_messages = []
             for msg in messages:
                 process_message_with_reasoning_summary(msg)
-                print(f"处理思考信息后的消息: {msg}")
-                processed_msg,image_ocr_tokens = process_message_with_attachments(
-                    msg, 
-                    model_type, 
-                    model_support_list, 
-                    user_id,
-                    enable_ocr,
-                    enhanced_visual
-                )
-                processed_messages.append(processed_msg)
-                total_image_ocr_tokens[0] += image_ocr_tokens[0]
-                total_image_ocr_tokens[1] += image_ocr_tokens[1]
+                logger.debug("处理思考信息后的消息: %s", truncate(msg))
+            # 所有附件在线程池中并行预处理，结果按原始顺序放回
+            processed_messages, total_image_ocr_tokens = preprocess_messages(
+                messages,
+                model_type,
+                model_support_list,
+                user_id,
+                enable_ocr,
+                enhanced_visual,
+                conversation_id
+            )
             # 初始化token计数器和累积输出
             token_counter = TokenCounter()
             accumulated_output = []
@@ -736,109 +520,31 @@ def chat():
 
             if model_type == 'openai':
                 # OpenAI 模型调用
-                formatted_messages_for_deepseek = []
-                if model_id.startswith('deepseek'):
-                    if provider == 'deepseek':
-                        client = deepseek_client
-                    elif provider == 'siliconcloud':
-                        client = siliconcloud_client
-                    for msg in processed_messages:
-                        # 确保content是字符串
-                        content = ''
-                        if isinstance(msg.get('content'), str):
-                            content = msg['content']
-                        elif isinstance(msg.get('content'), list):
-                            text_parts = []
-                            for item in msg['content']:
-                                if isinstance(item, dict):
-                                    if item.get('type') == 'text':
-                                        text_parts.append(item.get('text', ''))
-                                    elif 'text' in item:
-                                        text_parts.append(item['text'])
-                                elif isinstance(item, str):
-                                    text_parts.append(item)
-                            content = ' '.join(text_parts)
-                        
-                        # 处理parts字段
-                        if 'parts' in msg:
-                            parts_content = []
-                            for part in msg['parts']:
-                                if isinstance(part, dict) and 'text' in part:
-                                    parts_content.append(part['text'])
-                                elif isinstance(part, str):
-                                    parts_content.append(part)
-                            if parts_content:
-                                content = content + ' ' + ' '.join(parts_content)
-                        
-                        formatted_messages_for_deepseek.append({
-                            'role': msg['role'],
-                            'content': content.strip(),
-                            'tool_results': msg.get('tool_results', [])
-                        })
-                    
-                    #print("发送给模型的消息:", formatted_messages_for_deepseek)
-                else:
-                    if provider == 'xai':
-                        client = xai_client
-                    elif provider == 'oaipro':
-                        client = oaipro_client
-                
-                # 初始化token计数
-                input_tokens_total = 0
-                output_tokens_total = 0
-                cached_input_tokens_total = 0
+                client = route.client
                 
                 # 移除工具调用自循环逻辑，一次只处理一轮对话
-                print("\n=== 开始处理模型请求 ===")
+                logger.debug("=== 开始处理模型请求 ===")
                 
                 # 如果是思考模型但不返回思考内容，发送等待信号
-                if model_id in THINKING_MODELS_WITHOUT_CONTENT:
-                    print(f"发送 waiting_reasoning 数据，模型: {model_id}")
+                if route.thinking_without_content:
+                    logger.debug("发送 waiting_reasoning 数据，模型: %s", model_id)
                     yield f"data: {json.dumps({'waiting_reasoning':True})}\n\n"
-                    print("waiting_reasoning 数据已发送")
+                    logger.debug("waiting_reasoning 数据已发送")
                 
-                # 创建基本参数
-                params = {
-                    "model": model_id,
-                    "messages": formatted_messages_for_deepseek if len(formatted_messages_for_deepseek) > 0 else processed_messages,
-                    "stream": True
-                }
-                                    # 导入转换函数
-                from tools.tool_processor import convert_tools_for_openai
-                # 一次性转换工具定义和消息
-                openai_config = convert_tools_for_openai(
-                    tools=available_tools,
-                    messages=params["messages"]
+                # 创建请求参数
+                params = build_openai_params(
+                    route,
+                    processed_messages,
+                    available_tools,
+                    enable_tools and supports_tools,
+                    max_tokens,
+                    temperature,
+                    reasoning_effort
                 )
-                # 更新转换后的消息
-                if "converted_messages" in openai_config:
-                    params["messages"] = openai_config["converted_messages"]
-                    print(f"转换后的消息: {params['messages']}")
-                # API调用前转换格式
-                if enable_tools and supports_tools and available_tools:
-
-                    # 更新工具配置
-                    if "tool_config" in openai_config:
-                        print(f"为OpenAI添加工具配置: {openai_config['tool_config']}")
-                        params.update(openai_config["tool_config"])
-                
-                # 根据模型类型添加不同的参数
-                if model_id in THINKING_MODELS_WITHOUT_CONTENT:
-                    # 推理模型使用max_completion_tokens
-                    params["max_completion_tokens"] = max_tokens
-                else:
-                    # 普通模型使用max_tokens和temperature
-                    params["max_tokens"] = max_tokens
-                    params["temperature"] = temperature
-                
-                # 仅为支持思考力度的模型添加reasoning_effort参数
-                if model_id in THINKING_MODELS_WITH_THINKING_DEGREE:
-                    print(f"为模型 {model_id} 添加思考力度参数: {reasoning_effort}")
-                    params["reasoning_effort"] = reasoning_effort
                 
                 # 调用模型API
-                print(f"调用模型API，参数: {params}")
-                print(f"发送给模型的消息: {params['messages']}")
+                logger.debug("调用模型API，参数: %s", truncate(params))
+                logger.debug("发送给模型的消息: %s", truncate(params['messages']))
                 stream = client.chat.completions.create(**params)
 
                 # 使用新的流处理函数
@@ -852,229 +558,35 @@ def chat():
                     yield response_chunk
                 
                 # 获取最后一个响应chunk用于token统计
-                last_response = get_last_chunk()
-                if last_response and hasattr(last_response, 'usage') and last_response.usage is not None:
-                    try:
-                        usage_dict = last_response.usage
-                        if usage_dict and hasattr(usage_dict, 'prompt_tokens'):
-                            current_input_tokens = usage_dict.prompt_tokens - (usage_dict.prompt_tokens_details.cached_tokens if hasattr(usage_dict, 'prompt_tokens_details') and usage_dict.prompt_tokens_details else 0)
-                            current_output_tokens = usage_dict.completion_tokens if hasattr(usage_dict, 'completion_tokens') else 0
-                            current_cached_input_tokens = usage_dict.prompt_tokens_details.cached_tokens if hasattr(usage_dict, 'prompt_tokens_details') and usage_dict.prompt_tokens_details else 0
-                            
-                            input_tokens_total += current_input_tokens
-                            output_tokens_total += current_output_tokens
-                            cached_input_tokens_total += current_cached_input_tokens
-                            
-                            use_estimated = False
-                            print(f"从OpenAI响应获取到token数 - 输入: {current_input_tokens}, 输出: {current_output_tokens}, 缓存输入: {current_cached_input_tokens}")
-                    except Exception as e:
-                        print(f"从OpenAI响应获取token数时出错: {e}")
-                        print(f"完整的usage信息: {last_response.usage if hasattr(last_response, 'usage') else 'None'}")
-                        use_estimated = True
+                usage_tokens = extract_openai_usage(get_last_chunk())
+                if usage_tokens:
+                    input_tokens, output_tokens, cached_input_tokens = usage_tokens
+                    use_estimated = False
                 else:
-                    print("无法从OpenAI响应获取token数，使用tiktoken估算")
                     use_estimated = True
-                
-                # 设置最终的token计数
-                input_tokens = input_tokens_total
-                output_tokens = output_tokens_total
-                cached_input_tokens = cached_input_tokens_total
-                
-                if use_estimated:
-                    # 使用tiktoken计算token数量
-                    print(f"使用tiktoken计算{model_id}的token数")
-                    
-                    # 针对OpenAI模型格式进行预处理
-                    formatted_messages_for_token = []
-                    for msg in processed_messages:
-                        formatted_msg = {'role': msg.get('role', 'user')}
-                        
-                        # 处理内容为列表的情况
-                        if 'content' in msg and isinstance(msg['content'], list):
-                            text_content = []
-                            for item in msg['content']:
-                                if isinstance(item, dict) and item.get('type') == 'text':
-                                    text_content.append(item.get('text', ''))
-                            formatted_msg['content'] = ' '.join(text_content)
-                        elif 'content' in msg:
-                            formatted_msg['content'] = msg['content']
-                        else:
-                            formatted_msg['content'] = ''
-                            
-                        formatted_messages_for_token.append(formatted_msg)
-                    
-                    print(f"格式化后的消息数量: {len(formatted_messages_for_token)}")
-                    # 估算输入token
-                    input_tokens = token_counter.estimate_message_tokens(formatted_messages_for_token, model_id)[0]
-                    
-                    print(f"输入token数: {input_tokens}")
-                    # 估算输出token
-                    output_text = ''.join(accumulated_output)
-                    output_tokens = token_counter.estimate_completion_tokens(output_text, model_id)
-                    print(f"Token计算结果 - 输入: {input_tokens}, 输出: {output_tokens}")
+                    input_tokens, output_tokens = estimate_openai_tokens(
+                        token_counter, processed_messages, accumulated_output, model_id
+                    )
             
             elif model_type == 'google':
                 # Google 模型调用
-                genai_client = gemini_pool.get_client()
+                genai_client = route.client.get_client()
                 
                 # 检查是否是思考模型，如果是则发送waiting_reasoning信号
-                if model_id in THINKING_MODELS_WITHOUT_CONTENT:
-                    print(f"发送 waiting_reasoning 数据，模型: {model_id}")
+                if route.thinking_without_content:
+                    logger.debug("发送 waiting_reasoning 数据，模型: %s", model_id)
                     yield f"data: {json.dumps({'waiting_reasoning':True})}\n\n"
-                    print("waiting_reasoning 数据已发送")
+                    logger.debug("waiting_reasoning 数据已发送")
                 
-                # 将消息转换为 Google SDK 格式，采用新的格式标准
-                formatted_history = []
-                system_instruction = ""
-                
-                # 先完整预处理所有消息（除了最后一条）
-                processed_history = []
-                for msg in processed_messages[:-1]:
-                    # 处理系统提示词
-                    if msg['role'] == 'system':
-                        counter = 0
-                        for part in msg['parts']:
-                            system_instruction += "system_instruction {}:".format(counter)
-                            counter += 1
-                            if isinstance(part, dict) and 'text' in part:
-                                system_instruction += part['text']
-                    else:
-                        # 基本消息处理 - 转换角色
-                        google_role = msg['role']
-                        if google_role == 'assistant':
-                            google_role = 'model'
-                        elif google_role not in ['user', 'model']:
-                            google_role = 'user'
-                        
-                        # 创建统一格式的消息对象
-                        processed_msg = {
-                            'role': google_role,
-                            'parts': [],
-                            'tool_results': msg.get('tool_results', [])  # 确保保留工具结果信息
-                        }
-                        
-                        # 添加消息内容
-                        if 'parts' in msg:
-                            for part in msg['parts']:
-                                if isinstance(part, dict):
-                                    processed_msg['parts'].append(part)
-                                else:
-                                    processed_msg['parts'].append(part)
-                        
-                        processed_history.append(processed_msg)
-                
-                # 设置安全配置和基本配置
-                print("\n=== 开始发送消息到Gemini ===")
-                safety_settings_list = [
-                    {'category': HarmCategory.HARM_CATEGORY_HATE_SPEECH, 'threshold': HarmBlockThreshold.BLOCK_NONE},
-                    {'category': HarmCategory.HARM_CATEGORY_HARASSMENT, 'threshold': HarmBlockThreshold.BLOCK_NONE},
-                    {'category': HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT, 'threshold': HarmBlockThreshold.BLOCK_NONE},
-                    {'category': HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT, 'threshold': HarmBlockThreshold.BLOCK_NONE},
-                ]
-                
-                print("\n=== 安全设置 ===")
-                for setting in safety_settings_list:
-                    print(f"类别: {setting['category'].name}, 阈值: {setting['threshold'].name}")
-                
-                # 创建配置对象
-                config = GenerateContentConfigDict(
-                    system_instruction=system_instruction,
-                    max_output_tokens=max_tokens,
-                    temperature=temperature,
-                    safety_settings=safety_settings_list
+                # 将消息转换为 Google SDK 格式
+                formatted_history, last_message_parts, config = build_gemini_request(
+                    processed_messages,
+                    available_tools,
+                    enable_tools and supports_tools,
+                    max_tokens,
+                    temperature
                 )
                 
-                # 准备格式化消息历史和工具配置
-                formatted_history = []
-                
-                # 如果支持工具且已启用工具，添加工具参数
-                if enable_tools and supports_tools and available_tools:
-                    # 导入转换函数
-                    from tools.tool_processor import convert_tools_for_google
-                    
-                    # 将预处理后的历史消息传给工具转换函数
-                    google_config = convert_tools_for_google(
-                        tools=available_tools,
-                        messages=processed_history
-                    )
-                    
-                    # 添加工具配置
-                    if "tool_config" in google_config:
-                        print(f"为Google/Gemini添加工具配置: {google_config['tool_config']}")
-                        config.update(google_config["tool_config"])
-                    
-                    # 使用转换后的消息历史
-                    if "converted_messages" in google_config and google_config["converted_messages"]:
-                        formatted_history = google_config["converted_messages"]
-                        print(f"使用工具转换后的历史消息，共 {len(formatted_history)} 条")
-                    else:
-                        print("手动格式化消息历史")
-                        for msg in processed_history:
-                            msg_role = msg['role']
-                            has_content = False
-                            parts = []
-                            
-                            # 收集所有非空内容
-                            for part in msg['parts']:
-                                # 处理文本内容
-                                if isinstance(part, dict) and 'text' in part:
-                                    if part['text'] and part['text'].strip():
-                                        parts.append(Part(text=part['text']))
-                                        has_content = True
-                                # 处理附件
-                                elif isinstance(part, dict) and 'inline_data' in part:
-                                    # 附件总是有内容的
-                                    inline_part = Part.from_bytes(
-                                        data=part['inline_data']['data'], 
-                                        mime_type=part['inline_data']['mime_type']
-                                    )
-                                    parts.append(inline_part)
-                                    has_content = True
-                            
-                            # 只有当消息有内容时才添加
-                            if has_content:
-                                formatted_history.append(Content(
-                                    role=msg_role,
-                                    parts=parts
-                                ))
-                            else:
-                                print(f"跳过空消息，角色: {msg_role}")
-                
-                # 获取并处理最后一条消息
-                last_message = processed_messages[-1]
-                last_message_parts = []
-                
-                # 添加所有的消息，包括文字和附件
-                if 'parts' in last_message:
-                    last_message_parts.extend(last_message['parts'])
-                
-                print("发送给Gemini的消息内容：", last_message_parts)
-                
-                # 检查最后一条消息是否为空或只包含空文本
-                has_valid_content = False
-                for part in last_message_parts:
-                    if isinstance(part, dict) and 'text' in part and part['text'].strip():
-                        has_valid_content = True
-                        break
-                
-                # 如果没有有效内容，添加一个默认文本
-                if not has_valid_content:
-                    print("警告：最后一条消息没有有效内容，添加默认文本")
-                    last_message_parts.append({"text": "请继续我们的对话"})
-                
-                # 调试输出历史消息
-                print("\n=== 最终历史消息 ===")
-                for i, msg in enumerate(formatted_history):
-                    print(f"历史消息[{i}]: 角色={msg.role}, 内容类型={type(msg.parts)}")
-                
-                # 确保历史消息不为空
-                if not formatted_history:
-                    print("警告：历史消息为空，创建一个默认历史消息")
-                    formatted_history.append(Content(
-                        role='user',
-                        parts=[Part(text="请开始我们的对话")]
-                    ))
-                
                 try:
                     # 创建聊天实例并传入历史记录
                     chat = genai_client.chats.create(model=model_id, history=formatted_history)
@@ -1084,7 +596,7 @@ def chat():
                         message=last_message_parts,
                         config=config
                     )
-                    print("成功获取响应流")
+                    logger.debug("成功获取响应流")
                     
                     # 使用新的流处理函数
                     from utils.chat.stream_processor import process_google_stream_response
@@ -1097,30 +609,13 @@ def chat():
                         yield response_chunk
 
                     # 获取最后一个响应chunk用于token统计
-                    last_response = get_last_chunk()
-
-                    # 从最后一个响应中获取token使用情况
-                    if last_response and hasattr(last_response, 'usage_metadata'):
-                        input_tokens = last_response.usage_metadata.prompt_token_count
-                        output_tokens = last_response.usage_metadata.candidates_token_count
-                        use_estimated = False  # 更新为使用实际值
-                        print(f"从Gemini响应获取到token数 - 输入: {input_tokens}, 输出: {output_tokens}")
-                    else:
-                        print("无法从Gemini响应获取token数，使用tiktoken估算")
-                        use_estimated = True  # 更新为使用预估值
-                        # 使用tiktoken估算token数
-                        input_tokens = token_counter.estimate_message_tokens(processed_messages,model_id)[0]
-                        output_text = ''.join(accumulated_output)
-                        output_tokens = token_counter.estimate_completion_tokens(output_text,model_id)
+                    input_tokens, output_tokens, use_estimated = extract_gemini_usage(
+                        get_last_chunk(), token_counter, processed_messages, accumulated_output, model_id
+                    )
                 
                 except Exception as e:
                     error_msg = f"与Gemini通信时出错: {str(e)}"
-                    print(f"\n=== 错误信息 ===")
-                    print(f"类型: {type(e).__name__}")
-                    print(f"描述: {str(e)}")
-                    print("详细堆栈:")
-                    import traceback
-                    print(traceback.format_exc())
+                    logger.error("与Gemini通信时出错 (%s): %s", type(e).__name__, e, exc_info=True)
                     error_response = {
                         'error': error_msg,
                         'error_type': type(e).__name__,
@@ -1130,8 +625,7 @@ def chat():
 
         except Exception as e:
             error_msg = f"记录使用情况时出错: {str(e)}"
-            print(error_msg)
-            print(f"错误详情:\n{traceback.format_exc()}")
+            logger.error("%s", error_msg, exc_info=True)
             db.session.rollback()
             error_response = {
                 'error': error_msg,
@@ -1140,43 +634,44 @@ def chat():
             }
             yield f"data: {json.dumps(error_response)}\n\n"
 
-        with app.app_context():
-            usage = Usage(
-                user_id=user_id,
-                model_name=model_id,
-                tokens_in=input_tokens,
-                cached_input_tokens=cached_input_tokens,
-                tokens_out=output_tokens,
-                image_ocr_input_tokens=total_image_ocr_tokens[0],
-                image_ocr_output_tokens=total_image_ocr_tokens[1]
-            )
-            usage.calculate_cost()
-            db.session.add(usage)
-            db.session.commit()
-            
-            print("\n=== 使用统计 ===")
-            print(f"Token计数方式: {'tiktoken预估' if use_estimated else '模型实际值'}")
-            print(f"输入token数: {input_tokens}, 命中缓存token数: {cached_input_tokens}, 成本: ${usage.input_cost:.6f}")
-            print(f"输出token数: {output_tokens}, 成本: ${usage.output_cost:.6f}")
-            print(f"图片OCR输入token数: {total_image_ocr_tokens[0]}, 图片OCR输出token数: {total_image_ocr_tokens[1]}, 成本: ${usage.image_ocr_cost:.6f}")
-            print(f"总成本: ${usage.total_cost:.6f}")
-            
-            usage_info = {
-                'type': 'usage_info',
-                'input_tokens': input_tokens,
-                'output_tokens': output_tokens,
-                'total_tokens': input_tokens + output_tokens,
-                'image_ocr_cost': usage.image_ocr_cost,
-                'input_cost': usage.input_cost,
-                'output_cost': usage.output_cost,
-                'total_cost': usage.total_cost,
-                'is_estimated': use_estimated,
-                'status_code': 200
-            }
-            yield f"data: {json.dumps(usage_info)}\n\n"
+        # 费用在当前线程计算，数据库写入由后台写入器批量完成
+        usage_info = record_usage(
+            user_id,
+            model_id,
+            input_tokens,
+            cached_input_tokens,
+            output_tokens,
+            total_image_ocr_tokens,
+            use_estimated
+        )
+        yield f"data: {json.dumps(usage_info)}\n\n"
 
     return Response(generate(), mimetype='text/event-stream')
 
+@app.route('/api/budget', methods=['GET'])
+@login_required
+def get_budget_status():
+    """当前用户今日/本月的用量和消费限额"""
+    return jsonify(budget_tracker.status(session['user_id']))
+
+@app.route('/api/metrics/usage_writer', methods=['GET'])
+@admin_required
+def usage_writer_metrics():
+    """用量写入队列的运行指标（队列深度、已写入数量等）"""
+    return jsonify(usage_writer.stats())
+
+@app.route('/api/metrics/attachments', methods=['GET'])
+@admin_required
+def attachment_metrics():
+    """附件回收的运行指标（登记、回收数量和队列深度）"""
+    return jsonify(attachment_registry.stats())
+
+@app.route('/api/metrics/db_writer', methods=['GET'])
+@admin_required
+def db_writer_metrics():
+    """SQLite写入队列的运行指标（合并的事务数、锁冲突重试次数等）"""
+    return jsonify(db_writer.stats())
+
 # 添加重置密码路由
 @app.route('/reset_password', methods=['GET', 'POST'])
 def reset_password():
@@ -1236,10 +731,63 @@ def reset_password_confirm():
 @login_required
 def get_conversations():
     conversations = Conversation.query.filter_by(user_id=session['user_id']).order_by(Conversation.updated_at.desc()).all()
+    Conversation.preload_messages(conversations)
     return jsonify({
         'conversations': [conv.to_dict() for conv in conversations]
     })
 
+@app.route('/api/conversations/summary', methods=['GET'])
+@login_required
+def get_conversation_summaries():
+    """分页获取对话摘要（不含消息），用于侧边栏"""
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    cursor = request.args.get('cursor')
+    try:
+        summaries, next_cursor = Conversation.summary_page(session['user_id'], limit, cursor)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({
+        'conversations': summaries,
+        'next_cursor': next_cursor
+    })
+
+@app.route('/api/conversations/search', methods=['GET'])
+@login_required
+def search_conversations():
+    """全文搜索对话标题、系统提示词和消息，按相关度分页返回带高亮的片段"""
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({'error': '缺少搜索关键词'}), 400
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    results, has_more = conversation_search.search(session['user_id'], query, limit, offset)
+    return jsonify({
+        'results': results,
+        'has_more': has_more,
+        'next_offset': offset + limit if has_more else None
+    })
+
+@app.route('/api/conversations/<conversation_id>/messages', methods=['GET'])
+@login_required
+def get_conversation_messages(conversation_id):
+    """按窗口获取对话消息，默认返回最新的一段，before参数向前翻页"""
+    conversation = Conversation.query.filter_by(id=conversation_id, user_id=session['user_id']).first()
+    if not conversation:
+        return jsonify({'error': '对话不存在'}), 404
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+    before = request.args.get('before', type=int)
+    start, messages = conversation.get_message_window(before, limit)
+    data = conversation.to_dict(include_messages=False)
+    data.update({
+        'messages': messages,
+        'start_seq': start,
+        'message_count': conversation.message_count,
+        'has_more': start > 0
+    })
+    response = jsonify(data)
+    response.headers['ETag'] = make_etag(conversation.version)
+    return response
+
 @app.route('/api/conversations', methods=['POST'])
 @login_required
 def save_conversations():
@@ -1250,8 +798,20 @@ def save_conversations():
     max_tokens = data.get('max_tokens')  # 移除默认值，使用数据库的默认值
     model_id = data.get('model_id')
     reasoning_effort = data.get('reasoning_effort', 'high')  # 添加思考力度参数
-    
-    try:
+    base_version = parse_etag(request.headers.get('If-Match'))
+    user_id = session['user_id']
+    # 删除对话时先记下它引用的附件，写入成功后交给后台回收
+    attachment_keys = []
+    if operation == 'delete':
+        owned = Conversation.query.filter_by(id=conversation_data['id'], user_id=user_id).first()
+        if owned:
+            attachment_keys = attachment_registry.conversation_keys(owned.id, user_id)
+        # 读取完成后结束当前会话的读事务，写入在写入队列中进行
+        db.session.rollback()
+
+    def write(db_session):
+        """在写入队列中执行，返回 (响应数据, 状态码, 版本号)"""
+        conversation = None
         if operation == 'create':
             # 创建新对话
             conversation = Conversation(
@@ -1259,23 +819,26 @@ def save_conversations():
                 title=conversation_data['title'],
                 messages=conversation_data['messages'],
                 system_prompt=conversation_data.get('systemPrompt'),
-                user_id=session['user_id'],
+                user_id=user_id,
                 temperature=temperature,
                 max_tokens=max_tokens,
                 reasoning_effort=reasoning_effort  # 添加思考力度
             )
-            db.session.add(conversation)
+            db_session.add(conversation)
             
         elif operation == 'update':
             # 更新现有对话
             conversation = Conversation.query.filter_by(
                 id=conversation_data['id'], 
-                user_id=session['user_id']
+                user_id=user_id
             ).first()
             
+            if conversation and base_version is not None and conversation.version != base_version:
+                return {'error': '对话版本已过期', 'version': conversation.version}, 412, None
             if conversation:
                 conversation.title = conversation_data['title']
-                conversation.messages = conversation_data['messages']
+                # 只写入新增或变化的消息行
+                conversation.sync_messages(conversation_data['messages'])
                 conversation.system_prompt = conversation_data.get('systemPrompt')
                 # 只在提供了新值时更新
                 if temperature is not None:
@@ -1287,20 +850,89 @@ def save_conversations():
             
         elif operation == 'delete':
             # 删除对话
-            Conversation.query.filter_by(
+            conversation = Conversation.query.filter_by(
                 id=conversation_data['id'], 
-                user_id=session['user_id']
-            ).delete()
-        
-        db.session.commit()
-        return jsonify({'message': '保存成功'})
+                user_id=user_id
+            ).first()
+            if conversation:
+                conversation.delete_messages()
+                db_session.delete(conversation)
+            return {'message': '保存成功'}, 200, None
+
+        if conversation is None:
+            return {'message': '保存成功'}, 200, None
+        # 先flush，得到写入后的版本号
+        db_session.flush()
+        return {'message': '保存成功', 'version': conversation.version}, 200, conversation.version
+
+    try:
+        payload, status, version = db_writer.execute(write)
+        if operation == 'delete':
+            processed_message_cache.invalidate_conversation(conversation_data['id'])
+            attachment_registry.release(attachment_keys)
+        response = jsonify(payload)
+        if version is not None:
+            response.headers['ETag'] = make_etag(version)
+        return response, status
         
+    except StaleDataError:
+        return jsonify({'error': '对话已被其他请求修改，请刷新后重试'}), 409
     except Exception as e:
-        db.session.rollback()
         app.logger.error(f"保存对话失败: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/conversations/<conversation_id>', methods=['PATCH'])
+@login_required
+def patch_conversation(conversation_id):
+    """
+    增量同步对话，只提交变化的部分
+
+    请求头If-Match（或请求体base_version）必须是客户端持有的版本，
+    版本不一致时返回412和服务器当前版本，客户端应重新拉取后再提交。
+    """
+    data = request.get_json(silent=True) or {}
+    base_version = parse_etag(request.headers.get('If-Match'))
+    if base_version is None:
+        base_version = data.get('base_version')
+    if base_version is None:
+        return jsonify({'error': '缺少版本号(If-Match或base_version)'}), 428
+    user_id = session['user_id']
+
+    def write(db_session):
+        """在写入队列中执行，返回 (响应数据, 状态码, 版本号)"""
+        conversation = Conversation.query.filter_by(id=conversation_id, user_id=user_id).first()
+        if not conversation:
+            return {'error': '对话不存在'}, 404, None
+        if conversation.version != base_version:
+            return {'error': '对话版本已过期', 'version': conversation.version}, 412, conversation.version
+        # 操作无效时抛出ValueError，写入队列只回滚这一次写入
+        stats = conversation.apply_ops(data.get('ops'))
+        # flush时对话行的版本号会在WHERE条件中再次校验，并发修改会引发StaleDataError
+        db_session.flush()
+        return {
+            'version': conversation.version,
+            'message_count': conversation.message_count,
+            'applied': stats
+        }, 200, conversation.version
+
+    try:
+        payload, status, version = db_writer.execute(write)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except StaleDataError:
+        current = db.session.query(Conversation.version).filter_by(id=conversation_id).first()
+        return jsonify({'error': '对话版本已过期', 'version': current.version if current else None}), 412
+    except Exception as e:
+        app.logger.error(f"增量保存对话失败: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+    response = jsonify(payload)
+    if version is not None:
+        response.headers['ETag'] = make_etag(version)
+    return response, status
+
+
 @app.route('/api/conversations/<conversation_id>', methods=['DELETE'])
 @login_required
 def delete_conversation(conversation_id):
@@ -1309,30 +941,21 @@ def delete_conversation(conversation_id):
         return jsonify({'error': '对话不存在'}), 404
         
     try:
-        # 删除相关的本地文件和 base64 文件
-        for message in conversation.messages:
-            if 'attachments' in message and message['attachments']:
-                for attachment in message['attachments']:
-                    # 删除本地文件
-                    file_path = attachment.get('file_path')
-                    if file_path and os.path.exists(file_path):
-                        try:
-                            os.remove(file_path)
-                            print(f"已删除文件: {file_path}")
-                        except Exception as e:
-                            print(f"删除文件失败 {file_path}: {str(e)}")
-                            
-                    # 删除 base64 文件
-                    base64_id = attachment.get('base64_id')
-                    if base64_id:
-                        try:
-                            delete_base64_file(base64_id, session['user_id'])
-                            print(f"已删除 base64 文件: {base64_id}")
-                        except Exception as e:
-                            print(f"删除 base64 文件失败 {base64_id}: {str(e)}")
-        
-        db.session.delete(conversation)
-        db.session.commit()
+        # 对话引用的附件在删除后交给后台回收，没有被其它对话引用的才会删除文件
+        attachment_keys = attachment_registry.conversation_keys(conversation_id, session['user_id'])
+
+        def write(db_session):
+            target = Conversation.query.filter_by(id=conversation_id, user_id=user_id).first()
+            if target:
+                target.delete_messages()
+                db_session.delete(target)
+
+        user_id = session['user_id']
+        # 读取完成后结束当前会话的读事务，写入在写入队列中进行
+        db.session.rollback()
+        db_writer.execute(write)
+        processed_message_cache.invalidate_conversation(conversation_id)
+        attachment_registry.release(attachment_keys)
         return jsonify({'message': '删除成功'})
     except Exception as e:
         db.session.rollback()
@@ -1378,6 +1001,8 @@ def get_models():
 # 创建数据库表
 with app.app_context():
     db.create_all()
+    # 读取当前的消息压缩字典，之后定期检查是否有新训练的字典
+    message_codec.load()
 
 # 测试邮件连接
 try:
@@ -1413,38 +1038,24 @@ def generate_title():
 
 def stream_chat_response_for_title(messages, model_id):
     # 确定模型类型
-    model_type = None
-    for provider, config in AVAILABLE_MODELS.items():
-        for model in config['models']:
-            if model['id'] == model_id:
-                model_type = config['api_type']
-                break
-        if model_type:
-            break
+    route = get_model_route(model_id)
+    model_type = route.api_type if route else None
 
     if model_type == 'openai':
         # OpenAI 模型调用
-        if model_id.startswith('grok'):
-            stream = xai_client.chat.completions.create(
-                model=model_id,
-                messages=messages,
-                stream=True,
-                temperature=0.7
-            )
-        elif model_id.startswith('deepseek'):
-            stream = deepseek_client.chat.completions.create(
-                model=model_id,
-                messages=messages,
-                stream=True,
-                temperature=0.7
-            )
+        stream = route.client.chat.completions.create(
+            model=model_id,
+            messages=messages,
+            stream=True,
+            temperature=0.7
+        )
         for chunk in stream:
             if hasattr(chunk.choices[0].delta, 'content') and chunk.choices[0].delta.content is not None:
                 yield chunk.choices[0].delta.content
 
     elif model_type == 'google':
         # Google 模型调用
-        genai_client = gemini_pool.get_client()
+        genai_client = route.client.get_client()
         response = genai_client.models.generate_content_stream(model=model_id, contents=messages[-1]['content'],config=GenerateContentConfigDict(temperature=0.7))
         for chunk in response:
             if chunk.text:
@@ -1540,6 +1151,7 @@ def upload_video():
         try:
             # 直接保存文件
             video.save(file_path)
+            attachment_registry.register(file_path)
             
             return jsonify({
                 'message': '视频上传成功',
@@ -1601,6 +1213,7 @@ def process_large_file():
             
             # 处理大文件（这里可以添加具体的处理逻辑）
             process_result = process_video_file(temp_path, final_path)
+            attachment_registry.register(final_path)
             
             return jsonify({
                 'message': 'File processed successfully',
@@ -0,0 +1,9 @@
+# ASGI入口：POST /chat 使用异步聊天引擎，其余路由仍由Flask处理
+# 启动方式: uvicorn asgi:application --host 127.0.0.1 --port 5001 --workers 2 --timeout-keep-alive 5
+from asgiref.wsgi import WsgiToAsgi
+
+from app import app
+from utils.chat.async_engine import AsyncChatApp
+
+# 同步路由在asgiref的线程池中执行
+application = AsyncChatApp(app, fallback=WsgiToAsgi(app))
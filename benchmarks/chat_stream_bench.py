@@ -0,0 +1,170 @@
+"""
+对比gevent路径（gunicorn + 同步OpenAI客户端）与ASGI路径（uvicorn + AsyncOpenAI）的并发SSE能力
+
+1. 启动一个慢速的模拟上游（OpenAI兼容接口，逐个chunk慢慢返回）:
+       python benchmarks/chat_stream_bench.py provider --port 9000 --chunks 200 --interval 0.05
+2. 在config.py中把某个服务商的API_BASE_URLS改为 http://127.0.0.1:9000/v1 ，然后分别启动两种服务:
+       gunicorn -c gunicorn_config.py app:app                       # 127.0.0.1:5000
+       uvicorn asgi:application --host 127.0.0.1 --port 5001
+3. 对两个服务分别压测:
+       python benchmarks/chat_stream_bench.py load --url http://127.0.0.1:5000/chat --user-id 1 --model grok-2-latest -c 2000
+       python benchmarks/chat_stream_bench.py load --url http://127.0.0.1:5001/chat --user-id 1 --model grok-2-latest -c 2000
+
+输出首字节延迟、完成时间分位数，以及成功/失败的流数量。
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_provider_app(chunks: int, interval: float):
+    """模拟OpenAI兼容的流式接口"""
+
+    async def provider_app(scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        # 读完请求体
+        while True:
+            message = await receive()
+            if not message.get('more_body'):
+                break
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream')]
+        })
+        created = int(time.time())
+        for i in range(chunks):
+            chunk = {
+                'id': 'bench',
+                'object': 'chat.completion.chunk',
+                'created': created,
+                'model': 'bench',
+                'choices': [{'index': 0, 'delta': {'content': f'token{i} '}, 'finish_reason': None}]
+            }
+            await send({'type': 'http.response.body', 'body': f"data: {json.dumps(chunk)}\n\n".encode(), 'more_body': True})
+            await asyncio.sleep(interval)
+        final = {
+            'id': 'bench',
+            'object': 'chat.completion.chunk',
+            'created': created,
+            'model': 'bench',
+            'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': 10, 'completion_tokens': chunks, 'total_tokens': 10 + chunks}
+        }
+        await send({'type': 'http.response.body', 'body': f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode(), 'more_body': False})
+
+    return provider_app
+
+
+def run_provider(args):
+    import uvicorn
+    uvicorn.run(make_provider_app(args.chunks, args.interval), host='127.0.0.1', port=args.port,
+                log_level='warning', backlog=4096)
+
+
+def make_session_cookie(user_id: int) -> str:
+    """使用应用的secret_key签发登录session"""
+    from initialization import app
+    serializer = app.session_interface.get_signing_serializer(app)
+    return serializer.dumps({'user_id': user_id})
+
+
+async def one_stream(client, url, payload, results):
+    start = time.perf_counter()
+    first_byte = None
+    frames = 0
+    try:
+        async with client.stream('POST', url, json=payload) as response:
+            if response.status_code != 200:
+                results.append(('error', f'HTTP {response.status_code}', None, None))
+                return
+            async for line in response.aiter_lines():
+                if not line.startswith('data: '):
+                    continue
+                if first_byte is None:
+                    first_byte = time.perf_counter() - start
+                frames += 1
+                if '"error"' in line:
+                    results.append(('error', line[:200], first_byte, None))
+                    return
+        results.append(('ok', frames, first_byte, time.perf_counter() - start))
+    except Exception as e:
+        results.append(('error', f'{type(e).__name__}: {e}', first_byte, None))
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def run_load(args):
+    import httpx
+
+    cookie = args.cookie or make_session_cookie(args.user_id)
+    payload = {
+        'model_id': args.model,
+        'enable_tools': False,
+        'max_tokens': 256,
+        'messages': [{'role': 'user', 'content': 'benchmark'}]
+    }
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    results = []
+    async with httpx.AsyncClient(cookies={'session': cookie}, limits=limits, timeout=args.timeout) as client:
+        start = time.perf_counter()
+        tasks = []
+        for _ in range(args.concurrency):
+            tasks.append(asyncio.create_task(one_stream(client, args.url, payload, results)))
+            if args.ramp:
+                await asyncio.sleep(args.ramp / args.concurrency)
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+    ok = [r for r in results if r[0] == 'ok']
+    errors = [r for r in results if r[0] == 'error']
+    ttfb = [r[2] for r in ok if r[2] is not None]
+    totals = [r[3] for r in ok]
+    print(f"目标: {args.url}")
+    print(f"并发流: {args.concurrency}, 成功: {len(ok)}, 失败: {len(errors)}, 总耗时: {elapsed:.2f}s")
+    print(f"首字节延迟 p50={percentile(ttfb, 50):.3f}s p95={percentile(ttfb, 95):.3f}s p99={percentile(ttfb, 99):.3f}s")
+    print(f"完成时间   p50={percentile(totals, 50):.3f}s p95={percentile(totals, 95):.3f}s p99={percentile(totals, 99):.3f}s")
+    if errors:
+        print("部分错误示例:")
+        for r in errors[:5]:
+            print(f"  {r[1]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='gevent与ASGI聊天流式接口并发对比')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    provider = sub.add_parser('provider', help='启动模拟的慢速上游')
+    provider.add_argument('--port', type=int, default=9000)
+    provider.add_argument('--chunks', type=int, default=200, help='每个响应的chunk数')
+    provider.add_argument('--interval', type=float, default=0.05, help='chunk之间的间隔（秒）')
+
+    load = sub.add_parser('load', help='对/chat发起并发流式请求')
+    load.add_argument('--url', required=True)
+    load.add_argument('--model', default='grok-2-latest')
+    load.add_argument('--user-id', type=int, default=1, help='用于签发session的用户ID')
+    load.add_argument('--cookie', default=None, help='直接使用已有的session cookie')
+    load.add_argument('-c', '--concurrency', type=int, default=1000)
+    load.add_argument('--ramp', type=float, default=5.0, help='在多少秒内逐步建立全部连接')
+    load.add_argument('--timeout', type=float, default=600.0)
+
+    args = parser.parse_args()
+    if args.command == 'provider':
+        run_provider(args)
+    else:
+        asyncio.run(run_load(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+"""
+模拟多个gunicorn进程中并发的聊天请求对SQLite的写入竞争
+
+每次"聊天完成"包含与线上相同形状的写入：追加两条消息行并更新对话行、写入一条用量记录，
+其中一部分请求还会更新用户设置。对比三种模式：
+
+    baseline  回滚日志模式，不等待写锁（当前线上配置）
+    wal       WAL + busy_timeout + 锁冲突重试，每个请求单独提交
+    queue     WAL + 进程内单写入队列，合并小事务后提交
+
+用法:
+    python benchmarks/sqlite_contention_bench.py --processes 4 --concurrency 64 --requests 2000
+    python benchmarks/sqlite_contention_bench.py --modes wal,queue --processes 4 --concurrency 256
+
+输出每种模式的吞吐量、延迟分位数、失败数和重试数。数据库文件在临时目录中创建，不会影响users.db。
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import (create_engine, MetaData, Table, Column, Integer, String, Text, Float, DateTime,
+                        UniqueConstraint, insert, update, func, select)
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import OperationalError
+
+from utils.sqlite_writer import WriteQueue, configure_sqlite_engine, is_locked_error, retry_on_locked
+
+metadata = MetaData()
+conversation = Table(
+    'conversation', metadata,
+    Column('id', String(50), primary_key=True),
+    Column('user_id', Integer, nullable=False),
+    Column('message_count', Integer, default=0),
+    Column('version', Integer, default=0),
+    Column('updated_at', DateTime, server_default=func.current_timestamp()),
+)
+conversation_message = Table(
+    'conversation_message', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('conversation_id', String(50), nullable=False, index=True),
+    Column('seq', Integer, nullable=False),
+    Column('role', String(20)),
+    Column('content', Text),
+    UniqueConstraint('conversation_id', 'seq'),
+)
+usage = Table(
+    'usage', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, nullable=False),
+    Column('model_name', String(100)),
+    Column('tokens_in', Integer),
+    Column('tokens_out', Integer),
+    Column('total_cost', Float),
+)
+user_settings = Table(
+    'user', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('settings', Text),
+)
+
+USERS = 200
+CONVERSATIONS_PER_USER = 5
+SETTINGS_UPDATE_RATIO = 0.1
+ASSISTANT_TEXT = '这是一段模拟的助手回复。' * 40
+
+
+def setup_database(path: str) -> None:
+    engine = create_engine(f'sqlite:///{path}')
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(user_settings), [{'id': u, 'settings': '{}'} for u in range(USERS)])
+        conn.execute(insert(conversation), [
+            {'id': f'{u}-{c}', 'user_id': u, 'message_count': 0, 'version': 0}
+            for u in range(USERS) for c in range(CONVERSATIONS_PER_USER)
+        ])
+    engine.dispose()
+
+
+def chat_completion_writes(session: Session, rng: random.Random) -> None:
+    """一次聊天完成后的写入"""
+    user_id = rng.randrange(USERS)
+    conversation_id = f'{user_id}-{rng.randrange(CONVERSATIONS_PER_USER)}'
+    # 在同一条语句中计算下一个序号，同一对话的并发请求不会得到相同的seq
+    for role, content in (('user', '问题'), ('assistant', ASSISTANT_TEXT)):
+        next_seq = select(func.coalesce(func.max(conversation_message.c.seq), -1) + 1)\
+            .where(conversation_message.c.conversation_id == conversation_id).scalar_subquery()
+        session.execute(insert(conversation_message).values(
+            conversation_id=conversation_id, seq=next_seq, role=role, content=content))
+    session.execute(
+        update(conversation).where(conversation.c.id == conversation_id)
+        .values(message_count=conversation.c.message_count + 2, version=conversation.c.version + 1,
+                updated_at=func.current_timestamp())
+    )
+    session.execute(insert(usage).values(user_id=user_id, model_name='bench', tokens_in=1000,
+                                         tokens_out=400, total_cost=0.01))
+    if rng.random() < SETTINGS_UPDATE_RATIO:
+        session.execute(update(user_settings).where(user_settings.c.id == user_id)
+                        .values(settings='{"dark_theme": true}'))
+
+
+def worker_process(mode: str, path: str, threads: int, requests: int, result_queue) -> None:
+    if mode == 'baseline':
+        # 与当前线上配置一致：默认回滚日志，拿不到锁立即失败
+        engine = create_engine(f'sqlite:///{path}', connect_args={'timeout': 0})
+    else:
+        engine = create_engine(f'sqlite:///{path}', connect_args={'timeout': 15})
+        configure_sqlite_engine(engine)
+
+    @contextmanager
+    def session_scope():
+        with Session(engine) as session:
+            yield session
+
+    writer = WriteQueue(session_scope) if mode == 'queue' else None
+    latencies, errors, retries = [], [0], [0]
+    lock = threading.Lock()
+    per_thread = requests // threads
+
+    def run_thread(seed: int) -> None:
+        rng = random.Random(seed)
+        local_latencies, local_errors, local_retries = [], 0, 0
+        for _ in range(per_thread):
+            start = time.perf_counter()
+            try:
+                if writer is not None:
+                    writer.execute(lambda s: chat_completion_writes(s, rng))
+                elif mode == 'wal':
+                    with Session(engine) as session:
+                        def attempt():
+                            chat_completion_writes(session, rng)
+                            session.commit()
+
+                        def on_retry():
+                            nonlocal local_retries
+                            local_retries += 1
+                            session.rollback()
+                        retry_on_locked(attempt, retries=8, on_retry=on_retry)
+                else:
+                    with Session(engine) as session:
+                        chat_completion_writes(session, rng)
+                        session.commit()
+                local_latencies.append(time.perf_counter() - start)
+            except OperationalError as e:
+                if not is_locked_error(e):
+                    raise
+                local_errors += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+            retries[0] += local_retries
+
+    pool = [threading.Thread(target=run_thread, args=(os.getpid() * 1000 + i,)) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    if writer is not None:
+        stats = writer.stats()
+        retries[0] += stats['retries']
+        result_queue.put((latencies, errors[0], retries[0], stats['transactions']))
+    else:
+        result_queue.put((latencies, errors[0], retries[0], len(latencies)))
+    engine.dispose()
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def run_mode(mode: str, processes: int, concurrency: int, requests: int) -> None:
+    workdir = tempfile.mkdtemp(prefix='sqlite-bench-')
+    path = os.path.join(workdir, 'bench.db')
+    try:
+        setup_database(path)
+        threads = max(1, concurrency // processes)
+        per_process = requests // processes
+        result_queue = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=worker_process,
+                                           args=(mode, path, threads, per_process, result_queue))
+                   for _ in range(processes)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        results = [result_queue.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        latencies = [value for result in results for value in result[0]]
+        errors = sum(result[1] for result in results)
+        retries = sum(result[2] for result in results)
+        transactions = sum(result[3] for result in results)
+        print(f"{mode:<9} ok={len(latencies):<6} locked={errors:<5} retries={retries:<5} "
+              f"commits={transactions:<6} {len(latencies) / elapsed:8.1f} req/s  "
+              f"p50={percentile(latencies, 0.5) * 1000:7.1f}ms  p95={percentile(latencies, 0.95) * 1000:7.1f}ms  "
+              f"p99={percentile(latencies, 0.99) * 1000:7.1f}ms")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite写入竞争压测')
+    parser.add_argument('--modes', default='baseline,wal,queue', help='逗号分隔的模式列表')
+    parser.add_argument('--processes', type=int, default=4, help='模拟的gunicorn进程数')
+    parser.add_argument('--concurrency', type=int, default=64, help='所有进程合计的并发请求数')
+    parser.add_argument('--requests', type=int, default=2000, help='所有进程合计的请求数')
+    args = parser.parse_args()
+
+    print(f"processes={args.processes} concurrency={args.concurrency} requests={args.requests}")
+    for mode in args.modes.split(','):
+        run_mode(mode.strip(), args.processes, args.concurrency, args.requests)
+
+
+if __name__ == '__main__':
+    main()
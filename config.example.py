@@ -81,6 +81,37 @@ MODELS_WITHOUT_TOOL_SUPPORT = ['deepseek-reasoner', 'deepseek-ai/DeepSeek-R1']
 RATE_LIMIT_WINDOW = 60  # 60秒时间窗口
 MAX_EMAILS_PER_WINDOW = 3  # 每个时间窗口内最多发送3封邮件
 
+#日志级别（环境变量LOG_LEVEL / LOG_LEVELS优先）
+LOG_LEVEL = 'INFO'
+# 模块级别，例如调试流式响应时设置 'utils.chat.stream_processor': 'DEBUG'
+# 逐token日志使用 'utils.chat.stream_processor.tokens': 'DEBUG' 开启（采样输出）
+LOG_LEVELS = {}
+
+#SSE流式输出合并：窗口内连续的文本增量合并为一帧发送（只用于ASGI异步引擎，同步路由逐个发送）
+SSE_COALESCE_WINDOW_MS = 30  # 合并窗口（毫秒），设置为0时关闭合并
+SSE_COALESCE_MAX_BYTES = 2048  # 缓冲达到该大小时立即发送
+
+#对话消息压缩存储：序列化后超过阈值的消息压缩后存入数据库
+MESSAGE_COMPRESSION_CODEC = 'auto'  # auto（安装了zstandard时用zstd，否则zlib）、zstd、zlib、none
+MESSAGE_COMPRESSION_THRESHOLD = 2048  # 超过该字节数才压缩
+MESSAGE_COMPRESSION_LEVEL = 6
+MESSAGE_DICTIONARY_REFRESH_INTERVAL = 300  # 每隔多少秒检查是否有新训练的压缩字典
+
+#用户消费限额：超出时/chat在调用模型前返回402，None表示不限制（按UTC日期/月份统计）
+USER_BUDGET_LIMITS = {
+    'daily_cost': None,    # 每日消费上限（美元）
+    'monthly_cost': None,  # 每月消费上限（美元）
+    'daily_tokens': None,  # 每日token上限
+}
+USER_BUDGET_OVERRIDES = {}  # 用户ID -> 覆盖的限额，例如 {1: {'monthly_cost': 50}}
+
+#管理员邮箱：只有这些用户可以访问 /api/metrics/* 等进程内部指标，为空时所有人都无权访问
+ADMIN_EMAILS = []
+
+# 文本附件嵌入向量的存储类型：float32，或float16（磁盘占用减半）
+EMBEDDING_DTYPE = 'float32'
+EMBEDDING_CACHE_MAX_BYTES = 256 * 1024 * 1024  # 每个用户分块嵌入缓存的大小上限（字节），超过后按LRU淘汰
+
 #设置AliYun API用于Qwen2.5VL模型，用于增强型OCR（计价）
 # API配置
 API_KEYS = {
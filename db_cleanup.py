@@ -1,10 +1,13 @@
+import sys
 import sqlite3
 import json
 import time
 from pathlib import Path
 from initialization import app, db
 from utils.attachment_handler.image_handler import save_base64_locally, normalize_user_id
-from utils.conversation_model import Conversation
+from sqlalchemy import bindparam, or_
+from utils.conversation_model import Conversation, last_model_id
+from utils.maintenance import BatchRunner
 
 def add_new_columns():
     """添加新的temperature和max_tokens列"""
@@ -37,57 +40,52 @@ def add_new_columns():
         print(f"添加新列时发生错误: {str(e)}")
         raise e
 
-def update_old_conversations():
-    """为旧对话添加默认的max_tokens和temperature值"""
+def default_max_tokens(model_id):
+    """根据对话最后使用的模型返回默认的max_tokens"""
+    if model_id:
+        if 'grok' in model_id.lower():
+            return 2048  # Grok默认值
+        elif 'deepseek' in model_id.lower():
+            return 4096  # DeepSeek默认值
+        elif 'gemini' in model_id.lower():
+            return 8192  # Gemini默认值
+    return 4096  # 通用默认值
+
+
+def update_old_conversations(restart=False, batch_size=BatchRunner.DEFAULT_BATCH_SIZE):
+    """为旧对话添加默认的max_tokens和temperature值（按主键分批处理，中断后可继续）"""
+    table = Conversation.__table__
+    # 只读取需要的列，不加载消息；尚未拆分的旧对话从legacy_messages中查找模型
+    query = db.session.query(
+        Conversation.id, Conversation.temperature, Conversation.max_tokens,
+        Conversation.last_model, Conversation.legacy_messages
+    ).filter(or_(Conversation.temperature.is_(None), Conversation.max_tokens.is_(None)))
+    # 直接更新表，不增加乐观锁版本号，也不修改updated_at
+    statement = table.update().where(table.c.id == bindparam('b_id')).values(
+        temperature=bindparam('b_temperature'),
+        max_tokens=bindparam('b_max_tokens'),
+        updated_at=table.c.updated_at
+    )
+
+    def process_batch(rows):
+        params = []
+        for row in rows:
+            model_id = row.last_model or last_model_id(row.legacy_messages)
+            params.append({
+                'b_id': row.id,
+                'b_temperature': 0.7 if row.temperature is None else row.temperature,
+                'b_max_tokens': default_max_tokens(model_id) if row.max_tokens is None else row.max_tokens
+            })
+        db.session.execute(statement, params)
+        return len(params)
+
     try:
-        # 获取所有对话
-        conversations = Conversation.query.all()
-        updated_count = 0
-        
-        for conversation in conversations:
-            updated = False
-            
-            # 检查并设置默认temperature
-            if conversation.temperature is None:
-                conversation.temperature = 0.7
-                updated = True
-            
-            # 检查并设置默认max_tokens
-            if conversation.max_tokens is None:
-                # 检查对话中最后一条助手消息的模型类型
-                last_assistant_message = None
-                if conversation.messages:
-                    for msg in reversed(conversation.messages):
-                        if msg.get('role') == 'assistant':
-                            last_assistant_message = msg
-                            break
-                
-                # 根据不同模型设置不同的默认max_tokens
-                model_id = last_assistant_message.get('modelId') if last_assistant_message else None
-                if model_id:
-                    if 'grok' in model_id.lower():
-                        conversation.max_tokens = 2048  # Grok默认值
-                    elif 'deepseek' in model_id.lower():
-                        conversation.max_tokens = 4096  # DeepSeek默认值
-                    elif 'gemini' in model_id.lower():
-                        conversation.max_tokens = 8192  # Gemini默认值
-                    else:
-                        conversation.max_tokens = 4096  # 通用默认值
-                else:
-                    conversation.max_tokens = 4096  # 如果没有模型信息，使用通用默认值
-                
-                updated = True
-            
-            if updated:
-                updated_count += 1
-        
-        # 提交所有更改
-        if updated_count > 0:
-            db.session.commit()
-            print(f"成功更新了 {updated_count} 个旧对话的设置")
+        runner = BatchRunner('update_old_conversations', batch_size=batch_size, resume=not restart)
+        stats = runner.run(query, Conversation.id, process_batch)
+        if stats['changed'] > 0:
+            print(f"成功更新了 {stats['changed']} 个旧对话的设置")
         else:
             print("没有需要更新的旧对话")
-            
     except Exception as e:
         db.session.rollback()
         print(f"更新旧对话时发生错误: {str(e)}")
@@ -99,4 +97,4 @@ if __name__ == '__main__':
         # 先添加新列
         add_new_columns()
         # 然后更新数据
-        update_old_conversations() 
\ No newline at end of file
+        update_old_conversations(restart='--restart' in sys.argv)
\ No newline at end of file
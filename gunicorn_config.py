@@ -22,3 +22,15 @@ keepalive = 2
 # 重启设置
 max_requests = 1000
 max_requests_jitter = 50
+
+
+def post_worker_init(worker):
+    """工作进程启动后开始定期回收无引用的附件"""
+    from utils.attachment_registry import attachment_registry
+    attachment_registry.start()
+
+
+def worker_exit(server, worker):
+    """工作进程退出前写完队列中的用量记录"""
+    from utils.price.usage_writer import usage_writer
+    usage_writer.shutdown()
@@ -2,11 +2,12 @@ import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_mail import Mail
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 #老旧的import google.generativeai as genai
 from google import genai
 from config import API_KEYS, API_BASE_URLS
 from flask_migrate import Migrate
+from utils.sqlite_writer import WriteQueue, configure_sqlite_engine, flask_session_scope
 import random
 
 # 创建Gemini API实例池
@@ -56,6 +57,8 @@ app.config['MAX_CONTENT_PATH'] = None  # 不限制文件路径长度
 # 数据库配置
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///users.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# sqlite3驱动在拿不到写锁时等待的秒数（多个gunicorn进程共享同一个数据库文件）
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 15}}
 
 # 邮件服务器配置
 app.config['MAIL_SERVER'] = 'smtp.qq.com'  # QQ邮箱的SMTP服务器
@@ -73,6 +76,11 @@ app.config['MAIL_TIMEOUT'] = 30  # 设置超时时间为30秒
 db = SQLAlchemy(app)
 mail = Mail(app)
 
+# SQLite开启WAL（等待写锁的时间由上面的timeout连接参数决定），进程内的写事务通过单写入队列合并提交
+with app.app_context():
+    configure_sqlite_engine(db.engine)
+db_writer = WriteQueue(flask_session_scope(app, db))
+
 # 初始化Gemini API池
 gemini_pool = GeminiAPIPool(API_KEYS['google'])
 
@@ -84,6 +92,12 @@ aliyun_client = OpenAI(api_key=API_KEYS['aliyun'][0], base_url=API_BASE_URLS['al
 oaipro_client = OpenAI(api_key=API_KEYS['oaipro'][0], base_url=API_BASE_URLS['oaipro'])
 yunwu_client = OpenAI(api_key=API_KEYS['yunwu'][0], base_url=API_BASE_URLS['yunwu'])
 
+# 异步API客户端，供ASGI聊天引擎使用（只能在同一个事件循环中使用）
+xai_async_client = AsyncOpenAI(api_key=API_KEYS['xai'][0], base_url=API_BASE_URLS['xai'])
+deepseek_async_client = AsyncOpenAI(api_key=API_KEYS['deepseek'][0], base_url=API_BASE_URLS['deepseek'])
+siliconcloud_async_client = AsyncOpenAI(api_key=API_KEYS['siliconcloud'][0], base_url=API_BASE_URLS['siliconcloud'])
+oaipro_async_client = AsyncOpenAI(api_key=API_KEYS['oaipro'][0], base_url=API_BASE_URLS['oaipro'])
+
 # 初始化数据库迁移
 migrate = Migrate(app, db)
 
@@ -0,0 +1,77 @@
+import os
+import sys
+
+# 添加项目根目录到Python路径
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(current_dir)
+sys.path.append(project_root)
+
+from app import app, db
+from sqlalchemy import text
+from utils.conversation_model import Conversation, ConversationMessage, last_model_id
+
+# 每批回填的对话数
+BATCH_SIZE = 200
+
+
+def add_conversation_summary_fields():
+    """
+    添加message_count和last_model列到conversation表，并回填已有对话
+
+    需要先运行add_conversation_version.py添加版本列
+    """
+    with app.app_context():
+        # 检查列是否已存在
+        inspector = db.inspect(db.engine)
+        columns = [col['name'] for col in inspector.get_columns('conversation')]
+
+        try:
+            # 新增的列允许为NULL，SQLite可以直接ADD COLUMN
+            if 'message_count' not in columns:
+                print("正在添加列: message_count")
+                db.session.execute(text("ALTER TABLE conversation ADD COLUMN message_count INTEGER DEFAULT 0"))
+            if 'last_model' not in columns:
+                print("正在添加列: last_model")
+                db.session.execute(text("ALTER TABLE conversation ADD COLUMN last_model VARCHAR(100)"))
+            db.session.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_conversation_user_updated ON conversation (user_id, updated_at)"
+            ))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"更新数据库时出错: {str(e)}")
+            raise
+
+        # 回填摘要字段，保留原来的更新时间
+        table = Conversation.__table__
+        ids = [row.id for row in db.session.query(Conversation.id).order_by(Conversation.id)]
+        print(f"正在回填 {len(ids)} 个对话的摘要字段")
+        for i in range(0, len(ids), BATCH_SIZE):
+            batch_ids = ids[i:i + BATCH_SIZE]
+            try:
+                for conversation in Conversation.query.filter(Conversation.id.in_(batch_ids)):
+                    if conversation.legacy_messages is not None:
+                        messages = conversation.legacy_messages
+                    else:
+                        rows = ConversationMessage.query.filter_by(conversation_id=conversation.id)\
+                            .order_by(ConversationMessage.seq).all()
+                        messages = [row.to_message() for row in rows]
+                    db.session.execute(
+                        table.update()
+                        .where(table.c.id == conversation.id)
+                        .values(message_count=len(messages),
+                                last_model=last_model_id(messages),
+                                updated_at=table.c.updated_at)
+                    )
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"回填摘要字段时出错: {str(e)}")
+                raise
+            print(f"已回填 {min(i + BATCH_SIZE, len(ids))}/{len(ids)} 个对话")
+
+        print("成功添加对话摘要字段！")
+
+
+if __name__ == '__main__':
+    add_conversation_summary_fields()
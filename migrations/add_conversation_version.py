@@ -0,0 +1,34 @@
+import os
+import sys
+
+# 添加项目根目录到Python路径
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(current_dir)
+sys.path.append(project_root)
+
+from app import app, db
+from sqlalchemy import text
+
+def add_conversation_version():
+    """添加version列到conversation表，用于增量同步的版本校验"""
+    with app.app_context():
+        # 检查列是否已存在
+        inspector = db.inspect(db.engine)
+        columns = [col['name'] for col in inspector.get_columns('conversation')]
+
+        if 'version' not in columns:
+            print("正在添加列: version")
+            try:
+                # 带默认值的NOT NULL列可以直接ADD COLUMN，已有对话的版本为0
+                db.session.execute(text("ALTER TABLE conversation ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+                db.session.commit()
+                print("成功添加列: version！")
+            except Exception as e:
+                db.session.rollback()
+                print(f"更新数据库时出错: {str(e)}")
+                raise
+        else:
+            print("version列已存在，无需更新。")
+
+if __name__ == '__main__':
+    add_conversation_version()
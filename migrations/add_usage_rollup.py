@@ -0,0 +1,51 @@
+import os
+import sys
+
+# 添加项目根目录到Python路径
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(current_dir)
+sys.path.append(project_root)
+
+from app import app, db
+from sqlalchemy import text
+from utils.price.usage_model import UsageRollup
+
+def add_usage_rollup():
+    """创建usage(user_id, created_at)索引和按日汇总的usage_rollup表，并用已有记录回填汇总"""
+    with app.app_context():
+        inspector = db.inspect(db.engine)
+        indexes = [index['name'] for index in inspector.get_indexes('usage')]
+        try:
+            if 'ix_usage_user_created' not in indexes:
+                print("正在创建索引: ix_usage_user_created")
+                db.session.execute(text("CREATE INDEX ix_usage_user_created ON usage (user_id, created_at)"))
+            else:
+                print("ix_usage_user_created索引已存在。")
+
+            if inspector.has_table('usage_rollup'):
+                print("usage_rollup表已存在，重新计算汇总")
+                db.session.execute(text("DELETE FROM usage_rollup"))
+            else:
+                print("正在创建表: usage_rollup")
+                db.session.commit()
+                UsageRollup.__table__.create(db.engine)
+
+            # 按UTC日期分组，与写入时的增量汇总口径一致
+            sums = ', '.join(f"COALESCE(SUM({column}), 0)" for column in UsageRollup.SUM_COLUMNS)
+            columns = ', '.join(UsageRollup.SUM_COLUMNS)
+            result = db.session.execute(text(f"""
+                INSERT INTO usage_rollup (user_id, model_name, day, requests, {columns})
+                SELECT user_id, model_name, date(created_at), COUNT(*), {sums}
+                FROM usage
+                WHERE created_at IS NOT NULL
+                GROUP BY user_id, model_name, date(created_at)
+            """))
+            db.session.commit()
+            print(f"成功回填用量汇总 {result.rowcount} 行！")
+        except Exception as e:
+            db.session.rollback()
+            print(f"更新数据库时出错: {str(e)}")
+            raise
+
+if __name__ == '__main__':
+    add_usage_rollup()
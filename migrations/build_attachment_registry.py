@@ -0,0 +1,107 @@
+import os
+import sys
+
+# 添加项目根目录到Python路径
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(current_dir)
+sys.path.append(project_root)
+
+from app import app, db
+from datetime import datetime
+from sqlalchemy import text
+from utils.conversation_model import Conversation, ConversationMessage
+from utils.attachment_registry import StoredObject, AttachmentRef, attachment_registry
+from utils.maintenance import BatchRunner
+
+# 每批处理的消息数
+BATCH_SIZE = 1000
+
+
+def register_existing_objects():
+    """登记上传目录中已有的文件（只在迁移时遍历一次上传目录）"""
+    upload_folder = attachment_registry.upload_folder
+    keys = []
+    for user_entry in os.scandir(upload_folder):
+        if not user_entry.is_dir() or user_entry.name == 'temp':
+            continue
+        for entry in os.scandir(user_entry.path):
+            if entry.is_file() and not entry.name.startswith('.'):
+                keys.append(f"{user_entry.name}/{entry.name}")
+            elif entry.is_dir() and entry.name == 'base64_store':
+                keys.extend(f"{user_entry.name}/base64_store/{name}" for name in os.listdir(entry.path)
+                            if name.endswith('.json'))
+            elif entry.is_dir() and entry.name == 'text_files':
+                keys.extend(f"{user_entry.name}/text_files/{name}" for name in os.listdir(entry.path)
+                            if name.endswith('.txt'))
+    for i in range(0, len(keys), BATCH_SIZE):
+        chunk = keys[i:i + BATCH_SIZE]
+        # 已有文件以修改时间作为登记时间，超过宽限期且没有引用的会在下一轮清扫中标记
+        db.session.execute(text(
+            "INSERT OR IGNORE INTO stored_object (key, kind, created_at) VALUES (:key, :kind, :created_at)"
+        ), [{
+            'key': key,
+            'kind': attachment_registry.kind_for_key(key),
+            'created_at': _mtime(attachment_registry.path_for_key(key))
+        } for key in chunk])
+        db.session.commit()
+    print(f"已登记 {len(keys)} 个存储对象")
+
+
+def _mtime(path):
+    try:
+        return datetime.utcfromtimestamp(os.path.getmtime(path))
+    except OSError:
+        return datetime.utcnow()
+
+
+def build_attachment_registry(rebuild=False):
+    """创建附件登记表，记录已有对话对附件的引用并登记已有文件"""
+    with app.app_context():
+        StoredObject.__table__.create(db.engine, checkfirst=True)
+        AttachmentRef.__table__.create(db.engine, checkfirst=True)
+        if rebuild:
+            print("正在清空附件引用")
+            db.session.execute(text("DELETE FROM attachment_ref"))
+            db.session.commit()
+
+        # 重建时从头开始，否则从上次中断的批次继续
+        resume = not rebuild
+        owners = dict(db.session.query(Conversation.id, Conversation.user_id).all())
+
+        # 尚未拆分为消息行的旧对话
+        def track_legacy(rows):
+            for row in rows:
+                attachment_registry.untrack_messages(db.session, row.id)
+                attachment_registry.track_new_messages(db.session, row.user_id, row.id, 0, row.legacy_messages or [])
+            return len(rows)
+
+        # 按主键分批读取消息，每批与断点一起提交
+        def track_rows(rows):
+            by_conversation = {}
+            for row in rows:
+                # 压缩存储的消息附件在payload中，需要解压后判断
+                if row.conversation_id in owners and (row.attachments or row.payload is not None):
+                    by_conversation.setdefault(row.conversation_id, []).append((row.id, row.seq, row.to_message()))
+            for conversation_id, items in by_conversation.items():
+                attachment_registry.track_messages(db.session, owners[conversation_id], conversation_id, items)
+            return sum(len(items) for items in by_conversation.values())
+
+        try:
+            BatchRunner('build_attachment_registry.legacy', batch_size=BATCH_SIZE, resume=resume).run(
+                db.session.query(Conversation.id, Conversation.user_id, Conversation.legacy_messages)
+                .filter(Conversation.legacy_messages.isnot(None)),
+                Conversation.id, track_legacy)
+            stats = BatchRunner('build_attachment_registry.messages', batch_size=BATCH_SIZE, resume=resume).run(
+                ConversationMessage.query, ConversationMessage.id, track_rows)
+            print(f"已处理 {stats['processed']} 条消息，其中 {stats['changed']} 条带有附件")
+        except Exception as e:
+            db.session.rollback()
+            print(f"记录附件引用时出错: {str(e)}")
+            raise
+
+        register_existing_objects()
+        print("成功建立附件登记表！")
+
+
+if __name__ == '__main__':
+    build_attachment_registry(rebuild='--rebuild' in sys.argv)
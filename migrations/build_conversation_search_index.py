@@ -0,0 +1,74 @@
+import os
+import sys
+
+# 添加项目根目录到Python路径
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(current_dir)
+sys.path.append(project_root)
+
+from app import app, db
+from sqlalchemy import text
+from utils.conversation_model import Conversation, ConversationMessage
+from utils.conversation_search import ConversationSearchDoc, conversation_search
+from utils.maintenance import BatchRunner
+
+# 每批索引的消息数
+BATCH_SIZE = 1000
+
+
+def build_conversation_search_index(rebuild=False):
+    """为已有对话建立全文索引"""
+    with app.app_context():
+        ConversationSearchDoc.__table__.create(db.engine, checkfirst=True)
+        if rebuild:
+            print("正在清空全文索引")
+            db.session.execute(text(f"DROP TABLE IF EXISTS {conversation_search.TABLE}"))
+            db.session.execute(text(f"DROP TABLE IF EXISTS {conversation_search.GRAM_TABLE}"))
+            db.session.execute(text("DELETE FROM conversation_search_doc"))
+            db.session.commit()
+        conversation_search.ensure_schema(db.session)
+
+        # 重建时两个阶段都从头开始，否则从上次中断的批次继续
+        resume = not rebuild
+
+        # 对话标题和系统提示词
+        def index_headers(headers):
+            for header in headers:
+                conversation_search.index_header(db.session, header.user_id, header.id, header.title,
+                                                 header.system_prompt)
+            return len(headers)
+
+        # 按主键分批读取消息，每批与断点一起提交
+        def index_messages(rows):
+            by_conversation = {}
+            for row in rows:
+                if row.conversation_id in owners:
+                    by_conversation.setdefault(row.conversation_id, []).append((row.id, row.seq, row.to_message()))
+            for conversation_id, items in by_conversation.items():
+                conversation_search.index_messages(db.session, owners[conversation_id], conversation_id, items)
+            return sum(len(items) for items in by_conversation.values())
+
+        try:
+            stats = BatchRunner('build_conversation_search_index.headers', batch_size=BATCH_SIZE, resume=resume).run(
+                db.session.query(Conversation.id, Conversation.user_id, Conversation.title, Conversation.system_prompt),
+                Conversation.id, index_headers)
+            print(f"已索引 {stats['changed']} 个对话的标题")
+
+            owners = dict(db.session.query(Conversation.id, Conversation.user_id).all())
+            stats = BatchRunner('build_conversation_search_index.messages', batch_size=BATCH_SIZE, resume=resume).run(
+                ConversationMessage.query, ConversationMessage.id, index_messages)
+            print(f"已索引 {stats['changed']} 条消息")
+        except Exception as e:
+            db.session.rollback()
+            print(f"建立全文索引时出错: {str(e)}")
+            raise
+
+        # 合并FTS5的索引段，减小索引体积
+        for table in (conversation_search.TABLE, conversation_search.GRAM_TABLE):
+            db.session.execute(text(f"INSERT INTO {table}({table}) VALUES('optimize')"))
+        db.session.commit()
+        print("成功建立对话全文索引！")
+
+
+if __name__ == '__main__':
+    build_conversation_search_index(rebuild='--rebuild' in sys.argv)
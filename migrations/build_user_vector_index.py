@@ -0,0 +1,35 @@
+import os
+import sys
+import time
+
+# 添加项目根目录到Python路径
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(current_dir)
+sys.path.append(project_root)
+
+from app import app
+from utils.text_attachment.user_vector_index import UserVectorIndex
+
+
+def build_user_vector_indexes():
+    """为每个用户从已有的文本附件嵌入重建跨文件向量索引"""
+    upload_folder = app.config['UPLOAD_FOLDER']
+    started = time.time()
+    users = 0
+    files = 0
+    for user_entry in os.scandir(upload_folder):
+        if not user_entry.is_dir() or not os.path.isdir(os.path.join(user_entry.path, 'embeddings')):
+            continue
+        try:
+            count = UserVectorIndex(user_entry.path).rebuild()
+        except Exception as e:
+            print(f"重建 {user_entry.name} 的向量索引失败: {str(e)}")
+            continue
+        users += 1
+        files += count
+        print(f"{user_entry.name}: {count} 个文件")
+    print(f"完成: {users} 个用户，{files} 个文件，耗时 {time.time() - started:.1f} 秒")
+
+
+if __name__ == '__main__':
+    build_user_vector_indexes()
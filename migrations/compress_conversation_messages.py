@@ -0,0 +1,91 @@
+import os
+import sys
+import json
+import random
+
+# 添加项目根目录到Python路径
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(current_dir)
+sys.path.append(project_root)
+
+from app import app, db
+from sqlalchemy import text
+from utils.conversation_model import ConversationMessage
+from utils.message_codec import MessageDictionary, message_codec
+from utils.maintenance import BatchRunner
+
+# 每批压缩的消息数
+BATCH_SIZE = 500
+# 训练字典使用的样本数
+SAMPLE_SIZE = 5000
+
+
+def train_dictionary():
+    """从已有消息中随机抽样训练压缩字典"""
+    max_id = db.session.query(db.func.max(ConversationMessage.id)).scalar() or 0
+    if not max_id:
+        return None
+    ids = random.sample(range(1, max_id + 1), min(SAMPLE_SIZE, max_id))
+    samples = []
+    for i in range(0, len(ids), BATCH_SIZE):
+        rows = ConversationMessage.query.filter(ConversationMessage.id.in_(ids[i:i + BATCH_SIZE])).all()
+        for row in rows:
+            message = row.to_message()
+            meta = {k: v for k, v in message.items() if k not in ConversationMessage.BASE_FIELDS}
+            samples.append([message.get('content'), message.get('attachments'), meta or None])
+    return message_codec.train(samples)
+
+
+def compress_conversation_messages(retrain=False, restart=False):
+    """添加payload列，训练压缩字典，并原地压缩超过阈值的消息"""
+    with app.app_context():
+        if not message_codec.enabled:
+            print("消息压缩已关闭(MESSAGE_COMPRESSION_CODEC=none)，无需更新。")
+            return
+
+        # 检查列是否已存在
+        inspector = db.inspect(db.engine)
+        columns = [col['name'] for col in inspector.get_columns('conversation_message')]
+        if 'payload' not in columns:
+            print("正在添加列: payload")
+            db.session.execute(text("ALTER TABLE conversation_message ADD COLUMN payload BLOB"))
+            db.session.commit()
+        MessageDictionary.__table__.create(db.engine, checkfirst=True)
+
+        if retrain or not MessageDictionary.query.filter_by(codec=message_codec.codec).count():
+            print("正在训练压缩字典")
+            train_dictionary()
+
+        saved_bytes = 0
+
+        def process_batch(rows):
+            nonlocal saved_bytes
+            updates = []
+            for row in rows:
+                original = {'content': row.content, 'attachments': row.attachments, 'meta': row.meta}
+                result = ConversationMessage.compress_row(dict(original, payload=None))
+                if result['payload'] is not None:
+                    updates.append({'id': row.id, 'content': None, 'attachments': None,
+                                    'meta': None, 'payload': result['payload']})
+                    raw = json.dumps(list(original.values()), ensure_ascii=False, default=str)
+                    saved_bytes += len(raw.encode('utf-8')) - len(result['payload'])
+            if updates:
+                db.session.bulk_update_mappings(ConversationMessage, updates)
+            return len(updates)
+
+        try:
+            # 按主键分批处理，每批与断点一起提交，中断后从下一批继续
+            runner = BatchRunner('compress_conversation_messages', batch_size=BATCH_SIZE, resume=not restart)
+            stats = runner.run(ConversationMessage.query.filter(ConversationMessage.payload.is_(None)),
+                               ConversationMessage.id, process_batch)
+        except Exception as e:
+            db.session.rollback()
+            print(f"压缩消息时出错: {str(e)}")
+            raise
+
+        print(f"成功压缩对话消息！检查 {stats['processed']} 条，压缩 {stats['changed']} 条，"
+              f"约节省 {saved_bytes / 1024 / 1024:.1f} MB。可以运行 VACUUM 回收数据库文件中的空闲页。")
+
+
+if __name__ == '__main__':
+    compress_conversation_messages(retrain='--retrain' in sys.argv, restart='--restart' in sys.argv)
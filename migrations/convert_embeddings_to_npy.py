@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+
+# 添加项目根目录到Python路径
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(current_dir)
+sys.path.append(project_root)
+
+from app import app
+from utils.text_attachment.embedding_store import EmbeddingStore
+
+
+def convert_embeddings(dtype=EmbeddingStore.DEFAULT_DTYPE):
+    """把上传目录中旧版本的embeddings.json转换为 vectors-<版本>.npy + chunks-<版本>.txt + chunks.json"""
+    upload_folder = app.config['UPLOAD_FOLDER']
+    converted = 0
+    failed = 0
+    saved_bytes = 0
+    started = time.time()
+
+    for user_entry in os.scandir(upload_folder):
+        embedding_root = os.path.join(user_entry.path, 'embeddings')
+        if not user_entry.is_dir() or not os.path.isdir(embedding_root):
+            continue
+        for file_entry in os.scandir(embedding_root):
+            legacy_path = os.path.join(file_entry.path, EmbeddingStore.LEGACY_FILE)
+            if not file_entry.is_dir() or not os.path.exists(legacy_path):
+                continue
+            legacy_size = os.path.getsize(legacy_path)
+            try:
+                EmbeddingStore.convert_legacy(user_entry.path, file_entry.name, dtype=dtype)
+            except Exception as e:
+                failed += 1
+                print(f"转换 {legacy_path} 失败: {str(e)}")
+                continue
+            new_size = sum(entry.stat().st_size for entry in os.scandir(file_entry.path) if entry.is_file())
+            saved_bytes += legacy_size - new_size
+            converted += 1
+            if converted % 100 == 0:
+                print(f"已转换 {converted} 个嵌入文件")
+
+    print(f"转换完成: {converted} 个文件，失败 {failed} 个，节省 {saved_bytes / 1024 / 1024:.1f} MB，"
+          f"耗时 {time.time() - started:.1f} 秒")
+
+
+if __name__ == '__main__':
+    convert_embeddings(dtype='float16' if '--float16' in sys.argv else EmbeddingStore.DEFAULT_DTYPE)
@@ -0,0 +1,69 @@
+import os
+import sys
+
+# 添加项目根目录到Python路径
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(current_dir)
+sys.path.append(project_root)
+
+from app import app, db
+from utils.conversation_model import Conversation, ConversationMessage
+from utils.maintenance import BatchRunner
+
+# 每批处理的对话数，每批提交一次，避免长时间持有写锁
+BATCH_SIZE = 100
+
+
+def split_conversation_messages(restart=False):
+    """
+    把conversation.messages中的JSON数组拆分到conversation_message表
+
+    需要先运行add_conversation_summary_fields.py添加对话摘要列
+    """
+    with app.app_context():
+        # 创建消息表（已存在时跳过）
+        ConversationMessage.__table__.create(db.engine, checkfirst=True)
+
+        total = Conversation.query.filter(Conversation.legacy_messages.isnot(None)).count()
+        if not total:
+            print("没有需要拆分的对话，无需更新。")
+            return
+        print(f"正在拆分 {total} 个对话的消息")
+
+        table = Conversation.__table__
+        message_count = 0
+
+        def process_batch(batch):
+            nonlocal message_count
+            for conversation in batch:
+                messages = conversation.legacy_messages or []
+                # 清理可能残留的半迁移数据
+                conversation.delete_messages()
+                rows = [ConversationMessage.row_from_message(conversation.id, seq, message)
+                        for seq, message in enumerate(messages)]
+                if rows:
+                    db.session.bulk_insert_mappings(ConversationMessage, rows)
+                message_count += len(rows)
+            # 置空旧列，并保留原来的更新时间（不触发onupdate）
+            db.session.execute(
+                table.update()
+                .where(table.c.id.in_([c.id for c in batch]))
+                .values(messages=None, updated_at=table.c.updated_at)
+            )
+            return len(batch)
+
+        try:
+            # 已拆分的对话messages列被置为NULL，中断后重新运行只处理剩余的对话
+            runner = BatchRunner('split_conversation_messages', batch_size=BATCH_SIZE, resume=not restart)
+            stats = runner.run(Conversation.query.filter(Conversation.legacy_messages.isnot(None)),
+                               Conversation.id, process_batch)
+        except Exception as e:
+            db.session.rollback()
+            print(f"拆分对话消息时出错: {str(e)}")
+            raise
+
+        print(f"成功拆分 {stats['changed']} 个对话，共 {message_count} 条消息！")
+
+
+if __name__ == '__main__':
+    split_conversation_messages(restart='--restart' in sys.argv)
@@ -1,6 +1,6 @@
 from flask import Blueprint, request, jsonify, Response
 import json
-from initialization import xai_client
+from utils.model_registry import get_model_route
 
 # 创建蓝图
 summary_bp = Blueprint('summary', __name__)
@@ -50,9 +50,10 @@ def stream_chat_response_for_summary(messages, model_id='grok-2-latest'):
     # 默认使用grok-2模型
     
     try:
-        # 使用xai_client调用OpenAI兼容API
-        if model_id.startswith('grok'):
-            stream = xai_client.chat.completions.create(
+        # 通过模型路由表获取对应服务商的OpenAI兼容客户端
+        route = get_model_route(model_id)
+        if route and route.api_type == 'openai':
+            stream = route.client.chat.completions.create(
                 model=model_id,
                 messages=messages,
                 stream=True
@@ -300,6 +300,44 @@ def delete_text(content_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# 跨文件搜索一次请求最多包含的查询数
+MAX_SEARCH_QUERIES = 20
+
+@text_bp.route('/search', methods=['POST'])
+@login_required
+def search_texts():
+    """在用户的所有文本文件中语义搜索"""
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'error': '未登录'}), 401
+        
+    data = request.get_json(silent=True) or {}
+    query = data.get('query')
+    if not query:
+        return jsonify({'error': '缺少查询内容'}), 400
+    if isinstance(query, list):
+        # 所有查询在一次嵌入请求中计算，限制数量
+        if len(query) > MAX_SEARCH_QUERIES:
+            return jsonify({'error': f'一次最多搜索{MAX_SEARCH_QUERIES}个查询'}), 400
+        if not all(isinstance(item, str) and item for item in query):
+            return jsonify({'error': '查询内容必须是非空字符串'}), 400
+    elif not isinstance(query, str):
+        return jsonify({'error': '查询内容必须是字符串或字符串列表'}), 400
+    try:
+        top_k = min(max(int(data.get('top_k', 5)), 1), 50)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'top_k必须是整数'}), 400
+    
+    base_dir = Path(app.config['UPLOAD_FOLDER']) / normalize_user_id(user_id)
+    loop = asyncio.new_event_loop()
+    try:
+        result = loop.run_until_complete(TextEmbedding().search_user_files(query, str(base_dir), top_k=top_k))
+    finally:
+        loop.close()
+    if not result['success']:
+        return jsonify({'error': result['error']}), 500
+    return jsonify({'results': result['results']})
+
 @text_bp.route('/test_async', methods=['GET'])
 def test_async():
     """测试异步处理功能是否正常工作"""
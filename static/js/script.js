@@ -765,6 +765,223 @@ const default_system_prompt = String.raw`你是一个AI助理。你需要尽可
 
 请确保公式格式正确，并在适当的场景使用合适的公式环境。每个公式都必须经过仔细检查，确保所有命令都有正确的反斜杠前缀，并且环境标签正确匹配。`;
 
+// 每个对话最近一次同步到服务器时的快照，用于计算增量修改
+const syncedSnapshots = new Map();
+// 增量同步中可以修改的对话字段
+const PATCHABLE_FIELDS = ['title', 'systemPrompt', 'temperature', 'max_tokens', 'reasoning_effort'];
+
+// 按键名排序序列化，服务器返回的消息与本地对象键顺序不同也能正确比较
+function stableStringify(value) {
+    return JSON.stringify(value, (key, item) => {
+        if (item && typeof item === 'object' && !Array.isArray(item)) {
+            return Object.keys(item).sort().reduce((sorted, name) => {
+                sorted[name] = item[name];
+                return sorted;
+            }, {});
+        }
+        return item;
+    });
+}
+
+function snapshotConversation(conversation) {
+    const snapshot = {
+        messages: (conversation.messages || []).map(message => stableStringify(message))
+    };
+    PATCHABLE_FIELDS.forEach(field => { snapshot[field] = conversation[field]; });
+    return snapshot;
+}
+
+function rememberSyncedConversation(conversation, version) {
+    if (version !== undefined && version !== null) {
+        conversation.version = version;
+    }
+    syncedSnapshots.set(conversation.id, snapshotConversation(conversation));
+}
+
+// 对比快照生成增量操作：截断、替换变化的消息、追加新消息、修改字段
+function buildConversationOps(previous, current, conversation) {
+    const ops = [];
+    const common = Math.min(previous.messages.length, current.messages.length);
+    if (current.messages.length < previous.messages.length) {
+        ops.push({ op: 'truncate', length: current.messages.length });
+    }
+    for (let i = 0; i < common; i++) {
+        if (previous.messages[i] !== current.messages[i]) {
+            ops.push({ op: 'replace', seq: i, message: conversation.messages[i] });
+        }
+    }
+    if (current.messages.length > previous.messages.length) {
+        ops.push({ op: 'append', messages: conversation.messages.slice(previous.messages.length) });
+    }
+    const fields = {};
+    PATCHABLE_FIELDS.forEach(field => {
+        if (current[field] !== previous[field] && current[field] !== undefined) {
+            fields[field] = current[field];
+        }
+    });
+    if (Object.keys(fields).length > 0) {
+        ops.push({ op: 'set', fields: fields });
+    }
+    return ops;
+}
+
+// 版本冲突时最多重新拉取并重试的次数
+const MAX_PATCH_ATTEMPTS = 3;
+
+// 从服务器拉取对话的全部消息、字段和当前版本；对话不存在时返回null
+async function fetchServerConversation(conversationId) {
+    const serverCopy = { id: conversationId, messages: [] };
+    let version = null;
+    let before = null;
+    do {
+        const params = new URLSearchParams({ limit: '500' });
+        if (before !== null) {
+            params.set('before', before);
+        }
+        const response = await fetch(`/api/conversations/${encodeURIComponent(conversationId)}/messages?${params}`);
+        if (response.status === 404) {
+            return null;
+        }
+        if (!response.ok) {
+            throw new Error(`重新加载对话失败: ${response.status}`);
+        }
+        const data = await response.json();
+        if (version === null) {
+            // 以最新一页的版本为准，翻页期间若有新的修改，下一次提交会再次收到412
+            version = data.version;
+            Object.keys(data).forEach(key => {
+                if (!['messages', 'start_seq', 'message_count', 'has_more'].includes(key)) {
+                    serverCopy[key] = data[key];
+                }
+            });
+        }
+        serverCopy.messages = data.messages.concat(serverCopy.messages);
+        before = data.has_more ? data.start_seq : null;
+    } while (before !== null);
+    serverCopy.version = version;
+    normalizeConversationMessages(serverCopy);
+    return serverCopy;
+}
+
+// 把本页面相对同步基准的修改（编辑过的消息、截断、追加、字段）重放到服务器的最新内容上。
+// 这些位置在服务器上也被修改过时无法安全合并，返回null
+function rebaseConversation(base, conversation, serverCopy) {
+    const local = snapshotConversation(conversation);
+    const server = snapshotConversation(serverCopy);
+    const baseLength = base.messages.length;
+    const localLength = local.messages.length;
+    const touched = [];
+    for (let i = 0; i < Math.min(baseLength, localLength); i++) {
+        if (local.messages[i] !== base.messages[i]) {
+            touched.push(i);
+        }
+    }
+    if (localLength !== baseLength) {
+        // 截断或追加依赖消息总数，服务器上的消息数已变化时不能合并
+        if (server.messages.length !== baseLength) {
+            return null;
+        }
+        for (let i = localLength; i < baseLength; i++) {
+            touched.push(i);
+        }
+    }
+    if (touched.some(i => i >= server.messages.length || server.messages[i] !== base.messages[i])) {
+        return null;
+    }
+
+    const merged = { ...serverCopy };
+    if (localLength === baseLength) {
+        merged.messages = serverCopy.messages.slice();
+        touched.forEach(i => { merged.messages[i] = conversation.messages[i]; });
+    } else {
+        merged.messages = conversation.messages.map((message, i) =>
+            i < baseLength && local.messages[i] === base.messages[i] ? serverCopy.messages[i] : message);
+    }
+    for (const field of PATCHABLE_FIELDS) {
+        if (local[field] === base[field]) {
+            continue;
+        }
+        if (server[field] !== base[field] && server[field] !== local[field]) {
+            return null;
+        }
+        merged[field] = conversation[field];
+    }
+    return merged;
+}
+
+// 用服务器上的内容替换本地对话，当前打开的对话同时重新渲染
+function applyServerConversation(conversation, serverCopy) {
+    const changed = stableStringify(snapshotConversation(conversation)) !== stableStringify(snapshotConversation(serverCopy));
+    Object.assign(conversation, serverCopy);
+    rememberSyncedConversation(conversation, serverCopy.version);
+    if (changed && conversation.id === currentConversationId && !currentReader && !window.isGenerating) {
+        switchConversation(conversation.id);
+    }
+}
+
+// 只提交相对基准变化的部分，成功返回true；版本冲突返回false，其它失败抛出异常
+async function patchConversation(conversation, base) {
+    const current = snapshotConversation(conversation);
+    const ops = buildConversationOps(base, current, conversation);
+    if (ops.length === 0) {
+        return true;
+    }
+    const response = await fetch(`/api/conversations/${encodeURIComponent(conversation.id)}`, {
+        method: 'PATCH',
+        headers: {
+            'Content-Type': 'application/json',
+            'If-Match': `"v${conversation.version}"`
+        },
+        body: JSON.stringify({ ops: ops })
+    });
+    if (response.status === 412) {
+        return false;
+    }
+    if (!response.ok) {
+        throw new Error(`增量保存失败: ${response.status}`);
+    }
+    const data = await response.json();
+    conversation.version = data.version;
+    syncedSnapshots.set(conversation.id, current);
+    return true;
+}
+
+// 增量保存对话。版本冲突时保留原来的基准，只把本页面自己的修改重放到服务器的最新内容上再提交；
+// 本页面修改过的消息在服务器上也被改过时放弃本地修改，提示冲突并加载服务器上的内容
+async function syncConversation(conversation) {
+    const base = syncedSnapshots.get(conversation.id);
+    if (!base || conversation.version === undefined || conversation.version === null) {
+        // 没有同步基准就无法区分哪些是本页面的修改
+        const serverCopy = await fetchServerConversation(conversation.id);
+        if (serverCopy) {
+            applyServerConversation(conversation, serverCopy);
+            throw new Error('对话未同步，已加载服务器上的内容');
+        }
+        throw new Error('对话不存在');
+    }
+    if (await patchConversation(conversation, base)) {
+        return;
+    }
+    for (let attempt = 1; attempt < MAX_PATCH_ATTEMPTS; attempt++) {
+        console.warn('对话版本已过期，把本页面的修改合并到服务器的最新内容后重试');
+        const serverCopy = await fetchServerConversation(conversation.id);
+        if (!serverCopy) {
+            throw new Error('对话已在其他页面删除');
+        }
+        const merged = rebaseConversation(base, conversation, serverCopy);
+        if (!merged) {
+            applyServerConversation(conversation, serverCopy);
+            throw new Error('对话已在其他页面修改，本页面的修改与之冲突，已加载最新内容');
+        }
+        // 以服务器内容为基准只提交本页面自己的修改，成功后本地换成合并后的内容
+        if (await patchConversation(merged, snapshotConversation(serverCopy))) {
+            applyServerConversation(conversation, merged);
+            return;
+        }
+    }
+    throw new Error('对话被其他页面频繁修改，请刷新后重试');
+}
+
 // 修改保存函数，改为只保存单个对话
 export async function saveConversation(conversationId, operation = 'update') {
     const conversation = conversations.find(c => c.id === conversationId);
@@ -789,10 +1006,20 @@ export async function saveConversation(conversationId, operation = 'update') {
             model_id: selectedModel,
             reasoning_effort: modelSettings.reasoning_effort
         });
-        
+
+        // 更新只提交增量，不做无版本校验的完整保存，避免覆盖服务器上更新的内容
+        if (operation === 'update') {
+            await syncConversation(conversation);
+            return;
+        }
+
+        const headers = { 'Content-Type': 'application/json' };
+        if (conversation.version !== undefined && conversation.version !== null) {
+            headers['If-Match'] = `"v${conversation.version}"`;
+        }
         const response = await fetch('/api/conversations', {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: headers,
             body: JSON.stringify({
                 conversation: conversation,
                 operation: operation,
@@ -806,6 +1033,12 @@ export async function saveConversation(conversationId, operation = 'update') {
         if (!response.ok) {
             throw new Error('保存失败');
         }
+        if (operation === 'delete') {
+            syncedSnapshots.delete(conversationId);
+        } else {
+            const data = await response.json();
+            rememberSyncedConversation(conversation, data.version);
+        }
         // 只在特定操作时显示提示
         if (operation === 'create') {
             showToast('新对话已创建');
@@ -839,7 +1072,8 @@ async function createNewConversation() {
         id: Date.now().toString(),
         title: '新对话',
         messages: [],
-        systemPrompt: default_system_prompt
+        systemPrompt: default_system_prompt,
+        loaded: true
     };
     
     // 获取当前的模型设置
@@ -905,69 +1139,131 @@ async function deleteConversation(conversationId) {
     }
 }
 
-// 修改加载对话函数
-async function loadConversations() {
-    try {
-        const response = await fetch('/api/conversations');
-        if (!response.ok) {
-            throw new Error('加载对话失败');
-        }
-        const data = await response.json();
-        conversations = data.conversations || [];
-        
-        // 修复数据结构：确保每个消息和版本都有正确的字段
-        conversations.forEach(conversation => {
-            if (conversation.messages) {
-                // 遍历所有消息
-                conversation.messages.forEach((message, index) => {
-                    // 如果是助手消息，则确保currentVersion存在
-                    if (message.role === 'assistant' && message.versions && message.versions.length > 0) {
-                        // 确保currentVersion是有效的
-                        if (message.currentVersion === undefined || message.currentVersion < 0 || 
-                            message.currentVersion >= message.versions.length) {
-                            message.currentVersion = message.versions.length - 1;
-                            console.log(`修正 ${index} 号消息的版本索引为`, message.currentVersion);
-                        }
-                        
-                        // 确保每个版本都有必要的字段
-                        message.versions.forEach((version, versionIndex) => {
-                            // 确保版本有内容字段
-                            if (!version.content && message.content) {
-                                version.content = message.content;
-                            }
-                            
-                            // 确保版本有模型信息
-                            if (!version.modelId && message.modelId) {
-                                version.modelId = message.modelId;
-                            }
-                            if (!version.modelIcon && message.modelIcon) {
-                                version.modelIcon = message.modelIcon;
-                            }
-                            
-                            // 确保每个版本都有subsequentMessages字段
-                            if (!version.subsequentMessages) {
-                                version.subsequentMessages = [];
-                                
-                                // 如果是当前版本，保存之后的消息作为后续消息
-                                if (versionIndex === message.currentVersion) {
-                                    version.subsequentMessages = conversation.messages.slice(index + 1);
-                                }
-                            }
-                        });
+// 修复数据结构：确保每个消息和版本都有正确的字段
+function normalizeConversationMessages(conversation) {
+    if (conversation.messages) {
+        // 遍历所有消息
+        conversation.messages.forEach((message, index) => {
+            // 如果是助手消息，则确保currentVersion存在
+            if (message.role === 'assistant' && message.versions && message.versions.length > 0) {
+                // 确保currentVersion是有效的
+                if (message.currentVersion === undefined || message.currentVersion < 0 || 
+                    message.currentVersion >= message.versions.length) {
+                    message.currentVersion = message.versions.length - 1;
+                    console.log(`修正 ${index} 号消息的版本索引为`, message.currentVersion);
+                }
+                
+                // 确保每个版本都有必要的字段
+                message.versions.forEach((version, versionIndex) => {
+                    // 确保版本有内容字段
+                    if (!version.content && message.content) {
+                        version.content = message.content;
+                    }
+                    
+                    // 确保版本有模型信息
+                    if (!version.modelId && message.modelId) {
+                        version.modelId = message.modelId;
+                    }
+                    if (!version.modelIcon && message.modelIcon) {
+                        version.modelIcon = message.modelIcon;
+                    }
+                    
+                    // 确保每个版本都有subsequentMessages字段
+                    if (!version.subsequentMessages) {
+                        version.subsequentMessages = [];
                         
-                        // 使用当前版本的内容更新消息内容，确保UI显示正确版本
-                        const currentVersion = message.versions[message.currentVersion];
-                        if (currentVersion && currentVersion.content) {
-                            message.content = currentVersion.content;
+                        // 如果是当前版本，保存之后的消息作为后续消息
+                        if (versionIndex === message.currentVersion) {
+                            version.subsequentMessages = conversation.messages.slice(index + 1);
                         }
                     }
                 });
+                
+                // 使用当前版本的内容更新消息内容，确保UI显示正确版本
+                const currentVersion = message.versions[message.currentVersion];
+                if (currentVersion && currentVersion.content) {
+                    message.content = currentVersion.content;
+                }
             }
         });
+    }
+}
+
+// 侧边栏每页加载的对话数
+const CONVERSATION_PAGE_SIZE = 50;
+// 下一页对话摘要的游标，为null时没有更多
+let conversationsCursor = null;
+let loadingMoreConversations = false;
+
+// 分页获取对话摘要；摘要不含消息，打开对话时再加载
+async function fetchConversationSummaries(cursor) {
+    const params = new URLSearchParams({ limit: String(CONVERSATION_PAGE_SIZE) });
+    if (cursor) {
+        params.set('cursor', cursor);
+    }
+    const response = await fetch(`/api/conversations/summary?${params}`);
+    if (!response.ok) {
+        throw new Error('加载对话失败');
+    }
+    const data = await response.json();
+    conversationsCursor = data.next_cursor || null;
+    return (data.conversations || []).map(summary => ({ ...summary, loaded: false }));
+}
+
+// 加载下一页对话摘要追加到侧边栏
+async function loadMoreConversations() {
+    if (!conversationsCursor || loadingMoreConversations) {
+        return;
+    }
+    loadingMoreConversations = true;
+    try {
+        const page = await fetchConversationSummaries(conversationsCursor);
+        // 本地新建或刚更新的对话已经在列表里
+        const known = new Set(conversations.map(c => c.id));
+        conversations.push(...page.filter(c => !known.has(c.id)));
+        renderConversationsList();
+    } catch (error) {
+        console.error('加载更多对话出错:', error);
+        return;
+    } finally {
+        loadingMoreConversations = false;
+    }
+    loadMoreConversationsIfNeeded();
+}
+
+// 侧边栏滚动到底部附近或还没有填满时加载下一页
+function loadMoreConversationsIfNeeded() {
+    const conversationsList = document.querySelector('.conversations-list');
+    if (conversationsCursor && conversationsList
+        && conversationsList.scrollHeight - conversationsList.scrollTop - conversationsList.clientHeight < 100) {
+        loadMoreConversations();
+    }
+}
+
+// 第一次打开对话时从服务器加载它的消息和设置，对话不存在时返回false
+async function ensureConversationLoaded(conversation) {
+    if (conversation.loaded) {
+        return true;
+    }
+    const serverCopy = await fetchServerConversation(conversation.id);
+    if (!serverCopy) {
+        return false;
+    }
+    // fetchServerConversation已修正数据结构，之后记录的同步快照与界面上的内容一致
+    Object.assign(conversation, serverCopy, { loaded: true });
+    rememberSyncedConversation(conversation, serverCopy.version);
+    return true;
+}
+
+// 修改加载对话函数
+async function loadConversations() {
+    try {
+        syncedSnapshots.clear();
+        conversations = await fetchConversationSummaries(null);
         
         if (currentConversationId) {
             const currentConversation = conversations.find(c => c.id === currentConversationId);
-            if (currentConversation) {
+            if (currentConversation && currentConversation.loaded) {
                 const systemPromptTextarea = document.getElementById('system-prompt');
                 systemPromptTextarea.value = currentConversation.systemPrompt || default_system_prompt;
                 
@@ -1017,6 +1313,7 @@ async function loadConversations() {
         }
         
         renderConversationsList();
+        loadMoreConversationsIfNeeded();
     } catch (error) {
         console.error('加载对话出错:', error);
         conversations = [];
@@ -1083,6 +1380,21 @@ async function switchConversation(conversationId) {
     const conversation = conversations.find(c => c.id === conversationId);
     if (!conversation) return;
     
+    if (!conversation.loaded) {
+        try {
+            if (!await ensureConversationLoaded(conversation)) {
+                showToast('对话不存在', 'error');
+                return;
+            }
+        } catch (error) {
+            console.error('加载对话消息失败:', error);
+            showToast('加载对话失败', 'error');
+            return;
+        }
+        // 加载期间用户又切换到了别的对话
+        if (currentConversationId !== conversationId) return;
+    }
+    
     // 更新系统提示词
     const systemPromptTextarea = document.getElementById('system-prompt');
     systemPromptTextarea.value = conversation.systemPrompt || default_system_prompt;
@@ -1813,6 +2125,7 @@ function initializePasteHandler() {
 
 document.addEventListener('DOMContentLoaded', async () => {
     await loadConversations();
+    document.querySelector('.conversations-list').addEventListener('scroll', loadMoreConversationsIfNeeded);
     
     // 初始化各种功能
     document.getElementById('new-chat-btn').addEventListener('click', createNewConversation);
@@ -3088,7 +3401,8 @@ function editConversationTitle(conversationId) {
         const newTitle = input.value.trim();
         if (newTitle && newTitle !== currentTitle) {
             const conversation = conversations.find(c => c.id === conversationId);
-            if (conversation) {
+            // 未打开过的对话先加载，保存时才能按同步快照只提交标题的修改
+            if (conversation && await ensureConversationLoaded(conversation).catch(() => false)) {
                 conversation.title = newTitle;
                 await saveConversation(conversation.id, 'update');
             }
@@ -43,6 +43,9 @@ def save_base64_locally(base64_data, user_id):
     print(f"保存 base64 数据到文件: {file_path}")
     with open(str(file_path), 'w') as f:
         json.dump(data, f)
+    # 登记存储对象，长期未被对话引用时由后台回收
+    from utils.attachment_registry import attachment_registry
+    attachment_registry.register(str(file_path))
     
     return unique_id
 
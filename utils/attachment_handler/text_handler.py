@@ -5,6 +5,7 @@ from pathlib import Path
 from initialization import app
 from utils.attachment_handler.image_handler import normalize_user_id
 from utils.text_attachment.embeddings import TextEmbedding
+from utils.attachment_registry import attachment_registry
 from typing import Dict, Any, List
 
 class TextHandler:
@@ -73,6 +74,8 @@ class TextHandler:
             metadata_path = text_dir / f"{unique_id}_meta.json"
             with open(str(metadata_path), 'w', encoding='utf-8') as f:
                 json.dump(metadata, f, ensure_ascii=False, indent=2)
+            # 登记存储对象，长期未被对话引用时由后台回收
+            attachment_registry.register(str(file_path))
             
             # 生成和保存embeddings
             try:
@@ -154,28 +157,38 @@ class TextHandler:
         try:
             normalized_user_id = normalize_user_id(user_id)
             base_dir = Path(app.config['UPLOAD_FOLDER']) / normalized_user_id
-            text_dir = base_dir / 'text_files'
-            
-            # 删除文本文件
-            file_path = text_dir / f"{content_id}.txt"
-            if file_path.exists():
-                os.remove(str(file_path))
-            
-            # 删除元数据文件
-            metadata_path = text_dir / f"{content_id}_meta.json"
-            if metadata_path.exists():
-                os.remove(str(metadata_path))
-            
-            # 删除embeddings
-            embedding_processor = TextEmbedding()
-            embedding_processor.delete_embeddings(str(base_dir), content_id)
-            
+            TextHandler.delete_text_files(str(base_dir), content_id)
             return True
             
         except Exception as e:
             print(f"删除文本文件失败: {str(e)}")
             return False
 
+    @staticmethod
+    def delete_text_files(base_dir, content_id):
+        """
+        删除用户目录中的文本文件、元数据和embeddings（附件回收时也使用）
+        
+        Args:
+            base_dir (str): 用户上传目录
+            content_id (str): 内容唯一标识符
+        """
+        text_dir = Path(base_dir) / 'text_files'
+        
+        # 删除文本文件
+        file_path = text_dir / f"{content_id}.txt"
+        if file_path.exists():
+            os.remove(str(file_path))
+        
+        # 删除元数据文件
+        metadata_path = text_dir / f"{content_id}_meta.json"
+        if metadata_path.exists():
+            os.remove(str(metadata_path))
+        
+        # 删除embeddings
+        embedding_processor = TextEmbedding()
+        embedding_processor.delete_embeddings(str(base_dir), content_id)
+
     @staticmethod
     def get_text_by_lines(content_id: str, user_id: str, index_line: int, up_line_count: int = 5, down_line_count: int = 5) -> Dict[str, Any]:
         """
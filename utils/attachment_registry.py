@@ -0,0 +1,456 @@
+import os
+import glob
+import time
+import queue
+import shutil
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import text
+
+from initialization import app, db, db_writer
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+# 上传目录中的存储对象（图片/视频文件、base64数据、文本附件），键为相对UPLOAD_FOLDER的路径
+class StoredObject(db.Model):
+    __tablename__ = 'stored_object'
+
+    key = db.Column(db.String(255), primary_key=True)
+    kind = db.Column(db.String(10), nullable=False)  # file / base64 / text
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # 清扫时第一次发现没有引用的时间，再次确认后才删除
+    orphaned_at = db.Column(db.DateTime, nullable=True)
+
+
+# 对话消息对存储对象的引用，随消息的增删改在同一事务中维护
+class AttachmentRef(db.Model):
+    __tablename__ = 'attachment_ref'
+    __table_args__ = (
+        db.Index('ix_attachment_ref_conversation_seq', 'conversation_id', 'seq'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    conversation_id = db.Column(db.String(50), nullable=False)
+    seq = db.Column(db.Integer, nullable=False)
+    object_key = db.Column(db.String(255), nullable=False, index=True)
+
+
+class AttachmentRegistry:
+    """
+    附件的引用登记和后台回收
+
+    - 上传时登记存储对象，保存对话时按消息记录引用（与全文索引相同的增量维护方式）
+    - 删除对话只把不再被引用的对象放入后台队列，请求中不删除文件
+    - 后台线程定期按键顺序分批检查已登记的对象：上传超过宽限期且没有引用的对象先标记，
+      间隔一段时间后仍没有引用才删除，不需要遍历整个上传目录
+    - 删除对象时一并清理派生数据：OCR缓存、Gemini文件缓存记录、文本元数据和嵌入向量
+    """
+
+    # 上传后多久仍未被任何对话引用才视为废弃（秒）
+    ORPHAN_GRACE = 24 * 3600
+    # 标记为无引用后，再次确认前的等待时间（秒）
+    ORPHAN_CONFIRM = 600
+    # 每次清扫检查的对象数
+    SWEEP_BATCH = 200
+    # 后台清扫的间隔（秒）
+    SWEEP_INTERVAL = 60
+    # 临时目录中超过该时间的文件被删除（秒）
+    TEMP_MAX_AGE = 6 * 3600
+    # 临时目录的清理间隔（秒）
+    TEMP_SWEEP_INTERVAL = 3600
+    # Gemini文件缓存记录的有效期，与message_processor一致（秒）
+    GEMINI_CACHE_EXPIRY = 48 * 3600
+
+    def __init__(self, upload_folder: str, temp_folders: Iterable[str] = ()):
+        self.upload_folder = os.path.abspath(upload_folder)
+        self.temp_folders = [os.path.abspath(folder) for folder in temp_folders]
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._user_dirs: Dict[Any, str] = {}
+        self._sweep_cursor = ''
+        self._last_temp_sweep = 0.0
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'registered': 0,
+            'deleted': 0,
+            'marked': 0,
+            'swept': 0,
+            'temp_deleted': 0,
+            'errors': 0,
+            'last_sweep_at': None
+        }
+
+    # ---- 键的计算 ----
+
+    def key_for_path(self, path: Optional[str]) -> Optional[str]:
+        """上传目录中的文件路径对应的键，不在上传目录中的路径返回None"""
+        if not path:
+            return None
+        absolute = os.path.abspath(os.path.join(self.upload_folder, path))
+        if os.path.commonpath([absolute, self.upload_folder]) != self.upload_folder or absolute == self.upload_folder:
+            return None
+        return os.path.relpath(absolute, self.upload_folder).replace(os.sep, '/')
+
+    def path_for_key(self, key: str) -> str:
+        return os.path.join(self.upload_folder, *key.split('/'))
+
+    @staticmethod
+    def kind_for_key(key: str) -> str:
+        if '/base64_store/' in key:
+            return 'base64'
+        if '/text_files/' in key:
+            return 'text'
+        return 'file'
+
+    def user_dir(self, executor, user_id: Any) -> str:
+        """用户的上传目录名（与normalize_user_id相同），使用传入的连接查询，可以在flush事件中调用"""
+        cached = self._user_dirs.get(user_id)
+        if cached is not None:
+            return cached
+        value = user_id
+        if str(user_id).isdigit():
+            email = executor.execute(text('SELECT email FROM "user" WHERE id = :id'), {'id': int(user_id)}).scalar()
+            if email:
+                value = email
+        normalized = str(value).replace('@', '_').replace('.', '_')
+        self._user_dirs[user_id] = normalized
+        return normalized
+
+    def message_keys(self, executor, user_id: Any, message: Dict) -> List[str]:
+        """消息中附件引用的存储对象的键，只包括该用户上传目录中的对象"""
+        user_prefix = self.user_dir(executor, user_id) + '/'
+        keys = []
+        for attachment in message.get('attachments') or []:
+            if not isinstance(attachment, dict):
+                continue
+            key = self.key_for_path(attachment.get('file_path'))
+            if key:
+                keys.append(key)
+            for field in ('base64_id', 'thumbnail_base64_id'):
+                value = attachment.get(field)
+                if value and str(value).isalnum():
+                    keys.append(f"{user_prefix}base64_store/{value}.json")
+            content_id = attachment.get('content_id')
+            if content_id and str(content_id).isalnum():
+                keys.append(f"{user_prefix}text_files/{content_id}.txt")
+        # 消息内容由客户端提交，指向其他用户目录的路径不能成为引用，否则删除对话时会回收别人的文件
+        return [key for key in dict.fromkeys(keys) if key.startswith(user_prefix)]
+
+    # ---- 引用维护（与消息写入在同一事务中） ----
+
+    def track_messages(self, executor, user_id: Any, conversation_id: str,
+                       rows: Iterable[Tuple[int, int, Dict]]) -> None:
+        """
+        替换消息的引用
+
+        Args:
+            rows: (消息行ID, seq, 消息) 列表，与conversation_search.index_messages相同
+        """
+        rows = list(rows)
+        if not rows:
+            return
+        executor.execute(text(
+            "DELETE FROM attachment_ref WHERE conversation_id = :cid AND seq = :seq"
+        ), [{'cid': conversation_id, 'seq': seq} for _, seq, _ in rows])
+        self._insert_refs(executor, user_id, conversation_id, [(seq, message) for _, seq, message in rows])
+
+    def track_new_messages(self, executor, user_id: Any, conversation_id: str, start_seq: int,
+                           messages: List[Dict]) -> None:
+        """记录新插入的消息（seq从start_seq开始）的引用"""
+        self._insert_refs(executor, user_id, conversation_id,
+                          [(start_seq + i, message) for i, message in enumerate(messages)])
+
+    def untrack_messages(self, executor, conversation_id: str, from_seq: int = 0) -> None:
+        """删除seq >= from_seq的消息的引用"""
+        executor.execute(text(
+            "DELETE FROM attachment_ref WHERE conversation_id = :cid AND seq >= :seq"
+        ), {'cid': conversation_id, 'seq': from_seq})
+
+    def _insert_refs(self, executor, user_id: Any, conversation_id: str, messages: List[Tuple[int, Dict]]) -> None:
+        params = [{'cid': conversation_id, 'seq': seq, 'key': key}
+                  for seq, message in messages if message.get('attachments')
+                  for key in self.message_keys(executor, user_id, message)]
+        if params:
+            executor.execute(text(
+                "INSERT INTO attachment_ref (conversation_id, seq, object_key) VALUES (:cid, :seq, :key)"
+            ), params)
+
+    def conversation_keys(self, conversation_id: str, user_id: Any) -> List[str]:
+        """对话引用的、位于对话所属用户上传目录中的存储对象"""
+        user_prefix = self.user_dir(db.session, user_id) + '/'
+        rows = db.session.execute(text(
+            "SELECT DISTINCT object_key FROM attachment_ref WHERE conversation_id = :cid"
+        ), {'cid': conversation_id}).fetchall()
+        return [row[0] for row in rows if row[0].startswith(user_prefix)]
+
+    # ---- 登记和释放（由后台线程写入） ----
+
+    def register(self, path: str) -> None:
+        """登记新上传的存储对象，不等待写入"""
+        key = self.key_for_path(path)
+        if key:
+            self._submit(('register', key))
+
+    def release(self, keys: Iterable[str]) -> None:
+        """对象的引用被删除后调用，后台确认没有其它引用后删除"""
+        keys = [key for key in keys if key]
+        if keys:
+            self._submit(('release', keys))
+
+    def _submit(self, item: Tuple[str, Any]) -> None:
+        self._ensure_started()
+        self._queue.put(item)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queue_depth'] = self._queue.qsize()
+        stats['running'] = self._thread is not None and self._thread.is_alive()
+        return stats
+
+    def _count(self, name: str, value: int = 1) -> None:
+        with self._stats_lock:
+            self._stats[name] += value
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='attachment-gc', daemon=True)
+            self._thread.start()
+
+    def start(self) -> None:
+        """启动后台线程（定期清扫），进程启动后调用一次"""
+        self._ensure_started()
+
+    def _run(self) -> None:
+        next_sweep = time.monotonic() + self.SWEEP_INTERVAL
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0.0, next_sweep - time.monotonic()))
+            except queue.Empty:
+                item = None
+            try:
+                with app.app_context():
+                    if item is None:
+                        self.sweep_step()
+                        next_sweep = time.monotonic() + self.SWEEP_INTERVAL
+                    else:
+                        self._handle(item)
+            except Exception as e:
+                self._count('errors')
+                logger.error("附件回收任务失败: %s", e, exc_info=True)
+
+    def _handle(self, item: Tuple[str, Any]) -> None:
+        action, payload = item
+        if action == 'register':
+            keys = [payload]
+            # 合并队列中紧接着的登记
+            while True:
+                try:
+                    next_item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if next_item[0] != 'register':
+                    self._queue.put(next_item)
+                    break
+                keys.append(next_item[1])
+            now = datetime.utcnow()
+
+            def write(session):
+                session.execute(text(
+                    "INSERT OR IGNORE INTO stored_object (key, kind, created_at) VALUES (:key, :kind, :created_at)"
+                ), [{'key': key, 'kind': self.kind_for_key(key), 'created_at': now} for key in keys])
+
+            db_writer.execute(write)
+            self._count('registered', len(keys))
+        elif action == 'release':
+            unreferenced = self._unreferenced(payload)
+            self._delete_objects(unreferenced)
+
+    # ---- 清扫 ----
+
+    def _unreferenced(self, keys: List[str]) -> List[str]:
+        """返回没有任何引用的键"""
+        referenced = set()
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = db.session.query(AttachmentRef.object_key).filter(AttachmentRef.object_key.in_(chunk)).distinct()
+            referenced.update(row[0] for row in rows)
+        db.session.rollback()
+        return [key for key in keys if key not in referenced]
+
+    def sweep_step(self, batch_size: Optional[int] = None) -> Dict[str, int]:
+        """
+        检查一批已登记的对象（从上次的位置继续），标记或删除无引用的对象
+
+        Returns:
+            Dict[str, int]: 本次检查、标记、删除的对象数
+        """
+        batch_size = batch_size or self.SWEEP_BATCH
+        now = datetime.utcnow()
+        objects = StoredObject.query.filter(StoredObject.key > self._sweep_cursor)\
+            .order_by(StoredObject.key).limit(batch_size).all()
+        # 到达末尾后下一次从头开始
+        self._sweep_cursor = objects[-1].key if len(objects) == batch_size else ''
+        candidates = [obj for obj in objects if obj.created_at and now - obj.created_at > timedelta(seconds=self.ORPHAN_GRACE)]
+        orphaned_at = {obj.key: obj.orphaned_at for obj in candidates}
+        unreferenced = set(self._unreferenced(list(orphaned_at)))
+
+        to_mark, to_clear, to_delete = [], [], []
+        for key, marked_at in orphaned_at.items():
+            if key not in unreferenced:
+                if marked_at is not None:
+                    to_clear.append(key)
+            elif marked_at is None:
+                to_mark.append(key)
+            elif now - marked_at > timedelta(seconds=self.ORPHAN_CONFIRM):
+                to_delete.append(key)
+
+        if to_mark or to_clear:
+            def write(session):
+                if to_mark:
+                    session.execute(text("UPDATE stored_object SET orphaned_at = :now WHERE key = :key"),
+                                    [{'now': now, 'key': key} for key in to_mark])
+                if to_clear:
+                    session.execute(text("UPDATE stored_object SET orphaned_at = NULL WHERE key = :key"),
+                                    [{'key': key} for key in to_clear])
+            db_writer.execute(write)
+        # 删除前再确认一次，期间可能有对话重新引用了对象
+        deleted = self._delete_objects(self._unreferenced(to_delete)) if to_delete else 0
+
+        self._count('marked', len(to_mark))
+        self._count('swept', len(objects))
+        with self._stats_lock:
+            self._stats['last_sweep_at'] = now.isoformat()
+        if time.monotonic() - self._last_temp_sweep > self.TEMP_SWEEP_INTERVAL:
+            self._last_temp_sweep = time.monotonic()
+            self.sweep_temp()
+        return {'checked': len(objects), 'marked': len(to_mark), 'deleted': deleted}
+
+    def sweep_temp(self) -> int:
+        """删除临时目录中过期的文件（只遍历临时目录的第一层）"""
+        deleted = 0
+        cutoff = time.time() - self.TEMP_MAX_AGE
+        for folder in self.temp_folders:
+            if not os.path.isdir(folder):
+                continue
+            for entry in os.scandir(folder):
+                try:
+                    if entry.stat(follow_symlinks=False).st_mtime > cutoff:
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.remove(entry.path)
+                    deleted += 1
+                except OSError as e:
+                    logger.warning("删除临时文件失败 %s: %s", entry.path, e)
+        if deleted:
+            self._count('temp_deleted', deleted)
+            logger.info("已清理过期临时文件 %d 个", deleted)
+        return deleted
+
+    def _registered(self, keys: List[str]) -> List[str]:
+        """返回已在stored_object中登记的键"""
+        registered = set()
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = db.session.query(StoredObject.key).filter(StoredObject.key.in_(chunk))
+            registered.update(row[0] for row in rows)
+        db.session.rollback()
+        return [key for key in keys if key in registered]
+
+    def _delete_objects(self, keys: List[str]) -> int:
+        """
+        删除存储对象及其派生数据，然后删除登记记录；删除失败的对象保留登记，下次回收时重试
+
+        只删除已登记的对象，引用中出现但从未登记的键（例如旧数据中的异常路径）不会触及磁盘
+        """
+        keys = self._registered(keys) if keys else []
+        if not keys:
+            return 0
+        gemini_paths: Dict[str, set] = {}
+        removed = []
+        for key in keys:
+            try:
+                self._delete_object(key)
+                removed.append(key)
+                if self.kind_for_key(key) == 'file':
+                    path = self.path_for_key(key)
+                    gemini_paths.setdefault(os.path.dirname(path), set()).add(os.path.normpath(path))
+            except Exception as e:
+                self._count('errors')
+                logger.warning("删除附件失败 %s: %s", key, e)
+        for directory, paths in gemini_paths.items():
+            self._prune_gemini_cache(directory, paths)
+        if not removed:
+            return 0
+
+        def write(session):
+            session.execute(text("DELETE FROM stored_object WHERE key = :key"), [{'key': key} for key in removed])
+        db_writer.execute(write)
+        self._count('deleted', len(removed))
+        logger.info("已回收无引用的附件 %d 个", len(removed))
+        return len(removed)
+
+    def _delete_object(self, key: str) -> None:
+        path = self.path_for_key(key)
+        kind = self.kind_for_key(key)
+        if kind == 'text':
+            from utils.attachment_handler.text_handler import TextHandler
+            user_folder = self.path_for_key(key.split('/', 1)[0])
+            TextHandler.delete_text_files(user_folder, os.path.splitext(os.path.basename(path))[0])
+            return
+        if os.path.exists(path):
+            os.remove(path)
+        if kind == 'file':
+            # OCR缓存以图片路径的md5命名（前缀为用户ID）
+            image_hash = hashlib.md5(path.encode()).hexdigest()
+            for cache_file in glob.glob(os.path.join(os.path.dirname(path), '.ocr_cache', f'*_{image_hash}.json')):
+                os.remove(cache_file)
+
+    def _prune_gemini_cache(self, directory: str, deleted_paths: set) -> None:
+        """从目录的Gemini文件缓存中删除已删除文件和已过期的记录"""
+        cache_file = os.path.join(directory, '.gemini_files_cache.txt')
+        if not os.path.exists(cache_file):
+            return
+        now = time.time()
+        kept = []
+        try:
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    parts = line.strip().split('|')
+                    if len(parts) < 4:
+                        continue
+                    try:
+                        expired = now - float(parts[3]) > self.GEMINI_CACHE_EXPIRY
+                    except ValueError:
+                        continue
+                    if expired or os.path.normpath(parts[0]) in deleted_paths:
+                        continue
+                    kept.append(line.strip())
+            if kept:
+                temp_file = cache_file + '.tmp'
+                with open(temp_file, 'w', encoding='utf-8') as f:
+                    f.write('\n'.join(kept) + '\n')
+                os.replace(temp_file, cache_file)
+            else:
+                os.remove(cache_file)
+        except OSError as e:
+            logger.warning("清理Gemini文件缓存失败 %s: %s", cache_file, e)
+
+
+# 创建全局实例
+attachment_registry = AttachmentRegistry(
+    app.config['UPLOAD_FOLDER'],
+    temp_folders=(app.config['TEMP_FOLDER'], os.path.join(app.config['UPLOAD_FOLDER'], 'temp'))
+)
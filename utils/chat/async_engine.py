@@ -0,0 +1,385 @@
+import json
+import asyncio
+import inspect
+from typing import Dict, Any, AsyncGenerator, Optional, Tuple
+
+from initialization import app
+from utils.model_registry import get_model_route
+from utils.user_model import User, DEFAULT_USER_SETTINGS
+from utils.conversation_model import Conversation
+from utils.price.tokenCounter import TokenCounter
+from utils.chat.attachment_pipeline import preprocess_messages
+from utils.chat.chat_request import build_openai_params, extract_openai_usage, estimate_openai_tokens
+from utils.chat.chat_request import build_gemini_request, extract_gemini_usage, record_usage, sse_error
+from utils.chat.stream_processor import OpenAIStreamProcessor, GoogleStreamProcessor, process_stream_response_async
+from tools.tool_processor import get_tools
+from utils.logger import get_logger
+from utils.price.usage_writer import usage_writer
+from utils.price.budget import budget_tracker, BUDGET_MESSAGES
+
+logger = get_logger(__name__)
+
+
+# 基于asyncio的聊天引擎：模型流式响应使用AsyncOpenAI和Gemini的异步客户端读取，
+# 等待上游时不占用线程或greenlet，单个进程可以同时保持数千个SSE连接。
+# 数据库访问和附件预处理仍是同步代码，通过asyncio.to_thread放到线程中执行。
+
+
+class ChatRequestError(Exception):
+    """请求校验失败，在开始流式响应之前返回给客户端"""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def _run_in_app_context(func, *args, **kwargs):
+    """在Flask应用上下文中执行同步函数（供asyncio.to_thread调用）"""
+    with app.app_context():
+        return func(*args, **kwargs)
+
+
+def _load_user_settings(user_id: int, conversation_id: Optional[str]) -> Tuple[bool, bool]:
+    """读取用户设置并验证对话归属权，返回 (enable_ocr, enhanced_visual)"""
+    user = User.query.get(user_id)
+    if not user:
+        raise ChatRequestError('用户不存在', 401)
+    enable_ocr = user.get_setting('enable_ocr', DEFAULT_USER_SETTINGS['enable_ocr'])
+    enhanced_visual = user.get_setting('enhanced_visual', DEFAULT_USER_SETTINGS['enhanced_visual'])
+    # 验证对话归属权
+    if conversation_id:
+        conversation = Conversation.query.filter_by(id=conversation_id, user_id=user_id).first()
+        if not conversation:
+            raise ChatRequestError('对话不存在或无权访问', 404)
+    return enable_ocr, enhanced_visual
+
+
+class AsyncChatSession:
+    """
+    一次异步聊天请求，参数和行为与同步的/chat路由保持一致
+
+    先调用prepare()完成校验（失败时抛出ChatRequestError），再通过stream()获取SSE数据。
+    """
+
+    def __init__(self, data: Dict[str, Any], user_id: int):
+        self.messages = data.get('messages', [])
+        self.conversation_id = data.get('conversation_id')
+        self.model_id = data.get('model_id', 'grok-2-latest')
+        self.user_id = user_id
+        self.temperature = data.get('temperature', 0.7)
+        self.max_tokens = data.get('max_tokens', 4096)
+        self.reasoning_effort = data.get('reasoning_effort', 'high')
+        self.enable_tools = data.get('enable_tools', True)
+        self.route = None
+        self.enable_ocr = DEFAULT_USER_SETTINGS['enable_ocr']
+        self.enhanced_visual = DEFAULT_USER_SETTINGS['enhanced_visual']
+        self.available_tools = []
+
+    async def prepare(self) -> None:
+        """校验模型和对话归属权，读取用户设置"""
+        self.route = get_model_route(self.model_id)
+        if not self.route:
+            raise ChatRequestError('不支持的模型', 400)
+        if self.route.async_client is None:
+            raise ChatRequestError('该模型暂不支持异步聊天引擎', 400)
+
+        self.enable_ocr, self.enhanced_visual = await asyncio.to_thread(
+            _run_in_app_context, _load_user_settings, self.user_id, self.conversation_id
+        )
+
+        # 消费限额预检查，在调用模型之前拒绝
+        budget = await asyncio.to_thread(
+            _run_in_app_context, budget_tracker.check_request, self.user_id, self.model_id, self.messages
+        )
+        if not budget['allowed']:
+            raise ChatRequestError(BUDGET_MESSAGES[budget['reason']], 402)
+
+        logger.info(
+            "异步聊天请求: 模型=%s 会话=%s 消息数=%d 用户=%s",
+            self.model_id, self.conversation_id, len(self.messages), self.user_id
+        )
+
+        # 检查模型是否支持工具调用
+        if self.enable_tools and not self.route.supports_tools:
+            logger.warning("警告: 模型 %s 不支持工具调用，已禁用工具功能", self.model_id)
+            self.enable_tools = False
+        if self.enable_tools:
+            self.available_tools = get_tools(self.enable_tools)
+
+    async def stream(self) -> AsyncGenerator[str, None]:
+        """
+        产生SSE格式的响应数据，最后发送usage_info
+
+        客户端断开导致生成器被取消或关闭时，已经发送给上游的输入和已经生成的输出
+        仍会按估算值记录用量，计入费用和限额
+        """
+        route = self.route
+        total_image_ocr_tokens = [0.0, 0.0]
+        token_counter = TokenCounter()
+        accumulated_output = []
+        processed_messages = None
+        interrupted = False
+        input_tokens = 0
+        output_tokens = 0
+        cached_input_tokens = 0
+        use_estimated = True
+        usage_info = None
+        usage_error = None
+
+        try:
+            # 把思考摘要拼回助手消息
+            for msg in self.messages:
+                if msg.get('role') == 'assistant' and msg.get('reasoning_summary'):
+                    msg['content'] = '<think>' + msg.get('reasoning_summary') + '</think>\n' + msg.get('content')
+
+            # 附件预处理会读写文件，放到线程中执行
+            processed_messages, total_image_ocr_tokens = await asyncio.to_thread(
+                _run_in_app_context,
+                preprocess_messages,
+                self.messages,
+                route.api_type,
+                route.attachments,
+                self.user_id,
+                self.enable_ocr,
+                self.enhanced_visual,
+                self.conversation_id
+            )
+
+            # 如果是思考模型但不返回思考内容，发送等待信号
+            if route.thinking_without_content:
+                yield f"data: {json.dumps({'waiting_reasoning':True})}\n\n"
+
+            if route.api_type == 'openai':
+                params = build_openai_params(
+                    route,
+                    processed_messages,
+                    self.available_tools,
+                    self.enable_tools,
+                    self.max_tokens,
+                    self.temperature,
+                    self.reasoning_effort
+                )
+                stream = await route.async_client.chat.completions.create(**params)
+                processor = OpenAIStreamProcessor(route.reasoner, accumulated_output)
+                try:
+                    async for frame in process_stream_response_async(stream, processor):
+                        yield frame
+                finally:
+                    # 客户端断开时及时释放上游连接
+                    await stream.close()
+
+                usage_tokens = extract_openai_usage(processor.last_chunk)
+                if usage_tokens:
+                    input_tokens, output_tokens, cached_input_tokens = usage_tokens
+                    use_estimated = False
+                else:
+                    input_tokens, output_tokens = estimate_openai_tokens(
+                        token_counter, processed_messages, accumulated_output, self.model_id
+                    )
+
+            elif route.api_type == 'google':
+                formatted_history, last_message_parts, config = build_gemini_request(
+                    processed_messages,
+                    self.available_tools,
+                    self.enable_tools,
+                    self.max_tokens,
+                    self.temperature
+                )
+                genai_client = route.async_client.get_client()
+                chat = genai_client.aio.chats.create(model=self.model_id, history=formatted_history)
+                response = chat.send_message_stream(message=last_message_parts, config=config)
+                # 不同版本的SDK分别返回协程或异步迭代器
+                if inspect.isawaitable(response):
+                    response = await response
+                processor = GoogleStreamProcessor(accumulated_output)
+                try:
+                    async for frame in process_stream_response_async(response, processor):
+                        yield frame
+                finally:
+                    # 客户端断开时及时释放上游连接
+                    aclose = getattr(response, 'aclose', None)
+                    if aclose is not None:
+                        await aclose()
+
+                input_tokens, output_tokens, use_estimated = extract_gemini_usage(
+                    processor.last_chunk, token_counter, processed_messages, accumulated_output, self.model_id
+                )
+
+        except Exception as e:
+            logger.error("异步聊天引擎出错: %s", e, exc_info=True)
+            yield sse_error(f"与模型通信时出错: {str(e)}", type(e).__name__)
+
+        except (asyncio.CancelledError, GeneratorExit):
+            interrupted = True
+            raise
+
+        finally:
+            try:
+                if interrupted and processed_messages is not None:
+                    # 流式响应被中断，没有拿到上游的用量，按已发送和已生成的内容估算
+                    if route.api_type == 'google':
+                        input_tokens, output_tokens, use_estimated = extract_gemini_usage(
+                            None, token_counter, processed_messages, accumulated_output, self.model_id
+                        )
+                    else:
+                        input_tokens, output_tokens = estimate_openai_tokens(
+                            token_counter, processed_messages, accumulated_output, self.model_id
+                        )
+                # 只计算费用并放入写入队列，不会阻塞事件循环
+                usage_info = record_usage(
+                    self.user_id,
+                    self.model_id,
+                    input_tokens,
+                    cached_input_tokens,
+                    output_tokens,
+                    total_image_ocr_tokens,
+                    use_estimated
+                )
+            except Exception as e:
+                logger.error("记录使用情况时出错: %s", e)
+                usage_error = e
+
+        if usage_info is not None:
+            yield f"data: {json.dumps(usage_info)}\n\n"
+        else:
+            yield sse_error(f"记录使用情况时出错: {str(usage_error)}", 'DatabaseError')
+
+
+class AsyncChatApp:
+    """
+    ASGI应用：POST /chat 由异步聊天引擎处理，其余请求交给fallback（通常是包装后的Flask应用）
+
+    登录状态通过解析Flask的session cookie获得，与同步路由共用同一套登录。
+    """
+
+    # 异步引擎处理的路径，与同步路由相同，前端无需修改
+    CHAT_PATHS = ('/chat',)
+
+    def __init__(self, flask_app: Any, fallback: Any = None):
+        self.flask_app = flask_app
+        self.fallback = fallback
+        self.max_body_size = flask_app.config.get('MAX_CONTENT_LENGTH')
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] in self.CHAT_PATHS:
+            await self._handle_chat(scope, receive, send)
+            return
+        if self.fallback is None:
+            await self._send_json(send, 404, {'error': 'Not Found'})
+            return
+        await self.fallback(scope, receive, send)
+
+    async def _lifespan(self, receive: Any, send: Any) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                # 退出前写完队列中的用量记录
+                await asyncio.to_thread(usage_writer.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _load_session(self, scope: Dict[str, Any]) -> Dict[str, Any]:
+        """从请求头中的cookie解析Flask session"""
+        from http.cookies import SimpleCookie
+
+        cookie_name = self.flask_app.config.get('SESSION_COOKIE_NAME', 'session')
+        cookies = SimpleCookie()
+        for name, value in scope.get('headers', []):
+            if name == b'cookie':
+                cookies.load(value.decode('latin-1'))
+        if cookie_name not in cookies:
+            return {}
+        serializer = self.flask_app.session_interface.get_signing_serializer(self.flask_app)
+        if serializer is None:
+            return {}
+        try:
+            max_age = int(self.flask_app.permanent_session_lifetime.total_seconds())
+            return serializer.loads(cookies[cookie_name].value, max_age=max_age)
+        except Exception:
+            return {}
+
+    async def _read_body(self, receive: Any) -> bytes:
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                raise ConnectionError('客户端已断开')
+            body.extend(message.get('body', b''))
+            if self.max_body_size and len(body) > self.max_body_size:
+                raise ChatRequestError('请求体过大', 413)
+            if not message.get('more_body'):
+                return bytes(body)
+
+    async def _send_json(self, send: Any, status: int, payload: Dict[str, Any]) -> None:
+        body = json.dumps(payload).encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode('ascii'))
+            ]
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _handle_chat(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        user_id = self._load_session(scope).get('user_id')
+        if not user_id:
+            await self._send_json(send, 401, {'error': '用户未登录'})
+            return
+
+        try:
+            data = json.loads(await self._read_body(receive) or b'{}')
+            chat_session = AsyncChatSession(data, user_id)
+            await chat_session.prepare()
+        except ChatRequestError as e:
+            await self._send_json(send, e.status_code, {'error': e.message})
+            return
+        except ConnectionError:
+            return
+        except ValueError:
+            await self._send_json(send, 400, {'error': '请求格式错误'})
+            return
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no')
+            ]
+        })
+
+        # 监听客户端断开，断开后取消流式任务以释放上游连接
+        stream_task = asyncio.current_task()
+        disconnect_watcher = asyncio.create_task(self._watch_disconnect(receive, stream_task))
+        frames = chat_session.stream()
+        try:
+            async for frame in frames:
+                await send({'type': 'http.response.body', 'body': frame.encode('utf-8'), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        except asyncio.CancelledError:
+            if not disconnect_watcher.done() or disconnect_watcher.cancelled():
+                raise
+            # 取消来自断开监听，已经处理完毕，撤销取消状态后正常返回
+            stream_task.uncancel()
+            logger.debug("客户端已断开，停止用户 %s 的流式响应", user_id)
+        finally:
+            disconnect_watcher.cancel()
+            # 关闭生成器，中断的响应在其finally中记录用量
+            await frames.aclose()
+
+    @staticmethod
+    async def _watch_disconnect(receive: Any, task: asyncio.Task) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                task.cancel()
+                return
@@ -0,0 +1,460 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Dict, List, Any, Tuple
+
+from initialization import app
+from utils.files.file_config import MIME_TYPE_MAPPING, ATTACHMENT_TYPES, AttachmentType
+from utils.attachment_handler.image_handler import get_base64_by_id
+from utils.chat.message_cache import processed_message_cache
+from utils.chat.message_processor import (
+    process_image_attachment,
+    process_binary_attachment,
+    process_video_attachment,
+    process_image_attachment_by_ocr,
+    process_text_attachment
+)
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# 附件预处理线程池的最大并发数（整个进程共享，避免单个请求耗尽资源）
+MAX_ATTACHMENT_WORKERS = 8
+
+# 单个附件的处理超时时间（秒），从附件真正开始处理时计时
+DEFAULT_ATTACHMENT_TIMEOUT = 120
+# 视频需要上传到Gemini并等待服务端处理（最长300秒），因此单独放宽
+VIDEO_ATTACHMENT_TIMEOUT = 420
+# 附件在线程池中排队等待开始的最长时间（秒），从提交时计时；
+# 超时的任务仍占用工作线程，排队时间不设上限会让后续请求一直等下去
+ATTACHMENT_QUEUE_TIMEOUT = 60
+
+_executor = ThreadPoolExecutor(max_workers=MAX_ATTACHMENT_WORKERS, thread_name_prefix='attachment')
+
+
+def build_processed_message(message: Dict[str, Any], model_type: str) -> Dict[str, Any]:
+    """
+    根据模型类型创建消息骨架，只复制必要的字段并放入文本内容
+
+    Args:
+        message: 前端传来的原始消息
+        model_type: 模型类型 ('openai' 或 'google')
+
+    Returns:
+        Dict: 尚未包含附件内容的消息
+    """
+    processed_message = {
+        'role': message.get('role', ''),
+        'tool_results': message.get('tool_results', [])
+    }
+
+    # 根据模型类型初始化消息格式
+    if model_type == 'openai':
+        processed_message['content'] = []
+        if message.get('content') and isinstance(message['content'], str):
+            processed_message['content'].append({
+                "type": "text",
+                "text": message['content']
+            })
+    elif model_type == 'google':
+        processed_message['parts'] = []
+        # 确保始终添加文本内容，即使是空字符串
+        text_content = message.get('content', '')
+        if isinstance(text_content, str):
+            if not text_content and 'attachments' in message:
+                # 如果没有文本但有附件，添加默认文本
+                text_content = "请分析以下附件内容："
+            processed_message['parts'].append({
+                "text": text_content
+            })
+
+    return processed_message
+
+
+def finalize_processed_message(processed_message: Dict[str, Any], model_type: str) -> Dict[str, Any]:
+    """确保消息至少包含一个文本片段"""
+    # 如果是OpenAI模型且没有任何内容，添加一个空文本
+    if model_type == 'openai' and not processed_message['content']:
+        processed_message['content'].append({
+            "type": "text",
+            "text": ""
+        })
+
+    # 如果是Google模型且没有任何内容，添加一个空文本
+    if model_type == 'google' and not processed_message['parts']:
+        processed_message['parts'].append({
+            "text": ""
+        })
+
+    return processed_message
+
+
+def process_attachment(
+    attachment: Dict[str, Any],
+    model_type: str,
+    model_support_list: List[AttachmentType],
+    user_id: str,
+    enable_ocr: bool,
+    enhanced_visual: bool,
+    processed_message: Dict[str, Any]
+) -> Tuple[float, float]:
+    """
+    处理单个附件，把转换后的内容追加到processed_message中
+
+    Args:
+        attachment: 附件信息字典
+        model_type: 模型类型 ('openai' 或 'google')
+        model_support_list: 模型支持的附件类型列表
+        user_id: 用户ID
+        enable_ocr: 是否开启OCR功能
+        enhanced_visual: 是否开启增强视觉分析
+        processed_message: 接收附件内容的消息（或消息片段）
+
+    Returns:
+        Tuple[float, float]: 图片OCR的(输入token数, 输出token数)
+    """
+    image_ocr_tokens = (0.0, 0.0)
+
+    # 获取附件类型和MIME类型
+    attachment_type = attachment.get('type')
+    mime_type = attachment.get('mime_type')
+    file_path = attachment.get('file_path', '')
+
+    # 优先使用attachment中的extension属性，如果没有再从文件路径提取
+    file_ext = attachment.get('extension', '')
+    if not file_ext and file_path:
+        file_ext = os.path.splitext(file_path)[1].lower()
+
+    logger.debug("=== 附件信息 ===")
+    logger.debug("附件类型: %s", attachment_type)
+    logger.debug("MIME类型: %s", mime_type)
+    logger.debug("文件路径: %s", file_path)
+    logger.debug("文件扩展名: %s", file_ext)
+
+    # 验证MIME类型是否在支持列表中
+    if mime_type:
+        supported_type = MIME_TYPE_MAPPING.get(mime_type)
+        # 使用枚举的value_str属性输出更友好的字符串
+        logger.debug("MIME类型映射结果: %s", supported_type.value_str if supported_type else '未找到映射')
+
+        # 首先判断是否为图片类型
+        is_image = (supported_type == AttachmentType.IMAGE and 
+                  file_ext in ATTACHMENT_TYPES[AttachmentType.IMAGE]['extensions'] and 
+                  mime_type in ATTACHMENT_TYPES[AttachmentType.IMAGE]['mime_types'])
+
+        if is_image:
+            logger.debug("检测到图片文件")
+            # 检查模型是否支持图片处理
+            if AttachmentType.IMAGE in model_support_list:
+                logger.debug("模型支持图片处理，使用标准图片处理流程")
+                if model_type == 'openai':
+                    # 获取 base64 数据
+                    base64_data = None
+                    if 'base64_id' in attachment:
+                        try:
+                            base64_data = get_base64_by_id(attachment['base64_id'], user_id)
+                            logger.debug("成功获取base64数据")
+                        except Exception as e:
+                            logger.error("获取base64数据失败: %s", e)
+                            return image_ocr_tokens
+
+                    if base64_data:
+                        processed_message['content'].append({
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:{mime_type};base64,{base64_data}",
+                                "detail": "high"
+                            }
+                        })
+                        logger.debug("添加图片附件，MIME类型: %s", mime_type)
+                else:
+                    process_image_attachment(
+                        attachment,
+                        model_type,
+                        processed_message,
+                        AttachmentType.IMAGE,  # 使用枚举类型
+                        mime_type,
+                        user_id
+                    )
+            else:
+                logger.debug("模型不支持图片处理，使用OCR提取文本")
+                image_ocr_tokens = process_image_attachment_by_ocr(
+                    attachment,
+                    model_type,
+                    processed_message,
+                    user_id,  # 传递用户ID
+                    enable_ocr,  # 传递OCR功能状态
+                    enhanced_visual  # 传递增强视觉分析状态
+                )
+            return image_ocr_tokens
+
+        # 如果不是图片，再检查其他类型
+        if not supported_type:
+            supported_type = AttachmentType.BINARY
+            logger.debug("未找到MIME类型映射，使用默认类型: %s", supported_type)
+
+        # 检查模型是否支持该类型的附件
+        # 特殊处理视频类型：统一处理 VIDEO 和 GEMINI_VIDEO
+        if supported_type == AttachmentType.VIDEO:
+            if AttachmentType.VIDEO in model_support_list or AttachmentType.GEMINI_VIDEO in model_support_list:
+                logger.debug("检测到视频类型，模型支持视频处理")
+                # 如果是Gemini模型，将类型转换为GEMINI_VIDEO
+                if model_type == 'google':
+                    supported_type = AttachmentType.GEMINI_VIDEO
+            else:
+                logger.debug("模型不支持视频类型，将作为二进制文件处理")
+                supported_type = AttachmentType.BINARY
+        elif supported_type not in model_support_list:
+            # 使用枚举的value_str属性输出更友好的字符串
+            logger.debug("模型不支持的附件类型: %s", supported_type.value_str if supported_type else '未知类型')
+            # 将模型支持的类型转换为更易读的格式
+            supported_types_str = [t.value_str for t in model_support_list]
+            logger.debug("模型支持的类型: %s", supported_types_str)
+            supported_type = AttachmentType.BINARY
+
+        # 处理视频附件（包括 VIDEO 和 GEMINI_VIDEO）
+        if supported_type in [AttachmentType.VIDEO, AttachmentType.GEMINI_VIDEO]:
+            logger.debug("处理视频附件: model_type=%s, file_ext=%s, mime_type=%s", model_type, file_ext, mime_type)
+            # 如果是Google模型，使用GEMINI_VIDEO配置
+            if model_type == 'google':
+                logger.debug("检查Gemini视频支持: extensions=%s, mime_types=%s", ATTACHMENT_TYPES[AttachmentType.GEMINI_VIDEO]['extensions'], ATTACHMENT_TYPES[AttachmentType.GEMINI_VIDEO]['mime_types'])
+                if (file_ext in ATTACHMENT_TYPES[AttachmentType.GEMINI_VIDEO]['extensions'] and 
+                    mime_type in ATTACHMENT_TYPES[AttachmentType.GEMINI_VIDEO]['mime_types']):
+                    logger.debug("视频格式符合Gemini要求，开始处理...")
+                    process_video_attachment(
+                        attachment,
+                        model_type,
+                        processed_message,
+                        AttachmentType.GEMINI_VIDEO,  # 使用枚举类型
+                        mime_type
+                    )
+                else:
+                    logger.debug("视频格式不受Gemini支持: %s, %s", file_ext, mime_type)
+                    process_binary_attachment(
+                        attachment,
+                        model_type,
+                        processed_message,
+                        AttachmentType.BINARY  # 使用枚举类型
+                    )
+                    if model_type == 'google':
+                        processed_message['parts'].append({
+                            "text": f"\n注意：该视频格式不受Gemini支持。\n支持的格式：{', '.join(ATTACHMENT_TYPES[AttachmentType.GEMINI_VIDEO]['extensions'])}"
+                        })
+            else:
+                # 非Google模型的视频处理
+                process_video_attachment(
+                    attachment,
+                    model_type,
+                    processed_message,
+                    AttachmentType.VIDEO,  # 使用枚举类型VIDEO
+                    mime_type
+                )
+        # 检查是否为文本附件
+        elif supported_type == AttachmentType.TEXT:
+            logger.debug("处理文本附件: model_type=%s, file_ext=%s, mime_type=%s", model_type, file_ext, mime_type)
+            # 检查文件MIME类型是否符合文本文件要求
+            # 注意：对文本类型优先使用MIME类型判断，因为文件路径可能没有扩展名
+            if mime_type in ATTACHMENT_TYPES[AttachmentType.TEXT]['mime_types']:
+                logger.debug("文本MIME类型符合要求，开始处理...")
+                # 调用文本处理函数
+                process_text_attachment(
+                    attachment,
+                    model_type,
+                    processed_message,
+                    AttachmentType.TEXT,  # 使用枚举类型
+                    mime_type,
+                    user_id
+                )
+            else:
+                logger.debug("文本MIME类型不符合要求: %s", mime_type)
+                process_binary_attachment(
+                    attachment,
+                    model_type,
+                    processed_message,
+                    AttachmentType.BINARY  # 使用枚举类型
+                )
+        # 其他类型的附件处理
+        else:
+            # 直接使用支持类型枚举值
+            process_binary_attachment(
+                attachment,
+                model_type,
+                processed_message,
+                supported_type  # 使用枚举类型
+            )
+
+    return image_ocr_tokens
+
+
+def _attachment_timeout(attachment: Dict[str, Any]) -> float:
+    """根据附件类型返回处理超时时间"""
+    if MIME_TYPE_MAPPING.get(attachment.get('mime_type')) == AttachmentType.VIDEO:
+        return VIDEO_ATTACHMENT_TIMEOUT
+    return DEFAULT_ATTACHMENT_TIMEOUT
+
+
+def _empty_fragment(model_type: str) -> Dict[str, Any]:
+    """创建用于接收单个附件内容的消息片段"""
+    if model_type == 'openai':
+        return {'content': []}
+    return {'parts': []}
+
+
+def _append_text(fragment: Dict[str, Any], model_type: str, text: str) -> None:
+    if model_type == 'openai':
+        fragment['content'].append({"type": "text", "text": text})
+    else:
+        fragment['parts'].append({"text": text})
+
+
+class _AttachmentJob:
+    """线程池中的单个附件任务"""
+
+    def __init__(self, attachment, model_type, model_support_list, user_id, enable_ocr, enhanced_visual):
+        self.attachment = attachment
+        self.model_type = model_type
+        self.model_support_list = model_support_list
+        self.user_id = user_id
+        self.enable_ocr = enable_ocr
+        self.enhanced_visual = enhanced_visual
+        self.fragment = _empty_fragment(model_type)
+        self.timeout = _attachment_timeout(attachment)
+        self.started = threading.Event()
+        self.started_at = None
+        self.submitted_at = None
+        self.future = None
+
+    def submit(self) -> None:
+        self.submitted_at = time.monotonic()
+        self.future = _executor.submit(self.run)
+
+    def run(self) -> Tuple[float, float]:
+        self.started_at = time.monotonic()
+        self.started.set()
+        # 附件处理会访问数据库和app.config，工作线程需要自己的应用上下文
+        with app.app_context():
+            return process_attachment(
+                self.attachment,
+                self.model_type,
+                self.model_support_list,
+                self.user_id,
+                self.enable_ocr,
+                self.enhanced_visual,
+                self.fragment
+            )
+
+    def wait(self) -> Tuple[float, float]:
+        """
+        等待任务完成；处理超时从任务真正开始执行时计算，排队时间不计入，
+        排队本身最多等待ATTACHMENT_QUEUE_TIMEOUT秒
+
+        Raises:
+            FutureTimeoutError: 排队或处理超时
+        """
+        queue_remaining = self.submitted_at + ATTACHMENT_QUEUE_TIMEOUT - time.monotonic()
+        if not self.started.wait(timeout=max(queue_remaining, 0)):
+            raise FutureTimeoutError()
+        remaining = self.started_at + self.timeout - time.monotonic()
+        return self.future.result(timeout=max(remaining, 0))
+
+
+def preprocess_messages(
+    messages: List[Dict[str, Any]],
+    model_type: str,
+    model_support_list: List[AttachmentType],
+    user_id: str,
+    enable_ocr: bool,
+    enhanced_visual: bool,
+    conversation_id: str = None
+) -> Tuple[List[Dict[str, Any]], List[float]]:
+    """
+    并行处理整个对话历史中的所有附件，并按原始顺序组装消息
+
+    所有消息的附件会一起提交到共享线程池，预处理耗时取决于最慢的附件，
+    而不是所有附件耗时之和。每个附件的结果写入独立的片段，最后按附件在
+    消息中的原始顺序合并，保证发送给模型的内容顺序与串行处理完全一致。
+    历史消息的转换结果会按对话缓存，通常只有最新一轮消息需要真正处理。
+
+    Args:
+        messages: 前端传来的消息列表
+        model_type: 模型类型 ('openai' 或 'google')
+        model_support_list: 模型支持的附件类型列表
+        user_id: 用户ID
+        enable_ocr: 是否开启OCR功能
+        enhanced_visual: 是否开启增强视觉分析
+        conversation_id: 对话ID，提供时会复用已缓存的历史消息转换结果
+
+    Returns:
+        Tuple[List[Dict], List[float]]: 处理后的消息列表和图片OCR的[输入token数, 输出token数]
+    """
+    total_image_ocr_tokens = [0.0, 0.0]
+    content_key = 'content' if model_type == 'openai' else 'parts'
+
+    # 先查缓存，未命中的消息创建骨架，并把所有附件提交到线程池
+    skeletons = []
+    jobs_per_message = []
+    cache_keys = []
+    cache_hits = 0
+    for message in messages:
+        cache_key = None
+        if conversation_id:
+            cache_key = processed_message_cache.make_key(
+                conversation_id, user_id, message, model_type, model_support_list, enable_ocr, enhanced_visual
+            )
+            cached_message = processed_message_cache.get(cache_key)
+            if cached_message is not None:
+                cache_hits += 1
+                skeletons.append(cached_message)
+                jobs_per_message.append(None)
+                cache_keys.append(None)
+                continue
+        cache_keys.append(cache_key)
+        skeletons.append(build_processed_message(message, model_type))
+        jobs = []
+        for attachment in message.get('attachments') or []:
+            job = _AttachmentJob(attachment, model_type, model_support_list, user_id, enable_ocr, enhanced_visual)
+            job.submit()
+            jobs.append(job)
+        jobs_per_message.append(jobs)
+
+    total_jobs = sum(len(jobs) for jobs in jobs_per_message if jobs)
+    if cache_hits:
+        logger.debug("消息缓存命中: %s/%s", cache_hits, len(messages))
+    if total_jobs:
+        logger.debug("并行预处理附件: %s 个，最大并发 %s", total_jobs, MAX_ATTACHMENT_WORKERS)
+
+    # 按原始顺序收集结果
+    processed_messages = []
+    for processed_message, jobs, cache_key in zip(skeletons, jobs_per_message, cache_keys):
+        if jobs is None:
+            # 缓存命中的消息已经是完整结果
+            processed_messages.append(processed_message)
+            continue
+        # 只有所有附件都成功处理的消息才写入缓存
+        cacheable = cache_key is not None
+        for job in jobs:
+            file_name = job.attachment.get('fileName', '未命名文件')
+            try:
+                image_ocr_tokens = job.wait()
+                processed_message[content_key].extend(job.fragment[content_key])
+                total_image_ocr_tokens[0] += image_ocr_tokens[0]
+                total_image_ocr_tokens[1] += image_ocr_tokens[1]
+            except FutureTimeoutError:
+                # 还在排队的任务会被取消；无法中断已经在运行的线程，只能放弃它的结果
+                job.future.cancel()
+                logger.debug("附件处理超时(%s): %s",
+                             f"{job.timeout}秒" if job.started.is_set() else "排队", file_name)
+                _append_text(processed_message, model_type, f"[附件处理超时: {file_name}]")
+                cacheable = False
+            except Exception as e:
+                logger.error("附件处理失败 %s: %s", file_name, e, exc_info=True)
+                _append_text(processed_message, model_type, f"[附件处理失败: {file_name}]")
+                cacheable = False
+
+        processed_message = finalize_processed_message(processed_message, model_type)
+        if cacheable:
+            processed_message_cache.put(cache_key, processed_message)
+        processed_messages.append(processed_message)
+
+    return processed_messages, total_image_ocr_tokens
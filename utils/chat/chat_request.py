@@ -0,0 +1,425 @@
+import json
+from typing import Dict, List, Any, Optional, Tuple
+
+from google.genai.types import HarmCategory, HarmBlockThreshold
+from google.genai.types import Part, GenerateContentConfigDict, Content
+
+from utils.price.usage_model import Usage
+from utils.price.usage_writer import usage_writer
+from utils.price.budget import budget_tracker
+from utils.logger import get_logger, truncate
+
+logger = get_logger(__name__)
+
+
+# 同步的/chat路由和异步的ASGI聊天引擎共用的请求构建和用量统计逻辑
+
+
+def flatten_text_messages(processed_messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    把消息内容展开为纯文本（DeepSeek系列只接受字符串content）
+
+    Args:
+        processed_messages: 处理后的消息列表
+
+    Returns:
+        List[Dict]: content为字符串的消息列表
+    """
+    formatted_messages = []
+    for msg in processed_messages:
+        # 确保content是字符串
+        content = ''
+        if isinstance(msg.get('content'), str):
+            content = msg['content']
+        elif isinstance(msg.get('content'), list):
+            text_parts = []
+            for item in msg['content']:
+                if isinstance(item, dict):
+                    if item.get('type') == 'text':
+                        text_parts.append(item.get('text', ''))
+                    elif 'text' in item:
+                        text_parts.append(item['text'])
+                elif isinstance(item, str):
+                    text_parts.append(item)
+            content = ' '.join(text_parts)
+
+        # 处理parts字段
+        if 'parts' in msg:
+            parts_content = []
+            for part in msg['parts']:
+                if isinstance(part, dict) and 'text' in part:
+                    parts_content.append(part['text'])
+                elif isinstance(part, str):
+                    parts_content.append(part)
+            if parts_content:
+                content = content + ' ' + ' '.join(parts_content)
+
+        formatted_messages.append({
+            'role': msg['role'],
+            'content': content.strip(),
+            'tool_results': msg.get('tool_results', [])
+        })
+    return formatted_messages
+
+
+def build_openai_params(route: Any, processed_messages: List[Dict[str, Any]], available_tools: List[Dict[str, Any]],
+                        use_tools: bool, max_tokens: int, temperature: float,
+                        reasoning_effort: str) -> Dict[str, Any]:
+    """
+    构建OpenAI兼容接口的请求参数
+
+    Args:
+        route: 模型路由信息
+        processed_messages: 处理后的消息列表
+        available_tools: 可用工具列表
+        use_tools: 是否启用工具
+        max_tokens: 最大输出token数
+        temperature: 温度
+        reasoning_effort: 思考力度
+
+    Returns:
+        Dict: 传给chat.completions.create的参数
+    """
+    model_id = route.model_id
+    formatted_messages = flatten_text_messages(processed_messages) if route.flatten_content else []
+
+    # 创建基本参数
+    params = {
+        "model": model_id,
+        "messages": formatted_messages if len(formatted_messages) > 0 else processed_messages,
+        "stream": True
+    }
+    # 导入转换函数
+    from tools.tool_processor import convert_tools_for_openai
+    # 一次性转换工具定义和消息
+    openai_config = convert_tools_for_openai(
+        tools=available_tools,
+        messages=params["messages"]
+    )
+    # 更新转换后的消息
+    if "converted_messages" in openai_config:
+        params["messages"] = openai_config["converted_messages"]
+        logger.debug("转换后的消息: %s", truncate(params['messages']))
+    # API调用前转换格式
+    if use_tools and available_tools:
+        # 更新工具配置
+        if "tool_config" in openai_config:
+            logger.debug("为OpenAI添加工具配置: %s", truncate(openai_config['tool_config']))
+            params.update(openai_config["tool_config"])
+
+    # 根据模型类型添加不同的参数
+    if route.thinking_without_content:
+        # 推理模型使用max_completion_tokens
+        params["max_completion_tokens"] = max_tokens
+    else:
+        # 普通模型使用max_tokens和temperature
+        params["max_tokens"] = max_tokens
+        params["temperature"] = temperature
+
+    # 仅为支持思考力度的模型添加reasoning_effort参数
+    if route.thinking_degree:
+        logger.debug("为模型 %s 添加思考力度参数: %s", model_id, reasoning_effort)
+        params["reasoning_effort"] = reasoning_effort
+
+    return params
+
+
+def extract_openai_usage(last_response: Any) -> Optional[Tuple[int, int, int]]:
+    """
+    从OpenAI兼容接口的最后一个chunk中读取token用量
+
+    Returns:
+        Tuple[int, int, int]: (输入token数, 输出token数, 命中缓存的输入token数)，无法获取时返回None
+    """
+    if last_response and hasattr(last_response, 'usage') and last_response.usage is not None:
+        try:
+            usage_dict = last_response.usage
+            if usage_dict and hasattr(usage_dict, 'prompt_tokens'):
+                cached_tokens = usage_dict.prompt_tokens_details.cached_tokens if hasattr(usage_dict, 'prompt_tokens_details') and usage_dict.prompt_tokens_details else 0
+                input_tokens = usage_dict.prompt_tokens - cached_tokens
+                output_tokens = usage_dict.completion_tokens if hasattr(usage_dict, 'completion_tokens') else 0
+                logger.debug("从OpenAI响应获取到token数 - 输入: %s, 输出: %s, 缓存输入: %s", input_tokens, output_tokens, cached_tokens)
+                return input_tokens, output_tokens, cached_tokens
+        except Exception as e:
+            logger.error("从OpenAI响应获取token数时出错: %s", e)
+            logger.debug("完整的usage信息: %s", truncate(last_response.usage if hasattr(last_response, 'usage') else 'None'))
+            return None
+    logger.debug("无法从OpenAI响应获取token数，使用tiktoken估算")
+    return None
+
+
+def estimate_openai_tokens(token_counter: Any, processed_messages: List[Dict[str, Any]],
+                           accumulated_output: List[str], model_id: str) -> Tuple[int, int]:
+    """
+    使用tiktoken估算OpenAI兼容模型的输入和输出token数
+
+    Returns:
+        Tuple[int, int]: (输入token数, 输出token数)
+    """
+    logger.debug("使用tiktoken计算%s的token数", model_id)
+
+    # 针对OpenAI模型格式进行预处理
+    formatted_messages_for_token = []
+    for msg in processed_messages:
+        formatted_msg = {'role': msg.get('role', 'user')}
+
+        # 处理内容为列表的情况
+        if 'content' in msg and isinstance(msg['content'], list):
+            text_content = []
+            for item in msg['content']:
+                if isinstance(item, dict) and item.get('type') == 'text':
+                    text_content.append(item.get('text', ''))
+            formatted_msg['content'] = ' '.join(text_content)
+        elif 'content' in msg:
+            formatted_msg['content'] = msg['content']
+        else:
+            formatted_msg['content'] = ''
+
+        formatted_messages_for_token.append(formatted_msg)
+
+    logger.debug("格式化后的消息数量: %s", len(formatted_messages_for_token))
+    # 估算输入token
+    input_tokens = token_counter.estimate_message_tokens(formatted_messages_for_token, model_id)[0]
+
+    logger.debug("输入token数: %s", input_tokens)
+    # 估算输出token
+    output_text = ''.join(accumulated_output)
+    output_tokens = token_counter.estimate_completion_tokens(output_text, model_id)
+    logger.debug("Token计算结果 - 输入: %s, 输出: %s", input_tokens, output_tokens)
+    return input_tokens, output_tokens
+
+
+def build_gemini_request(processed_messages: List[Dict[str, Any]], available_tools: List[Dict[str, Any]],
+                         use_tools: bool, max_tokens: int,
+                         temperature: float) -> Tuple[List[Content], List[Any], GenerateContentConfigDict]:
+    """
+    把处理后的消息转换为Gemini聊天所需的历史记录、最后一条消息和配置
+
+    Args:
+        processed_messages: 处理后的消息列表
+        available_tools: 可用工具列表
+        use_tools: 是否启用工具
+        max_tokens: 最大输出token数
+        temperature: 温度
+
+    Returns:
+        Tuple: (历史消息, 最后一条消息的parts, 生成配置)
+    """
+    system_instruction = ""
+
+    # 先完整预处理所有消息（除了最后一条）
+    processed_history = []
+    for msg in processed_messages[:-1]:
+        # 处理系统提示词
+        if msg['role'] == 'system':
+            counter = 0
+            for part in msg['parts']:
+                system_instruction += "system_instruction {}:".format(counter)
+                counter += 1
+                if isinstance(part, dict) and 'text' in part:
+                    system_instruction += part['text']
+        else:
+            # 基本消息处理 - 转换角色
+            google_role = msg['role']
+            if google_role == 'assistant':
+                google_role = 'model'
+            elif google_role not in ['user', 'model']:
+                google_role = 'user'
+
+            # 创建统一格式的消息对象
+            processed_msg = {
+                'role': google_role,
+                'parts': [],
+                'tool_results': msg.get('tool_results', [])  # 确保保留工具结果信息
+            }
+
+            # 添加消息内容
+            if 'parts' in msg:
+                for part in msg['parts']:
+                    processed_msg['parts'].append(part)
+
+            processed_history.append(processed_msg)
+
+    # 设置安全配置和基本配置
+    logger.debug("=== 开始发送消息到Gemini ===")
+    safety_settings_list = [
+        {'category': HarmCategory.HARM_CATEGORY_HATE_SPEECH, 'threshold': HarmBlockThreshold.BLOCK_NONE},
+        {'category': HarmCategory.HARM_CATEGORY_HARASSMENT, 'threshold': HarmBlockThreshold.BLOCK_NONE},
+        {'category': HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT, 'threshold': HarmBlockThreshold.BLOCK_NONE},
+        {'category': HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT, 'threshold': HarmBlockThreshold.BLOCK_NONE},
+    ]
+
+    logger.debug("=== 安全设置 ===")
+    for setting in safety_settings_list:
+        logger.debug("类别: %s, 阈值: %s", setting['category'].name, setting['threshold'].name)
+
+    # 创建配置对象
+    config = GenerateContentConfigDict(
+        system_instruction=system_instruction,
+        max_output_tokens=max_tokens,
+        temperature=temperature,
+        safety_settings=safety_settings_list
+    )
+
+    # 准备格式化消息历史和工具配置
+    formatted_history = []
+
+    # 如果支持工具且已启用工具，添加工具参数
+    if use_tools and available_tools:
+        # 导入转换函数
+        from tools.tool_processor import convert_tools_for_google
+
+        # 将预处理后的历史消息传给工具转换函数
+        google_config = convert_tools_for_google(
+            tools=available_tools,
+            messages=processed_history
+        )
+
+        # 添加工具配置
+        if "tool_config" in google_config:
+            logger.debug("为Google/Gemini添加工具配置: %s", truncate(google_config['tool_config']))
+            config.update(google_config["tool_config"])
+
+        # 使用转换后的消息历史
+        if "converted_messages" in google_config and google_config["converted_messages"]:
+            formatted_history = google_config["converted_messages"]
+            logger.debug("使用工具转换后的历史消息，共 %s 条", len(formatted_history))
+        else:
+            logger.debug("手动格式化消息历史")
+            for msg in processed_history:
+                msg_role = msg['role']
+                has_content = False
+                parts = []
+
+                # 收集所有非空内容
+                for part in msg['parts']:
+                    # 处理文本内容
+                    if isinstance(part, dict) and 'text' in part:
+                        if part['text'] and part['text'].strip():
+                            parts.append(Part(text=part['text']))
+                            has_content = True
+                    # 处理附件
+                    elif isinstance(part, dict) and 'inline_data' in part:
+                        # 附件总是有内容的
+                        inline_part = Part.from_bytes(
+                            data=part['inline_data']['data'],
+                            mime_type=part['inline_data']['mime_type']
+                        )
+                        parts.append(inline_part)
+                        has_content = True
+
+                # 只有当消息有内容时才添加
+                if has_content:
+                    formatted_history.append(Content(
+                        role=msg_role,
+                        parts=parts
+                    ))
+                else:
+                    logger.debug("跳过空消息，角色: %s", msg_role)
+
+    # 获取并处理最后一条消息
+    last_message = processed_messages[-1]
+    last_message_parts = []
+
+    # 添加所有的消息，包括文字和附件
+    if 'parts' in last_message:
+        last_message_parts.extend(last_message['parts'])
+
+    logger.debug("发送给Gemini的消息内容： %s", truncate(last_message_parts))
+
+    # 检查最后一条消息是否为空或只包含空文本
+    has_valid_content = False
+    for part in last_message_parts:
+        if isinstance(part, dict) and 'text' in part and part['text'].strip():
+            has_valid_content = True
+            break
+
+    # 如果没有有效内容，添加一个默认文本
+    if not has_valid_content:
+        logger.warning("警告：最后一条消息没有有效内容，添加默认文本")
+        last_message_parts.append({"text": "请继续我们的对话"})
+
+    # 调试输出历史消息
+    logger.debug("=== 最终历史消息 ===")
+    for i, msg in enumerate(formatted_history):
+        logger.debug("历史消息[%s]: 角色=%s, 内容类型=%s", i, truncate(msg.role), type(msg.parts))
+
+    # 确保历史消息不为空
+    if not formatted_history:
+        logger.warning("警告：历史消息为空，创建一个默认历史消息")
+        formatted_history.append(Content(
+            role='user',
+            parts=[Part(text="请开始我们的对话")]
+        ))
+
+    return formatted_history, last_message_parts, config
+
+
+def extract_gemini_usage(last_response: Any, token_counter: Any, processed_messages: List[Dict[str, Any]],
+                         accumulated_output: List[str], model_id: str) -> Tuple[int, int, bool]:
+    """
+    读取Gemini响应的token用量，无法获取时使用tiktoken估算
+
+    Returns:
+        Tuple[int, int, bool]: (输入token数, 输出token数, 是否为估算值)
+    """
+    # 从最后一个响应中获取token使用情况
+    if last_response and hasattr(last_response, 'usage_metadata'):
+        input_tokens = last_response.usage_metadata.prompt_token_count
+        output_tokens = last_response.usage_metadata.candidates_token_count
+        logger.debug("从Gemini响应获取到token数 - 输入: %s, 输出: %s", input_tokens, output_tokens)
+        return input_tokens, output_tokens, False
+
+    logger.debug("无法从Gemini响应获取token数，使用tiktoken估算")
+    # 使用tiktoken估算token数
+    input_tokens = token_counter.estimate_message_tokens(processed_messages, model_id)[0]
+    output_text = ''.join(accumulated_output)
+    output_tokens = token_counter.estimate_completion_tokens(output_text, model_id)
+    return input_tokens, output_tokens, True
+
+
+def record_usage(user_id: int, model_id: str, input_tokens: int, cached_input_tokens: int, output_tokens: int,
+                 image_ocr_tokens: List[float], use_estimated: bool) -> Dict[str, Any]:
+    """
+    计算一次对话的费用并提交给后台写入器，不等待数据库写入
+
+    Returns:
+        Dict: 发送给前端的usage_info数据
+    """
+    usage = Usage(
+        user_id=user_id,
+        model_name=model_id,
+        tokens_in=input_tokens,
+        cached_input_tokens=cached_input_tokens,
+        tokens_out=output_tokens,
+        image_ocr_input_tokens=image_ocr_tokens[0],
+        image_ocr_output_tokens=image_ocr_tokens[1]
+    )
+    usage.calculate_cost()
+    usage_writer.submit(usage)
+    # 同步累加限额计数，下一个请求的预检查立即生效
+    budget_tracker.record(user_id, usage.total_cost, input_tokens + cached_input_tokens + output_tokens)
+
+    logger.info(
+        "使用统计: 模型=%s 计数方式=%s 输入=%s 缓存=%s 输出=%s OCR输入=%s OCR输出=%s 总成本=$%.6f",
+        model_id, 'tiktoken预估' if use_estimated else '模型实际值', input_tokens, cached_input_tokens,
+        output_tokens, image_ocr_tokens[0], image_ocr_tokens[1], usage.total_cost
+    )
+
+    return {
+        'type': 'usage_info',
+        'input_tokens': input_tokens,
+        'output_tokens': output_tokens,
+        'total_tokens': input_tokens + output_tokens,
+        'image_ocr_cost': usage.image_ocr_cost,
+        'input_cost': usage.input_cost,
+        'output_cost': usage.output_cost,
+        'total_cost': usage.total_cost,
+        'is_estimated': use_estimated,
+        'status_code': 200
+    }
+
+
+def sse_error(error_msg: str, error_type: str, status_code: int = 500) -> str:
+    """格式化SSE错误数据"""
+    return f"data: {json.dumps({'error': error_msg, 'error_type': error_type, 'status_code': status_code})}\n\n"
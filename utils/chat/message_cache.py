@@ -0,0 +1,143 @@
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional, Tuple
+
+from utils.files.file_config import AttachmentType
+
+
+class ProcessedMessageCache:
+    """
+    缓存已经转换为模型格式的消息（OpenAI的content或Gemini的parts）
+
+    对话历史中的旧消息在每次请求时都不会变化，缓存后只需处理最新一轮消息，
+    避免重复读取base64文件、检查OCR缓存和重新上传Gemini文件。
+
+    缓存键为 (对话ID, 用户ID, 消息内容哈希, 模型类型, 模型支持的附件类型, OCR开关, 增强视觉开关)，
+    任何一项变化都会自然地得到新的缓存条目。对话ID来自客户端，缓存在进程内共享，
+    因此键中包含用户ID，不同用户的请求不会命中彼此的条目。
+    """
+
+    # 缓存条目的有效期（秒），需远小于Gemini文件48小时的有效期
+    DEFAULT_TTL = 3600
+    # 最大缓存条目数
+    DEFAULT_MAX_ENTRIES = 2000
+    # 缓存内容的估算总大小上限（字节），图片base64会占用较多内存
+    DEFAULT_MAX_BYTES = 128 * 1024 * 1024
+
+    def __init__(self, ttl: int = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (过期时间, 大小, 条目)
+        self._conversation_keys = {}  # conversation_id -> set(key)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def message_hash(message: Dict[str, Any]) -> str:
+        """计算消息中影响转换结果的字段的哈希值"""
+        payload = {
+            'role': message.get('role'),
+            'content': message.get('content'),
+            'attachments': message.get('attachments'),
+            'tool_results': message.get('tool_results')
+        }
+        raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def make_key(cls, conversation_id: str, user_id: Any, message: Dict[str, Any], model_type: str,
+                 model_support_list: List[AttachmentType], enable_ocr: bool,
+                 enhanced_visual: bool) -> Tuple:
+        """生成缓存键"""
+        support_key = tuple(sorted(t.value_str for t in model_support_list))
+        return (
+            conversation_id,
+            user_id,
+            cls.message_hash(message),
+            model_type,
+            support_key,
+            bool(enable_ocr),
+            bool(enhanced_visual)
+        )
+
+    @staticmethod
+    def _estimate_size(entry: Dict[str, Any]) -> int:
+        """粗略估算条目占用的内存大小"""
+        size = 0
+        for item in entry.get('content', []) + entry.get('parts', []):
+            if isinstance(item, dict):
+                size += len(item.get('text') or '')
+                if 'image_url' in item:
+                    size += len(item['image_url'].get('url', ''))
+                if 'inline_data' in item:
+                    size += len(item['inline_data'].get('data') or '')
+            size += 64
+        return size
+
+    @staticmethod
+    def _copy(entry: Dict[str, Any]) -> Dict[str, Any]:
+        """返回条目的浅拷贝，调用方修改列表时不会影响缓存"""
+        copied = dict(entry)
+        for field in ('content', 'parts', 'tool_results'):
+            if isinstance(copied.get(field), list):
+                copied[field] = list(copied[field])
+        return copied
+
+    def get(self, key: Tuple) -> Optional[Dict[str, Any]]:
+        """获取缓存的消息，不存在或过期时返回None"""
+        with self._lock:
+            record = self._entries.get(key)
+            if record is None:
+                return None
+            expires_at, _, entry = record
+            if expires_at < time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return self._copy(entry)
+
+    def put(self, key: Tuple, entry: Dict[str, Any]) -> None:
+        """保存转换后的消息"""
+        conversation_id = key[0]
+        if not conversation_id:
+            return
+        size = self._estimate_size(entry)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time() + self.ttl, size, self._copy(entry))
+            self._conversation_keys.setdefault(conversation_id, set()).add(key)
+            self._total_bytes += size
+            # 淘汰最久未使用的条目
+            while self._entries and (len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes):
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+
+    def invalidate_conversation(self, conversation_id: str) -> None:
+        """删除某个对话的所有缓存条目"""
+        with self._lock:
+            for key in list(self._conversation_keys.get(conversation_id, ())):
+                self._remove(key)
+
+    def _remove(self, key: Tuple) -> None:
+        """删除单个条目（调用方需持有锁）"""
+        record = self._entries.pop(key, None)
+        if record is None:
+            return
+        self._total_bytes -= record[1]
+        keys = self._conversation_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._conversation_keys[key[0]]
+
+
+# 创建全局实例
+processed_message_cache = ProcessedMessageCache()
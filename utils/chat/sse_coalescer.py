@@ -0,0 +1,127 @@
+import json
+import time
+from typing import Any, Iterable, List, Optional, Tuple, Union
+
+# orjson为可选依赖，未安装时使用标准库
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import config
+except ImportError:
+    config = None
+
+# 合并的时间窗口（秒）：窗口内连续的同类增量合并为一帧
+COALESCE_WINDOW = getattr(config, 'SSE_COALESCE_WINDOW_MS', 30) / 1000
+# 缓冲的文本达到该字节数时立即发送
+COALESCE_MAX_BYTES = getattr(config, 'SSE_COALESCE_MAX_BYTES', 2048)
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+
+def encode_json(payload: Any) -> str:
+    """快速序列化JSON，优先使用orjson"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(payload).decode('utf-8')
+        except TypeError:
+            # orjson不支持的类型交给标准库处理
+            pass
+    try:
+        return _json_encoder.encode(payload)
+    except (TypeError, ValueError):
+        return json.dumps(payload, default=str)
+
+
+def sse_frame(payload: Any) -> str:
+    """格式化一帧SSE数据"""
+    return f"data: {encode_json(payload)}\n\n"
+
+
+class SSECoalescer:
+    """
+    合并连续的content / reasoning_content增量，减少每个流的JSON序列化和socket写入次数
+
+    - 距离上次发送已超过时间窗口时，新的增量立即发送（首个token不会被延迟）
+    - 窗口内到达的同类增量先缓冲，窗口到期、缓冲超过字节阈值或增量类型变化时发送
+    - 其它类型的帧（工具步骤、错误等）发送前会先发送缓冲的内容，保证顺序
+
+    合并后的帧格式与单个增量相同，例如 data: {"content": "..."}，前端无需修改。
+    """
+
+    __slots__ = ('window', 'max_bytes', '_kind', '_parts', '_size', '_started_at', '_last_flush')
+
+    def __init__(self, window: float = COALESCE_WINDOW, max_bytes: int = COALESCE_MAX_BYTES):
+        self.window = window
+        self.max_bytes = max_bytes
+        self._kind = None
+        self._parts = []
+        self._size = 0
+        self._started_at = 0.0
+        self._last_flush = 0.0
+
+    @property
+    def pending(self) -> bool:
+        """是否有缓冲中的内容"""
+        return bool(self._parts)
+
+    def deadline(self) -> Optional[float]:
+        """缓冲内容最迟应发送的时间点（time.monotonic），无缓冲时返回None"""
+        if not self._parts:
+            return None
+        return self._started_at + self.window
+
+    def add(self, kind: str, text: str) -> List[str]:
+        """
+        添加一个增量，返回此时需要发送的帧（可能为空）
+
+        Args:
+            kind: 增量字段名（content或reasoning_content）
+            text: 增量文本
+        """
+        if not text:
+            return []
+        now = time.monotonic()
+        frames = []
+        if self._parts and kind != self._kind:
+            frames.extend(self.flush())
+        if self.window <= 0 or (not self._parts and now - self._last_flush >= self.window):
+            # 空闲一段时间后的首个增量直接发送
+            self._last_flush = now
+            frames.append(sse_frame({kind: text}))
+            return frames
+        if not self._parts:
+            self._kind = kind
+            self._started_at = now
+        self._parts.append(text)
+        self._size += len(text)
+        # 按每个字符最多3字节（UTF-8中文）估算，避免逐个编码
+        if self._size * 3 >= self.max_bytes or now - self._started_at >= self.window:
+            frames.extend(self.flush())
+        return frames
+
+    def flush(self) -> List[str]:
+        """发送缓冲中的内容"""
+        if not self._parts:
+            return []
+        text = ''.join(self._parts)
+        kind = self._kind
+        self._parts = []
+        self._size = 0
+        self._kind = None
+        self._last_flush = time.monotonic()
+        return [sse_frame({kind: text})]
+
+    def feed(self, items: Iterable[Union[str, Tuple[str, str]]]) -> Iterable[str]:
+        """
+        处理处理器产生的输出：(字段, 文本) 元组为可合并的增量，字符串为完整的帧
+
+        完整的帧发送前会先发送缓冲内容，保证前端收到的顺序不变。
+        """
+        for item in items:
+            if isinstance(item, tuple):
+                yield from self.add(item[0], item[1])
+            else:
+                yield from self.flush()
+                yield item
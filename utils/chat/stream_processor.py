@@ -1,588 +1,686 @@
 import json
-import traceback
-from typing import Dict, List, Any, Generator, Optional, Union, Tuple
+import time
+import asyncio
+from typing import Dict, List, Any, Generator, AsyncGenerator, Optional, Union, Tuple
 
 # 导入工具处理相关函数
 from tools.tool_processor import process_streaming_tool_call, format_tool_results
+from utils.logger import get_logger, truncate, TokenLogSampler
+from utils.chat.sse_coalescer import SSECoalescer, sse_frame, COALESCE_WINDOW
 
-def process_stream_response(
-    stream: Any, 
-    is_reasoner: bool, 
-    accumulated_output: List[str]
-) -> Tuple[Generator[str, None, None], Any]:
+logger = get_logger(__name__)
+
+
+class OpenAIStreamProcessor:
     """
-    处理来自AI模型的流式响应数据，并返回一个生成器和最后的响应chunk
-    
-    Args:
-        stream: AI模型返回的流式响应对象
-        is_reasoner: 是否为reasoner模式
-        accumulated_output: 用于累积输出内容的列表
-        
-    Returns:
-        Tuple[Generator[str, None, None], Any]: 
-            - 生成器，产生格式化为SSE的响应数据
-            - 最后一个响应chunk，用于token统计
+    逐个chunk处理OpenAI兼容接口的流式响应，产生SSE格式的数据
+
+    处理器只保存流的状态，不关心chunk来自同步还是异步的流，
+    同步的gevent路径和异步的ASGI路径共用同一套处理逻辑。
     """
-    def stream_generator():
-        # 使用可变对象来存储最后一个chunk，避免使用nonlocal
-        last_chunk_container = {"value": None}
-        
+
+    def __init__(self, is_reasoner: bool, accumulated_output: List[str],
+                 coalesce_window: float = COALESCE_WINDOW):
+        """
+        Args:
+            is_reasoner: 是否为reasoner模式
+            accumulated_output: 用于累积输出内容的列表
+            coalesce_window: 文本增量的合并窗口（秒），0表示不合并
+        """
+        self.is_reasoner = is_reasoner
+        self.accumulated_output = accumulated_output
+        # 最后一个chunk，用于token统计
+        self.last_chunk = None
+        # 逐token的调试日志（默认关闭）
+        self.token_log = TokenLogSampler(__name__)
+        # 合并连续的文本增量
+        self.coalescer = SSECoalescer(window=coalesce_window)
+
         # 存储工具调用数据
-        tool_calls_data = []
-        current_tool_call = None
-        
+        self.tool_calls_data = []
+        self.current_tool_call = None
+
         # 存储工具调用结果，用于添加到历史记录
-        tool_response_messages = []
-        
+        self.tool_response_messages = []
+
         if is_reasoner:
-            print("使用reasoner模式")
-            for chunk in stream:
-                # 保存最后一个chunk
-                last_chunk_container["value"] = chunk
-                try:
-                    reasoning_content = None
-                    content = None
-                    
-                    # 检查是否有工具调用
-                    if hasattr(chunk.choices[0].delta, 'tool_calls') and chunk.choices[0].delta.tool_calls:
-                        print("\n!!! 推理模式下发现工具调用 !!!")
-                        print(f"tool_calls: {chunk.choices[0].delta.tool_calls}")
-                        
-                        # 处理工具调用
-                        for tc in chunk.choices[0].delta.tool_calls:
-                            tool_id = tc.id if hasattr(tc, 'id') else None
-                            tool_index = tc.index if hasattr(tc, 'index') else 0
-                            
-                            if hasattr(tc, 'function'):
-                                func_name = tc.function.name if hasattr(tc.function, 'name') else None
-                                func_args = tc.function.arguments if hasattr(tc.function, 'arguments') else None
-                                
-                                # 收集工具调用数据
-                                if tool_id:
-                                    existing_call = next((t for t in tool_calls_data if t.get('id') == tool_id), None)
-                                    
-                                    if not existing_call:
-                                        tool_call_data = {
-                                            'id': tool_id,
-                                            'index': tool_index,
-                                            'function': {
-                                                'name': func_name,
-                                                'arguments': ''
-                                            }
-                                        }
-                                        tool_calls_data.append(tool_call_data)
-                                        current_tool_call = tool_call_data
-                                    else:
-                                        current_tool_call = existing_call
-                                    
-                                    # 累积函数参数
-                                    if func_args and current_tool_call:
-                                        current_tool_call['function']['arguments'] += func_args
-                    
-                    if hasattr(chunk.choices[0].delta, 'reasoning_content') and chunk.choices[0].delta.reasoning_content is not None:
-                        reasoning_content = chunk.choices[0].delta.reasoning_content
-                        accumulated_output.append(reasoning_content)
-                        # 立即发送推理内容
-                        response = f"data: {json.dumps({'reasoning_content': reasoning_content})}\n\n"
-                        yield response
-                        # 强制刷新
-                        if hasattr(response, 'flush'):
-                            response.flush()
-                    elif hasattr(chunk.choices[0].delta, 'content') and chunk.choices[0].delta.content is not None:
-                        content = chunk.choices[0].delta.content
-                        accumulated_output.append(content)
-                        # 立即发送内容
-                        try:
-                            response = f"data: {json.dumps({'content': content})}\n\n"
-                            yield response
-                            # 强制刷新
-                            if hasattr(response, 'flush'):
-                                response.flush()
-                        except Exception as e:
-                            print(f"JSON序列化错误: {str(e)}, 内容: {content}")
-                            # 尝试使用安全的JSON序列化
-                            try:
-                                response = f"data: {json.dumps({'content': content}, ensure_ascii=False)}\n\n"
-                                yield response
-                            except:
-                                print("无法序列化内容，跳过")
-                    
-                    # 检查是否工具调用结束
-                    if hasattr(chunk.choices[0], 'finish_reason') and chunk.choices[0].finish_reason == 'tool_calls':
-                        print("\n*** 推理模式下工具调用结束 ***")
-                        # 执行工具并处理结果
-                        for tool_call in tool_calls_data:
-                            tool_id = tool_call.get('id')
-                            tool_name = tool_call.get('function', {}).get('name')
-                            tool_args_str = tool_call.get('function', {}).get('arguments', '{}')
-                            
-                            try:
-                                tool_args = json.loads(tool_args_str) if isinstance(tool_args_str, str) else tool_args_str
-                            except json.JSONDecodeError:
-                                error_msg = f"工具参数解析错误: {tool_args_str}"
-                                print(error_msg)
-                                continue
-                            
-                            # 执行工具并处理流式响应
-                            for tool_response in process_streaming_tool_call(tool_name, tool_args, tool_id):
-                                response_type = tool_response.get('type')
-                                response_data = tool_response.get('data', {})
-                                
-                                if response_type == 'tool_step_response':
-                                    # 处理中间步骤响应
-                                    try:
-                                        step_response = f"data: {json.dumps({'step_response': response_data})}\n\n"
-                                        yield step_response
-                                    except Exception as e:
-                                        print(f"步骤响应序列化错误: {str(e)}")
-                                
-                                elif response_type == 'tool_final_response':
-                                    # 处理最终响应
-                                    try:
-                                        final_response = f"data: {json.dumps({'final_response': response_data})}\n\n"
-                                        yield final_response
-                                        
-                                        # 打印工具执行结果
-                                        print(f"\n===== 工具执行结果 =====")
-                                        print(f"工具: {tool_name}")
-                                        print(f"参数: {tool_args}")
-                                        print(f"状态: {response_data.get('status', 'unknown')}")
-                                        print(f"显示文本: {response_data.get('display_text', '')}")
-                                        print(f"结果数据: {response_data.get('result', {})}")
-                                        print("======================\n")
-                                        
-                                        # 格式化工具响应，以便添加到历史记录
-                                        formatted_results = format_tool_results([response_data])
-                                        # 添加统一格式的消息到历史记录
-                                        tool_response_messages.extend(formatted_results)
-                                    except Exception as e:
-                                        print(f"最终响应序列化错误: {str(e)}")
-                                        
-                                        
-                    # 安全地记录日志，避免空值
-                    if reasoning_content is not None:
-                        print(f"reasoning_content: {reasoning_content}")
-                    if content is not None:
-                        print(f"content: {content}")
-                except Exception as e:
-                    print(f"处理流式响应chunk时出错: {str(e)}")
-                    print(f"错误详情:\n{traceback.format_exc()}")
-                    continue
-        else:        
-            # 处理常规模式
-            for chunk in stream:
-                # 保存最后一个chunk
-                last_chunk_container["value"] = chunk
-                try:
-                    # # 调试信息：打印整个chunk
-                    # print("\n--- 调试: Stream Chunk ---")
-                    # print(f"Chunk类型: {type(chunk)}")
-                    # print(f"Chunk内容: {chunk}")
-                    
-                    # 检查是否有工具调用
-                    if hasattr(chunk.choices[0].delta, 'tool_calls') and chunk.choices[0].delta.tool_calls:
-                        print("\n!!! 发现工具调用 !!!")
-                        print(f"tool_calls: {chunk.choices[0].delta.tool_calls}")
-                        
-                        # 处理工具调用（仅记录，暂不执行）
-                        for tc in chunk.choices[0].delta.tool_calls:
-                            tool_id = tc.id if hasattr(tc, 'id') else None
-                            tool_index = tc.index if hasattr(tc, 'index') else 0
-                            print(f"  工具ID: {tool_id}, 索引: {tool_index}")
-                            
-                            if hasattr(tc, 'function'):
-                                func_name = tc.function.name if hasattr(tc.function, 'name') else None
-                                func_args = tc.function.arguments if hasattr(tc.function, 'arguments') else None
-                                print(f"  函数名: {func_name}")
-                                print(f"  函数参数: {func_args}")
-                            
-                            # 工具调用数据收集
-                            if tool_id:
-                                # 查找现有工具调用记录
-                                existing_call = next((t for t in tool_calls_data if t.get('id') == tool_id), None)
-                                
-                                if not existing_call:
-                                    # 新建工具调用记录
-                                    tool_call_data = {
-                                        'id': tool_id,
-                                        'index': tool_index,
-                                        'function': {
-                                            'name': func_name,
-                                            'arguments': ''
-                                        }
+            logger.debug("使用reasoner模式")
+
+    @staticmethod
+    def runs_tools(chunk: Any) -> bool:
+        """判断处理该chunk时是否会执行工具（可能阻塞较长时间）"""
+        try:
+            return getattr(chunk.choices[0], 'finish_reason', None) == 'tool_calls'
+        except (AttributeError, IndexError):
+            return False
+
+    def process_chunk(self, chunk: Any) -> Generator[str, None, None]:
+        """处理单个chunk，产生需要发送给前端的SSE数据"""
+        # 保存最后一个chunk
+        self.last_chunk = chunk
+        if self.is_reasoner:
+            frames = self._process_reasoner_chunk(chunk)
+        else:
+            frames = self._process_regular_chunk(chunk)
+        # 内部产生的 (字段, 文本) 增量经过合并后再发送
+        yield from self.coalescer.feed(frames)
+
+    def flush(self) -> List[str]:
+        """发送缓冲中的文本增量（异步路径在合并窗口到期时调用）"""
+        return self.coalescer.flush()
+
+    def _process_reasoner_chunk(self, chunk: Any) -> Generator[Union[str, Tuple[str, str]], None, None]:
+        try:
+            reasoning_content = None
+            content = None
+
+            # 检查是否有工具调用
+            if hasattr(chunk.choices[0].delta, 'tool_calls') and chunk.choices[0].delta.tool_calls:
+                logger.debug("!!! 推理模式下发现工具调用 !!!")
+                logger.debug("tool_calls: %s", truncate(chunk.choices[0].delta.tool_calls))
+
+                # 处理工具调用
+                for tc in chunk.choices[0].delta.tool_calls:
+                    tool_id = tc.id if hasattr(tc, 'id') else None
+                    tool_index = tc.index if hasattr(tc, 'index') else 0
+
+                    if hasattr(tc, 'function'):
+                        func_name = tc.function.name if hasattr(tc.function, 'name') else None
+                        func_args = tc.function.arguments if hasattr(tc.function, 'arguments') else None
+
+                        # 收集工具调用数据
+                        if tool_id:
+                            existing_call = next((t for t in self.tool_calls_data if t.get('id') == tool_id), None)
+
+                            if not existing_call:
+                                tool_call_data = {
+                                    'id': tool_id,
+                                    'index': tool_index,
+                                    'function': {
+                                        'name': func_name,
+                                        'arguments': ''
                                     }
-                                    tool_calls_data.append(tool_call_data)
-                                    current_tool_call = tool_call_data
-                                    print(f"创建新工具调用记录: {tool_call_data}")
-                                else:
-                                    current_tool_call = existing_call
-                                
-                                # 累积函数参数
-                                if func_args and current_tool_call:
-                                    current_tool_call['function']['arguments'] += func_args
-                                    print(f"累积参数: {current_tool_call['function']['arguments']}")
-                            elif tool_index is not None and func_args is not None:
-                                # 没有ID但有索引和参数 - 这是DeepSeek和GPT模型的第二个chunk
-                                # 查找匹配索引的工具调用
-                                existing_call = next((t for t in tool_calls_data if t.get('index') == tool_index), None)
-                                
-                                if existing_call:
-                                    # 找到匹配索引的调用，将参数关联到它
-                                    current_tool_call = existing_call
-                                    print(f"根据索引{tool_index}找到现有工具调用: {current_tool_call}")
-                                    
-                                    # 累积函数参数
-                                    current_tool_call['function']['arguments'] += func_args
-                                    print(f"累积参数: {current_tool_call['function']['arguments']}")
-                                else:
-                                    # 如果没有任何工具调用记录，创建一个新的
-                                    if not tool_calls_data:
-                                        new_id = f"auto_generated_id_{tool_index}"
-                                        tool_call_data = {
-                                            'id': new_id,
-                                            'index': tool_index,
-                                            'function': {
-                                                'name': func_name or 'unknown_function',
-                                                'arguments': func_args or ''
-                                            }
-                                        }
-                                        tool_calls_data.append(tool_call_data)
-                                        current_tool_call = tool_call_data
-                                        print(f"创建没有ID的工具调用记录: {tool_call_data}")
-                                    else:
-                                        # 如果有其他工具调用但索引不匹配，使用最后一个
-                                        current_tool_call = tool_calls_data[-1]
-                                        print(f"没有匹配索引，使用最后一个工具调用: {current_tool_call}")
-                                        current_tool_call['function']['arguments'] += func_args
-                                        print(f"累积参数: {current_tool_call['function']['arguments']}")
-                    
-                    # 检查是否有内容
-                    if hasattr(chunk.choices[0].delta, 'content') and chunk.choices[0].delta.content is not None:
-                        content = chunk.choices[0].delta.content
-                        accumulated_output.append(content)
-                        # 立即发送内容
-                        try:
-                            response = f"data: {json.dumps({'content': content})}\n\n"
-                            yield response
-                            # 强制刷新
-                            if hasattr(response, 'flush'):
-                                response.flush()
-                        except Exception as e:
-                            print(f"JSON序列化错误: {str(e)}, 内容: {content}")
-                            # 尝试使用安全的JSON序列化
+                                }
+                                self.tool_calls_data.append(tool_call_data)
+                                self.current_tool_call = tool_call_data
+                            else:
+                                self.current_tool_call = existing_call
+
+                            # 累积函数参数
+                            if func_args and self.current_tool_call:
+                                self.current_tool_call['function']['arguments'] += func_args
+
+            if hasattr(chunk.choices[0].delta, 'reasoning_content') and chunk.choices[0].delta.reasoning_content is not None:
+                reasoning_content = chunk.choices[0].delta.reasoning_content
+                self.accumulated_output.append(reasoning_content)
+                yield ('reasoning_content', reasoning_content)
+            elif hasattr(chunk.choices[0].delta, 'content') and chunk.choices[0].delta.content is not None:
+                content = chunk.choices[0].delta.content
+                self.accumulated_output.append(content)
+                yield ('content', content)
+
+            # 检查是否工具调用结束
+            if hasattr(chunk.choices[0], 'finish_reason') and chunk.choices[0].finish_reason == 'tool_calls':
+                logger.debug("*** 推理模式下工具调用结束 ***")
+                # 执行工具并处理结果
+                for tool_call in self.tool_calls_data:
+                    tool_id = tool_call.get('id')
+                    tool_name = tool_call.get('function', {}).get('name')
+                    tool_args_str = tool_call.get('function', {}).get('arguments', '{}')
+
+                    try:
+                        tool_args = json.loads(tool_args_str) if isinstance(tool_args_str, str) else tool_args_str
+                    except json.JSONDecodeError:
+                        logger.error("工具参数解析错误: %s", truncate(tool_args_str))
+                        continue
+
+                    # 执行工具并处理流式响应
+                    for tool_response in process_streaming_tool_call(tool_name, tool_args, tool_id):
+                        response_type = tool_response.get('type')
+                        response_data = tool_response.get('data', {})
+
+                        if response_type == 'tool_step_response':
+                            # 处理中间步骤响应
                             try:
-                                response = f"data: {json.dumps({'content': content}, ensure_ascii=False)}\n\n"
-                                yield response
-                            except:
-                                print("无法序列化内容，跳过")
-                    
-                    # 检查是否工具调用结束
-                    if hasattr(chunk.choices[0], 'finish_reason') and chunk.choices[0].finish_reason == 'tool_calls':
-                        print("\n*** 工具调用结束，finish_reason=tool_calls ***")
-                        
-                        # 执行工具并处理结果
-                        for tool_call in tool_calls_data:
-                            tool_id = tool_call.get('id')
-                            tool_name = tool_call.get('function', {}).get('name')
-                            tool_args_str = tool_call.get('function', {}).get('arguments', '{}')
-                            
-                            print(f"处理工具调用: ID={tool_id}, 名称={tool_name}, 原始参数={tool_args_str}")
-                            
-                            # 处理空参数情况
-                            if not tool_args_str or tool_args_str.strip() == '':
-                                tool_args_str = '{}'
-                                print(f"参数为空，设置为空对象: {tool_args_str}")
-                            
+                                step_response = sse_frame({'step_response': response_data})
+                                yield step_response
+                            except Exception as e:
+                                logger.error("步骤响应序列化错误: %s", e)
+
+                        elif response_type == 'tool_final_response':
+                            # 处理最终响应
                             try:
-                                # 尝试修复可能的JSON格式问题
-                                if not tool_args_str.startswith('{'):
-                                    tool_args_str = '{' + tool_args_str
-                                    print(f"修复参数开始: {tool_args_str}")
-                                
-                                if not tool_args_str.endswith('}'):
-                                    tool_args_str = tool_args_str + '}'
-                                    print(f"修复参数结束: {tool_args_str}")
-                                
-                                # 解析参数
-                                tool_args = json.loads(tool_args_str) if isinstance(tool_args_str, str) else tool_args_str
-                                print(f"解析后的参数: {tool_args}")
-                                
-                                # 检查工具名称是否有效
-                                if not tool_name:
-                                    print(f"警告: 工具名称为空，跳过执行")
-                                    continue
-                                
-                                # 执行工具并处理流式响应
-                                for tool_response in process_streaming_tool_call(tool_name, tool_args, tool_id):
-                                    response_type = tool_response.get('type')
-                                    response_data = tool_response.get('data', {})
-                                    
-                                    if response_type == 'tool_step_response':
-                                        # 处理中间步骤响应
-                                        try:
-                                            step_response = f"data: {json.dumps({'step_response': response_data})}\n\n"
-                                            yield step_response
-                                        except Exception as e:
-                                            print(f"步骤响应序列化错误: {str(e)}")
-                                    
-                                    elif response_type == 'tool_final_response':
-                                        # 处理最终响应
-                                        try:
-                                            final_response = f"data: {json.dumps({'final_response': response_data})}\n\n"
-                                            yield final_response
-                                            
-                                            # 打印工具执行结果
-                                            print(f"\n===== 工具执行结果 =====")
-                                            print(f"工具: {tool_name}")
-                                            print(f"参数: {tool_args}")
-                                            print(f"状态: {response_data.get('status', 'unknown')}")
-                                            print(f"显示文本: {response_data.get('display_text', '')}")
-                                            print(f"结果数据: {response_data.get('result', {})}")
-                                            print("======================\n")
-                                            
-                                            # 格式化工具响应，以便添加到历史记录
-                                            formatted_results = format_tool_results([response_data])
-                                            # 添加统一格式的消息到历史记录
-                                            tool_response_messages.extend(formatted_results)
-                                        except Exception as e:
-                                            print(f"最终响应序列化错误: {str(e)}")
-                            except json.JSONDecodeError as e:
-                                error_msg = f"工具参数解析错误: {tool_args_str}, 错误: {str(e)}"
-                                print(error_msg)
-                                continue
+                                final_response = sse_frame({'final_response': response_data})
+                                yield final_response
+
+                                # 打印工具执行结果
+                                logger.debug("===== 工具执行结果 =====")
+                                logger.debug("工具: %s", tool_name)
+                                logger.debug("参数: %s", truncate(tool_args))
+                                logger.debug("状态: %s", response_data.get('status', 'unknown'))
+                                logger.debug("显示文本: %s", response_data.get('display_text', ''))
+                                logger.debug("结果数据: %s", truncate(response_data.get('result', {})))
+                                logger.debug("======================")
+
+                                # 格式化工具响应，以便添加到历史记录
+                                formatted_results = format_tool_results([response_data])
+                                # 添加统一格式的消息到历史记录
+                                self.tool_response_messages.extend(formatted_results)
                             except Exception as e:
-                                print(f"执行工具时发生未知错误: {str(e)}")
-                                print(f"错误详情:\n{traceback.format_exc()}")
-                                continue
-                    
-                except Exception as e:
-                    print(f"处理流式响应chunk时出错: {str(e)}")
-                    print(f"错误详情:\n{traceback.format_exc()}")
-                    continue
-                    
-        # 在常规模式下，添加工具消息调试信息
-        if tool_response_messages:
-            try:
-                # 打印工具消息调试信息
-                print("\n===== 发送工具消息到前端 =====")
-                print(f"工具消息数量: {len(tool_response_messages)}")
-                for idx, msg in enumerate(tool_response_messages):
-                    print(f"消息 {idx+1}:")
-                    print(f"  类型: {msg.get('type', 'unknown')}")
-                    print(f"  工具名称: {msg.get('function', {}).get('name', 'unknown')}")
-                    print(f"  显示文本: {msg.get('display_text', 'none')}")
-                    print(f"  状态: {msg.get('status', 'unknown')}")
-                    if 'result' in msg:
-                        print(f"  结果: {msg['result']}")
-                print("===========================\n")
-                
-                # 使用统一的格式返回工具消息
-                tool_messages_response = f"data: {json.dumps({'tool_messages': tool_response_messages})}\n\n"
-                yield tool_messages_response
-            except Exception as e:
-                print(f"工具响应消息序列化错误: {str(e)}")
-                print(f"错误详情:\n{traceback.format_exc()}")
-        
-        # 在处理完所有流后，返回最后一个chunk
-        return last_chunk_container["value"]
-    
-    # 创建一个闭包来跟踪最后一个chunk
-    last_chunk_ref = [None]
-    
-    def capturing_generator():
-        last_chunk = yield from stream_generator()
-        last_chunk_ref[0] = last_chunk
-        
-    gen = capturing_generator()
-    
-    # 返回生成器和获取最后一个chunk的函数
-    return gen, lambda: last_chunk_ref[0]
+                                logger.error("最终响应序列化错误: %s", e)
 
-def process_google_stream_response(
-    stream: Any, 
-    accumulated_output: List[str]
-) -> Tuple[Generator[str, None, None], Any]:
-    """
-    处理来自Google API的流式响应数据，并返回一个生成器和最后的响应chunk
-    
-    Args:
-        stream: Google API返回的流式响应对象
-        accumulated_output: 用于累积输出内容的列表
-        
-    Returns:
-        Tuple[Generator[str, None, None], Any]: 
-            - 生成器，产生格式化为SSE的响应数据
-            - 最后一个响应chunk，用于token统计
-    """
-    def stream_generator():
-        # 存储最后一个chunk
-        last_chunk_container = {"value": None}
-        
-        # 存储工具调用数据
-        tool_calls_data = []
-        
-        # 存储工具调用结果，用于添加到历史记录
-        tool_response_messages = []
-        
-        for chunk in stream:
-            # 保存最后一个chunk
-            last_chunk_container["value"] = chunk
-            
-            try:
-                # 首先检查响应的类型，Gemini的响应是互斥的 - 要么是文本，要么是函数调用
-
-                # 检查是否为函数调用响应
-                has_function_call = False
-                
-                # 用于去重的工具名称集合
-                seen_tool_names = set()
-                
-                # 检查candidates中的function_call
-                if hasattr(chunk, 'candidates') and chunk.candidates:
-                    for candidate in chunk.candidates:
-                        if hasattr(candidate, 'content') and candidate.content:
-                            for part in candidate.content.parts:
-                                if hasattr(part, 'function_call') and part.function_call is not None:
-                                    has_function_call = True
-                                    func_call = part.function_call
-                                    func_name = func_call.name
-                                    
-                                    # 检查是否已经处理过这个工具
-                                    if func_name in seen_tool_names:
-                                        print(f"跳过重复的函数调用: {func_name}")
-                                        continue
-                                    
-                                    seen_tool_names.add(func_name)
-                                    print(f"\n!!! Gemini发现函数调用: {func_name} !!!")
-                                    
-                                    # 收集工具调用数据
-                                    tool_call_data = {
-                                        'id': func_name,  # Gemini没有id，使用函数名作为id
-                                        'function': {
-                                            'name': func_name,
-                                            'arguments': func_call.args
-                                        }
+
+            # 逐token日志经过采样，关闭时几乎没有开销
+            if reasoning_content is not None:
+                self.token_log.log('reasoning_content', reasoning_content)
+            if content is not None:
+                self.token_log.log('content', content)
+        except Exception as e:
+            logger.error("处理流式响应chunk时出错: %s", e, exc_info=True)
+
+    def _process_regular_chunk(self, chunk: Any) -> Generator[Union[str, Tuple[str, str]], None, None]:
+        try:
+            # # 调试信息：打印整个chunk
+            # print("\n--- 调试: Stream Chunk ---")
+            # print(f"Chunk类型: {type(chunk)}")
+            # print(f"Chunk内容: {chunk}")
+
+            # 检查是否有工具调用
+            if hasattr(chunk.choices[0].delta, 'tool_calls') and chunk.choices[0].delta.tool_calls:
+                logger.debug("!!! 发现工具调用 !!!")
+                logger.debug("tool_calls: %s", truncate(chunk.choices[0].delta.tool_calls))
+
+                # 处理工具调用（仅记录，暂不执行）
+                for tc in chunk.choices[0].delta.tool_calls:
+                    tool_id = tc.id if hasattr(tc, 'id') else None
+                    tool_index = tc.index if hasattr(tc, 'index') else 0
+                    logger.debug("工具ID: %s, 索引: %s", tool_id, tool_index)
+
+                    if hasattr(tc, 'function'):
+                        func_name = tc.function.name if hasattr(tc.function, 'name') else None
+                        func_args = tc.function.arguments if hasattr(tc.function, 'arguments') else None
+                        logger.debug("函数名: %s", func_name)
+                        logger.debug("函数参数: %s", truncate(func_args))
+
+                    # 工具调用数据收集
+                    if tool_id:
+                        # 查找现有工具调用记录
+                        existing_call = next((t for t in self.tool_calls_data if t.get('id') == tool_id), None)
+
+                        if not existing_call:
+                            # 新建工具调用记录
+                            tool_call_data = {
+                                'id': tool_id,
+                                'index': tool_index,
+                                'function': {
+                                    'name': func_name,
+                                    'arguments': ''
+                                }
+                            }
+                            self.tool_calls_data.append(tool_call_data)
+                            self.current_tool_call = tool_call_data
+                            logger.debug("创建新工具调用记录: %s", truncate(tool_call_data))
+                        else:
+                            self.current_tool_call = existing_call
+
+                        # 累积函数参数
+                        if func_args and self.current_tool_call:
+                            self.current_tool_call['function']['arguments'] += func_args
+                            logger.debug("累积参数: %s", truncate(self.current_tool_call['function']['arguments']))
+                    elif tool_index is not None and func_args is not None:
+                        # 没有ID但有索引和参数 - 这是DeepSeek和GPT模型的第二个chunk
+                        # 查找匹配索引的工具调用
+                        existing_call = next((t for t in self.tool_calls_data if t.get('index') == tool_index), None)
+
+                        if existing_call:
+                            # 找到匹配索引的调用，将参数关联到它
+                            self.current_tool_call = existing_call
+                            logger.debug("根据索引%s找到现有工具调用: %s", tool_index, truncate(self.current_tool_call))
+
+                            # 累积函数参数
+                            self.current_tool_call['function']['arguments'] += func_args
+                            logger.debug("累积参数: %s", truncate(self.current_tool_call['function']['arguments']))
+                        else:
+                            # 如果没有任何工具调用记录，创建一个新的
+                            if not self.tool_calls_data:
+                                new_id = f"auto_generated_id_{tool_index}"
+                                tool_call_data = {
+                                    'id': new_id,
+                                    'index': tool_index,
+                                    'function': {
+                                        'name': func_name or 'unknown_function',
+                                        'arguments': func_args or ''
                                     }
-                                    tool_calls_data.append(tool_call_data)
-                
-                # 检查直接的function_calls
-                if hasattr(chunk, 'function_calls') and chunk.function_calls is not None:
-                    has_function_call = True
-                    for func_call in chunk.function_calls:
-                        func_name = func_call.name
-                        
-                        # 检查是否已经处理过这个工具
-                        if func_name in seen_tool_names:
-                            print(f"跳过重复的并行函数调用: {func_name}")
+                                }
+                                self.tool_calls_data.append(tool_call_data)
+                                self.current_tool_call = tool_call_data
+                                logger.debug("创建没有ID的工具调用记录: %s", truncate(tool_call_data))
+                            else:
+                                # 如果有其他工具调用但索引不匹配，使用最后一个
+                                self.current_tool_call = self.tool_calls_data[-1]
+                                logger.debug("没有匹配索引，使用最后一个工具调用: %s", truncate(self.current_tool_call))
+                                self.current_tool_call['function']['arguments'] += func_args
+                                logger.debug("累积参数: %s", truncate(self.current_tool_call['function']['arguments']))
+
+            # 检查是否有内容
+            if hasattr(chunk.choices[0].delta, 'content') and chunk.choices[0].delta.content is not None:
+                content = chunk.choices[0].delta.content
+                self.accumulated_output.append(content)
+                self.token_log.log('content', content)
+                yield ('content', content)
+
+            # 检查是否工具调用结束
+            if hasattr(chunk.choices[0], 'finish_reason') and chunk.choices[0].finish_reason == 'tool_calls':
+                logger.debug("*** 工具调用结束，finish_reason=tool_calls ***")
+
+                # 执行工具并处理结果
+                for tool_call in self.tool_calls_data:
+                    tool_id = tool_call.get('id')
+                    tool_name = tool_call.get('function', {}).get('name')
+                    tool_args_str = tool_call.get('function', {}).get('arguments', '{}')
+
+                    logger.debug("处理工具调用: ID=%s, 名称=%s, 原始参数=%s", tool_id, tool_name, truncate(tool_args_str))
+
+                    # 处理空参数情况
+                    if not tool_args_str or tool_args_str.strip() == '':
+                        tool_args_str = '{}'
+                        logger.debug("参数为空，设置为空对象: %s", truncate(tool_args_str))
+
+                    try:
+                        # 尝试修复可能的JSON格式问题
+                        if not tool_args_str.startswith('{'):
+                            tool_args_str = '{' + tool_args_str
+                            logger.debug("修复参数开始: %s", truncate(tool_args_str))
+
+                        if not tool_args_str.endswith('}'):
+                            tool_args_str = tool_args_str + '}'
+                            logger.debug("修复参数结束: %s", truncate(tool_args_str))
+
+                        # 解析参数
+                        tool_args = json.loads(tool_args_str) if isinstance(tool_args_str, str) else tool_args_str
+                        logger.debug("解析后的参数: %s", truncate(tool_args))
+
+                        # 检查工具名称是否有效
+                        if not tool_name:
+                            logger.warning("警告: 工具名称为空，跳过执行")
                             continue
-                        
-                        seen_tool_names.add(func_name)
-                        print(f"\n!!! Gemini发现并行函数调用: {func_name} !!!")
-                        
-                        # 收集工具调用数据
-                        tool_call_data = {
-                            'id': func_name,
-                            'function': {
-                                'name': func_name,
-                                'arguments': func_call.args
-                            }
-                        }
-                        tool_calls_data.append(tool_call_data)
-                
-                # 如果不是函数调用，那么检查文本内容
-                if not has_function_call and hasattr(chunk, 'text') and chunk.text:
-                    accumulated_output.append(chunk.text)
-                    yield f"data: {json.dumps({'content': chunk.text})}\n\n"
-                
-                # 处理完整的工具调用
-                # Gemini的工具调用结束标志可能不同于OpenAI
-                # 需要立即执行工具调用，不需要等待finish_reason标志
-                if has_function_call and tool_calls_data:
-                    print("\n*** Gemini工具调用执行 ***")
-                    
-                    # 执行所有收集到的工具
-                    for tool_call in tool_calls_data:
-                        tool_id = tool_call.get('id')
-                        tool_name = tool_call.get('function', {}).get('name')
-                        tool_args = tool_call.get('function', {}).get('arguments', {})
-                        
+
                         # 执行工具并处理流式响应
                         for tool_response in process_streaming_tool_call(tool_name, tool_args, tool_id):
                             response_type = tool_response.get('type')
                             response_data = tool_response.get('data', {})
-                            
+
                             if response_type == 'tool_step_response':
                                 # 处理中间步骤响应
                                 try:
-                                    step_response = f"data: {json.dumps({'step_response': response_data})}\n\n"
+                                    step_response = sse_frame({'step_response': response_data})
                                     yield step_response
                                 except Exception as e:
-                                    print(f"步骤响应序列化错误: {str(e)}")
-                            
+                                    logger.error("步骤响应序列化错误: %s", e)
+
                             elif response_type == 'tool_final_response':
                                 # 处理最终响应
                                 try:
-                                    final_response = f"data: {json.dumps({'final_response': response_data})}\n\n"
+                                    final_response = sse_frame({'final_response': response_data})
                                     yield final_response
-                                    
+
                                     # 打印工具执行结果
-                                    print(f"\n===== 工具执行结果 =====")
-                                    print(f"工具: {tool_name}")
-                                    print(f"参数: {tool_args}")
-                                    print(f"状态: {response_data.get('status', 'unknown')}")
-                                    print(f"显示文本: {response_data.get('display_text', '')}")
-                                    print(f"结果数据: {response_data.get('result', {})}")
-                                    print("======================\n")
-                                    
+                                    logger.debug("===== 工具执行结果 =====")
+                                    logger.debug("工具: %s", tool_name)
+                                    logger.debug("参数: %s", truncate(tool_args))
+                                    logger.debug("状态: %s", response_data.get('status', 'unknown'))
+                                    logger.debug("显示文本: %s", response_data.get('display_text', ''))
+                                    logger.debug("结果数据: %s", truncate(response_data.get('result', {})))
+                                    logger.debug("======================")
+
                                     # 格式化工具响应，以便添加到历史记录
                                     formatted_results = format_tool_results([response_data])
                                     # 添加统一格式的消息到历史记录
-                                    tool_response_messages.extend(formatted_results)
+                                    self.tool_response_messages.extend(formatted_results)
                                 except Exception as e:
-                                    print(f"最终响应序列化错误: {str(e)}")
-                    
-                    # 清空工具调用数据，防止重复执行
-                    tool_calls_data = []
-            
+                                    logger.error("最终响应序列化错误: %s", e)
+                    except json.JSONDecodeError as e:
+                        logger.error("工具参数解析错误: %s, 错误: %s", truncate(tool_args_str), e)
+                        continue
+                    except Exception as e:
+                        logger.error("执行工具时发生未知错误: %s", e, exc_info=True)
+                        continue
+
+        except Exception as e:
+            logger.error("处理流式响应chunk时出错: %s", e, exc_info=True)
+
+    def finish(self) -> Generator[str, None, None]:
+        """流结束后调用，发送缓冲的文本和工具消息"""
+        yield from self.coalescer.flush()
+        # 在常规模式下，添加工具消息调试信息
+        if self.tool_response_messages:
+            try:
+                # 打印工具消息调试信息
+                logger.debug("===== 发送工具消息到前端 =====")
+                logger.debug("工具消息数量: %s", len(self.tool_response_messages))
+                for idx, msg in enumerate(self.tool_response_messages):
+                    logger.debug("消息 %s:", idx+1)
+                    logger.debug("类型: %s", msg.get('type', 'unknown'))
+                    logger.debug("工具名称: %s", truncate(msg.get('function', {}).get('name', 'unknown')))
+                    logger.debug("显示文本: %s", msg.get('display_text', 'none'))
+                    logger.debug("状态: %s", msg.get('status', 'unknown'))
+                    if 'result' in msg:
+                        logger.debug("结果: %s", truncate(msg['result']))
+                logger.debug("===========================")
+
+                # 使用统一的格式返回工具消息
+                tool_messages_response = sse_frame({'tool_messages': self.tool_response_messages})
+                yield tool_messages_response
             except Exception as e:
-                print(f"处理Gemini流式响应chunk时出错: {str(e)}")
-                print(f"错误详情:\n{traceback.format_exc()}")
-                continue
-        
+                logger.error("工具响应消息序列化错误: %s", e, exc_info=True)
+
+
+class GoogleStreamProcessor:
+    """逐个chunk处理Google API的流式响应，产生SSE格式的数据"""
+
+    def __init__(self, accumulated_output: List[str], coalesce_window: float = COALESCE_WINDOW):
+        """
+        Args:
+            accumulated_output: 用于累积输出内容的列表
+            coalesce_window: 文本增量的合并窗口（秒），0表示不合并
+        """
+        self.accumulated_output = accumulated_output
+        # 最后一个chunk，用于token统计
+        self.last_chunk = None
+        # 逐token的调试日志（默认关闭）
+        self.token_log = TokenLogSampler(__name__)
+        # 合并连续的文本增量
+        self.coalescer = SSECoalescer(window=coalesce_window)
+
+        # 存储工具调用数据
+        self.tool_calls_data = []
+
+        # 存储工具调用结果，用于添加到历史记录
+        self.tool_response_messages = []
+
+    @staticmethod
+    def runs_tools(chunk: Any) -> bool:
+        """判断处理该chunk时是否会执行工具（可能阻塞较长时间）"""
+        if getattr(chunk, 'function_calls', None):
+            return True
+        for candidate in getattr(chunk, 'candidates', None) or []:
+            content = getattr(candidate, 'content', None)
+            for part in getattr(content, 'parts', None) or []:
+                if getattr(part, 'function_call', None) is not None:
+                    return True
+        return False
+
+    def process_chunk(self, chunk: Any) -> Generator[str, None, None]:
+        """处理单个chunk，产生需要发送给前端的SSE数据"""
+        # 保存最后一个chunk
+        self.last_chunk = chunk
+        # 内部产生的 (字段, 文本) 增量经过合并后再发送
+        yield from self.coalescer.feed(self._process_google_chunk(chunk))
+
+    def flush(self) -> List[str]:
+        """发送缓冲中的文本增量（异步路径在合并窗口到期时调用）"""
+        return self.coalescer.flush()
+
+    def _process_google_chunk(self, chunk: Any) -> Generator[Union[str, Tuple[str, str]], None, None]:
+        try:
+            # 首先检查响应的类型，Gemini的响应是互斥的 - 要么是文本，要么是函数调用
+
+            # 检查是否为函数调用响应
+            has_function_call = False
+
+            # 用于去重的工具名称集合
+            seen_tool_names = set()
+
+            # 检查candidates中的function_call
+            if hasattr(chunk, 'candidates') and chunk.candidates:
+                for candidate in chunk.candidates:
+                    if hasattr(candidate, 'content') and candidate.content:
+                        for part in candidate.content.parts:
+                            if hasattr(part, 'function_call') and part.function_call is not None:
+                                has_function_call = True
+                                func_call = part.function_call
+                                func_name = func_call.name
+
+                                # 检查是否已经处理过这个工具
+                                if func_name in seen_tool_names:
+                                    logger.debug("跳过重复的函数调用: %s", func_name)
+                                    continue
+
+                                seen_tool_names.add(func_name)
+                                logger.debug("!!! Gemini发现函数调用: %s !!!", func_name)
+
+                                # 收集工具调用数据
+                                tool_call_data = {
+                                    'id': func_name,  # Gemini没有id，使用函数名作为id
+                                    'function': {
+                                        'name': func_name,
+                                        'arguments': func_call.args
+                                    }
+                                }
+                                self.tool_calls_data.append(tool_call_data)
+
+            # 检查直接的function_calls
+            if hasattr(chunk, 'function_calls') and chunk.function_calls is not None:
+                has_function_call = True
+                for func_call in chunk.function_calls:
+                    func_name = func_call.name
+
+                    # 检查是否已经处理过这个工具
+                    if func_name in seen_tool_names:
+                        logger.debug("跳过重复的并行函数调用: %s", func_name)
+                        continue
+
+                    seen_tool_names.add(func_name)
+                    logger.debug("!!! Gemini发现并行函数调用: %s !!!", func_name)
+
+                    # 收集工具调用数据
+                    tool_call_data = {
+                        'id': func_name,
+                        'function': {
+                            'name': func_name,
+                            'arguments': func_call.args
+                        }
+                    }
+                    self.tool_calls_data.append(tool_call_data)
+
+            # 如果不是函数调用，那么检查文本内容
+            if not has_function_call and hasattr(chunk, 'text') and chunk.text:
+                self.accumulated_output.append(chunk.text)
+                self.token_log.log('content', chunk.text)
+                yield ('content', chunk.text)
+
+            # 处理完整的工具调用
+            # Gemini的工具调用结束标志可能不同于OpenAI
+            # 需要立即执行工具调用，不需要等待finish_reason标志
+            if has_function_call and self.tool_calls_data:
+                logger.debug("*** Gemini工具调用执行 ***")
+
+                # 执行所有收集到的工具
+                for tool_call in self.tool_calls_data:
+                    tool_id = tool_call.get('id')
+                    tool_name = tool_call.get('function', {}).get('name')
+                    tool_args = tool_call.get('function', {}).get('arguments', {})
+
+                    # 执行工具并处理流式响应
+                    for tool_response in process_streaming_tool_call(tool_name, tool_args, tool_id):
+                        response_type = tool_response.get('type')
+                        response_data = tool_response.get('data', {})
+
+                        if response_type == 'tool_step_response':
+                            # 处理中间步骤响应
+                            try:
+                                step_response = sse_frame({'step_response': response_data})
+                                yield step_response
+                            except Exception as e:
+                                logger.error("步骤响应序列化错误: %s", e)
+
+                        elif response_type == 'tool_final_response':
+                            # 处理最终响应
+                            try:
+                                final_response = sse_frame({'final_response': response_data})
+                                yield final_response
+
+                                # 打印工具执行结果
+                                logger.debug("===== 工具执行结果 =====")
+                                logger.debug("工具: %s", tool_name)
+                                logger.debug("参数: %s", truncate(tool_args))
+                                logger.debug("状态: %s", response_data.get('status', 'unknown'))
+                                logger.debug("显示文本: %s", response_data.get('display_text', ''))
+                                logger.debug("结果数据: %s", truncate(response_data.get('result', {})))
+                                logger.debug("======================")
+
+                                # 格式化工具响应，以便添加到历史记录
+                                formatted_results = format_tool_results([response_data])
+                                # 添加统一格式的消息到历史记录
+                                self.tool_response_messages.extend(formatted_results)
+                            except Exception as e:
+                                logger.error("最终响应序列化错误: %s", e)
+
+                # 清空工具调用数据，防止重复执行
+                self.tool_calls_data = []
+
+        except Exception as e:
+            logger.error("处理Gemini流式响应chunk时出错: %s", e, exc_info=True)
+
+    def finish(self) -> Generator[str, None, None]:
+        """流结束后调用，发送缓冲的文本和工具消息"""
+        yield from self.coalescer.flush()
         # 在Google模式中，在发送工具消息前添加调试信息
         # 如果有工具响应消息，则作为特殊类型发送
-        if tool_response_messages:
+        if self.tool_response_messages:
             try:
                 # 打印工具消息调试信息
-                print("\n===== 发送工具消息到前端 =====")
-                print(f"工具消息数量: {len(tool_response_messages)}")
-                for idx, msg in enumerate(tool_response_messages):
-                    print(f"消息 {idx+1}:")
-                    print(f"  类型: {msg.get('type', 'unknown')}")
-                    print(f"  工具名称: {msg.get('function', {}).get('name', 'unknown')}")
-                    print(f"  显示文本: {msg.get('display_text', 'none')}")
-                    print(f"  状态: {msg.get('status', 'unknown')}")
+                logger.debug("===== 发送工具消息到前端 =====")
+                logger.debug("工具消息数量: %s", len(self.tool_response_messages))
+                for idx, msg in enumerate(self.tool_response_messages):
+                    logger.debug("消息 %s:", idx+1)
+                    logger.debug("类型: %s", msg.get('type', 'unknown'))
+                    logger.debug("工具名称: %s", truncate(msg.get('function', {}).get('name', 'unknown')))
+                    logger.debug("显示文本: %s", msg.get('display_text', 'none'))
+                    logger.debug("状态: %s", msg.get('status', 'unknown'))
                     if 'result' in msg:
-                        print(f"  结果: {msg['result']}")
-                print("===========================\n")
-                
+                        logger.debug("结果: %s", truncate(msg['result']))
+                logger.debug("===========================")
+
                 # 使用统一的格式返回工具消息
-                tool_messages_response = f"data: {json.dumps({'tool_messages': tool_response_messages})}\n\n"
+                tool_messages_response = sse_frame({'tool_messages': self.tool_response_messages})
                 yield tool_messages_response
             except Exception as e:
-                print(f"工具响应消息序列化错误: {str(e)}")
-                print(f"错误详情:\n{traceback.format_exc()}")
-        
-        return last_chunk_container["value"]
-    
-    # 创建闭包来跟踪最后一个chunk
-    last_chunk_ref = [None]
-    
-    def capturing_generator():
-        last_chunk = yield from stream_generator()
-        last_chunk_ref[0] = last_chunk
+                logger.error("工具响应消息序列化错误: %s", e, exc_info=True)
+
+
+def process_stream_response(
+    stream: Any, 
+    is_reasoner: bool, 
+    accumulated_output: List[str]
+) -> Tuple[Generator[str, None, None], Any]:
+    """
+    处理来自AI模型的流式响应数据，并返回一个生成器和最后的响应chunk
     
-    gen = capturing_generator()
+    Args:
+        stream: AI模型返回的流式响应对象
+        is_reasoner: 是否为reasoner模式
+        accumulated_output: 用于累积输出内容的列表
+        
+    Returns:
+        Tuple[Generator[str, None, None], Any]: 
+            - 生成器，产生格式化为SSE的响应数据
+            - 最后一个响应chunk，用于token统计
+    """
+    # 同步读取上游时无法在停顿期间按时发送缓冲的文本，因此不合并增量
+    processor = OpenAIStreamProcessor(is_reasoner, accumulated_output, coalesce_window=0)
+
+    def stream_generator():
+        for chunk in stream:
+            yield from processor.process_chunk(chunk)
+        yield from processor.finish()
+
+    # 返回生成器和获取最后一个chunk的函数
+    return stream_generator(), lambda: processor.last_chunk
+
+def process_google_stream_response(
+    stream: Any, 
+    accumulated_output: List[str]
+) -> Tuple[Generator[str, None, None], Any]:
+    """
+    处理来自Google API的流式响应数据，并返回一个生成器和最后的响应chunk
     
+    Args:
+        stream: Google API返回的流式响应对象
+        accumulated_output: 用于累积输出内容的列表
+        
+    Returns:
+        Tuple[Generator[str, None, None], Any]: 
+            - 生成器，产生格式化为SSE的响应数据
+            - 最后一个响应chunk，用于token统计
+    """
+    # 同步读取上游时无法在停顿期间按时发送缓冲的文本，因此不合并增量
+    processor = GoogleStreamProcessor(accumulated_output, coalesce_window=0)
+
+    def stream_generator():
+        for chunk in stream:
+            yield from processor.process_chunk(chunk)
+        yield from processor.finish()
+
     # 返回生成器和获取最后一个chunk的函数
-    return gen, lambda: last_chunk_ref[0] 
+    return stream_generator(), lambda: processor.last_chunk
+
+async def process_stream_response_async(stream: Any, processor: Any) -> AsyncGenerator[str, None]:
+    """
+    用OpenAIStreamProcessor或GoogleStreamProcessor处理异步流
+
+    普通chunk直接在事件循环中处理；会执行工具的chunk放到线程中处理，
+    避免同步的工具调用阻塞事件循环。上游停顿时，缓冲的文本在合并窗口到期后立即发送。
+
+    Args:
+        stream: 异步流式响应对象
+        processor: 流处理器实例
+
+    Yields:
+        str: 格式化为SSE的响应数据
+    """
+    iterator = stream.__aiter__()
+    pending_next = None
+    try:
+        while True:
+            deadline = processor.coalescer.deadline()
+            if pending_next is None and deadline is None:
+                # 没有缓冲内容时直接读取，不需要额外创建任务
+                try:
+                    chunk = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+            else:
+                if pending_next is None:
+                    pending_next = asyncio.ensure_future(iterator.__anext__())
+                if deadline is not None:
+                    # 等待下一个chunk，但不超过合并窗口；超时不取消读取，只先发送缓冲内容
+                    done, _ = await asyncio.wait({pending_next}, timeout=max(0.0, deadline - time.monotonic()))
+                    if not done:
+                        for frame in processor.flush():
+                            yield frame
+                        continue
+                try:
+                    chunk = await pending_next
+                except StopAsyncIteration:
+                    break
+                finally:
+                    pending_next = None
+
+            frames = processor.process_chunk(chunk)
+            if processor.runs_tools(chunk):
+                done_marker = object()
+                while True:
+                    frame = await asyncio.to_thread(next, frames, done_marker)
+                    if frame is done_marker:
+                        break
+                    yield frame
+            else:
+                for frame in frames:
+                    yield frame
+    finally:
+        # 客户端断开时取消尚未完成的读取
+        if pending_next is not None and not pending_next.done():
+            pending_next.cancel()
+    for frame in processor.finish():
+        yield frame
@@ -1,10 +1,118 @@
+import json
+import base64
+import hashlib
+from sqlalchemy import event
 from initialization import db
+from utils.message_codec import message_codec
+from utils.conversation_search import conversation_search
+from utils.attachment_registry import attachment_registry
 from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+
+def message_hash(message: Dict) -> str:
+    """计算单条消息的内容哈希，用于判断消息是否变化"""
+    raw = json.dumps(message, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(raw.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+# 单条消息表，每个对话的消息按seq顺序存储
+class ConversationMessage(db.Model):
+    __tablename__ = 'conversation_message'
+    __table_args__ = (
+        db.UniqueConstraint('conversation_id', 'seq', name='uq_conversation_message_seq'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    conversation_id = db.Column(db.String(50), db.ForeignKey('conversation.id'), nullable=False, index=True)
+    seq = db.Column(db.Integer, nullable=False)  # 消息在对话中的位置，从0开始
+    role = db.Column(db.String(20))
+    content = db.Column(db.JSON)
+    attachments = db.Column(db.JSON)
+    # metadata是SQLAlchemy保留的属性名，列名保持metadata
+    meta = db.Column('metadata', db.JSON)  # role/content/attachments以外的字段，如modelId、reasoning_content
+    content_hash = db.Column(db.String(40), nullable=False)  # 整条消息的哈希，保存时只比较哈希
+    # 较大的消息把content/attachments/metadata整体压缩存储在这里，此时三个JSON列为空
+    payload = db.Column(db.LargeBinary)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+    # 单独存储的字段
+    BASE_FIELDS = ('role', 'content', 'attachments')
+
+    @classmethod
+    def row_from_message(cls, conversation_id: str, seq: int, message: Dict) -> Dict:
+        """把前端的消息字典转换为可批量写入的行"""
+        meta = {k: v for k, v in message.items() if k not in cls.BASE_FIELDS}
+        row = {
+            'conversation_id': conversation_id,
+            'seq': seq,
+            'role': message.get('role'),
+            'content': message.get('content'),
+            'attachments': message.get('attachments'),
+            'meta': meta or None,
+            'content_hash': message_hash(message),
+            'payload': None,
+            'created_at': datetime.now(timezone.utc)
+        }
+        return cls.compress_row(row)
+
+    @staticmethod
+    def compress_row(row: Dict) -> Dict:
+        """超过压缩阈值时把消息内容压缩到payload列"""
+        payload = message_codec.compress([row['content'], row['attachments'], row['meta']])
+        if payload is not None:
+            row.update(content=None, attachments=None, meta=None, payload=payload)
+        return row
+
+    def to_message(self) -> Dict:
+        """还原为前端使用的消息字典，压缩的消息在这里才解压"""
+        if self.payload is not None:
+            content, attachments, meta = message_codec.decompress(self.payload)
+        else:
+            content, attachments, meta = self.content, self.attachments, self.meta
+        message = {'role': self.role, 'content': content}
+        if attachments is not None:
+            message['attachments'] = attachments
+        if meta:
+            message.update(meta)
+        return message
+
+
+def last_model_id(messages: List[Dict]) -> Optional[str]:
+    """最后一条助手消息使用的模型"""
+    for message in reversed(messages or []):
+        if message.get('role') == 'assistant' and message.get('modelId'):
+            return message['modelId']
+    return None
+
+
+def encode_cursor(updated_at: datetime, conversation_id: str) -> str:
+    """把分页位置编码为不透明的游标字符串"""
+    raw = json.dumps([updated_at.isoformat(), conversation_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    """解析游标，格式错误时抛出ValueError"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        updated_at, conversation_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        return datetime.fromisoformat(updated_at), str(conversation_id)
+    except Exception as e:
+        raise ValueError(f"无效的分页游标: {cursor}") from e
+
+
 # 添加Conversation模型
 class Conversation(db.Model):
+    __table_args__ = (
+        # 侧边栏按更新时间分页
+        db.Index('ix_conversation_user_updated', 'user_id', 'updated_at'),
+    )
+
     id = db.Column(db.String(50), primary_key=True)
     title = db.Column(db.String(200))
-    messages = db.Column(db.JSON)
+    # 旧版本把整个消息数组存在这一列，迁移后为NULL，消息存储在conversation_message表
+    legacy_messages = db.Column('messages', db.JSON)
     system_prompt = db.Column(db.Text)  # 添加系统提示词字段
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
@@ -12,17 +120,416 @@ class Conversation(db.Model):
     temperature = db.Column(db.Float, default=0.7)
     max_tokens = db.Column(db.Integer, default=4096)
     reasoning_effort = db.Column(db.String(20), default='high')  # 添加思考力度字段，默认为high
+    # 列表页使用的摘要字段，保存消息时维护，列表页不需要读取消息
+    message_count = db.Column(db.Integer, default=0)
+    last_model = db.Column(db.String(100))
+
+    # 每次写入对话行时由SQLAlchemy递增，用于增量同步时拒绝基于旧版本的修改
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    __mapper_args__ = {'version_id_col': version}
+
+    # 列表页只查询这些列
+    SUMMARY_COLUMNS = ('id', 'title', 'updated_at', 'message_count', 'last_model')
+    # 增量同步中可以修改的对话字段（前端字段名 -> 模型属性）
+    PATCHABLE_FIELDS = {
+        'title': 'title',
+        'systemPrompt': 'system_prompt',
+        'temperature': 'temperature',
+        'max_tokens': 'max_tokens',
+        'reasoning_effort': 'reasoning_effort'
+    }
+
+    def __init__(self, messages: Optional[List[Dict]] = None, **kwargs):
+        super().__init__(**kwargs)
+        # 新对话的消息在flush时写入消息表
+        self._pending_messages = messages
+        self.message_count = len(messages or [])
+        self.last_model = last_model_id(messages)
+
+    @property
+    def messages(self) -> List[Dict]:
+        """按需组装消息列表，只在第一次访问时查询消息表"""
+        cached = getattr(self, '_messages_cache', None)
+        if cached is not None:
+            return cached
+        pending = getattr(self, '_pending_messages', None)
+        if pending is not None:
+            return pending
+        if self.legacy_messages is not None:
+            messages = self.legacy_messages
+        else:
+            rows = ConversationMessage.query.filter_by(conversation_id=self.id)\
+                .order_by(ConversationMessage.seq).all()
+            messages = [row.to_message() for row in rows]
+        self._messages_cache = messages
+        return messages
+
+    @messages.setter
+    def messages(self, messages: List[Dict]):
+        self.sync_messages(messages)
+
+    def sync_messages(self, messages: List[Dict]) -> Dict[str, int]:
+        """
+        把前端提交的完整消息列表同步到消息表，只写入变化的行
+
+        - 新增的消息追加插入
+        - 内容哈希变化的消息原位更新
+        - 超出新列表长度的消息（如重新生成时截断）被删除
+
+        Returns:
+            Dict[str, int]: 插入、更新、删除的行数
+        """
+        messages = messages or []
+        self._messages_cache = None
+        self._pending_messages = None
+        stats = {'inserted': 0, 'updated': 0, 'deleted': 0}
+
+        if self.legacy_messages is not None:
+            # 尚未迁移的对话，在第一次保存时拆分为消息行
+            self.legacy_messages = None
+            existing = []
+        else:
+            # 只查询比较所需的列，不加载消息内容
+            existing = db.session.query(
+                ConversationMessage.id, ConversationMessage.seq, ConversationMessage.content_hash
+            ).filter(ConversationMessage.conversation_id == self.id)\
+                .order_by(ConversationMessage.seq).all()
+
+        to_insert, to_update = [], []
+        for seq, message in enumerate(messages):
+            row = ConversationMessage.row_from_message(self.id, seq, message)
+            if seq < len(existing):
+                if existing[seq].content_hash != row['content_hash']:
+                    row['id'] = existing[seq].id
+                    del row['created_at']
+                    to_update.append(row)
+            else:
+                to_insert.append(row)
+
+        if len(existing) > len(messages):
+            conversation_search.remove_messages(db.session, self.id, len(messages))
+            attachment_registry.untrack_messages(db.session, self.id, len(messages))
+            stats['deleted'] = ConversationMessage.query.filter(
+                ConversationMessage.conversation_id == self.id,
+                ConversationMessage.seq >= len(messages)
+            ).delete(synchronize_session=False)
+        if to_update:
+            db.session.bulk_update_mappings(ConversationMessage, to_update)
+            changed_rows = [(row['id'], row['seq'], messages[row['seq']]) for row in to_update]
+            conversation_search.index_messages(db.session, self.user_id, self.id, changed_rows)
+            attachment_registry.track_messages(db.session, self.user_id, self.id, changed_rows)
+            stats['updated'] = len(to_update)
+        if to_insert:
+            db.session.bulk_insert_mappings(ConversationMessage, to_insert)
+            conversation_search.index_new_messages(db.session, self.user_id, self.id, len(existing),
+                                                   messages[len(existing):])
+            attachment_registry.track_new_messages(db.session, self.user_id, self.id, len(existing),
+                                                   messages[len(existing):])
+            stats['inserted'] = len(to_insert)
+
+        if any(stats.values()):
+            # 只有消息变化时对话行本身可能没有变化，手动刷新更新时间
+            self.updated_at = datetime.now(timezone.utc)
+            self.message_count = len(messages)
+            self.last_model = last_model_id(messages)
+        self._messages_cache = list(messages)
+        return stats
 
+    def _split_legacy_messages(self) -> None:
+        """尚未迁移的对话在第一次增量修改前拆分为消息行"""
+        if self.legacy_messages is None:
+            return
+        messages = self.legacy_messages
+        self.legacy_messages = None
+        rows = [ConversationMessage.row_from_message(self.id, seq, message)
+                for seq, message in enumerate(messages)]
+        if rows:
+            db.session.bulk_insert_mappings(ConversationMessage, rows)
+            conversation_search.index_new_messages(db.session, self.user_id, self.id, 0, messages)
+            attachment_registry.track_new_messages(db.session, self.user_id, self.id, 0, messages)
+        self.message_count = len(messages)
 
-    def to_dict(self):
-        return {
+    def _current_message_count(self) -> int:
+        if self.message_count is None:
+            self.message_count = ConversationMessage.query.filter_by(conversation_id=self.id).count()
+        return self.message_count
+
+    def _refresh_last_model(self) -> None:
+        """从最后的助手消息开始向前查找使用的模型"""
+        self.last_model = None
+        rows = ConversationMessage.query.filter_by(conversation_id=self.id, role='assistant')\
+            .order_by(ConversationMessage.seq.desc()).yield_per(20)
+        for row in rows:
+            model_id = row.to_message().get('modelId')
+            if model_id:
+                self.last_model = model_id
+                break
+
+    def _touch(self) -> None:
+        self._messages_cache = None
+        self.updated_at = datetime.now(timezone.utc)
+
+    def append_messages(self, messages: List[Dict]) -> int:
+        """在对话末尾追加消息，不读取已有消息"""
+        if not messages:
+            return 0
+        self._split_legacy_messages()
+        start = self._current_message_count()
+        rows = [ConversationMessage.row_from_message(self.id, start + i, message)
+                for i, message in enumerate(messages)]
+        db.session.bulk_insert_mappings(ConversationMessage, rows)
+        conversation_search.index_new_messages(db.session, self.user_id, self.id, start, messages)
+        attachment_registry.track_new_messages(db.session, self.user_id, self.id, start, messages)
+        self.message_count = start + len(rows)
+        model_id = last_model_id(messages)
+        if model_id:
+            self.last_model = model_id
+        self._touch()
+        return len(rows)
+
+    def replace_message(self, seq: int, message: Dict) -> bool:
+        """
+        替换第seq条消息
+
+        Returns:
+            bool: 内容是否发生变化
+
+        Raises:
+            IndexError: seq超出范围
+        """
+        self._split_legacy_messages()
+        if not 0 <= seq < self._current_message_count():
+            raise IndexError(f"消息序号超出范围: {seq}")
+        row = ConversationMessage.row_from_message(self.id, seq, message)
+        existing = db.session.query(ConversationMessage.id, ConversationMessage.content_hash)\
+            .filter_by(conversation_id=self.id, seq=seq).first()
+        if existing is None:
+            raise IndexError(f"消息序号超出范围: {seq}")
+        if existing.content_hash == row['content_hash']:
+            return False
+        row['id'] = existing.id
+        del row['created_at']
+        db.session.bulk_update_mappings(ConversationMessage, [row])
+        conversation_search.index_messages(db.session, self.user_id, self.id, [(existing.id, seq, message)])
+        attachment_registry.track_messages(db.session, self.user_id, self.id, [(existing.id, seq, message)])
+        if message.get('role') == 'assistant' or seq == self.message_count - 1:
+            self._refresh_last_model()
+        self._touch()
+        return True
+
+    def truncate_messages(self, length: int) -> int:
+        """只保留前length条消息，返回删除的条数"""
+        if length < 0:
+            raise IndexError(f"消息数量不能为负数: {length}")
+        self._split_legacy_messages()
+        conversation_search.remove_messages(db.session, self.id, length)
+        attachment_registry.untrack_messages(db.session, self.id, length)
+        deleted = ConversationMessage.query.filter(
+            ConversationMessage.conversation_id == self.id,
+            ConversationMessage.seq >= length
+        ).delete(synchronize_session=False)
+        if deleted:
+            self.message_count = min(self._current_message_count(), length)
+            self._refresh_last_model()
+            self._touch()
+        return deleted
+
+    def apply_ops(self, ops: List[Dict]) -> Dict[str, int]:
+        """
+        按顺序应用增量修改
+
+        支持的操作:
+            {'op': 'append', 'messages': [...]}
+            {'op': 'replace', 'seq': N, 'message': {...}}
+            {'op': 'truncate', 'length': N}
+            {'op': 'set', 'fields': {'title': ..., 'systemPrompt': ..., ...}}
+
+        Raises:
+            ValueError: 操作格式错误或序号越界
+        """
+        stats = {'appended': 0, 'replaced': 0, 'deleted': 0, 'fields': 0}
+        for op in ops or []:
+            kind = op.get('op') if isinstance(op, dict) else None
+            try:
+                if kind == 'append':
+                    messages = op.get('messages')
+                    if not isinstance(messages, list):
+                        raise ValueError("append操作需要messages列表")
+                    stats['appended'] += self.append_messages(messages)
+                elif kind == 'replace':
+                    message = op.get('message')
+                    if not isinstance(message, dict):
+                        raise ValueError("replace操作需要message对象")
+                    if self.replace_message(int(op['seq']), message):
+                        stats['replaced'] += 1
+                elif kind == 'truncate':
+                    stats['deleted'] += self.truncate_messages(int(op['length']))
+                elif kind == 'set':
+                    fields = op.get('fields') or {}
+                    for name, value in fields.items():
+                        attr = self.PATCHABLE_FIELDS.get(name)
+                        if attr is None:
+                            raise ValueError(f"不支持修改的字段: {name}")
+                        if value is not None and getattr(self, attr) != value:
+                            setattr(self, attr, value)
+                            stats['fields'] += 1
+                    if stats['fields']:
+                        self._touch()
+                else:
+                    raise ValueError(f"不支持的操作: {kind}")
+            except (KeyError, TypeError, IndexError) as e:
+                raise ValueError(f"无效的{kind}操作: {e}") from e
+        return stats
+
+    def get_message_window(self, before: Optional[int] = None, limit: int = 50) -> Tuple[int, List[Dict]]:
+        """
+        读取一段连续的消息，用于按需加载长对话
+
+        Args:
+            before: 只返回seq小于该值的消息，默认从最新的消息开始
+            limit: 最多返回的消息数
+
+        Returns:
+            Tuple[int, List[Dict]]: (第一条消息的seq, 按seq升序排列的消息)
+        """
+        if self.legacy_messages is not None:
+            end = len(self.legacy_messages) if before is None else min(before, len(self.legacy_messages))
+            start = max(end - limit, 0)
+            return start, self.legacy_messages[start:end]
+
+        query = ConversationMessage.query.filter(ConversationMessage.conversation_id == self.id)
+        if before is not None:
+            query = query.filter(ConversationMessage.seq < before)
+        # 倒序取最新的limit条，再恢复为正序
+        rows = query.order_by(ConversationMessage.seq.desc()).limit(limit).all()
+        rows.reverse()
+        start = rows[0].seq if rows else (before if before is not None else 0)
+        return start, [row.to_message() for row in rows]
+
+    @classmethod
+    def summary_page(cls, user_id: int, limit: int = 50, cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """
+        按更新时间倒序分页列出对话摘要，只查询摘要所需的列
+
+        Args:
+            user_id: 用户ID
+            limit: 每页条数
+            cursor: 上一页返回的游标，为空时从第一页开始
+
+        Returns:
+            Tuple[List[Dict], Optional[str]]: (对话摘要列表, 下一页的游标，没有更多时为None)
+        """
+        columns = [getattr(cls, name) for name in cls.SUMMARY_COLUMNS]
+        query = db.session.query(*columns).filter(cls.user_id == user_id)
+        if cursor:
+            updated_at, conversation_id = decode_cursor(cursor)
+            query = query.filter(db.or_(
+                cls.updated_at < updated_at,
+                db.and_(cls.updated_at == updated_at, cls.id < conversation_id)
+            ))
+        # 多取一条判断是否还有下一页
+        rows = query.order_by(cls.updated_at.desc(), cls.id.desc()).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        summaries = [{
+            'id': row.id,
+            'title': row.title,
+            'updated_at': row.updated_at.isoformat() if row.updated_at else None,
+            'message_count': row.message_count or 0,
+            'last_model': row.last_model
+        } for row in rows]
+        next_cursor = encode_cursor(rows[-1].updated_at, rows[-1].id) if has_more and rows else None
+        return summaries, next_cursor
+
+    def delete_messages(self) -> int:
+        """删除对话的全部消息行"""
+        self._messages_cache = None
+        conversation_search.remove_messages(db.session, self.id)
+        attachment_registry.untrack_messages(db.session, self.id)
+        return ConversationMessage.query.filter_by(conversation_id=self.id).delete(synchronize_session=False)
+
+    @classmethod
+    def preload_messages(cls, conversations: List['Conversation']) -> None:
+        """一次查询加载多个对话的消息，避免逐个对话查询"""
+        pending = {c.id: c for c in conversations
+                   if c.legacy_messages is None and getattr(c, '_messages_cache', None) is None}
+        if not pending:
+            return
+        grouped = {conversation_id: [] for conversation_id in pending}
+        rows = ConversationMessage.query.filter(ConversationMessage.conversation_id.in_(list(pending)))\
+            .order_by(ConversationMessage.conversation_id, ConversationMessage.seq).all()
+        for row in rows:
+            grouped[row.conversation_id].append(row.to_message())
+        for conversation_id, messages in grouped.items():
+            pending[conversation_id]._messages_cache = messages
+
+    def to_dict(self, include_messages: bool = True):
+        data = {
             'id': self.id,
             'title': self.title,
-            'messages': self.messages,
             'systemPrompt': self.system_prompt,  # 添加系统提示词到返回的字典中
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat(),
             'temperature': self.temperature,
             'max_tokens': self.max_tokens,
-            'reasoning_effort': self.reasoning_effort  # 添加思考力度到返回的字典中
-        }
\ No newline at end of file
+            'reasoning_effort': self.reasoning_effort,  # 添加思考力度到返回的字典中
+            'version': self.version
+        }
+        if include_messages:
+            data['messages'] = self.messages
+        return data
+
+
+@event.listens_for(Conversation, 'after_insert')
+def _insert_pending_messages(mapper, connection, target):
+    """新对话插入后写入其消息行，并建立全文索引和附件引用"""
+    conversation_search.index_header(connection, target.user_id, target.id, target.title, target.system_prompt)
+    pending = getattr(target, '_pending_messages', None)
+    if not pending:
+        return
+    rows = [ConversationMessage.row_from_message(target.id, seq, message)
+            for seq, message in enumerate(pending)]
+    connection.execute(ConversationMessage.__table__.insert(), [
+        {('metadata' if k == 'meta' else k): v for k, v in row.items()} for row in rows
+    ])
+    conversation_search.index_new_messages(connection, target.user_id, target.id, 0, pending)
+    attachment_registry.track_new_messages(connection, target.user_id, target.id, 0, pending)
+    target._messages_cache = list(pending)
+    target._pending_messages = None
+
+
+@event.listens_for(Conversation, 'after_update')
+def _reindex_header(mapper, connection, target):
+    """标题或系统提示词变化时更新全文索引"""
+    state = db.inspect(target)
+    if state.attrs.title.history.has_changes() or state.attrs.system_prompt.history.has_changes():
+        conversation_search.index_header(connection, target.user_id, target.id, target.title, target.system_prompt)
+
+
+@event.listens_for(Conversation, 'after_delete')
+def _remove_header(mapper, connection, target):
+    conversation_search.remove_header(connection, target.id)
+
+
+def make_etag(version: int) -> str:
+    """对话版本对应的ETag"""
+    return f'"v{version}"'
+
+
+def parse_etag(value: Optional[str]) -> Optional[int]:
+    """解析If-Match中的版本号，格式错误时返回None"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.startswith('W/'):
+        value = value[2:]
+    value = value.strip('"')
+    if value.startswith('v'):
+        value = value[1:]
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
@@ -0,0 +1,345 @@
+import re
+import html
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import text
+
+from initialization import db
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+# 对话标题/系统提示词在全文索引中的文档ID（FTS5的rowid必须是整数，对话ID是字符串）
+class ConversationSearchDoc(db.Model):
+    __tablename__ = 'conversation_search_doc'
+
+    id = db.Column(db.Integer, primary_key=True)
+    conversation_id = db.Column(db.String(50), nullable=False, unique=True)
+
+
+class ConversationSearchIndex:
+    """
+    基于SQLite FTS5的对话全文索引
+
+    - 每条消息一行，rowid为conversation_message.id；每个对话另有一行标题和系统提示词，rowid为负的文档ID
+    - 使用trigram分词，中文不需要分词也能按子串搜索
+    - trigram无法索引少于3个字符的词（中文里很常见），另建一张单字/双字索引表，rowid与主表相同，
+      短词通过它检索和排序，命中后从主表读取原文生成高亮片段
+    - owner列保存定长的用户标记，查询时先按用户缩小范围
+    - 索引与消息在同一个事务中写入，保存对话时增量维护
+    """
+
+    TABLE = 'conversation_fts'
+    # 短词索引表，不保存原文（SQLite低于3.43不支持contentless_delete时退回保存内容的普通表）
+    GRAM_TABLE = 'conversation_fts_gram'
+    # 标题匹配的权重高于正文
+    TITLE_WEIGHT = 10.0
+    BODY_WEIGHT = 1.0
+    # 单次查询最多参与排序的命中行数，常见词不会拖慢查询
+    MAX_HITS = 5000
+    # trigram分词能索引的最短词长
+    MIN_INDEXED_TERM = 3
+    # 短词命中时由Python生成的片段长度（字符数）和命中位置之前保留的字符数
+    SNIPPET_CHARS = 64
+    SNIPPET_LEAD = 16
+    # 高亮标记，先用私有区字符占位，转义正文后再替换为<mark>
+    _OPEN, _CLOSE = '\ue000', '\ue001'
+
+    def __init__(self):
+        self._ready = False
+        self._tokenizer = None
+        self._lock = threading.Lock()
+
+    def ensure_schema(self, executor) -> None:
+        """创建FTS5虚拟表（已存在时跳过），SQLite低于3.34时没有trigram分词器，退回unicode61"""
+        if self._ready:
+            return
+        with self._lock:
+            if self._ready:
+                return
+            for tokenizer in ('trigram', 'unicode61'):
+                try:
+                    executor.execute(text(
+                        f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.TABLE} USING fts5("
+                        f"owner, title, body, conversation_id UNINDEXED, seq UNINDEXED, tokenize='{tokenizer}')"
+                    ))
+                    self._tokenizer = tokenizer
+                    break
+                except Exception as e:
+                    logger.warning("创建全文索引(%s)失败: %s", tokenizer, e)
+            else:
+                raise RuntimeError("当前SQLite不支持FTS5，无法创建对话全文索引")
+            for options in (", content='', contentless_delete=1", ''):
+                try:
+                    executor.execute(text(
+                        f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.GRAM_TABLE} USING fts5("
+                        f"owner, title, body{options})"
+                    ))
+                    break
+                except Exception as e:
+                    logger.warning("创建短词索引失败，改为保存内容的索引表: %s", e)
+            self._ready = True
+
+    @staticmethod
+    def owner_token(user_id: int) -> str:
+        """定长的用户标记，trigram下不会与其它用户的标记部分匹配"""
+        return f"u{int(user_id):010d}"
+
+    @staticmethod
+    def message_text(message: Dict) -> str:
+        """提取消息中需要索引的文本"""
+        content = message.get('content')
+        if isinstance(content, str):
+            return content
+        if isinstance(content, list):
+            return '\n'.join(item.get('text', '') for item in content
+                             if isinstance(item, dict) and item.get('type') == 'text')
+        return ''
+
+    @staticmethod
+    def gram_text(value: Optional[str]) -> str:
+        """
+        把文本转换为单字和相邻双字的标记，写入短词索引
+
+        标记为字符码位的十六进制编码，不受分词器对中文和标点的切分影响；空白不参与组合，
+        与按空白拆分的查询词一致
+        """
+        chars = (value or '').lower()
+        tokens = []
+        for i, char in enumerate(chars):
+            if char.isspace():
+                continue
+            tokens.append(f"u{ord(char):06x}")
+            if i + 1 < len(chars) and not chars[i + 1].isspace():
+                tokens.append(f"b{ord(char):06x}{ord(chars[i + 1]):06x}")
+        return ' '.join(tokens)
+
+    def _write_rows(self, executor, params: List[Dict[str, Any]]) -> None:
+        """替换主表和短词索引中的行，params中的title和body为原文"""
+        rowids = [{'rowid': p['rowid']} for p in params]
+        executor.execute(text(f"DELETE FROM {self.TABLE} WHERE rowid = :rowid"), rowids)
+        executor.execute(text(f"DELETE FROM {self.GRAM_TABLE} WHERE rowid = :rowid"), rowids)
+        executor.execute(text(
+            f"INSERT INTO {self.TABLE}(rowid, owner, title, body, conversation_id, seq) "
+            f"VALUES (:rowid, :owner, :title, :body, :conversation_id, :seq)"
+        ), params)
+        executor.execute(text(
+            f"INSERT INTO {self.GRAM_TABLE}(rowid, owner, title, body) VALUES (:rowid, :owner, :title, :body)"
+        ), [{'rowid': p['rowid'], 'owner': p['owner'], 'title': self.gram_text(p['title']),
+             'body': self.gram_text(p['body'])} for p in params])
+
+    def index_messages(self, executor, user_id: int, conversation_id: str,
+                       rows: Iterable[Tuple[int, int, Dict]]) -> None:
+        """
+        写入或替换消息的索引
+
+        Args:
+            rows: (消息行ID, seq, 消息) 列表
+        """
+        params = [{
+            'rowid': row_id,
+            'owner': self.owner_token(user_id),
+            'title': '',
+            'body': self.message_text(message),
+            'conversation_id': conversation_id,
+            'seq': seq
+        } for row_id, seq, message in rows]
+        if not params:
+            return
+        self.ensure_schema(executor)
+        self._write_rows(executor, params)
+
+    def index_new_messages(self, executor, user_id: int, conversation_id: str, start_seq: int,
+                           messages: List[Dict]) -> None:
+        """为刚插入的消息（seq从start_seq开始）建立索引，消息行ID从数据库中读取"""
+        if not messages:
+            return
+        ids = executor.execute(text(
+            "SELECT id, seq FROM conversation_message WHERE conversation_id = :cid AND seq >= :start"
+        ), {'cid': conversation_id, 'start': start_seq}).fetchall()
+        rows = [(row_id, seq, messages[seq - start_seq]) for row_id, seq in ids
+                if 0 <= seq - start_seq < len(messages)]
+        self.index_messages(executor, user_id, conversation_id, rows)
+
+    def remove_messages(self, executor, conversation_id: str, from_seq: int = 0) -> None:
+        """删除seq >= from_seq的消息索引，需要在删除消息行之前调用"""
+        self.ensure_schema(executor)
+        for table in (self.TABLE, self.GRAM_TABLE):
+            executor.execute(text(
+                f"DELETE FROM {table} WHERE rowid IN "
+                f"(SELECT id FROM conversation_message WHERE conversation_id = :cid AND seq >= :seq)"
+            ), {'cid': conversation_id, 'seq': from_seq})
+
+    def index_header(self, executor, user_id: int, conversation_id: str, title: Optional[str],
+                     system_prompt: Optional[str]) -> None:
+        """写入或替换对话标题和系统提示词的索引"""
+        self.ensure_schema(executor)
+        executor.execute(text(
+            "INSERT OR IGNORE INTO conversation_search_doc (conversation_id) VALUES (:cid)"
+        ), {'cid': conversation_id})
+        doc_id = executor.execute(text(
+            "SELECT id FROM conversation_search_doc WHERE conversation_id = :cid"
+        ), {'cid': conversation_id}).scalar()
+        self._write_rows(executor, [{'rowid': -doc_id, 'owner': self.owner_token(user_id), 'title': title or '',
+                                     'body': system_prompt or '', 'conversation_id': conversation_id, 'seq': -1}])
+
+    def remove_header(self, executor, conversation_id: str) -> None:
+        """删除对话标题的索引和文档ID"""
+        self.ensure_schema(executor)
+        doc_id = executor.execute(text(
+            "SELECT id FROM conversation_search_doc WHERE conversation_id = :cid"
+        ), {'cid': conversation_id}).scalar()
+        if doc_id is None:
+            return
+        for table in (self.TABLE, self.GRAM_TABLE):
+            executor.execute(text(f"DELETE FROM {table} WHERE rowid = :rowid"), {'rowid': -doc_id})
+        executor.execute(text("DELETE FROM conversation_search_doc WHERE id = :id"), {'id': doc_id})
+
+    @classmethod
+    def _build_query(cls, query: str) -> Tuple[Optional[str], Optional[str], List[str]]:
+        """
+        把用户输入拆分为主表和短词索引的FTS5查询
+
+        Returns:
+            Tuple[Optional[str], Optional[str], List[str]]: (主表的MATCH表达式, 短词索引的MATCH表达式, 全部查询词)
+        """
+        phrases, grams, terms = [], [], []
+        for term in query.split():
+            terms.append(term)
+            if len(term) >= cls.MIN_INDEXED_TERM:
+                # 作为短语查询，双引号需要转义，避免用户输入被解析为FTS5语法
+                phrases.append('"' + term.replace('"', '""') + '"')
+            else:
+                # 短词的标记与gram_text一致：两个字符查双字标记，单个字符查单字标记
+                grams.append(cls.gram_text(term).split()[-1])
+        match = ' AND '.join(f"{{title body}}:{phrase}" for phrase in phrases) or None
+        gram_match = ' AND '.join(f"{{title body}}:{gram}" for gram in grams) or None
+        return match, gram_match, terms
+
+    def _highlight(self, value: Optional[str]) -> str:
+        escaped = html.escape(value or '')
+        return escaped.replace(self._OPEN, '<mark>').replace(self._CLOSE, '</mark>')
+
+    def _mark_terms(self, value: str, pattern: 're.Pattern', snippet: bool = False) -> str:
+        """在原文中标记查询词（短词命中时FTS5的highlight/snippet无法使用），snippet为True时只截取第一处命中附近"""
+        value = value or ''
+        if snippet:
+            first = pattern.search(value)
+            start = max(0, first.start() - self.SNIPPET_LEAD) if first else 0
+            end = min(len(value), start + self.SNIPPET_CHARS)
+            value = ('…' if start > 0 else '') + value[start:end] + ('…' if end < len(value) else '')
+        marked = pattern.sub(lambda m: self._OPEN + m.group(0) + self._CLOSE, value)
+        return self._highlight(marked)
+
+    def search(self, user_id: int, query: str, limit: int = 20, offset: int = 0) -> Tuple[List[Dict[str, Any]], bool]:
+        """
+        搜索用户的对话，每个对话只返回得分最高的一处命中
+
+        包含短词时由短词索引检索和排序（长词在主表中过滤同一行），片段和高亮在Python中生成
+
+        Returns:
+            Tuple[List[Dict], bool]: (结果列表, 是否还有更多结果)
+        """
+        match, gram_match, terms = self._build_query(query)
+        if not match and not gram_match:
+            return [], False
+        self.ensure_schema(db.session)
+
+        owner = f'owner:"{self.owner_token(user_id)}"'
+        params = {
+            'open': self._OPEN,
+            'close': self._CLOSE,
+            'max_hits': self.MAX_HITS,
+            'user_id': user_id,
+            'limit': limit + 1,
+            'offset': offset
+        }
+        if gram_match:
+            params['gram_match'] = f"{owner} AND {gram_match}"
+            extra = ''
+            if match:
+                params['match'] = f"{owner} AND {match}"
+                extra = f" AND rowid IN (SELECT rowid FROM {self.TABLE} WHERE {self.TABLE} MATCH :match)"
+            hits = f"""
+                SELECT rowid AS doc_rowid, NULL AS snippet, NULL AS title_highlight,
+                       bm25({self.GRAM_TABLE}, 0.0, {self.TITLE_WEIGHT}, {self.BODY_WEIGHT}) AS score
+                FROM {self.GRAM_TABLE}
+                WHERE {self.GRAM_TABLE} MATCH :gram_match{extra}
+            """
+        else:
+            params['match'] = f"{owner} AND {match}"
+            hits = f"""
+                SELECT rowid AS doc_rowid,
+                       snippet({self.TABLE}, 2, :open, :close, '…', 24) AS snippet,
+                       highlight({self.TABLE}, 1, :open, :close) AS title_highlight,
+                       bm25({self.TABLE}, 0.0, {self.TITLE_WEIGHT}, {self.BODY_WEIGHT}) AS score
+                FROM {self.TABLE}
+                WHERE {self.TABLE} MATCH :match
+            """
+
+        sql = f"""
+            WITH hits AS (
+                {hits}
+                ORDER BY score
+                LIMIT :max_hits
+            ), located AS (
+                SELECT h.*, f.conversation_id, f.seq
+                FROM hits h JOIN {self.TABLE} f ON f.rowid = h.doc_rowid
+            ), ranked AS (
+                SELECT *,
+                       ROW_NUMBER() OVER (PARTITION BY conversation_id ORDER BY score) AS rn,
+                       COUNT(*) OVER (PARTITION BY conversation_id) AS hit_count
+                FROM located
+            )
+            SELECT r.doc_rowid, r.conversation_id, r.seq, r.snippet, r.title_highlight, r.score, r.hit_count,
+                   c.title, c.updated_at
+            FROM ranked r JOIN conversation c ON c.id = r.conversation_id
+            WHERE r.rn = 1 AND c.user_id = :user_id
+            ORDER BY r.score
+            LIMIT :limit OFFSET :offset
+        """
+        rows = db.session.execute(text(sql), params).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        documents = {}
+        pattern = None
+        if gram_match and rows:
+            # 只读取本页结果的原文生成片段
+            placeholders = ', '.join(f':r{i}' for i in range(len(rows)))
+            documents = {row.rowid: row for row in db.session.execute(text(
+                f"SELECT rowid, title, body FROM {self.TABLE} WHERE rowid IN ({placeholders})"
+            ), {f'r{i}': row.doc_rowid for i, row in enumerate(rows)})}
+            pattern = re.compile('|'.join(re.escape(term) for term in sorted(terms, key=len, reverse=True)),
+                                 re.IGNORECASE)
+
+        results = []
+        for row in rows:
+            if pattern is not None:
+                document = documents.get(row.doc_rowid)
+                title_highlight = self._mark_terms(document.title, pattern) if document and document.title else None
+                snippet = self._mark_terms(document.body, pattern, snippet=True) if document else ''
+            else:
+                title_highlight = self._highlight(row.title_highlight) if row.title_highlight else None
+                snippet = self._highlight(row.snippet)
+            updated_at = row.updated_at
+            results.append({
+                'conversation_id': row.conversation_id,
+                'title': row.title,
+                'title_highlight': title_highlight or html.escape(row.title or ''),
+                # seq为-1表示命中的是标题或系统提示词
+                'seq': row.seq if row.seq is not None and row.seq >= 0 else None,
+                'snippet': snippet,
+                'hits': row.hit_count,
+                'score': -row.score,
+                # 原生SQL查询返回SQLite中存储的字符串，统一为isoformat格式
+                'updated_at': updated_at.isoformat() if hasattr(updated_at, 'isoformat')
+                else (updated_at.replace(' ', 'T') if updated_at else None)
+            })
+        return results, has_more
+
+
+# 创建全局实例
+conversation_search = ConversationSearchIndex()
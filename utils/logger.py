@@ -0,0 +1,151 @@
+import os
+import logging
+import threading
+from typing import Any, Dict
+
+# 日志格式
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(name)s] %(message)s'
+# 未单独配置的模块使用的级别
+DEFAULT_LOG_LEVEL = 'INFO'
+# 各模块的默认级别，可以在config.py的LOG_LEVELS或环境变量LOG_LEVELS中覆盖
+# 逐token的日志记录器名称以 .tokens 结尾，默认关闭
+DEFAULT_MODULE_LEVELS = {
+    'utils.chat.stream_processor': 'INFO',
+    'utils.chat.stream_processor.tokens': 'WARNING',
+}
+# 日志中单个字段的最大长度
+MAX_FIELD_LENGTH = 300
+# 逐token日志的采样间隔：每N个delta记录一次
+TOKEN_LOG_SAMPLE_EVERY = 50
+
+_setup_lock = threading.Lock()
+_configured = False
+
+
+def _parse_levels(raw: str) -> Dict[str, str]:
+    """解析 "模块=级别,模块=级别" 格式的配置"""
+    levels = {}
+    for item in raw.split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging() -> None:
+    """
+    初始化日志系统，只执行一次
+
+    级别的优先级：环境变量 > config.py > DEFAULT_MODULE_LEVELS
+    - LOG_LEVEL: 全局级别，例如 DEBUG
+    - LOG_LEVELS: 模块级别，例如 "utils.chat.stream_processor=DEBUG,app=WARNING"
+    """
+    global _configured
+    if _configured:
+        return
+    with _setup_lock:
+        if _configured:
+            return
+        try:
+            import config
+        except ImportError:
+            config = None
+
+        root_level = os.environ.get('LOG_LEVEL') or getattr(config, 'LOG_LEVEL', DEFAULT_LOG_LEVEL)
+        module_levels = dict(DEFAULT_MODULE_LEVELS)
+        module_levels.update(getattr(config, 'LOG_LEVELS', {}) or {})
+        module_levels.update(_parse_levels(os.environ.get('LOG_LEVELS', '')))
+
+        root = logging.getLogger()
+        if not root.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter(LOG_FORMAT))
+            root.addHandler(handler)
+        root.setLevel(str(root_level).upper())
+        for name, level in module_levels.items():
+            logging.getLogger(name).setLevel(str(level).upper())
+        _configured = True
+
+
+def get_logger(name: str) -> logging.Logger:
+    """获取模块的日志记录器，一般传入 __name__"""
+    setup_logging()
+    return logging.getLogger(name)
+
+
+def _shorten(value: Any, limit: int, depth: int = 0) -> Any:
+    """截断字符串，把base64等大字段替换为长度说明"""
+    if isinstance(value, str):
+        if value.startswith('data:') and ';base64,' in value[:100]:
+            return f"<{value[:value.index(';')]} base64 {len(value)}字符>"
+        if len(value) > limit:
+            return f"{value[:limit]}...<共{len(value)}字符>"
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        return f"<{len(value)}字节>"
+    if depth >= 4:
+        return '...'
+    if isinstance(value, dict):
+        shortened = {}
+        for key, item in value.items():
+            if key in ('data', 'base64') and isinstance(item, (str, bytes)) and len(item) > limit:
+                shortened[key] = f"<base64 {len(item)}字符>"
+            else:
+                shortened[key] = _shorten(item, limit, depth + 1)
+        return shortened
+    if isinstance(value, (list, tuple)):
+        items = [_shorten(item, limit, depth + 1) for item in value[:20]]
+        if len(value) > 20:
+            items.append(f"...<共{len(value)}项>")
+        return items
+    return value
+
+
+class Truncated:
+    """
+    延迟截断的日志参数
+
+    只有日志真正输出时才会调用__str__，级别关闭时不产生任何格式化开销。
+    """
+
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value: Any, limit: int = MAX_FIELD_LENGTH):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self) -> str:
+        text = str(_shorten(self.value, self.limit))
+        if len(text) > self.limit * 4:
+            text = f"{text[:self.limit * 4]}...<共{len(text)}字符>"
+        return text
+
+    __repr__ = __str__
+
+
+def truncate(value: Any, limit: int = MAX_FIELD_LENGTH) -> Truncated:
+    """包装需要截断的日志字段（消息、参数、工具结果等）"""
+    return Truncated(value, limit)
+
+
+class TokenLogSampler:
+    """
+    逐token日志的采样器
+
+    是否启用在创建时确定（每个流创建一个），关闭时log()只做一次属性判断。
+    """
+
+    __slots__ = ('logger', 'enabled', 'every', 'count')
+
+    def __init__(self, name: str, every: int = TOKEN_LOG_SAMPLE_EVERY):
+        self.logger = get_logger(name + '.tokens')
+        self.enabled = self.logger.isEnabledFor(logging.DEBUG)
+        self.every = max(1, every)
+        self.count = 0
+
+    def log(self, kind: str, text: str) -> None:
+        if not self.enabled:
+            return
+        self.count += 1
+        if self.count % self.every == 1 or self.every == 1:
+            self.logger.debug("%s #%d: %s", kind, self.count, Truncated(text, 80))
@@ -0,0 +1,163 @@
+import json
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from initialization import db
+from utils.logger import get_logger
+from utils.sqlite_writer import retry_on_locked
+
+logger = get_logger(__name__)
+
+
+# 维护任务的断点，与每批的修改在同一事务中提交，中断后从最后提交的批次继续
+class MaintenanceCheckpoint(db.Model):
+    __tablename__ = 'maintenance_checkpoint'
+
+    name = db.Column(db.String(100), primary_key=True)
+    last_key = db.Column(db.Text)  # 最后处理的键（JSON）
+    processed = db.Column(db.Integer, default=0)
+    changed = db.Column(db.Integer, default=0)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+
+class BatchRunner:
+    """
+    大表维护任务的分批执行
+
+    - 按键分页（WHERE key > 上一批最后的键 ORDER BY key LIMIT n），每批查询的开销与表大小无关
+    - 每批读取后整体交给process_batch，处理完立即提交并清空会话，内存占用只与批大小有关
+    - 断点与批次的修改在同一事务中保存，中断后重新运行从下一批继续
+    - 每批输出进度、速度和预计剩余时间
+
+    用法:
+        runner = BatchRunner('fill_defaults', batch_size=500)
+        runner.run(query, Conversation.id, process_batch)
+
+    process_batch接收一批行（按键升序），在db.session上做修改，返回修改的行数；提交由BatchRunner负责。
+    """
+
+    DEFAULT_BATCH_SIZE = 500
+
+    def __init__(self, name: str, batch_size: int = DEFAULT_BATCH_SIZE, resume: bool = True,
+                 progress: Optional[Callable[[Dict[str, Any]], None]] = None):
+        self.name = name
+        self.batch_size = batch_size
+        self.resume = resume
+        self.progress = progress or self._log_progress
+
+    def _load_checkpoint(self) -> MaintenanceCheckpoint:
+        MaintenanceCheckpoint.__table__.create(db.engine, checkfirst=True)
+        checkpoint = db.session.get(MaintenanceCheckpoint, self.name)
+        if checkpoint is not None and self.resume and checkpoint.finished_at is None:
+            logger.info("任务 %s 从断点继续: 已处理 %d 条", self.name, checkpoint.processed or 0)
+            return checkpoint
+        if checkpoint is None:
+            checkpoint = MaintenanceCheckpoint(name=self.name)
+            db.session.add(checkpoint)
+        # 重新开始（未要求继续，或上次已经完成）
+        checkpoint.last_key = None
+        checkpoint.processed = 0
+        checkpoint.changed = 0
+        checkpoint.started_at = datetime.utcnow()
+        checkpoint.updated_at = checkpoint.started_at
+        checkpoint.finished_at = None
+        db.session.commit()
+        return checkpoint
+
+    def run(self, query, key_column, process_batch: Callable[[List[Any]], int],
+            count_total: bool = True) -> Dict[str, Any]:
+        """
+        分批处理query的全部结果
+
+        Args:
+            query: 未排序、未分页的Query，可以带过滤条件
+            key_column: 唯一且可排序的键列（通常是主键）
+            process_batch: 处理一批行的函数，返回修改的行数
+            count_total: 是否先统计剩余行数以便估算剩余时间
+
+        Returns:
+            Dict: processed（处理行数）、changed（修改行数）、batches、elapsed、rows_per_second
+        """
+        checkpoint = self._load_checkpoint()
+        last_key = json.loads(checkpoint.last_key) if checkpoint.last_key else None
+        remaining = None
+        if count_total:
+            pending = query if last_key is None else query.filter(key_column > last_key)
+            remaining = pending.order_by(None).count()
+        stats = {
+            'name': self.name,
+            'processed': 0,
+            'changed': 0,
+            'batches': 0,
+            'total': remaining,
+            'resumed_from': checkpoint.processed or 0
+        }
+        started = time.perf_counter()
+
+        while True:
+            batch_query = query if last_key is None else query.filter(key_column > last_key)
+            rows = batch_query.order_by(key_column).limit(self.batch_size).all()
+            if not rows:
+                break
+            batch_last_key = self._key_of(rows[-1], key_column)
+
+            def commit_batch():
+                changed = process_batch(rows) or 0
+                checkpoint_row = db.session.get(MaintenanceCheckpoint, self.name)
+                checkpoint_row.last_key = json.dumps(batch_last_key)
+                checkpoint_row.processed = (checkpoint_row.processed or 0) + len(rows)
+                checkpoint_row.changed = (checkpoint_row.changed or 0) + changed
+                checkpoint_row.updated_at = datetime.utcnow()
+                db.session.commit()
+                return changed
+
+            changed = retry_on_locked(commit_batch, on_retry=db.session.rollback)
+            # 释放已提交的对象，避免会话的标识映射随批次增长
+            db.session.expunge_all()
+            last_key = batch_last_key
+            stats['processed'] += len(rows)
+            stats['changed'] += changed
+            stats['batches'] += 1
+            self._report(stats, started)
+            if len(rows) < self.batch_size:
+                break
+
+        checkpoint = db.session.get(MaintenanceCheckpoint, self.name)
+        checkpoint.finished_at = datetime.utcnow()
+        db.session.commit()
+        stats['elapsed'] = round(time.perf_counter() - started, 3)
+        stats['rows_per_second'] = round(stats['processed'] / stats['elapsed'], 1) if stats['elapsed'] else None
+        logger.info("任务 %s 完成: 处理 %d 条，修改 %d 条，耗时 %.1f 秒",
+                    self.name, stats['processed'], stats['changed'], stats['elapsed'])
+        return stats
+
+    @staticmethod
+    def _key_of(row: Any, key_column) -> Any:
+        """读取行的键值（ORM对象或命名元组），键需要是整数或字符串以便保存到断点"""
+        name = key_column.key
+        return getattr(row, name) if hasattr(row, name) else row._mapping[key_column]
+
+    def _report(self, stats: Dict[str, Any], started: float) -> None:
+        elapsed = time.perf_counter() - started
+        rate = stats['processed'] / elapsed if elapsed > 0 else 0.0
+        progress = dict(stats, elapsed=elapsed, rows_per_second=rate)
+        if stats['total']:
+            left = max(stats['total'] - stats['processed'], 0)
+            progress['percent'] = min(100.0, stats['processed'] * 100.0 / stats['total'])
+            progress['eta'] = left / rate if rate > 0 else None
+        self.progress(progress)
+
+    @staticmethod
+    def _log_progress(progress: Dict[str, Any]) -> None:
+        if 'percent' in progress:
+            eta = progress.get('eta')
+            logger.info("[%s] 已处理 %d/%d (%.1f%%)，修改 %d 条，%.0f 条/秒，预计剩余 %s",
+                        progress['name'], progress['processed'], progress['total'], progress['percent'],
+                        progress['changed'], progress['rows_per_second'],
+                        f"{eta:.0f} 秒" if eta is not None else '未知')
+        else:
+            logger.info("[%s] 已处理 %d 条，修改 %d 条，%.0f 条/秒", progress['name'], progress['processed'],
+                        progress['changed'], progress['rows_per_second'])
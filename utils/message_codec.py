@@ -0,0 +1,237 @@
+import json
+import zlib
+import random
+import time
+import struct
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+from sqlalchemy import select
+
+from initialization import db
+from utils.logger import get_logger
+
+# zstandard为可选依赖，未安装时使用zlib（同样支持预置字典）
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import config
+except ImportError:
+    config = None
+
+logger = get_logger(__name__)
+
+# 序列化后超过该字节数的消息才压缩，短消息压缩收益小且会增加读取开销
+COMPRESSION_THRESHOLD = getattr(config, 'MESSAGE_COMPRESSION_THRESHOLD', 2048)
+# 压缩算法：auto（有zstandard时用zstd）、zstd、zlib、none
+COMPRESSION_CODEC = getattr(config, 'MESSAGE_COMPRESSION_CODEC', 'auto')
+COMPRESSION_LEVEL = getattr(config, 'MESSAGE_COMPRESSION_LEVEL', 6)
+# 重新检查是否有新训练的字典的间隔（秒），其它进程训练的字典无需重启即可生效
+DICTIONARY_REFRESH_INTERVAL = getattr(config, 'MESSAGE_DICTIONARY_REFRESH_INTERVAL', 300)
+
+CODEC_ZLIB = b'z'
+CODEC_ZSTD = b's'
+# 压缩数据头：算法(1字节) + 字典ID(4字节，0表示不使用字典)
+_HEADER = struct.Struct('>cI')
+# zlib的预置字典最多使用32KB
+ZLIB_MAX_DICT_SIZE = 32 * 1024
+
+
+# 压缩字典表，字典与消息存储在同一个数据库中，备份时不会丢失
+class MessageDictionary(db.Model):
+    __tablename__ = 'message_dictionary'
+
+    id = db.Column(db.Integer, primary_key=True)
+    codec = db.Column(db.String(10), nullable=False)  # zstd / zlib
+    data = db.Column(db.LargeBinary, nullable=False)
+    sample_count = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+
+def _encode_json(value: Any) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8', 'surrogatepass')
+
+
+class MessageCodec:
+    """
+    消息内容的透明压缩
+
+    - 序列化后超过阈值的消息整体压缩为一个二进制字段，其余消息保持JSON列不变
+    - 使用在本站消息语料上训练的字典（zstd字典或zlib预置字典），短小的消息也能获得较好的压缩率
+    - 压缩数据头记录算法和字典ID，更换字典后旧数据仍可解压
+    """
+
+    def __init__(self, threshold: int = COMPRESSION_THRESHOLD, codec: str = COMPRESSION_CODEC,
+                 level: int = COMPRESSION_LEVEL):
+        self.threshold = threshold
+        if codec == 'auto':
+            codec = 'zstd' if zstandard is not None else 'zlib'
+        if codec == 'zstd' and zstandard is None:
+            logger.warning("未安装zstandard，消息压缩改用zlib")
+            codec = 'zlib'
+        self.codec = codec
+        self.level = level
+        # 字典ID -> 字典数据，字典写入后不会修改
+        self._dictionaries: Dict[int, bytes] = {}
+        self._active_id = None
+        self._active_checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.codec in ('zstd', 'zlib')
+
+    def _active_dictionary(self):
+        """当前算法最新的字典，返回 (字典ID, 字典数据)，没有字典时为 (0, None)；每隔一段时间重新检查"""
+        if self._active_id is None or time.monotonic() - self._active_checked_at > DICTIONARY_REFRESH_INTERVAL:
+            with self._lock:
+                if self._active_id is None or \
+                        time.monotonic() - self._active_checked_at > DICTIONARY_REFRESH_INTERVAL:
+                    self._refresh_active()
+        return self._active_id, self._dictionaries.get(self._active_id)
+
+    def _refresh_active(self) -> None:
+        """
+        读取最新的字典ID（需持有_lock）
+
+        compress常在其它会话flush的过程中调用，因此使用单独的连接查询，不影响调用方的事务
+        """
+        try:
+            with db.engine.connect() as connection:
+                dict_id = connection.execute(
+                    select(MessageDictionary.id).where(MessageDictionary.codec == self.codec)
+                    .order_by(MessageDictionary.id.desc()).limit(1)
+                ).scalar()
+                if dict_id is not None and dict_id not in self._dictionaries:
+                    self._dictionaries[dict_id] = connection.execute(
+                        select(MessageDictionary.data).where(MessageDictionary.id == dict_id)
+                    ).scalar()
+        except Exception as e:
+            # 字典表尚未创建等情况下不使用字典，下次刷新时再试
+            logger.warning("读取压缩字典失败: %s", e)
+            dict_id = self._active_id
+        self._active_id = dict_id or 0
+        self._active_checked_at = time.monotonic()
+
+    def _dictionary(self, dict_id: int) -> Optional[bytes]:
+        if not dict_id:
+            return None
+        data = self._dictionaries.get(dict_id)
+        if data is None:
+            with db.engine.connect() as connection:
+                data = connection.execute(
+                    select(MessageDictionary.data).where(MessageDictionary.id == dict_id)
+                ).scalar()
+            if data is None:
+                raise ValueError(f"压缩字典不存在: {dict_id}")
+            self._dictionaries[dict_id] = data
+        return data
+
+    def load(self) -> None:
+        """启动时读取当前字典，避免第一次压缩时查询数据库"""
+        with self._lock:
+            self._refresh_active()
+
+    def compress(self, value: Any) -> Optional[bytes]:
+        """
+        序列化并压缩，未超过阈值或压缩后没有变小时返回None（调用方保持原样存储）
+        """
+        if not self.enabled:
+            return None
+        raw = _encode_json(value)
+        if len(raw) < self.threshold:
+            return None
+        dict_id, dictionary = self._active_dictionary()
+        if self.codec == 'zstd':
+            compressor = zstandard.ZstdCompressor(
+                level=self.level,
+                dict_data=zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            )
+            body = compressor.compress(raw)
+            header = _HEADER.pack(CODEC_ZSTD, dict_id)
+        else:
+            compressor = zlib.compressobj(self.level, zdict=dictionary) if dictionary else zlib.compressobj(self.level)
+            body = compressor.compress(raw) + compressor.flush()
+            header = _HEADER.pack(CODEC_ZLIB, dict_id)
+        if len(body) + _HEADER.size >= len(raw):
+            return None
+        return header + body
+
+    def decompress(self, blob: bytes) -> Any:
+        """解压并反序列化"""
+        codec, dict_id = _HEADER.unpack_from(blob)
+        body = memoryview(blob)[_HEADER.size:]
+        dictionary = self._dictionary(dict_id)
+        if codec == CODEC_ZSTD:
+            if zstandard is None:
+                raise RuntimeError("该消息使用zstd压缩，需要安装zstandard")
+            decompressor = zstandard.ZstdDecompressor(
+                dict_data=zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            )
+            raw = decompressor.decompressobj().decompress(bytes(body))
+        elif codec == CODEC_ZLIB:
+            decompressor = zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+            raw = decompressor.decompress(body) + decompressor.flush()
+        else:
+            raise ValueError(f"未知的压缩格式: {codec!r}")
+        return json.loads(raw)
+
+    def train(self, samples: Iterable[Any], dict_size: int = 64 * 1024) -> Optional[int]:
+        """
+        用消息样本训练新字典并设为当前字典
+
+        Args:
+            samples: 消息内容样本（与compress的输入相同）
+            dict_size: 字典大小（字节），zlib最多使用32KB
+
+        Returns:
+            Optional[int]: 新字典的ID，样本不足时返回None
+        """
+        encoded = [_encode_json(sample) for sample in samples]
+        encoded = [sample for sample in encoded if sample]
+        if len(encoded) < 10:
+            logger.warning("压缩字典样本不足(%d)，跳过训练", len(encoded))
+            return None
+        if self.codec == 'zstd':
+            data = zstandard.train_dictionary(dict_size, encoded).as_bytes()
+        else:
+            data = self._build_zlib_dictionary(encoded, min(dict_size, ZLIB_MAX_DICT_SIZE))
+        row = MessageDictionary(codec=self.codec, data=data, sample_count=len(encoded))
+        db.session.add(row)
+        db.session.commit()
+        with self._lock:
+            self._dictionaries[row.id] = data
+            self._active_id = row.id
+            self._active_checked_at = time.monotonic()
+        logger.info("已训练%s压缩字典 #%d (%d 字节, %d 个样本)", self.codec, row.id, len(data), len(encoded))
+        return row.id
+
+    @staticmethod
+    def _build_zlib_dictionary(samples: List[bytes], size: int, segment: int = 48) -> bytes:
+        """
+        构建zlib预置字典：统计样本中出现在最多消息里的片段，
+        按出现次数升序拼接（zlib对靠近字典末尾的内容编码更短）
+        """
+        counter = Counter()
+        for sample in random.sample(samples, min(len(samples), 5000)):
+            seen = set()
+            for i in range(0, max(len(sample) - segment, 1), segment // 2):
+                seen.add(sample[i:i + segment])
+            counter.update(seen)
+        chunks, total = [], 0
+        for chunk, count in counter.most_common():
+            if count < 2 or total + len(chunk) > size:
+                break
+            chunks.append(chunk)
+            total += len(chunk)
+        chunks.reverse()
+        return b''.join(chunks)
+
+
+# 创建全局实例
+message_codec = MessageCodec()
@@ -0,0 +1,128 @@
+import threading
+from dataclasses import dataclass
+from typing import Dict, Any, Optional, Tuple
+
+from config import AVAILABLE_MODELS
+from config import THINKING_MODELS_WITHOUT_CONTENT
+from config import MODELS_WITHOUT_TOOL_SUPPORT
+from config import THINKING_MODELS_WITH_THINKING_DEGREE
+from initialization import xai_client, deepseek_client, siliconcloud_client, oaipro_client, gemini_pool
+from initialization import xai_async_client, deepseek_async_client, siliconcloud_async_client, oaipro_async_client
+from utils.files.file_config import AttachmentType
+from utils.price.price_model import PriceConfig
+
+
+@dataclass(frozen=True)
+class ModelRoute:
+    """单个模型的路由信息，在导入时预先计算，请求路径上只读"""
+    model_id: str
+    provider: str
+    api_type: str
+    client: Any  # OpenAI兼容客户端；Google模型为GeminiAPIPool
+    async_client: Any  # AsyncOpenAI客户端；Google模型同样为GeminiAPIPool（通过client.aio调用）
+    attachments: Tuple[AttachmentType, ...]
+    reasoner: bool
+    supports_tools: bool
+    thinking_without_content: bool  # 思考模型但不返回思考内容
+    thinking_degree: bool  # 支持调整思考力度
+    flatten_content: bool  # 只接受纯文本content的模型（DeepSeek系列）
+    max_output_tokens: int
+    price: Optional[Dict[str, float]]
+
+
+# 服务商名称到客户端的映射
+_provider_clients: Dict[str, Any] = {
+    'xai': xai_client,
+    'deepseek': deepseek_client,
+    'siliconcloud': siliconcloud_client,
+    'oaipro': oaipro_client,
+    'google': gemini_pool
+}
+
+# 服务商名称到异步客户端的映射
+_provider_async_clients: Dict[str, Any] = {
+    'xai': xai_async_client,
+    'deepseek': deepseek_async_client,
+    'siliconcloud': siliconcloud_async_client,
+    'oaipro': oaipro_async_client,
+    'google': gemini_pool
+}
+
+# 通过register_provider添加的服务商配置，格式与AVAILABLE_MODELS相同
+_extra_providers: Dict[str, Dict[str, Any]] = {}
+
+_registry_lock = threading.Lock()
+_routes: Dict[str, ModelRoute] = {}
+
+
+def _build_routes() -> Dict[str, ModelRoute]:
+    """根据模型配置构建 model_id -> ModelRoute 的映射"""
+    routes = {}
+    providers = dict(AVAILABLE_MODELS)
+    providers.update(_extra_providers)
+    for provider, config in providers.items():
+        client = _provider_clients.get(provider)
+        for model in config['models']:
+            model_id = model['id']
+            # 同一个模型ID只取第一个服务商，与原先遍历查找的行为一致
+            if model_id in routes:
+                continue
+            routes[model_id] = ModelRoute(
+                model_id=model_id,
+                provider=provider,
+                api_type=config['api_type'],
+                client=client,
+                async_client=_provider_async_clients.get(provider),
+                attachments=tuple(model['available_attachments']),
+                reasoner=model.get('reasoner', False),
+                supports_tools=model_id not in MODELS_WITHOUT_TOOL_SUPPORT,
+                thinking_without_content=model_id in THINKING_MODELS_WITHOUT_CONTENT,
+                thinking_degree=model_id in THINKING_MODELS_WITH_THINKING_DEGREE,
+                flatten_content=model_id.startswith('deepseek'),
+                max_output_tokens=model['max_output_tokens'],
+                price=PriceConfig.get_model_price(model_id)
+            )
+    return routes
+
+
+def get_model_route(model_id: str) -> Optional[ModelRoute]:
+    """
+    获取模型的路由信息
+
+    Args:
+        model_id: 模型ID
+
+    Returns:
+        ModelRoute: 路由信息，不支持的模型返回None
+    """
+    return _routes.get(model_id)
+
+
+def register_provider(provider: str, client: Any, api_type: str = None, models: list = None,
+                      async_client: Any = None) -> None:
+    """
+    注册新的服务商（或替换已有服务商的客户端），无需修改请求处理代码
+
+    注册时重新构建整个路由表并整体替换，请求路径上的查找不需要加锁。
+
+    Args:
+        provider: 服务商名称
+        client: 该服务商的客户端实例
+        api_type: 接口类型 ('openai' 或 'google')，只注册客户端时可省略
+        models: 模型配置列表，格式与AVAILABLE_MODELS中的models相同
+        async_client: 该服务商的异步客户端实例，ASGI聊天引擎使用
+    """
+    global _routes
+    with _registry_lock:
+        _provider_clients[provider] = client
+        if async_client is not None:
+            _provider_async_clients[provider] = async_client
+        if models is not None:
+            _extra_providers[provider] = {
+                'models': models,
+                'api_type': api_type or 'openai'
+            }
+        _routes = _build_routes()
+
+
+_routes = _build_routes()
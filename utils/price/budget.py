@@ -0,0 +1,271 @@
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+import redis
+
+from initialization import db
+from utils.logger import get_logger
+from .price_model import PriceConfig
+from .usage_model import UsageRollup
+
+try:
+    import config
+except ImportError:
+    config = None
+
+logger = get_logger(__name__)
+
+# 默认消费限额，None表示不限制；按UTC日期和月份统计，与usage_rollup一致
+DEFAULT_BUDGET_LIMITS = {
+    'daily_cost': None,     # 每日消费上限（美元）
+    'monthly_cost': None,   # 每月消费上限（美元）
+    'daily_tokens': None,   # 每日token上限（输入+缓存输入+输出）
+}
+BUDGET_LIMITS = dict(DEFAULT_BUDGET_LIMITS, **getattr(config, 'USER_BUDGET_LIMITS', {}))
+# 用户ID -> 覆盖的限额，例如 {1: {'daily_cost': None}} 表示该用户不受每日消费限制
+BUDGET_OVERRIDES = getattr(config, 'USER_BUDGET_OVERRIDES', {})
+
+# 只有计数存在时才累加，避免在未加载历史用量的计数上开始计数
+_INCREMENT_IF_EXISTS = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HINCRBYFLOAT', KEYS[1], 'cost', ARGV[1])
+    redis.call('HINCRBY', KEYS[1], 'tokens', ARGV[2])
+end
+return 0
+"""
+
+
+class BudgetCounterStore:
+    """
+    用户在某个统计周期内的消费和token计数
+
+    优先使用Redis，多个gunicorn进程共享计数；Redis不可用时降级为进程内字典，
+    本地计数每隔LOCAL_TTL秒从汇总表重新加载一次，以包含其它进程写入的用量。
+    """
+
+    # 本地计数的有效期（秒）
+    LOCAL_TTL = 30
+
+    def __init__(self, host='localhost', port=6379, db=0):
+        self.redis = None
+        self._increment = None
+        # 键 -> [消费, token数, 加载时间]
+        self.local: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+        try:
+            self.redis = redis.Redis(
+                host=host,
+                port=port,
+                db=db,
+                decode_responses=True,
+                socket_timeout=2,
+                socket_connect_timeout=2,
+                retry_on_timeout=False
+            )
+            self.redis.ping()
+            self._increment = self.redis.register_script(_INCREMENT_IF_EXISTS)
+        except Exception as e:
+            logging.warning(f"Redis连接失败，消费计数使用本地存储: {e}")
+            self.redis = None
+
+    def get(self, key: str) -> Optional[Tuple[float, int]]:
+        """返回 (消费, token数)，计数不存在或已过期时返回None"""
+        if self.redis:
+            try:
+                cost, tokens = self.redis.hmget(f"budget:{key}", 'cost', 'tokens')
+                if cost is None:
+                    return None
+                return float(cost), int(tokens or 0)
+            except Exception as e:
+                logging.error(f"Redis获取消费计数失败: {e}")
+        entry = self.local.get(key)
+        if entry is None or time.monotonic() - entry[2] > self.LOCAL_TTL:
+            return None
+        return entry[0], int(entry[1])
+
+    def seed(self, key: str, cost: float, tokens: int, ttl: int) -> None:
+        """写入从数据库加载的初始计数（Redis中已有计数时保留已有值）"""
+        if self.redis:
+            try:
+                pipe = self.redis.pipeline()
+                pipe.hsetnx(f"budget:{key}", 'cost', cost)
+                pipe.hsetnx(f"budget:{key}", 'tokens', tokens)
+                pipe.expire(f"budget:{key}", ttl)
+                pipe.execute()
+                return
+            except Exception as e:
+                logging.error(f"Redis写入消费计数失败: {e}")
+        with self._lock:
+            self.local[key] = [cost, tokens, time.monotonic()]
+
+    def add(self, key: str, cost: float, tokens: int) -> None:
+        """累加一次请求的用量，计数不存在时忽略（下次检查时会从数据库加载）"""
+        if self.redis:
+            try:
+                self._increment(keys=[f"budget:{key}"], args=[cost, tokens])
+                return
+            except Exception as e:
+                logging.error(f"Redis累加消费计数失败: {e}")
+        with self._lock:
+            entry = self.local.get(key)
+            if entry is not None:
+                entry[0] += cost
+                entry[1] += tokens
+
+
+class BudgetTracker:
+    """
+    聊天请求前的消费限额检查
+
+    每个用户当天和当月的消费、token数保存在计数存储中，写入用量时同步累加，
+    检查时只读取计数并与限额比较，不需要对usage表求和；计数不存在时从usage_rollup加载一次。
+    """
+
+    PERIODS = (
+        # (周期, 限额字段, 计数字段)
+        ('day', 'daily_cost', 'cost'),
+        ('month', 'monthly_cost', 'cost'),
+        ('day', 'daily_tokens', 'tokens'),
+    )
+    # 计数在Redis中的保留时间（秒）
+    TTL = {'day': 2 * 24 * 3600, 'month': 32 * 24 * 3600}
+
+    def __init__(self, store: BudgetCounterStore, limits: Dict[str, Any] = None,
+                 overrides: Dict[int, Dict[str, Any]] = None):
+        self.store = store
+        self.limits = limits if limits is not None else BUDGET_LIMITS
+        self.overrides = overrides if overrides is not None else BUDGET_OVERRIDES
+        self._token_counter = None
+
+    def limits_for(self, user_id: int) -> Dict[str, Any]:
+        """用户适用的限额"""
+        override = self.overrides.get(user_id) or self.overrides.get(str(user_id))
+        return dict(self.limits, **override) if override else self.limits
+
+    def is_limited(self, user_id: int) -> bool:
+        return any(value is not None for value in self.limits_for(user_id).values())
+
+    @staticmethod
+    def _period_key(user_id: int, period: str, now: datetime) -> str:
+        return f"{user_id}:d:{now:%Y-%m-%d}" if period == 'day' else f"{user_id}:m:{now:%Y-%m}"
+
+    def _load(self, user_id: int, period: str, now: datetime) -> Tuple[float, int]:
+        """从汇总表加载当前周期的用量"""
+        today = now.date()
+        start_day = today if period == 'day' else today.replace(day=1)
+        cost, tokens = db.session.query(
+            db.func.coalesce(db.func.sum(UsageRollup.total_cost), 0.0),
+            db.func.coalesce(db.func.sum(UsageRollup.tokens_in + UsageRollup.cached_input_tokens +
+                                         UsageRollup.tokens_out), 0)
+        ).filter(UsageRollup.user_id == user_id, UsageRollup.day >= start_day,
+                 UsageRollup.day <= today).one()
+        return float(cost), int(tokens)
+
+    def current(self, user_id: int, period: str, now: Optional[datetime] = None) -> Tuple[float, int]:
+        """用户当前周期的 (消费, token数)，需要在应用上下文中调用"""
+        now = now or datetime.utcnow()
+        key = self._period_key(user_id, period, now)
+        value = self.store.get(key)
+        if value is None:
+            cost, tokens = self._load(user_id, period, now)
+            self.store.seed(key, cost, tokens, self.TTL[period])
+            value = self.store.get(key) or (cost, tokens)
+        return value
+
+    def record(self, user_id: int, cost: float, tokens: int, now: Optional[datetime] = None) -> None:
+        """累加一次请求的用量（不访问数据库，可以在事件循环中调用）"""
+        now = now or datetime.utcnow()
+        for period in ('day', 'month'):
+            self.store.add(self._period_key(user_id, period, now), cost or 0.0, int(tokens or 0))
+
+    def estimate_input_tokens(self, messages: List[Dict[str, Any]]) -> int:
+        """用tiktoken估算请求历史消息的token数，每条消息的结果按内容哈希缓存"""
+        if self._token_counter is None:
+            from .tokenCounter import TokenCounter
+            self._token_counter = TokenCounter()
+        # 按cl100k估算，避免预检查时调用Grok的远程分词接口
+        return self._token_counter.estimate_message_tokens(messages, 'cl100k')[0]
+
+    @staticmethod
+    def estimate_cost(model_id: str, input_tokens: int, output_tokens: int = 0) -> float:
+        """按模型价格估算请求费用（美元）"""
+        price = PriceConfig.get_model_price(model_id)
+        if price is None:
+            return 0.0
+        return (input_tokens / 1_000_000) * price['input'] + (output_tokens / 1_000_000) * price['output']
+
+    def check(self, user_id: int, model_id: str, input_tokens: int, output_tokens: int = 0) -> Dict[str, Any]:
+        """
+        检查请求是否会超出限额
+
+        Args:
+            input_tokens: 预估的输入token数（历史消息）
+            output_tokens: 预估的输出token数，默认不计入
+
+        Returns:
+            Dict: allowed为False时reason说明超出的限额
+        """
+        limits = self.limits_for(user_id)
+        result = {'allowed': True, 'reason': None, 'limits': limits, 'usage': {}}
+        if not self.is_limited(user_id):
+            return result
+        estimated_cost = self.estimate_cost(model_id, input_tokens, output_tokens)
+        estimated = {'cost': estimated_cost, 'tokens': input_tokens + output_tokens}
+        result['estimated_cost'] = round(estimated_cost, 6)
+        now = datetime.utcnow()
+        loaded = {}
+        for period, limit_name, field in self.PERIODS:
+            limit = limits.get(limit_name)
+            if limit is None:
+                continue
+            if period not in loaded:
+                loaded[period] = self.current(user_id, period, now)
+            cost, tokens = loaded[period]
+            used = cost if field == 'cost' else tokens
+            result['usage'][limit_name] = round(used, 6) if field == 'cost' else used
+            if used + estimated[field] > limit:
+                result['allowed'] = False
+                result['reason'] = limit_name
+                break
+        return result
+
+    def check_request(self, user_id: int, model_id: str, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """聊天请求的预检查，没有设置限额的用户不估算token"""
+        if not self.is_limited(user_id):
+            return {'allowed': True, 'reason': None, 'limits': self.limits_for(user_id), 'usage': {}}
+        try:
+            input_tokens = self.estimate_input_tokens(messages)
+        except Exception as e:
+            logger.warning("估算请求token数失败，按0计算: %s", e)
+            input_tokens = 0
+        return self.check(user_id, model_id, input_tokens)
+
+    def status(self, user_id: int) -> Dict[str, Any]:
+        """用户当前周期的用量和限额"""
+        now = datetime.utcnow()
+        day_cost, day_tokens = self.current(user_id, 'day', now)
+        month_cost, _ = self.current(user_id, 'month', now)
+        next_day = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        return {
+            'limits': self.limits_for(user_id),
+            'usage': {
+                'daily_cost': round(day_cost, 6),
+                'monthly_cost': round(month_cost, 6),
+                'daily_tokens': day_tokens
+            },
+            'resets_at': next_day.isoformat() + 'Z'
+        }
+
+
+# 超出限额时返回给前端的提示
+BUDGET_MESSAGES = {
+    'daily_cost': '已达到今日消费限额，请明天再试',
+    'monthly_cost': '已达到本月消费限额',
+    'daily_tokens': '已达到今日token用量限额，请明天再试',
+}
+
+# 创建全局实例
+budget_tracker = BudgetTracker(BudgetCounterStore())  # 如果Redis连接失败会自动降级到本地存储
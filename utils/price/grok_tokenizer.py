@@ -0,0 +1,172 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import API_KEYS, API_BASE_URLS
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class GrokTokenizer:
+    """
+    Grok远程分词客户端
+
+    - 复用带连接池的requests.Session，避免每次请求重新建立TLS连接
+    - 多段文本并发请求（接口每次只接受一段文本，批量即在连接池上并发发送）
+    - 精确结果按 (模型, 文本哈希) 缓存在LRU中
+    - 超过延迟预算仍未返回的文本使用本地tiktoken估算，请求在后台继续完成并写入缓存，
+      因此token估算不会给聊天响应增加一次完整的网络往返
+    - 请求失败的文本在一段时间内直接使用本地估算，不会每轮对话都重新请求
+    """
+
+    # 单次统计最多等待远程结果的时间（秒）
+    DEFAULT_LATENCY_BUDGET = 0.15
+    # 后台请求的超时时间 (连接, 读取)
+    REQUEST_TIMEOUT = (2, 5)
+    # 并发请求数（同时也是连接池大小）
+    MAX_CONCURRENCY = 16
+    # 缓存条目数
+    CACHE_SIZE = 50000
+    # 请求失败的文本在多长时间内不再重试（秒）
+    FAILURE_TTL = 60
+
+    def __init__(self, latency_budget: float = DEFAULT_LATENCY_BUDGET):
+        self.latency_budget = latency_budget
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.MAX_CONCURRENCY)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=self.MAX_CONCURRENCY, thread_name_prefix='grok-tokenize')
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        # 正在请求中的文本，避免同一段文本重复请求
+        self._inflight = {}
+        # 最近请求失败的文本 -> 可以重试的时间
+        self._failed = OrderedDict()
+
+    @staticmethod
+    def _key(model_id: str, text: str) -> Tuple[str, str]:
+        return model_id, hashlib.sha1(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+    def _cache_get(self, key: Tuple[str, str]) -> Optional[int]:
+        with self._lock:
+            value = self._cache.get(key)
+            if value is not None:
+                self._cache.move_to_end(key)
+            return value
+
+    def _cache_put(self, key: Tuple[str, str], value: int) -> None:
+        with self._lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+    def _recently_failed(self, key: Tuple[str, str]) -> bool:
+        with self._lock:
+            retry_at = self._failed.get(key)
+            if retry_at is None:
+                return False
+            if retry_at > time.monotonic():
+                return True
+            del self._failed[key]
+            return False
+
+    def _mark_failed(self, key: Tuple[str, str]) -> None:
+        with self._lock:
+            self._failed[key] = time.monotonic() + self.FAILURE_TTL
+            self._failed.move_to_end(key)
+            while len(self._failed) > self.CACHE_SIZE:
+                self._failed.popitem(last=False)
+
+    def _request(self, key: Tuple[str, str], text: str, model_id: str) -> Optional[int]:
+        """调用tokenize-text接口，成功时写入缓存"""
+        try:
+            response = self._session.post(
+                f"{API_BASE_URLS['xai']}/tokenize-text",
+                headers={"Authorization": f"Bearer {API_KEYS['xai'][0]}"},
+                json={"text": text, "model": model_id},
+                timeout=self.REQUEST_TIMEOUT
+            )
+            if not response.ok:
+                logger.warning("Grok分词接口返回 %s", response.status_code)
+                self._mark_failed(key)
+                return None
+            tokens = len(response.json()["token_ids"])
+            self._cache_put(key, tokens)
+            return tokens
+        except Exception as e:
+            logger.warning("Grok token计算失败: %s", e)
+            self._mark_failed(key)
+            return None
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def _submit(self, key: Tuple[str, str], text: str, model_id: str):
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is None:
+                future = self._executor.submit(self._request, key, text, model_id)
+                self._inflight[key] = future
+            return future
+
+    def count_many(self, texts: List[str], model_id: str, fallback: Callable[[str], int],
+                   budget: float = None) -> List[int]:
+        """
+        统计多段文本的token数
+
+        Args:
+            texts: 文本列表
+            model_id: Grok模型ID
+            fallback: 本地估算函数，远程结果未在预算内返回时使用
+            budget: 最多等待的秒数，默认使用latency_budget
+
+        Returns:
+            List[int]: 与texts一一对应的token数
+        """
+        budget = self.latency_budget if budget is None else budget
+        results = [0] * len(texts)
+        pending: Dict[int, object] = {}
+        for i, text in enumerate(texts):
+            if not text:
+                continue
+            key = self._key(model_id, text)
+            cached = self._cache_get(key)
+            if cached is not None:
+                results[i] = cached
+            elif self._recently_failed(key):
+                results[i] = fallback(text)
+            else:
+                pending[i] = self._submit(key, text, model_id)
+
+        if pending:
+            start = time.monotonic()
+            wait(list(pending.values()), timeout=budget)
+            fallback_count = 0
+            for i, future in pending.items():
+                tokens = future.result() if future.done() else None
+                if tokens is None:
+                    # 未完成的请求继续在后台运行，下次直接命中缓存
+                    tokens = fallback(texts[i])
+                    fallback_count += 1
+                results[i] = tokens
+            if fallback_count:
+                logger.debug("Grok分词 %d/%d 段超过预算(%.0fms)，使用本地估算",
+                             fallback_count, len(pending), (time.monotonic() - start) * 1000)
+        return results
+
+    def count(self, text: str, model_id: str, fallback: Callable[[str], int], budget: float = None) -> int:
+        """统计单段文本的token数"""
+        return self.count_many([text], model_id, fallback, budget)[0]
+
+
+# 创建全局实例
+grok_tokenizer = GrokTokenizer()
@@ -0,0 +1,304 @@
+"""
+按当前价格表批量重新计算历史用量的费用
+
+价格表（utils/price/price_config.py）修改或某个模型的价格配置有误时，用于修正usage表中已有记录的费用。
+按id分批流式读取记录，用numpy对整批做向量化计算，只把费用有变化的记录批量写回，
+并在同一事务中修正usage_rollup汇总表。
+
+用法:
+    python -m utils.price.repricing --dry-run                      # 只输出差异报告
+    python -m utils.price.repricing --model gpt-4o --since 2025-01-01
+    python -m utils.price.repricing --dry-run --report reprice.csv  # 差异明细写入CSV
+    python -m utils.price.repricing --price-file new_prices.json    # 使用指定的价格表
+"""
+import csv
+import json
+import time
+import argparse
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+
+from initialization import app, db
+from utils.logger import get_logger
+from utils.sqlite_writer import retry_on_locked
+from .price_config import PRICE_CONFIG
+from .usage_model import Usage, UsageRollup
+
+logger = get_logger(__name__)
+
+# 与Usage.calculate_cost一致，OCR费用按该模型的价格计算
+OCR_MODEL = 'qwen2.5-vl-72b-instruct'
+COST_COLUMNS = ('input_cost', 'output_cost', 'image_ocr_cost', 'total_cost')
+TOKEN_COLUMNS = ('tokens_in', 'cached_input_tokens', 'tokens_out', 'image_ocr_input_tokens', 'image_ocr_output_tokens')
+# 新旧费用相差不超过该值时视为未变化（费用保留6位小数）
+COST_TOLERANCE = 1e-9
+
+
+def round_costs(values: np.ndarray, digits: int = 6) -> np.ndarray:
+    """
+    与Python内置round结果一致的向量化舍入
+
+    np.round先乘以10的幂再取整，恰好落在两个舍入结果中间附近的值可能与round不同，
+    这部分值（通常极少）改用round逐个计算，其余值直接使用np.round的结果。
+    """
+    rounded = np.round(values, digits)
+    scaled = values * 10 ** digits
+    near_half = np.abs(np.abs(scaled - np.trunc(scaled)) - 0.5) < 1e-6
+    for i in np.flatnonzero(near_half):
+        rounded[i] = round(float(values[i]), digits)
+    return rounded
+
+
+class RepriceReport:
+    """重新计价的统计和差异明细"""
+
+    def __init__(self, dry_run: bool, sample_size: int = 20):
+        self.dry_run = dry_run
+        self.sample_size = sample_size
+        self.scanned = 0
+        self.changed = 0
+        self.batches = 0
+        self.old_total = 0.0
+        self.new_total = 0.0
+        self.unpriced_models = set()
+        # 模型 -> {'rows', 'changed', 'old_total', 'new_total'}
+        self.by_model: Dict[str, Dict[str, Any]] = {}
+        self.samples: List[Dict[str, Any]] = []
+        self.started_at = time.perf_counter()
+        self.elapsed = 0.0
+
+    def add_model(self, model_name: str, rows: int, changed: int, old_total: float, new_total: float) -> None:
+        stats = self.by_model.setdefault(model_name, {'rows': 0, 'changed': 0, 'old_total': 0.0, 'new_total': 0.0})
+        stats['rows'] += rows
+        stats['changed'] += changed
+        stats['old_total'] += old_total
+        stats['new_total'] += new_total
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'dry_run': self.dry_run,
+            'scanned': self.scanned,
+            'changed': self.changed,
+            'batches': self.batches,
+            'old_total': round(self.old_total, 6),
+            'new_total': round(self.new_total, 6),
+            'delta': round(self.new_total - self.old_total, 6),
+            'unpriced_models': sorted(self.unpriced_models),
+            'by_model': {name: {key: round(value, 6) if isinstance(value, float) else value
+                                for key, value in stats.items()}
+                         for name, stats in sorted(self.by_model.items())},
+            'samples': self.samples,
+            'elapsed': round(self.elapsed, 3),
+            'rows_per_second': round(self.scanned / self.elapsed, 1) if self.elapsed else None
+        }
+
+
+class UsageRepricer:
+    """
+    用量费用的批量重新计算
+
+    - 按主键分批读取（WHERE id > 上一批最大id），不会把整张表载入内存
+    - 每批的费用用numpy数组整体计算，计算口径与Usage.calculate_cost相同
+    - 只更新费用有变化的记录，每批单独提交，不会长时间占用SQLite写锁
+    """
+
+    DEFAULT_BATCH_SIZE = 5000
+
+    def __init__(self, price_config: Optional[Dict[str, Dict[str, float]]] = None,
+                 batch_size: int = DEFAULT_BATCH_SIZE, ocr_model: str = OCR_MODEL):
+        self.price_config = price_config if price_config is not None else PRICE_CONFIG
+        self.batch_size = batch_size
+        self.ocr_model = ocr_model
+
+    def iter_batches(self, models: Optional[List[str]] = None, user_id: Optional[int] = None,
+                     since: Optional[datetime] = None, until: Optional[datetime] = None) -> Iterator[Dict[str, np.ndarray]]:
+        """按id顺序分批读取用量记录，每批返回列名 -> numpy数组"""
+        table = Usage.__table__
+        columns = [table.c.id, table.c.user_id, table.c.model_name, table.c.created_at] + \
+                  [table.c[name] for name in TOKEN_COLUMNS + COST_COLUMNS]
+        last_id = 0
+        while True:
+            query = db.select(*columns).where(table.c.id > last_id)
+            if models:
+                query = query.where(table.c.model_name.in_(models))
+            if user_id is not None:
+                query = query.where(table.c.user_id == user_id)
+            if since is not None:
+                query = query.where(table.c.created_at >= since)
+            if until is not None:
+                query = query.where(table.c.created_at <= until)
+            rows = db.session.execute(query.order_by(table.c.id).limit(self.batch_size)).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1].id
+            batch = {
+                'id': np.fromiter((row.id for row in rows), dtype=np.int64, count=len(rows)),
+                'user_id': np.fromiter((row.user_id for row in rows), dtype=np.int64, count=len(rows)),
+                'model_name': np.array([row.model_name for row in rows], dtype=object),
+                'created_at': np.array([row.created_at for row in rows], dtype=object),
+            }
+            for name in TOKEN_COLUMNS + COST_COLUMNS:
+                dtype = np.float64 if name in COST_COLUMNS else np.int64
+                batch[name] = np.fromiter((getattr(row, name) or 0 for row in rows), dtype=dtype, count=len(rows))
+            yield batch
+
+    def price_batch(self, batch: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        """
+        按价格表计算一批记录的费用
+
+        Returns:
+            Dict[str, np.ndarray]: 费用列名 -> 新费用数组，另有priced表示模型是否有价格配置
+        """
+        # 每批只有少数几个模型，按模型查一次价格再展开为与记录等长的价格数组
+        names, inverse = np.unique(batch['model_name'].astype(str), return_inverse=True)
+        prices = [self.price_config.get(name) for name in names]
+        priced = np.array([price is not None for price in prices], dtype=bool)[inverse]
+        input_price = np.array([price['input'] if price else 0.0 for price in prices], dtype=np.float64)[inverse]
+        cached_price = np.array([price.get('cached_input', price['input']) if price else 0.0
+                                 for price in prices], dtype=np.float64)[inverse]
+        output_price = np.array([price['output'] if price else 0.0 for price in prices], dtype=np.float64)[inverse]
+
+        input_cost = (batch['tokens_in'] / 1_000_000) * input_price + \
+                     (batch['cached_input_tokens'] / 1_000_000) * cached_price
+        output_cost = (batch['tokens_out'] / 1_000_000) * output_price
+
+        ocr_price = self.price_config.get(self.ocr_model)
+        if ocr_price:
+            ocr_cost = (batch['image_ocr_input_tokens'] / 1_000_000) * ocr_price['input'] + \
+                       (batch['image_ocr_output_tokens'] / 1_000_000) * ocr_price['output']
+            # 与calculate_cost一致：模型本身没有价格配置时OCR费用也记为0
+            ocr_cost = np.where(priced, ocr_cost, 0.0)
+        else:
+            ocr_cost = np.zeros(len(input_cost))
+
+        total_cost = input_cost + output_cost + ocr_cost
+        return {
+            'input_cost': round_costs(input_cost),
+            'output_cost': round_costs(output_cost),
+            'image_ocr_cost': round_costs(ocr_cost),
+            'total_cost': round_costs(total_cost),
+            'priced': priced
+        }
+
+    def _write_batch(self, batch: Dict[str, np.ndarray], costs: Dict[str, np.ndarray], changed: np.ndarray) -> None:
+        """批量写回有变化的记录，并把费用差额累加到汇总表"""
+        indexes = np.flatnonzero(changed)
+        mappings = [{'id': int(batch['id'][i]), **{name: float(costs[name][i]) for name in COST_COLUMNS}}
+                    for i in indexes]
+        deltas = [{
+            'user_id': int(batch['user_id'][i]),
+            'model_name': batch['model_name'][i],
+            'created_at': batch['created_at'][i],
+            'requests': 0,
+            **{name: float(costs[name][i] - batch[name][i]) for name in COST_COLUMNS}
+        } for i in indexes if batch['created_at'][i] is not None]
+
+        def write():
+            db.session.bulk_update_mappings(Usage, mappings)
+            UsageRollup.apply(deltas)
+            db.session.commit()
+
+        retry_on_locked(write, on_retry=db.session.rollback)
+
+    def run(self, dry_run: bool = True, models: Optional[List[str]] = None, user_id: Optional[int] = None,
+            since: Optional[datetime] = None, until: Optional[datetime] = None,
+            report_path: Optional[str] = None, sample_size: int = 20) -> RepriceReport:
+        """
+        重新计算符合条件的用量记录的费用
+
+        Args:
+            dry_run: 为True时只统计差异，不写入数据库
+            report_path: 差异明细CSV的保存路径（每条有变化的记录一行）
+
+        Returns:
+            RepriceReport: 统计结果
+        """
+        report = RepriceReport(dry_run, sample_size)
+        csv_file = open(report_path, 'w', newline='', encoding='utf-8') if report_path else None
+        writer = None
+        if csv_file is not None:
+            writer = csv.writer(csv_file)
+            writer.writerow(['id', 'user_id', 'model_name', 'created_at'] +
+                            [f'old_{name}' for name in COST_COLUMNS] + [f'new_{name}' for name in COST_COLUMNS])
+        try:
+            for batch in self.iter_batches(models, user_id, since, until):
+                costs = self.price_batch(batch)
+                changed = np.zeros(len(batch['id']), dtype=bool)
+                for name in COST_COLUMNS:
+                    changed |= np.abs(costs[name] - batch[name]) > COST_TOLERANCE
+
+                report.batches += 1
+                report.scanned += len(batch['id'])
+                report.changed += int(changed.sum())
+                report.old_total += float(batch['total_cost'].sum())
+                report.new_total += float(costs['total_cost'].sum())
+                report.unpriced_models.update(str(name) for name in np.unique(batch['model_name'][~costs['priced']]))
+                names, inverse = np.unique(batch['model_name'].astype(str), return_inverse=True)
+                rows = np.bincount(inverse, minlength=len(names))
+                changed_rows = np.bincount(inverse, weights=changed, minlength=len(names))
+                old_totals = np.bincount(inverse, weights=batch['total_cost'], minlength=len(names))
+                new_totals = np.bincount(inverse, weights=costs['total_cost'], minlength=len(names))
+                for i, name in enumerate(names):
+                    report.add_model(str(name), int(rows[i]), int(changed_rows[i]),
+                                     float(old_totals[i]), float(new_totals[i]))
+
+                for i in np.flatnonzero(changed):
+                    row = [int(batch['id'][i]), int(batch['user_id'][i]), batch['model_name'][i],
+                           batch['created_at'][i].isoformat() if batch['created_at'][i] else None]
+                    old = [float(batch[name][i]) for name in COST_COLUMNS]
+                    new = [float(costs[name][i]) for name in COST_COLUMNS]
+                    if len(report.samples) < sample_size:
+                        report.samples.append({'id': row[0], 'user_id': row[1], 'model_name': row[2],
+                                               'old': dict(zip(COST_COLUMNS, old)), 'new': dict(zip(COST_COLUMNS, new))})
+                    if writer is None:
+                        if len(report.samples) >= sample_size:
+                            break
+                        continue
+                    writer.writerow(row + old + new)
+
+                if not dry_run and changed.any():
+                    self._write_batch(batch, costs, changed)
+                elif dry_run:
+                    # 只读时结束本批的读事务，避免长时间持有WAL快照
+                    db.session.rollback()
+                logger.info("重新计价: 已扫描 %d 条，变化 %d 条", report.scanned, report.changed)
+        finally:
+            if csv_file is not None:
+                csv_file.close()
+            report.elapsed = time.perf_counter() - report.started_at
+        return report
+
+
+def _parse_datetime(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='按价格表批量重新计算用量费用')
+    parser.add_argument('--dry-run', action='store_true', help='只输出差异报告，不写入数据库')
+    parser.add_argument('--model', action='append', dest='models', help='只处理指定模型，可重复')
+    parser.add_argument('--user-id', type=int, help='只处理指定用户')
+    parser.add_argument('--since', help='起始时间（ISO格式，UTC）')
+    parser.add_argument('--until', help='结束时间（ISO格式，UTC）')
+    parser.add_argument('--price-file', help='JSON格式的价格表，默认使用price_config.py')
+    parser.add_argument('--batch-size', type=int, default=UsageRepricer.DEFAULT_BATCH_SIZE, help='每批记录数')
+    parser.add_argument('--report', help='差异明细CSV的保存路径')
+    args = parser.parse_args()
+
+    price_config = None
+    if args.price_file:
+        with open(args.price_file, 'r', encoding='utf-8') as f:
+            price_config = json.load(f)
+
+    with app.app_context():
+        repricer = UsageRepricer(price_config, batch_size=args.batch_size)
+        report = repricer.run(dry_run=args.dry_run, models=args.models, user_id=args.user_id,
+                              since=_parse_datetime(args.since), until=_parse_datetime(args.until),
+                              report_path=args.report)
+    print(json.dumps(report.to_dict(), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,111 @@
 import tiktoken
-from typing import List, Dict, Tuple
+from typing import Callable, List, Dict, Tuple
 import json
-import requests
 import tempfile
 import os
 from PIL import Image
 import base64
 import io
 import math
+import hashlib
+import threading
+from collections import OrderedDict
 import cv2
-from config import API_KEYS, API_BASE_URLS
+from utils.price.grok_tokenizer import grok_tokenizer
+
+
+class _LRUCache:
+    """线程安全的简单LRU缓存"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# 进程内共享的编码器，tiktoken加载BPE表较慢，只加载一次
+_encoder = None
+_encoder_lock = threading.Lock()
+
+
+def get_shared_encoder():
+    """获取进程内共享的cl100k_base编码器"""
+    global _encoder
+    if _encoder is None:
+        with _encoder_lock:
+            if _encoder is None:
+                _encoder = tiktoken.get_encoding("cl100k_base")
+    return _encoder
+
+
+def _hash_text(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
 
 class TokenCounter:
+    # 以下缓存在所有实例间共享，历史消息只需编码一次
+    # (模型族, 消息哈希) -> (输入token数, 输出token数)
+    _message_cache = _LRUCache(20000)
+    # (模型族, 文本哈希) -> token数
+    _text_cache = _LRUCache(50000)
+    # 图片/视频的文件哈希（或路径+大小+修改时间） -> token数
+    _media_cache = _LRUCache(5000)
+    # 短文本直接编码比计算哈希更快，不缓存
+    MIN_CACHED_TEXT_LENGTH = 64
+
     def __init__(self):
-        """初始化token计数器，使用cl100k_base编码器"""
-        self.encoder = tiktoken.get_encoding("cl100k_base")
+        """初始化token计数器，使用共享的cl100k_base编码器"""
+        self.encoder = get_shared_encoder()
+
+    @staticmethod
+    def model_family(model_id: str) -> str:
+        """同一模型族的token计算方式相同，可以共享缓存"""
+        if model_id and model_id.startswith('grok'):
+            # Grok使用远程分词，不同模型可能不同
+            return model_id
+        return 'cl100k'
+
+    @staticmethod
+    def _file_key(path: str):
+        """本地文件以路径、大小和修改时间作为缓存键，避免读取整个文件计算哈希"""
+        try:
+            stat = os.stat(path)
+            return ('file', os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            return None
         
     def count_tokens_by_model(self, text: str, model_id: str) -> int:
-        """根据不同模型使用相应的token计算方法"""
+        """根据不同模型使用相应的token计算方法，长文本的结果会被缓存"""
+        if not text:
+            return 0
+        if len(text) < self.MIN_CACHED_TEXT_LENGTH or model_id.startswith('grok'):
+            # Grok的精确结果由grok_tokenizer缓存，这里不缓存可能是估算值的结果
+            return self._count_uncached(text, model_id)
+        key = (self.model_family(model_id), _hash_text(text))
+        tokens = self._text_cache.get(key)
+        if tokens is None:
+            tokens = self._count_uncached(text, model_id)
+            self._text_cache.put(key, tokens)
+        return tokens
+
+    def _count_uncached(self, text: str, model_id: str) -> int:
         if model_id.startswith('grok'):
             return self._count_grok_tokens(text, model_id)
         elif model_id.startswith('deepseek'):
@@ -26,22 +114,8 @@ class TokenCounter:
             return self.estimate_tokens(text)
             
     def _count_grok_tokens(self, text: str, model_id: str) -> int:
-        """使用Grok的tokenize-text API计算token数"""
-        try:
-            headers = {
-                "Authorization": f"Bearer {API_KEYS['xai'][0]}",
-                "Content-Type": "application/json"
-            }
-            data = {"text": text, "model": model_id}
-            response = requests.post(
-                f"{API_BASE_URLS['xai']}/tokenize-text",
-                headers=headers,
-                json=data
-            )
-            return len(response.json()["token_ids"]) if response.ok else self.estimate_tokens(text)
-        except Exception as e:
-            print(f"Grok token计算失败: {str(e)}")
-            return self.estimate_tokens(text)
+        """使用Grok的tokenize-text API计算token数，超过延迟预算时使用tiktoken估算"""
+        return grok_tokenizer.count(text, model_id, self.estimate_tokens)
             
     def _count_deepseek_tokens(self, text: str) -> int:
         """使用tiktoken计算DeepSeek模型的token数"""
@@ -52,7 +126,21 @@ class TokenCounter:
         return len(self.encoder.encode(text)) if text else 0
 
     def estimate_image_tokens(self, image_path: str = None, base64_data: str = None) -> int:
-        """估算图片的token数（基于16x16分块）"""
+        """估算图片的token数（基于16x16分块），按文件哈希缓存"""
+        if base64_data:
+            key = ('image', _hash_text(base64_data))
+        elif image_path:
+            key = self._file_key(image_path)
+        else:
+            return 0
+        tokens = self._media_cache.get(key) if key else None
+        if tokens is None:
+            tokens = self._estimate_image_tokens(image_path, base64_data)
+            if key:
+                self._media_cache.put(key, tokens)
+        return tokens
+
+    def _estimate_image_tokens(self, image_path: str = None, base64_data: str = None) -> int:
         try:
             if base64_data:
                 img = Image.open(io.BytesIO(base64.b64decode(base64_data)))
@@ -69,7 +157,16 @@ class TokenCounter:
             return 0
 
     def estimate_video_tokens(self, video_path: str) -> int:
-        """估算视频token数（1fps采样+音频估算）"""
+        """估算视频token数（1fps采样+音频估算），按文件缓存"""
+        key = self._file_key(video_path)
+        tokens = self._media_cache.get(key) if key else None
+        if tokens is None:
+            tokens = self._estimate_video_tokens(video_path)
+            if key:
+                self._media_cache.put(key, tokens)
+        return tokens
+
+    def _estimate_video_tokens(self, video_path: str) -> int:
         try:
             cap = cv2.VideoCapture(video_path)
             if not cap.isOpened():
@@ -102,41 +199,105 @@ class TokenCounter:
         返回: (输入token数, 输出token数)
         """
         input_tokens, output_tokens = 0, 0
-        
+        family = self.model_family(model_id)
+
+        if model_id.startswith('grok'):
+            # 一次性并发请求所有文本，只等待一次延迟预算，逐条统计时直接使用这次的结果
+            texts = self._collect_texts(messages)
+            counts = dict(zip(texts, grok_tokenizer.count_many(texts, model_id, self.estimate_tokens)))
+
+            def count_text(text: str) -> int:
+                tokens = counts.get(text)
+                return self.estimate_tokens(text) if tokens is None else tokens
+
+            for message in messages:
+                tokens = self._estimate_single_message(message, model_id, count_text)
+                input_tokens += tokens[0]
+                output_tokens += tokens[1]
+            return input_tokens, output_tokens
+
+        for message in messages:
+            # 历史消息不会变化，按消息内容哈希缓存每条消息的结果
+            key = (family, self._message_hash(message))
+            cached = self._message_cache.get(key)
+            if cached is None:
+                cached = self._estimate_single_message(message, model_id)
+                self._message_cache.put(key, cached)
+            input_tokens += cached[0]
+            output_tokens += cached[1]
+
+        return input_tokens, output_tokens
+
+    @staticmethod
+    def _collect_texts(messages: List[Dict]) -> List[str]:
+        """收集消息中需要远程分词的文本"""
+        texts = []
         for message in messages:
-            role = message.get('role', '')
-            
-            # 处理OpenAI格式（content列表）
             if 'content' in message and isinstance(message['content'], list):
                 for item in message['content']:
-                    tokens = self._process_content_item(item, model_id)
-                    input_tokens, output_tokens = self._accumulate_tokens(role, tokens, input_tokens, output_tokens)
-            
-            # 处理Google格式（parts列表）
+                    if item.get('type') == 'text':
+                        texts.append(item.get('text', ''))
             elif 'parts' in message:
                 for part in message['parts']:
-                    tokens = self._process_part(part, model_id)
-                    input_tokens, output_tokens = self._accumulate_tokens(role, tokens, input_tokens, output_tokens)
-            
-            # 处理纯文本消息
+                    if not (isinstance(part, dict) and 'inline_data' in part):
+                        texts.append(str(part))
             else:
-                text = str(message.get('content', ''))
-                tokens = self.count_tokens_by_model(text, model_id)
+                texts.append(str(message.get('content', '')))
+        return texts
+
+    @staticmethod
+    def _message_hash(message: Dict) -> str:
+        """计算消息中参与token计算的字段的哈希"""
+        payload = {
+            'role': message.get('role', ''),
+            'content': message.get('content'),
+            'parts': message.get('parts')
+        }
+        raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+        return _hash_text(raw)
+
+    def _estimate_single_message(self, message: Dict, model_id: str,
+                                 count_text: Callable[[str], int] = None) -> Tuple[int, int]:
+        """
+        估算单条消息的token数，返回 (输入token数, 输出token数)
+
+        count_text 用于统计文本的token数，默认按模型计算
+        """
+        if count_text is None:
+            count_text = lambda text: self.count_tokens_by_model(text, model_id)
+        input_tokens, output_tokens = 0, 0
+        role = message.get('role', '')
+        
+        # 处理OpenAI格式（content列表）
+        if 'content' in message and isinstance(message['content'], list):
+            for item in message['content']:
+                tokens = self._process_content_item(item, count_text)
+                input_tokens, output_tokens = self._accumulate_tokens(role, tokens, input_tokens, output_tokens)
+        
+        # 处理Google格式（parts列表）
+        elif 'parts' in message:
+            for part in message['parts']:
+                tokens = self._process_part(part, count_text)
                 input_tokens, output_tokens = self._accumulate_tokens(role, tokens, input_tokens, output_tokens)
         
+        # 处理纯文本消息
+        else:
+            tokens = count_text(str(message.get('content', '')))
+            input_tokens, output_tokens = self._accumulate_tokens(role, tokens, input_tokens, output_tokens)
+
         return input_tokens, output_tokens
 
-    def _process_content_item(self, item: Dict, model_id: str) -> int:
+    def _process_content_item(self, item: Dict, count_text: Callable[[str], int]) -> int:
         """处理OpenAI格式的内容项"""
         if item.get('type') == 'text':
-            return self.count_tokens_by_model(item.get('text', ''), model_id)
+            return count_text(item.get('text', ''))
         elif 'image_url' in item:
             url = item['image_url'].get('url', '')
             if url.startswith('data:image/'):
                 return self.estimate_image_tokens(base64_data=url.split(',', 1)[1])
         return 0
 
-    def _process_part(self, part, model_id: str) -> int:
+    def _process_part(self, part, count_text: Callable[[str], int]) -> int:
         """处理Google格式的内容部分"""
         if isinstance(part, dict) and 'inline_data' in part:
             mime_type = part['inline_data'].get('mime_type', '')
@@ -145,15 +306,22 @@ class TokenCounter:
             if mime_type.startswith('image/'):
                 return self.estimate_image_tokens(base64_data=data)
             elif mime_type.startswith('video/'):
+                # 按内容哈希缓存，避免每次都解码并写入临时文件
+                key = ('video', _hash_text(data))
+                tokens = self._media_cache.get(key)
+                if tokens is not None:
+                    return tokens
                 try:
                     with tempfile.NamedTemporaryFile(suffix='.mp4', delete=True) as f:
                         f.write(base64.b64decode(data))
                         f.flush()
-                        return self.estimate_video_tokens(f.name)
+                        tokens = self._estimate_video_tokens(f.name)
+                    self._media_cache.put(key, tokens)
+                    return tokens
                 except Exception as e:
                     print(f"视频解码失败: {str(e)}")
                     return 0
-        return self.count_tokens_by_model(str(part), model_id)
+        return count_text(str(part))
 
     def _accumulate_tokens(self, role: str, tokens: int, input_tokens: int, output_tokens: int) -> Tuple[int, int]:
         """累加token到相应统计量，返回更新后的(input_tokens, output_tokens)"""
@@ -164,5 +332,7 @@ class TokenCounter:
         return input_tokens, output_tokens
 
     def estimate_completion_tokens(self, text: str, model_id: str = None) -> int:
-        """计算生成文本的token数量"""
-        return self.count_tokens_by_model(text, model_id) if model_id else self.estimate_tokens(text)
\ No newline at end of file
+        """计算生成文本的token数量（每次输出都不同，不经过缓存）"""
+        if not text:
+            return 0
+        return self._count_uncached(text, model_id) if model_id else self.estimate_tokens(text)
\ No newline at end of file
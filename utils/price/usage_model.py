@@ -1,8 +1,15 @@
 from initialization import db
-from datetime import datetime
+from datetime import datetime, date, time, timedelta
+from typing import Dict, List, Any
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from .price_model import PriceConfig
 
 class Usage(db.Model):
+    __table_args__ = (
+        # 按用户和时间范围查询用量
+        db.Index('ix_usage_user_created', 'user_id', 'created_at'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     model_name = db.Column(db.String(50), nullable=False)  # 使用的模型名称
@@ -91,30 +98,183 @@ class Usage(db.Model):
                      image_ocr_input_tokens=image_ocr_input_tokens,
                      image_ocr_output_tokens=image_ocr_output_tokens)
         usage.calculate_cost()  # 手动调用计算成本
+        if usage.created_at is None:
+            usage.created_at = datetime.utcnow()
         db.session.add(usage)
+        UsageRollup.apply([usage])
         db.session.commit()
         return usage
 
     @staticmethod
-    def get_user_usage(user_id, start_date=None, end_date=None):
-        """获取用户使用记录"""
+    def get_user_usage(user_id, start_date=None, end_date=None, limit=None):
+        """获取用户使用记录（按时间倒序，使用(user_id, created_at)索引）"""
         query = Usage.query.filter_by(user_id=user_id)
         
         if start_date:
             query = query.filter(Usage.created_at >= start_date)
         if end_date:
             query = query.filter(Usage.created_at <= end_date)
-            
+
+        query = query.order_by(Usage.created_at.desc())
+        if limit:
+            query = query.limit(limit)
         return query.all()
 
     @staticmethod
     def get_user_total_cost(user_id, start_date=None, end_date=None):
-        """获取用户总消费（美元）"""
-        query = Usage.query.filter_by(user_id=user_id)
-        
-        if start_date:
-            query = query.filter(Usage.created_at >= start_date)
-        if end_date:
-            query = query.filter(Usage.created_at <= end_date)
-            
-        return query.with_entities(db.func.sum(Usage.total_cost)).scalar() or 0.0 
\ No newline at end of file
+        """
+        获取用户总消费（美元）
+
+        完整的日期从汇总表读取，时间范围两端不满一天的部分才查询明细记录。
+        """
+        full_days, partial_ranges = UsageRollup.split_range(start_date, end_date)
+        total = 0.0
+        if full_days is not None:
+            query = db.session.query(db.func.sum(UsageRollup.total_cost)).filter(UsageRollup.user_id == user_id)
+            first_day, last_day = full_days
+            if first_day is not None:
+                query = query.filter(UsageRollup.day >= first_day)
+            if last_day is not None:
+                query = query.filter(UsageRollup.day <= last_day)
+            total += query.scalar() or 0.0
+        for range_start, range_end, end_inclusive in partial_ranges:
+            query = db.session.query(db.func.sum(Usage.total_cost)).filter(
+                Usage.user_id == user_id, Usage.created_at >= range_start)
+            query = query.filter(Usage.created_at <= range_end if end_inclusive else Usage.created_at < range_end)
+            total += query.scalar() or 0.0
+        return total
+
+
+class UsageRollup(db.Model):
+    """
+    按 (用户, 模型, 日期) 汇总的用量，写入用量记录时在同一事务中增量更新
+
+    日期按created_at的UTC日期划分。
+    """
+    __tablename__ = 'usage_rollup'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'model_name', 'day', name='uq_usage_rollup_user_model_day'),
+        db.Index('ix_usage_rollup_user_day', 'user_id', 'day'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    model_name = db.Column(db.String(50), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    requests = db.Column(db.Integer, default=0)  # 请求次数
+    tokens_in = db.Column(db.Integer, default=0)
+    cached_input_tokens = db.Column(db.Integer, default=0)
+    tokens_out = db.Column(db.Integer, default=0)
+    image_ocr_input_tokens = db.Column(db.Integer, default=0)
+    image_ocr_output_tokens = db.Column(db.Integer, default=0)
+    input_cost = db.Column(db.Float, default=0.0)
+    output_cost = db.Column(db.Float, default=0.0)
+    image_ocr_cost = db.Column(db.Float, default=0.0)
+    total_cost = db.Column(db.Float, default=0.0)
+
+    # 需要累加的列
+    SUM_COLUMNS = ('tokens_in', 'cached_input_tokens', 'tokens_out', 'image_ocr_input_tokens',
+                   'image_ocr_output_tokens', 'input_cost', 'output_cost', 'image_ocr_cost', 'total_cost')
+
+    @classmethod
+    def aggregate(cls, rows: List[Any]) -> List[Dict[str, Any]]:
+        """把用量记录（Usage对象或字典）按 (用户, 模型, 日期) 合并"""
+        groups = {}
+        for row in rows:
+            get = row.get if isinstance(row, dict) else (lambda name, default=None, _row=row: getattr(_row, name, default))
+            created_at = get('created_at') or datetime.utcnow()
+            key = (get('user_id'), get('model_name'), created_at.date())
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = {'user_id': key[0], 'model_name': key[1], 'day': key[2], 'requests': 0}
+                for column in cls.SUM_COLUMNS:
+                    group[column] = 0
+            # 明细记录每条计一次请求，修正费用时传入requests=0只调整金额
+            requests = get('requests')
+            group['requests'] += 1 if requests is None else requests
+            for column in cls.SUM_COLUMNS:
+                group[column] += get(column) or 0
+        return list(groups.values())
+
+    @classmethod
+    def apply(cls, rows: List[Any], sign: int = 1) -> int:
+        """
+        把一批用量记录累加到汇总表（调用方负责提交事务）
+
+        Args:
+            rows: Usage对象或与Usage列同名的字典
+            sign: 1为累加，-1为扣除（删除或重新计价时使用）
+
+        Returns:
+            int: 更新的汇总行数
+        """
+        groups = cls.aggregate(rows)
+        if not groups:
+            return 0
+        if sign != 1:
+            for group in groups:
+                for column in cls.SUM_COLUMNS + ('requests',):
+                    group[column] = -group[column]
+        table = cls.__table__
+        stmt = sqlite_insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['user_id', 'model_name', 'day'],
+            set_={column: table.c[column] + stmt.excluded[column] for column in cls.SUM_COLUMNS + ('requests',)}
+        )
+        db.session.execute(stmt, groups)
+        return len(groups)
+
+    @staticmethod
+    def split_range(start_date=None, end_date=None):
+        """
+        把查询范围拆分为汇总表中的完整日期和需要查询明细的零散时间段
+
+        Returns:
+            (full_days, partial_ranges):
+                full_days为 (首日, 末日)，None表示不限，整体为None时没有完整的日期；
+                partial_ranges为 [(开始时间, 结束时间, 是否包含结束时间)]
+        """
+        if isinstance(start_date, date) and not isinstance(start_date, datetime):
+            start_date = datetime.combine(start_date, time.min)
+        if isinstance(end_date, date) and not isinstance(end_date, datetime):
+            # 只给日期时包含当天全部记录
+            end_date = datetime.combine(end_date, time.max)
+
+        first_day = None
+        partial_ranges = []
+        if start_date is not None:
+            first_day = start_date.date()
+            if start_date.time() != time.min:
+                first_day += timedelta(days=1)
+        last_day = None
+        if end_date is not None:
+            last_day = end_date.date()
+            if end_date.time() != time.max:
+                last_day -= timedelta(days=1)
+
+        if first_day is not None and last_day is not None and first_day > last_day:
+            # 范围不足一整天，全部查询明细
+            return None, [(start_date, end_date, True)]
+        if start_date is not None and start_date.time() != time.min:
+            partial_ranges.append((start_date, datetime.combine(first_day, time.min), False))
+        if end_date is not None and end_date.time() != time.max:
+            partial_ranges.append((datetime.combine(last_day + timedelta(days=1), time.min), end_date, True))
+        return (first_day, last_day), partial_ranges
+
+    @classmethod
+    def get_user_summary(cls, user_id, start_day=None, end_day=None, by_model=True) -> List[Dict[str, Any]]:
+        """按日期（和模型）返回用户的用量汇总"""
+        columns = [cls.day] + ([cls.model_name] if by_model else [])
+        sums = [db.func.sum(getattr(cls, column)).label(column) for column in ('requests',) + cls.SUM_COLUMNS]
+        query = db.session.query(*columns, *sums).filter(cls.user_id == user_id)
+        if start_day is not None:
+            query = query.filter(cls.day >= start_day)
+        if end_day is not None:
+            query = query.filter(cls.day <= end_day)
+        query = query.group_by(*columns).order_by(cls.day.desc())
+        results = []
+        for row in query.all():
+            item = dict(row._mapping)
+            item['day'] = item['day'].isoformat()
+            results.append(item)
+        return results 
\ No newline at end of file
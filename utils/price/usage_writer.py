@@ -0,0 +1,240 @@
+import os
+import glob
+import json
+import time
+import uuid
+import fcntl
+import queue
+import atexit
+import threading
+from datetime import datetime
+from typing import Dict, List, Any
+
+from initialization import app, db
+from utils.price.usage_model import Usage, UsageRollup
+from utils.logger import get_logger
+from utils.sqlite_writer import backoff_delay
+
+logger = get_logger(__name__)
+
+
+class UsageWriter:
+    """
+    用量记录的后台批量写入器
+
+    请求结束时只把计算好费用的记录放入队列，由后台线程合并为一个事务批量写入，
+    避免每个流式响应结束时都在SQLite写锁上排队。
+
+    - 队列满时退化为在调用线程中直接写入，不丢失计费数据
+    - 批量写入多次失败后，记录追加到溢出文件，下次启动时由后台线程重新写入；
+      多个worker共享溢出文件，重新写入时持有文件锁，同一时间只有一个进程在处理
+    - 进程退出时（atexit、gunicorn worker_exit、ASGI lifespan）会写完队列中的全部记录
+    """
+
+    # 队列容量
+    DEFAULT_MAX_QUEUE = 10000
+    # 单个事务最多写入的记录数
+    DEFAULT_BATCH_SIZE = 200
+    # 收到第一条记录后最多等待多久凑成一批（秒）
+    DEFAULT_FLUSH_INTERVAL = 0.5
+    # 批量写入的重试次数
+    MAX_RETRIES = 3
+    # 写入失败的记录保存位置
+    SPILL_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                              'usage_spill.jsonl')
+
+    def __init__(self, max_queue: int = DEFAULT_MAX_QUEUE, batch_size: int = DEFAULT_BATCH_SIZE,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'written': 0,
+            'batches': 0,
+            'inline_writes': 0,
+            'spilled': 0,
+            'last_batch_size': 0,
+            'last_flush_at': None
+        }
+
+    @staticmethod
+    def to_row(usage: Usage) -> Dict[str, Any]:
+        """把已计算费用的Usage对象转换为可批量插入的字典"""
+        row = {}
+        for column in Usage.__table__.columns:
+            if column.name == 'id':
+                continue
+            row[column.name] = getattr(usage, column.name)
+        # 创建时间以请求结束时为准，而不是写入时
+        if row.get('created_at') is None:
+            row['created_at'] = datetime.utcnow()
+        return row
+
+    def submit(self, usage: Usage) -> None:
+        """提交一条用量记录，不等待写入"""
+        row = self.to_row(usage)
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            logger.warning("用量写入队列已满(%d)，改为直接写入", self._queue.qsize())
+            self._write_with_retry([row])
+            with self._stats_lock:
+                self._stats['inline_writes'] += 1
+
+    def queue_depth(self) -> int:
+        """当前等待写入的记录数"""
+        return self._queue.qsize()
+
+    def stats(self) -> Dict[str, Any]:
+        """写入器的运行指标"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queue_depth'] = self.queue_depth()
+        stats['running'] = self._thread is not None and self._thread.is_alive()
+        return stats
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='usage-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        self._replay_spill()
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = self._collect_batch()
+            if batch:
+                self._write_with_retry(batch)
+
+    def _collect_batch(self) -> List[Dict[str, Any]]:
+        """等待第一条记录，然后在flush_interval内尽量凑满一批"""
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stopping.is_set():
+                # 停止时不再等待，直接取出已有的记录
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_with_retry(self, rows: List[Dict[str, Any]]) -> None:
+        for attempt in range(1, self.MAX_RETRIES + 1):
+            try:
+                with app.app_context():
+                    db.session.bulk_insert_mappings(Usage, rows)
+                    # 汇总表与明细在同一事务中更新，不会出现不一致
+                    UsageRollup.apply(rows)
+                    db.session.commit()
+                with self._stats_lock:
+                    self._stats['written'] += len(rows)
+                    self._stats['batches'] += 1
+                    self._stats['last_batch_size'] = len(rows)
+                    self._stats['last_flush_at'] = datetime.utcnow().isoformat()
+                logger.debug("批量写入用量记录 %d 条，剩余队列 %d", len(rows), self.queue_depth())
+                return
+            except Exception as e:
+                with app.app_context():
+                    db.session.rollback()
+                logger.warning("批量写入用量记录失败(第%d次): %s", attempt, e)
+                time.sleep(backoff_delay(attempt - 1, base_delay=0.2))
+        self._spill(rows)
+
+    def _spill(self, rows: List[Dict[str, Any]]) -> None:
+        """多次写入失败的记录追加到溢出文件"""
+        try:
+            with open(self.SPILL_FILE, 'a', encoding='utf-8') as f:
+                for row in rows:
+                    f.write(json.dumps(row, default=str, ensure_ascii=False) + '\n')
+            with self._stats_lock:
+                self._stats['spilled'] += len(rows)
+            logger.error("用量记录写入失败，已保存到 %s (%d 条)", self.SPILL_FILE, len(rows))
+        except Exception as e:
+            logger.error("保存用量溢出文件失败，丢失 %d 条记录: %s", len(rows), e, exc_info=True)
+
+    def _replay_spill(self) -> None:
+        """
+        启动时重新写入溢出文件中的记录
+
+        持有文件锁期间把溢出文件改名为本进程独有的 .replay 文件再写入，
+        之前进程中途退出留下的 .replay 文件也一并重新写入；
+        拿不到锁说明其它worker正在处理，直接跳过。
+        """
+        pattern = glob.escape(self.SPILL_FILE) + '*.replay'
+        if not os.path.exists(self.SPILL_FILE) and not glob.glob(pattern):
+            return
+        try:
+            with open(self.SPILL_FILE + '.lock', 'w') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return
+                try:
+                    if os.path.exists(self.SPILL_FILE):
+                        os.replace(self.SPILL_FILE, f"{self.SPILL_FILE}.{os.getpid()}-{uuid.uuid4().hex}.replay")
+                    for replay_path in sorted(glob.glob(pattern)):
+                        self._replay_file(replay_path)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        except Exception as e:
+            logger.error("重新写入用量溢出文件失败: %s", e, exc_info=True)
+
+    def _replay_file(self, replay_path: str) -> None:
+        """写入一个 .replay 文件中的记录，完成后删除该文件"""
+        try:
+            rows = []
+            with open(replay_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        row = json.loads(line)
+                        if row.get('created_at'):
+                            row['created_at'] = datetime.fromisoformat(row['created_at'])
+                        rows.append(row)
+            for i in range(0, len(rows), self.batch_size):
+                self._write_with_retry(rows[i:i + self.batch_size])
+            os.remove(replay_path)
+            logger.info("已重新写入溢出的用量记录 %d 条", len(rows))
+        except Exception as e:
+            logger.error("重新写入用量溢出文件失败: %s", e, exc_info=True)
+
+    def shutdown(self, timeout: float = 30.0) -> None:
+        """写完队列中的全部记录后停止后台线程"""
+        thread = self._thread
+        self._stopping.set()
+        if thread is not None and thread.is_alive():
+            thread.join(timeout)
+        # 线程未启动或未能在超时内完成时，在当前线程写完剩余记录
+        remaining = []
+        while True:
+            try:
+                remaining.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        for i in range(0, len(remaining), self.batch_size):
+            self._write_with_retry(remaining[i:i + self.batch_size])
+        if remaining or thread is not None:
+            logger.info("用量写入器已停止，退出前写入 %d 条", len(remaining))
+
+
+# 创建全局实例
+usage_writer = UsageWriter()
+atexit.register(usage_writer.shutdown)
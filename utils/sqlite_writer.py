@@ -0,0 +1,261 @@
+import time
+import queue
+import random
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Callable, ContextManager, Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# 连接级PRAGMA：WAL允许读写并发，NORMAL同步在WAL下仍然保证崩溃一致性
+# 等待写锁的时间（busy_timeout）由连接参数timeout决定（见initialization.py的connect_args），这里不再覆盖
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('temp_store', 'MEMORY'),
+    ('cache_size', -16000),   # 每个连接约16MB页缓存
+)
+
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS:
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+
+def configure_sqlite_engine(engine) -> None:
+    """为SQLite引擎的每个新连接设置WAL等PRAGMA，其它数据库不做处理"""
+    if engine.dialect.name != 'sqlite':
+        return
+    if not event.contains(engine, 'connect', _apply_sqlite_pragmas):
+        event.listen(engine, 'connect', _apply_sqlite_pragmas)
+    # 已经建立的连接不会触发connect事件，丢弃后按新设置重新连接
+    engine.dispose()
+
+
+def is_locked_error(exc: BaseException) -> bool:
+    """是否是SQLite的锁冲突（可以重试）"""
+    if not isinstance(exc, OperationalError):
+        return False
+    message = str(exc.orig if getattr(exc, 'orig', None) is not None else exc).lower()
+    return 'database is locked' in message or 'database is busy' in message or 'database table is locked' in message
+
+
+def backoff_delay(attempt: int, base_delay: float = 0.05, max_delay: float = 2.0) -> float:
+    """指数退避并加入随机抖动，避免多个进程同时重试"""
+    delay = min(max_delay, base_delay * (2 ** attempt))
+    return delay * (0.5 + random.random() / 2)
+
+
+def retry_on_locked(fn: Callable[[], Any], retries: int = 5, base_delay: float = 0.05,
+                    on_retry: Optional[Callable[[], None]] = None) -> Any:
+    """
+    执行fn，遇到database is locked时按指数退避重试
+
+    Args:
+        fn: 要执行的事务函数，重试前会调用on_retry（通常是session.rollback）
+        retries: 最多重试次数
+        base_delay: 第一次重试前的等待时间（秒）
+    """
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except OperationalError as e:
+            if not is_locked_error(e) or attempt >= retries:
+                raise
+            if on_retry is not None:
+                on_retry()
+            delay = backoff_delay(attempt, base_delay)
+            logger.debug("SQLite写锁冲突，%.0fms后第%d次重试", delay * 1000, attempt + 1)
+            time.sleep(delay)
+
+
+def flask_session_scope(app, db) -> Callable[[], ContextManager]:
+    """生成写入队列使用的会话作用域：每批写入在独立的应用上下文中使用db.session"""
+    @contextmanager
+    def scope():
+        with app.app_context():
+            try:
+                yield db.session
+            finally:
+                db.session.remove()
+    return scope
+
+
+class _WriteItem:
+    __slots__ = ('fn', 'future')
+
+    def __init__(self, fn: Callable, future: Future):
+        self.fn = fn
+        self.future = future
+
+
+class _ItemFailed(Exception):
+    """批次中的某个写入函数抛出了非锁冲突的异常"""
+
+    def __init__(self, index: int, error: BaseException):
+        super().__init__(str(error))
+        self.index = index
+        self.error = error
+
+
+class WriteQueue:
+    """
+    进程内的单写入队列
+
+    同一进程中的写事务由一个后台线程串行执行，短时间内到达的多个小事务合并为一次提交，
+    减少SQLite写锁的获取次数和fsync次数；多个gunicorn进程之间的竞争由WAL、busy_timeout
+    和锁冲突重试处理。
+
+    写入函数接收会话参数，在写入线程中执行，只应返回普通数据（ORM对象在提交后会脱离会话）。
+    批次中某个函数抛出异常时整批回滚，该函数的调用方收到异常，其余函数重新执行。
+    """
+
+    # 收到第一个写入后最多等待多久凑成一批（秒）
+    DEFAULT_BATCH_WINDOW = 0.005
+    # 每批最多合并的写入数
+    DEFAULT_MAX_BATCH = 32
+    # 锁冲突的重试次数
+    MAX_RETRIES = 6
+
+    def __init__(self, session_scope: Callable[[], ContextManager], batch_window: float = DEFAULT_BATCH_WINDOW,
+                 max_batch: int = DEFAULT_MAX_BATCH):
+        self.session_scope = session_scope
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'transactions': 0,
+            'writes': 0,
+            'retries': 0,
+            'failed': 0,
+            'max_batch': 0
+        }
+
+    def submit(self, fn: Callable[[Any], Any]) -> Future:
+        """提交一个写入函数，返回Future"""
+        future = Future()
+        self._ensure_started()
+        self._queue.put(_WriteItem(fn, future))
+        return future
+
+    def execute(self, fn: Callable[[Any], Any], timeout: Optional[float] = 60) -> Any:
+        """提交写入函数并等待提交完成，返回函数的返回值或抛出其异常"""
+        if threading.current_thread() is self._thread:
+            # 写入线程内嵌套调用时直接执行，避免等待自己
+            with self.session_scope() as session:
+                result = fn(session)
+                session.commit()
+                return result
+        return self.submit(fn).result(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queue_depth'] = self._queue.qsize()
+        return stats
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='sqlite-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect_batch()
+            try:
+                self._execute_batch(batch)
+            except Exception as e:
+                # 兜底：不能让写入线程退出，否则后续写入全部挂起
+                logger.error("写入批次执行失败: %s", e, exc_info=True)
+                for item in batch:
+                    if not item.future.done():
+                        item.future.set_exception(e)
+
+    def _collect_batch(self) -> List[_WriteItem]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _execute_batch(self, batch: List[_WriteItem]) -> None:
+        pending = [item for item in batch if item.future.set_running_or_notify_cancel()]
+        self._run_items(pending)
+
+    def _run_items(self, pending: List[_WriteItem]) -> None:
+        while pending:
+            try:
+                results = self._commit_with_retry(pending)
+            except _ItemFailed as failed:
+                item = pending.pop(failed.index)
+                item.future.set_exception(failed.error)
+                with self._stats_lock:
+                    self._stats['failed'] += 1
+                continue
+            except Exception as e:
+                if len(pending) > 1 and not is_locked_error(e):
+                    # 提交时失败无法确定是哪个写入导致的，逐个重新执行
+                    for item in pending:
+                        self._run_items([item])
+                    return
+                # 重试耗尽等整批失败的情况
+                for item in pending:
+                    item.future.set_exception(e)
+                with self._stats_lock:
+                    self._stats['failed'] += len(pending)
+                return
+            for item, result in zip(pending, results):
+                item.future.set_result(result)
+            with self._stats_lock:
+                self._stats['transactions'] += 1
+                self._stats['writes'] += len(pending)
+                self._stats['max_batch'] = max(self._stats['max_batch'], len(pending))
+            return
+
+    def _commit_with_retry(self, items: List[_WriteItem]) -> List[Any]:
+        for attempt in range(self.MAX_RETRIES + 1):
+            with self.session_scope() as session:
+                try:
+                    results = []
+                    for index, item in enumerate(items):
+                        try:
+                            results.append(item.fn(session))
+                            # 立即flush，让约束冲突等错误归属到对应的写入函数
+                            session.flush()
+                        except Exception as e:
+                            if is_locked_error(e):
+                                raise
+                            raise _ItemFailed(index, e) from e
+                    session.commit()
+                    return results
+                except OperationalError as e:
+                    session.rollback()
+                    if not is_locked_error(e) or attempt >= self.MAX_RETRIES:
+                        raise
+                except BaseException:
+                    session.rollback()
+                    raise
+            with self._stats_lock:
+                self._stats['retries'] += 1
+            time.sleep(backoff_delay(attempt))
@@ -0,0 +1,133 @@
+import os
+import hashlib
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from utils.logger import get_logger
+
+try:
+    import config
+except ImportError:
+    config = None
+
+logger = get_logger(__name__)
+
+
+class EmbeddingCache:
+    """
+    按内容寻址的分块嵌入缓存（每个用户一份，保存在 <用户目录>/embedding_cache/）
+
+    键是 sha256(模型 + 分块文本)，值是该分块的向量（float32 .npy）。同一用户重复上传或重新保存相同的文本时，
+    内容没有变化的分块直接使用缓存，不再调用嵌入接口；删除文本文件不会删除缓存。
+
+    缓存按LRU淘汰：命中时更新文件的修改时间，总大小超过max_bytes时删除最久未使用的条目，直到低于上限的90%。
+    """
+
+    DIR_NAME = 'embedding_cache'
+    # 每个用户缓存的大小上限（字节），默认256MB，约2万个text-embedding-3-large分块
+    DEFAULT_MAX_BYTES = getattr(config, 'EMBEDDING_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+    EVICT_TARGET = 0.9
+
+    # 进程内估算的各缓存目录大小，超过上限时才扫描目录
+    _sizes: Dict[str, int] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, user_dir: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.root = Path(user_dir) / self.DIR_NAME
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key_for(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode('utf-8', 'surrogatepass')).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        # 按前两位分目录，避免单个目录中文件过多
+        return self.root / key[:2] / f"{key}.npy"
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """查找一组分块的向量，未命中的位置为None"""
+        results = []
+        hits = 0
+        for text in texts:
+            path = self._path(self.key_for(model, text))
+            try:
+                vector = np.load(str(path))
+                os.utime(str(path))
+                hits += 1
+            except (OSError, ValueError):
+                vector = None
+            results.append(vector)
+        if texts:
+            logger.info("嵌入缓存命中 %d/%d 个分块", hits, len(texts))
+        return results
+
+    def put_many(self, model: str, texts: List[str], vectors) -> None:
+        """保存一组分块的向量，写入失败只记录日志"""
+        added = 0
+        for text, vector in zip(texts, vectors):
+            path = self._path(self.key_for(model, text))
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with open(str(tmp_path), 'wb') as f:
+                    np.save(f, np.asarray(vector, dtype=np.float32))
+                os.replace(str(tmp_path), str(path))
+                added += os.path.getsize(str(path))
+            except OSError as e:
+                logger.warning("写入嵌入缓存失败: %s", e)
+        if added:
+            self._account(added)
+
+    def _account(self, added: int) -> None:
+        root = str(self.root)
+        with self._lock:
+            size = self._sizes.get(root)
+            if size is None:
+                size = self._scan_size()
+            else:
+                size += added
+            self._sizes[root] = size
+            if size <= self.max_bytes:
+                return
+            self._sizes[root] = self.evict()
+
+    def _scan_size(self) -> int:
+        total = 0
+        for entry in self._iter_entries():
+            total += entry.stat().st_size
+        return total
+
+    def _iter_entries(self):
+        if not self.root.exists():
+            return
+        for shard in os.scandir(str(self.root)):
+            if shard.is_dir():
+                for entry in os.scandir(shard.path):
+                    if entry.name.endswith('.npy'):
+                        yield entry
+
+    def evict(self) -> int:
+        """删除最久未使用的条目直到总大小低于上限的90%，返回剩余大小"""
+        entries = []
+        total = 0
+        for entry in self._iter_entries():
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        target = int(self.max_bytes * self.EVICT_TARGET)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                removed += 1
+            except OSError:
+                pass
+        if removed:
+            logger.info("嵌入缓存 %s 淘汰 %d 个条目，剩余 %.1f MB", self.root, removed, total / 1024 / 1024)
+        return total
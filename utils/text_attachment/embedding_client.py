@@ -0,0 +1,236 @@
+import re
+import time
+import asyncio
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import openai
+from openai import AsyncOpenAI
+
+from initialization import oaipro_async_client
+from utils.logger import get_logger
+from utils.price.tokenCounter import get_shared_encoder
+
+logger = get_logger(__name__)
+
+
+class EmbeddingError(Exception):
+    """嵌入向量生成失败（重试后仍失败，或返回的数据不完整）"""
+    pass
+
+
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """解析限流响应头中的时长（如 '1s'、'6m0s'、'20ms'），返回秒数"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|s|m|h)', value)
+    if not parts:
+        return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+class AdaptiveConcurrency:
+    """
+    进程内共享的自适应并发限制（AIMD）
+
+    - 收到429时并发减半，并在Retry-After或重置时间之前暂停所有请求
+    - 连续成功的请求数达到当前并发数时并发加一
+    - 响应头显示剩余请求数或token数不足时，等到限额重置再发下一个请求
+
+    文本后台处理在各自线程的事件循环中运行，所以状态用线程锁保护，等待时轮询而不依赖某个事件循环。
+    """
+
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, initial: int = 4, minimum: int = 1, maximum: int = 16):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._successes = 0
+        self._lock = threading.Lock()
+
+    async def acquire(self) -> None:
+        while True:
+            with self._lock:
+                if self.in_flight < self.limit and time.monotonic() >= self.paused_until:
+                    self.in_flight += 1
+                    return
+                wait = max(self.paused_until - time.monotonic(), self.POLL_INTERVAL)
+            await asyncio.sleep(min(wait, 1.0))
+
+    def release(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+    def on_success(self, headers: Dict[str, str], batch_tokens: int) -> None:
+        """根据响应头调整：剩余额度不够下一批时暂停到额度重置"""
+        remaining_requests = headers.get('x-ratelimit-remaining-requests')
+        remaining_tokens = headers.get('x-ratelimit-remaining-tokens')
+        pause = None
+        if remaining_requests is not None and remaining_requests.isdigit() and int(remaining_requests) == 0:
+            pause = parse_reset_duration(headers.get('x-ratelimit-reset-requests'))
+        if remaining_tokens is not None and remaining_tokens.isdigit() and int(remaining_tokens) < batch_tokens:
+            pause = max(pause or 0.0, parse_reset_duration(headers.get('x-ratelimit-reset-tokens')) or 0.0)
+        with self._lock:
+            self._successes += 1
+            if self._successes >= self.limit:
+                self._successes = 0
+                self.limit = min(self.maximum, self.limit + 1)
+            if pause:
+                self.paused_until = max(self.paused_until, time.monotonic() + pause)
+
+    def on_rate_limited(self, retry_after: Optional[float]) -> float:
+        """收到429：并发减半并暂停，返回暂停的秒数"""
+        with self._lock:
+            self.limit = max(self.minimum, self.limit // 2)
+            self._successes = 0
+            pause = retry_after if retry_after is not None else 1.0
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+        logger.warning("嵌入请求被限流，并发降为 %d，暂停 %.1f 秒", self.limit, pause)
+        return pause
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'limit': self.limit, 'in_flight': self.in_flight,
+                    'paused_for': max(0.0, round(self.paused_until - time.monotonic(), 3))}
+
+
+class AsyncEmbeddingClient:
+    """
+    批量异步生成嵌入向量
+
+    把多个文本块按token数打包到同一个请求的input列表中（每个请求不超过MAX_BATCH_TOKENS和MAX_BATCH_INPUTS），
+    请求并发由AdaptiveConcurrency按429和限流响应头调整；重试后仍失败时抛出EmbeddingError，不返回零向量。
+    """
+
+    MAX_INPUT_TOKENS = 8191      # 单个输入的token上限
+    MAX_BATCH_TOKENS = 100000    # 每个请求的token总数上限（接口上限为300000，留出余量）
+    MAX_BATCH_INPUTS = 512       # 每个请求的输入数上限
+    MAX_RETRIES = 5
+
+    # 可以重试的错误：限流、超时、连接错误和服务端错误
+    RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError,
+                        openai.InternalServerError)
+
+    def __init__(self, template_client: AsyncOpenAI, concurrency: AdaptiveConcurrency = None):
+        self.template_client = template_client
+        self.concurrency = concurrency or AdaptiveConcurrency()
+
+    def _new_client(self) -> AsyncOpenAI:
+        """
+        为当前事件循环创建客户端
+
+        文本后台任务各自新建并关闭事件循环，共享的httpx连接池不能跨事件循环使用；
+        重试由本类控制，客户端自身不重试。
+        """
+        return AsyncOpenAI(api_key=self.template_client.api_key, base_url=self.template_client.base_url,
+                           max_retries=0)
+
+    def _prepare(self, texts: List[str]) -> Tuple[List[Any], List[int]]:
+        """计算每个输入的token数，超过单个输入上限的截断（以token列表提交）"""
+        encoder = get_shared_encoder()
+        inputs = []
+        counts = []
+        for text in texts:
+            tokens = encoder.encode(text, disallowed_special=())
+            if len(tokens) > self.MAX_INPUT_TOKENS:
+                logger.warning("文本块有 %d 个token，截断为 %d", len(tokens), self.MAX_INPUT_TOKENS)
+                inputs.append(tokens[:self.MAX_INPUT_TOKENS])
+                counts.append(self.MAX_INPUT_TOKENS)
+            else:
+                inputs.append(text)
+                counts.append(len(tokens))
+        return inputs, counts
+
+    def pack(self, counts: List[int]) -> List[Tuple[int, int]]:
+        """按token数把输入依次分成若干批，返回每批的 (起始下标, 结束下标)"""
+        batches = []
+        start = 0
+        batch_tokens = 0
+        for i, count in enumerate(counts):
+            if i > start and (batch_tokens + count > self.MAX_BATCH_TOKENS or i - start >= self.MAX_BATCH_INPUTS):
+                batches.append((start, i))
+                start = i
+                batch_tokens = 0
+            batch_tokens += count
+        if start < len(counts):
+            batches.append((start, len(counts)))
+        return batches
+
+    async def _request(self, client: AsyncOpenAI, model: str, inputs: List[Any], batch_tokens: int) -> List[List[float]]:
+        """发送一批输入，按429和临时错误重试"""
+        for attempt in range(self.MAX_RETRIES + 1):
+            await self.concurrency.acquire()
+            raw = None
+            delay = 0
+            try:
+                raw = await client.embeddings.with_raw_response.create(model=model, input=inputs)
+            except openai.RateLimitError as e:
+                if attempt >= self.MAX_RETRIES:
+                    raise EmbeddingError(f"获取嵌入向量失败（已重试{self.MAX_RETRIES}次）: {str(e)}") from e
+                headers = e.response.headers
+                retry_after = parse_reset_duration(headers.get('retry-after')) or \
+                    parse_reset_duration(headers.get('x-ratelimit-reset-requests'))
+                self.concurrency.on_rate_limited(retry_after)
+            except self.RETRYABLE_ERRORS as e:
+                if attempt >= self.MAX_RETRIES:
+                    raise EmbeddingError(f"获取嵌入向量失败（已重试{self.MAX_RETRIES}次）: {str(e)}") from e
+                delay = 2 ** attempt
+                logger.warning("嵌入请求失败，%d 秒后重试: %s", delay, e)
+            except openai.APIError as e:
+                raise EmbeddingError(f"获取嵌入向量失败: {str(e)}") from e
+            finally:
+                self.concurrency.release()
+
+            if raw is None:
+                # 限流时由AdaptiveConcurrency统一暂停；其它临时错误指数退避，等待时不占用并发名额
+                await asyncio.sleep(delay)
+                continue
+            self.concurrency.on_success(raw.headers, batch_tokens)
+            data = sorted(raw.parse().data, key=lambda item: item.index)
+            if len(data) != len(inputs):
+                raise EmbeddingError(f"嵌入接口返回了 {len(data)} 个向量，请求了 {len(inputs)} 个")
+            return [item.embedding for item in data]
+
+    async def embed(self, texts: List[str], model: str) -> np.ndarray:
+        """
+        生成一组文本的嵌入向量
+
+        Returns:
+            np.ndarray: (文本数, 维度) 的float32矩阵，顺序与texts一致
+
+        Raises:
+            EmbeddingError: 任一批重试后仍失败
+        """
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        inputs, counts = self._prepare(texts)
+        batches = self.pack(counts)
+        started = time.perf_counter()
+        async with self._new_client() as client:
+            tasks = [asyncio.ensure_future(self._request(client, model, inputs[start:end], sum(counts[start:end])))
+                     for start, end in batches]
+            try:
+                results = await asyncio.gather(*tasks)
+            except BaseException:
+                # 一批失败时取消其余请求，整个文件的嵌入视为失败
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+        vectors = np.asarray([vector for batch in results for vector in batch], dtype=np.float32)
+        logger.info("生成 %d 个嵌入向量（%d 个请求，%d tokens），耗时 %.2f 秒",
+                    len(texts), len(batches), sum(counts), time.perf_counter() - started)
+        return vectors
+
+
+# 创建全局实例
+embedding_client = AsyncEmbeddingClient(oaipro_async_client)
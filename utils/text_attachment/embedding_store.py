@@ -0,0 +1,259 @@
+import os
+import json
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import config
+except ImportError:
+    config = None
+
+
+def normalize_rows(matrix) -> np.ndarray:
+    """把每一行缩放为单位长度（float32），零向量保持为零"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    每一行得分最高的k个下标（按得分降序）
+
+    先用argpartition在O(n)内选出前k个，只对这k个排序
+
+    Args:
+        scores: (查询数, 候选数) 或 (候选数,) 的得分
+        k: 返回数量，超过候选数时返回全部
+    """
+    n = scores.shape[-1]
+    k = min(k, n)
+    if k <= 0:
+        return np.empty(scores.shape[:-1] + (0,), dtype=np.intp)
+    if k < n:
+        part = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    else:
+        part = np.broadcast_to(np.arange(n), scores.shape).copy()
+    order = np.argsort(-np.take_along_axis(scores, part, axis=-1), axis=-1, kind='stable')
+    return np.take_along_axis(part, order, axis=-1)
+
+
+class EmbeddingStore:
+    """
+    文本附件嵌入向量的二进制存储
+
+    每个文件的嵌入保存在 embeddings/<file_id>/ 目录下：
+    - vectors-<版本>.npy: 连续的 (分块数, 维度) 矩阵，每行已归一化为单位长度，默认float32，可选float16；
+      搜索时用mmap打开，不需要整体读入内存，余弦相似度就是一次矩阵向量乘法
+    - chunks-<版本>.txt: 所有分块文本按UTF-8顺序拼接
+    - chunks.json: 元数据、当前版本的向量和文本文件名，以及每个分块在文本文件中的字节偏移、长度和行号范围
+
+    每次保存都写入新版本的向量和文本文件，最后原子替换chunks.json切换到新版本，
+    因此读取者看到的矩阵、文本和元数据总是同一次保存的结果；上一个版本的文件保留给正在读取的请求。
+    chunks.json存在即表示该文件的嵌入已完整保存。
+    旧版本的 embeddings.json 仍可读取，可用 migrations/convert_embeddings_to_npy.py 批量转换。
+    """
+
+    VECTORS_FILE = 'vectors.npy'
+    TEXT_FILE = 'chunks.txt'
+    META_FILE = 'chunks.json'
+    LEGACY_FILE = 'embeddings.json'
+    DTYPES = ('float32', 'float16')
+    # float16可以减半磁盘占用和页缓存，相似度误差约1e-3
+    DEFAULT_DTYPE = getattr(config, 'EMBEDDING_DTYPE', 'float32')
+
+    @staticmethod
+    def file_dir(base_path: str, file_id: str) -> Path:
+        return Path(base_path) / 'embeddings' / file_id
+
+    @staticmethod
+    def _atomic_write(path: Path, write) -> None:
+        """先写临时文件再替换，搜索时不会读到写了一半的文件"""
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}-{uuid.uuid4().hex}.tmp")
+        with open(str(tmp_path), 'wb') as f:
+            write(f)
+        os.replace(str(tmp_path), str(path))
+
+    @classmethod
+    def save(cls, base_path: str, file_id: str, chunks: List[str], embeddings,
+             line_ranges: List[Dict[str, int]], metadata: Dict[str, Any], dtype: str = DEFAULT_DTYPE) -> Path:
+        """
+        保存一个文件的分块和嵌入向量
+
+        Args:
+            chunks: 分块文本
+            embeddings: 与分块一一对应的向量（列表或矩阵）
+            line_ranges: 每块的行号范围
+            metadata: 写入chunks.json的其它信息（模型、文本类型等）
+            dtype: 向量的存储类型，float32或float16
+
+        Returns:
+            Path: 向量文件路径
+        """
+        if dtype not in cls.DTYPES:
+            raise ValueError(f"不支持的向量类型: {dtype}")
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        if matrix.ndim != 2 or matrix.shape[0] != len(chunks):
+            raise ValueError(f"向量数量与分块数量不一致: {matrix.shape} / {len(chunks)}")
+
+        file_dir = cls.file_dir(base_path, file_id)
+        file_dir.mkdir(parents=True, exist_ok=True)
+
+        encoded = [chunk.encode('utf-8') for chunk in chunks]
+        chunk_entries = []
+        offset = 0
+        for data, line_range in zip(encoded, line_ranges):
+            chunk_entries.append({
+                'offset': offset,
+                'length': len(data),
+                'start_line': line_range['start_line'],
+                'end_line': line_range['end_line']
+            })
+            offset += len(data)
+
+        # 保存时归一化，搜索时不再计算范数
+        matrix = normalize_rows(matrix).astype(dtype, copy=False)
+        version = uuid.uuid4().hex[:16]
+        vectors_file = f"vectors-{version}.npy"
+        text_file = f"chunks-{version}.txt"
+        meta = dict(metadata, file_id=file_id, dtype=dtype, dim=int(matrix.shape[1]) if matrix.size else 0,
+                    count=len(chunks), normalized=True, vectors_file=vectors_file, text_file=text_file,
+                    chunks=chunk_entries)
+
+        meta_path = file_dir / cls.META_FILE
+        previous = cls._read_meta(meta_path)
+        vectors_path = file_dir / vectors_file
+        cls._atomic_write(vectors_path, lambda f: np.save(f, matrix))
+        cls._atomic_write(file_dir / text_file, lambda f: f.write(b''.join(encoded)))
+        # 替换chunks.json即切换到新版本
+        cls._atomic_write(meta_path, lambda f: f.write(json.dumps(meta, ensure_ascii=False).encode('utf-8')))
+
+        # 删除更早版本的数据文件和旧的JSON文件，上一个版本保留给已经读取了旧元数据的请求
+        keep = {cls.META_FILE, vectors_file, text_file}
+        if previous is not None:
+            keep.update(cls._data_files(previous))
+        for item in file_dir.iterdir():
+            if item.name not in keep and not item.name.endswith('.tmp'):
+                try:
+                    item.unlink()
+                except FileNotFoundError:
+                    pass
+        return vectors_path
+
+    @classmethod
+    def _data_files(cls, meta: Dict[str, Any]) -> Tuple[str, str]:
+        """元数据对应的 (向量文件名, 文本文件名)，旧版本没有记录时使用固定文件名"""
+        return meta.get('vectors_file', cls.VECTORS_FILE), meta.get('text_file', cls.TEXT_FILE)
+
+    @staticmethod
+    def _read_meta(meta_path: Path) -> Optional[Dict[str, Any]]:
+        try:
+            with open(str(meta_path), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def load(cls, base_path: str, file_id: str) -> Optional[Tuple[Dict[str, Any], np.ndarray]]:
+        """
+        打开一个文件的嵌入
+
+        Returns:
+            (元数据, 归一化的向量矩阵)，新格式的矩阵是只读mmap；找不到嵌入时返回None
+        """
+        file_dir = cls.file_dir(base_path, file_id)
+        meta_path = file_dir / cls.META_FILE
+        for attempt in range(3):
+            meta = cls._read_meta(meta_path)
+            if meta is None:
+                break
+            try:
+                vectors = np.load(str(file_dir / cls._data_files(meta)[0]), mmap_mode='r')
+            except FileNotFoundError:
+                # 读取元数据后又保存了两次，这个版本已被删除，重新读取元数据
+                if attempt == 2:
+                    raise
+                continue
+            if not meta.get('normalized'):
+                vectors = normalize_rows(vectors)
+            return meta, vectors
+
+        legacy_path = file_dir / cls.LEGACY_FILE
+        if legacy_path.exists():
+            meta, vectors, texts = cls._read_legacy(legacy_path)
+            # 旧格式没有文本文件，分块文本直接放在元数据中
+            for entry, text in zip(meta['chunks'], texts):
+                entry['text'] = text
+            return meta, normalize_rows(vectors)
+        return None
+
+    @classmethod
+    def read_texts(cls, base_path: str, file_id: str, meta: Dict[str, Any], indices: List[int]) -> List[str]:
+        """按字节偏移只读取需要的分块文本"""
+        entries = meta['chunks']
+        if all('text' in entries[i] for i in indices):
+            return [entries[i]['text'] for i in indices]
+        texts = []
+        with open(str(cls.file_dir(base_path, file_id) / cls._data_files(meta)[1]), 'rb') as f:
+            for i in indices:
+                f.seek(entries[i]['offset'])
+                texts.append(f.read(entries[i]['length']).decode('utf-8'))
+        return texts
+
+    @staticmethod
+    def score(vectors: np.ndarray, queries: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        用一次矩阵乘法计算一批查询对所有分块的余弦相似度，并选出每个查询的前top_k个
+
+        Args:
+            vectors: load返回的归一化矩阵 (分块数, 维度)
+            queries: (查询数, 维度) 的查询向量，不需要预先归一化
+            top_k: 每个查询返回的数量
+
+        Returns:
+            (下标, 相似度)，形状都是 (查询数, min(top_k, 分块数))
+        """
+        queries = normalize_rows(np.atleast_2d(queries))
+        if len(vectors) == 0:
+            empty = np.empty((len(queries), 0))
+            return empty.astype(np.intp), empty
+        # float16只用于存储，计算时转为float32
+        matrix = vectors if vectors.dtype == np.float32 else np.asarray(vectors, dtype=np.float32)
+        scores = queries @ matrix.T
+        indices = top_k_indices(scores, top_k)
+        return indices, np.take_along_axis(scores, indices, axis=-1)
+
+    @classmethod
+    def delete(cls, base_path: str, file_id: str) -> None:
+        """删除一个文件的嵌入目录"""
+        file_dir = cls.file_dir(base_path, file_id)
+        if file_dir.exists():
+            for item in file_dir.glob('*'):
+                item.unlink()
+            file_dir.rmdir()
+
+    @staticmethod
+    def _read_legacy(legacy_path: Path) -> Tuple[Dict[str, Any], np.ndarray, List[str]]:
+        """读取旧版本的embeddings.json，返回 (元数据, 向量矩阵, 分块文本)"""
+        with open(str(legacy_path), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        chunks = data.pop('chunks', [])
+        vectors = np.asarray([chunk['embedding'] for chunk in chunks], dtype=np.float32)
+        if not chunks:
+            vectors = vectors.reshape(0, 0)
+        data['chunks'] = [{'start_line': chunk['start_line'], 'end_line': chunk['end_line']} for chunk in chunks]
+        return data, vectors, [chunk['text'] for chunk in chunks]
+
+    @classmethod
+    def convert_legacy(cls, base_path: str, file_id: str, dtype: str = DEFAULT_DTYPE) -> bool:
+        """把旧版本的embeddings.json转换为二进制格式，没有旧文件时返回False"""
+        legacy_path = cls.file_dir(base_path, file_id) / cls.LEGACY_FILE
+        if not legacy_path.exists():
+            return False
+        meta, vectors, texts = cls._read_legacy(legacy_path)
+        line_ranges = meta.pop('chunks')
+        cls.save(base_path, file_id, texts, vectors, line_ranges, meta, dtype=dtype)
+        return True
@@ -1,10 +1,15 @@
 import os
 import json
 import time
+import hashlib
 from pathlib import Path
-from typing import Dict, Any, List, Tuple
+from typing import Dict, Any, List, Optional, Tuple, Union
 import numpy as np
-from initialization import app, oaipro_client
+from initialization import app
+from utils.text_attachment.embedding_store import EmbeddingStore, normalize_rows
+from utils.text_attachment.embedding_client import embedding_client
+from utils.text_attachment.embedding_cache import EmbeddingCache
+from utils.text_attachment.user_vector_index import UserVectorIndex
 import asyncio
 
 class TextEmbedding:
@@ -14,8 +19,10 @@ class TextEmbedding:
     DEFAULT_CHUNK_SIZE = 3000  # 默认分块大小（字符数）- 提高默认大小
     MIN_CHUNK_SIZE = 1500      # 最小分块大小 - 大幅提高最小块大小
     MAX_CHUNK_SIZE = 8000      # 最大分块大小 - 增加最大块大小
-    OVERLAP_RATIO = 0.05       # 分块重叠比例 - 减少重叠，避免过多小块
+    # 分块大小只取这些值，创意性评分或文本长度的小幅变化不会改变分块大小（从而改变全部分块边界）
+    CHUNK_SIZE_STEPS = (1500, 2000, 3000, 4000, 6000, 8000)
     EMBEDDING_MODEL = "text-embedding-3-large"  # 使用的嵌入模型
+    EMBEDDING_DTYPE = EmbeddingStore.DEFAULT_DTYPE  # 向量存储类型
     
     # 新增常量
     MAX_CHUNKS = 10            # 最大分块数量
@@ -23,7 +30,7 @@ class TextEmbedding:
     
     def __init__(self):
         self.model = self.EMBEDDING_MODEL
-        self.client = oaipro_client
+        self.client = embedding_client
     
     async def process_text(self, text: str, file_id: str, base_path: str, 
                          text_type: str = "普通文章", 
@@ -68,13 +75,13 @@ class TextEmbedding:
                 if len(chunks) > self.MAX_CHUNKS:
                     print(f"分块过多({len(chunks)}块)，进行重新分块...")
                     # 根据文本长度和最大分块数计算新的分块大小
-                    new_chunk_size = max(self.MIN_CHUNK_SIZE, text_length // self.MAX_CHUNKS)
+                    new_chunk_size = self._step_at_least(text_length // self.MAX_CHUNKS)
                     chunks, line_ranges = self._smart_split_text(text, lines, new_chunk_size, text_length)
                 
                 print(f"分块完成，共{len(chunks)}块，平均每块{text_length/len(chunks):.1f}字符")
             
             # 获取每个分块的嵌入向量
-            embeddings = await self._get_embeddings(chunks)
+            embeddings = await self._get_embeddings(chunks, base_path)
             
             # 保存嵌入向量和相关信息
             result = self._save_embeddings(
@@ -136,8 +143,19 @@ class TextEmbedding:
         elif text_length > 50000:  # 长文本
             base_size *= 1.2
             
-        # 确保在允许范围内
-        return max(self.MIN_CHUNK_SIZE, min(int(base_size), self.MAX_CHUNK_SIZE))
+        # 确保在允许范围内，并取最接近的固定档位
+        size = max(self.MIN_CHUNK_SIZE, min(int(base_size), self.MAX_CHUNK_SIZE))
+        return min(self.CHUNK_SIZE_STEPS, key=lambda step: abs(step - size))
+    
+    def _step_at_least(self, size: int) -> int:
+        """不小于size的最小档位，超过最大档位后按倍数增长"""
+        for step in self.CHUNK_SIZE_STEPS:
+            if step >= size:
+                return step
+        step = self.CHUNK_SIZE_STEPS[-1]
+        while step < size:
+            step *= 2
+        return step
     
     def _smart_split_text(self, text: str, lines: List[str], chunk_size: int, text_length: int) -> Tuple[List[str], List[Dict[str, int]]]:
         """
@@ -158,53 +176,18 @@ class TextEmbedding:
                 'start_line': 1,
                 'end_line': len(lines)
             }]
-            
-        # 估算分块数量
-        estimated_chunks = max(1, text_length // chunk_size)
-        if estimated_chunks <= 3:
-            # 文本较小，可以采用简单分割策略，每块尽量平均
-            return self._simple_split_text(text, lines, estimated_chunks)
-        else:
-            # 文本较大，使用原有的自然断点分割策略，但更大块
-            return self._split_text(text, lines, chunk_size)
-    
-    def _simple_split_text(self, text: str, lines: List[str], num_chunks: int) -> Tuple[List[str], List[Dict[str, int]]]:
-        """
-        简单分割策略，将文本尽量均匀地分成指定数量的块
-        
-        Args:
-            text: 完整文本
-            lines: 文本按行分割
-            num_chunks: 目标分块数量
-            
-        Returns:
-            Tuple[List[str], List[Dict[str, int]]]: 分块列表和每块对应的行号范围
-        """
-        chunks = []
-        line_ranges = []
-        total_lines = len(lines)
-        
-        # 计算每个块包含的行数
-        lines_per_chunk = max(1, total_lines // num_chunks)
-        
-        # 按行分块
-        for i in range(0, total_lines, lines_per_chunk):
-            end_idx = min(i + lines_per_chunk, total_lines)
-            
-            # 获取当前块的行范围
-            chunk_lines = lines[i:end_idx]
-            chunks.append('\n'.join(chunk_lines))
-            
-            line_ranges.append({
-                'start_line': i + 1,  # 1-based索引
-                'end_line': end_idx
-            })
-        
-        return chunks, line_ranges
+        return self._split_text(text, lines, chunk_size)
 
     def _split_text(self, text: str, lines: List[str], chunk_size: int) -> Tuple[List[str], List[Dict[str, int]]]:
         """
-        将文本分割成块，保持语义和行号完整性
+        按内容确定分块边界，保持行号完整性
+        
+        边界只落在行尾（过长的行先按句子拆开），某一行是否作为边界由该行的内容哈希决定，与它在全文中的位置无关。
+        编辑文本通常只改变所在的分块；分块长度的变化偶尔会让其后的几个分块改变，直到遇到下一个边界行重新对齐。
+        其它分块的文本不变，可以直接命中嵌入缓存。
+        
+        - 分块达到chunk_size的一半之后才允许切分，达到两倍时强制切分
+        - 之后每行成为边界的概率与行长成正比，平均分块长度约为chunk_size；分块已达到chunk_size时在空行（段落之间）切分
         
         Args:
             text: 完整文本
@@ -214,187 +197,85 @@ class TextEmbedding:
         Returns:
             Tuple[List[str], List[Dict[str, int]]]: 分块列表和每块对应的行号范围
         """
+        min_size = chunk_size // 2
+        max_size = chunk_size * 2
         chunks = []
         line_ranges = []
+        current = []
+        start_line = 0
+        length = 0
+        
+        for piece, line_index in self._split_units(text, max_size):
+            if not current:
+                start_line = line_index
+            current.append(piece)
+            length += len(piece)
+            if length >= max_size or (length >= min_size and self._is_boundary(piece, length, chunk_size - min_size, chunk_size)):
+                chunks.append(''.join(current))
+                line_ranges.append({
+                    'start_line': start_line + 1,  # 转为1-based索引
+                    'end_line': min(line_index + 1, len(lines))
+                })
+                current = []
+                length = 0
         
-        # 计算重叠大小（字符数）
-        overlap_size = int(chunk_size * self.OVERLAP_RATIO)
-        
-        # 当前处理位置
-        current_pos = 0
-        current_line = 0
-        text_length = len(text)
-        
-        while current_pos < text_length:
-            # 计算当前块的结束位置
-            end_pos = min(current_pos + chunk_size, text_length)
-            
-            # 如果不是最后一块，尝试找到自然分割点（段落、句子等）
-            if end_pos < text_length:
-                # 在重叠区域内寻找段落结束
-                search_end = min(end_pos + overlap_size, text_length)
-                natural_end = self._find_natural_break(text, end_pos, search_end)
-                end_pos = natural_end if natural_end > end_pos else end_pos
-            
-            # 提取当前块文本
-            chunk_text = text[current_pos:end_pos]
-            
-            # 确定当前块覆盖的行范围
-            start_line, end_line, current_line = self._determine_line_range(
-                text, lines, current_pos, end_pos, current_line)
-            
-            chunks.append(chunk_text)
+        if current:
+            chunks.append(''.join(current))
             line_ranges.append({
-                'start_line': start_line + 1,  # 转为1-based索引
-                'end_line': end_line + 1
+                'start_line': start_line + 1,
+                'end_line': len(lines)
             })
-            
-            # 更新下一个块的起始位置，大幅度前进以减少分块数量
-            current_pos = end_pos - (0 if end_pos == text_length else overlap_size)
-        
         return chunks, line_ranges
     
-    def _find_natural_break(self, text: str, start_pos: int, end_pos: int) -> int:
+    @staticmethod
+    def _split_units(text: str, max_size: int):
         """
-        在指定范围内找到自然分割点（优先级：段落>句子>单词）
+        把文本拆成可以作为分块边界的单元（行，保留换行符），返回(单元文本, 行号)
         
-        Args:
-            text: 文本内容
-            start_pos: 起始位置
-            end_pos: 结束位置
-            
-        Returns:
-            int: 自然分割点位置
+        与str.splitlines的行号一致；超过max_size的行按句子拆开，仍然过长的句子按max_size拆开
         """
-        # 搜索范围内的文本
-        search_text = text[start_pos:end_pos]
-        
-        # 尝试按段落分割（双换行）
-        paragraph_breaks = [m.start() + start_pos for m in re.finditer(r'\n\s*\n', search_text)]
-        if paragraph_breaks:
-            return paragraph_breaks[0] + 2  # +2 跳过换行符
-        
-        # 尝试按句子分割
-        sentence_breaks = [m.start() + start_pos for m in re.finditer(r'[.!?。！？]\s', search_text)]
-        if sentence_breaks:
-            return sentence_breaks[0] + 1
-        
-        # 尝试按逗号分割
-        comma_breaks = [m.start() + start_pos for m in re.finditer(r'[,，、]\s', search_text)]
-        if comma_breaks:
-            return comma_breaks[0] + 1
-        
-        # 尝试在单词边界分割（针对英文）
-        word_breaks = [m.start() + start_pos for m in re.finditer(r'\s', search_text)]
-        if word_breaks:
-            return word_breaks[0]
-        
-        # 找不到合适的分割点，返回原始结束位置
-        return end_pos
+        for line_index, line in enumerate(text.splitlines(keepends=True)):
+            if len(line) <= max_size:
+                yield line, line_index
+                continue
+            for sentence in re.split(r'(?<=[.!?。！？])', line):
+                for start in range(0, len(sentence), max_size):
+                    yield sentence[start:start + max_size], line_index
     
-    def _determine_line_range(self, text: str, lines: List[str], start_pos: int, end_pos: int, current_line: int) -> Tuple[int, int, int]:
-        """
-        确定文本块对应的行号范围
-        
-        Args:
-            text: 完整文本
-            lines: 文本按行分割
-            start_pos: 块起始位置（字符索引）
-            end_pos: 块结束位置（字符索引）
-            current_line: 当前处理到的行号
-            
-        Returns:
-            Tuple[int, int, int]: 起始行号，结束行号，下次处理的行号
-        """
-        start_line = current_line
-        line_pos = 0
-        
-        # 找到起始行
-        while start_line < len(lines):
-            line_length = len(lines[start_line]) + 1  # +1 for newline
-            if line_pos + line_length > start_pos:
-                break
-            line_pos += line_length
-            start_line += 1
-        
-        # 找到结束行
-        end_line = start_line
-        while end_line < len(lines) and line_pos < end_pos:
-            line_length = len(lines[end_line]) + 1
-            line_pos += line_length
-            if line_pos >= end_pos:
-                break
-            end_line += 1
-        
-        return start_line, min(end_line, len(lines) - 1), end_line
+    @staticmethod
+    def _is_boundary(piece: str, length: int, spacing: int, chunk_size: int) -> bool:
+        """单元之后是否切分：空行在分块足够长时切分，其它单元按内容哈希以 单元长度/spacing 的概率切分"""
+        if not piece.strip():
+            return length >= chunk_size
+        digest = hashlib.blake2b(piece.encode('utf-8', 'surrogatepass'), digest_size=8).digest()
+        return int.from_bytes(digest, 'big') / 2 ** 64 < len(piece) / max(spacing, 1)
     
-    async def _get_embeddings(self, chunks: List[str]) -> List[List[float]]:
+    async def _get_embeddings(self, chunks: List[str], base_path: Optional[str] = None) -> np.ndarray:
         """
-        并行获取文本块的嵌入向量
+        批量获取文本块的嵌入向量，先查用户的嵌入缓存，只为未命中的分块调用接口
         
         Args:
             chunks: 文本块列表
+            base_path: 用户目录，提供时使用该用户的嵌入缓存
             
         Returns:
-            List[List[float]]: 嵌入向量列表
-        """
-        # 使用异步并行处理，每批最多5个请求
-        batch_size = 5
-        embeddings = []
-        
-        for i in range(0, len(chunks), batch_size):
-            batch_chunks = chunks[i:i+batch_size]
-            tasks = []
-            
-            # 创建所有任务
-            for chunk in batch_chunks:
-                tasks.append(self._get_single_embedding(chunk))
-            
-            # 等待所有任务完成
-            print(f"并行处理嵌入向量，批次 {i//batch_size + 1}/{(len(chunks) + batch_size - 1)//batch_size}")
-            batch_results = await asyncio.gather(*tasks, return_exceptions=True)
-            
-            # 处理结果，如果有异常，使用零向量
-            for j, result in enumerate(batch_results):
-                if isinstance(result, Exception):
-                    print(f"获取嵌入向量失败: {str(result)}")
-                    embeddings.append([0.0] * 3072)  # text-embedding-3-large 的维度是3072
-                else:
-                    embeddings.append(result)
-            
-            # 添加短暂延迟避免API限流
-            await asyncio.sleep(0.5)
-        
-        return embeddings
-    
-    async def _get_single_embedding(self, chunk: str) -> List[float]:
-        """
-        获取单个文本块的嵌入向量
-        
-        Args:
-            chunk: 文本块
+            np.ndarray: 嵌入向量矩阵，顺序与chunks一致
             
-        Returns:
-            List[float]: 嵌入向量
+        Raises:
+            EmbeddingError: 重试后仍失败（不再用零向量代替）
         """
-        retry_count = 3
-        for attempt in range(retry_count):
-            try:
-                response = self.client.embeddings.create(
-                    model=self.model,
-                    input=chunk
-                )
-                return response.data[0].embedding
-            except Exception as e:
-                if attempt < retry_count - 1:
-                    # 指数退避重试
-                    await asyncio.sleep(2 ** attempt)
-                    continue
-                raise e
-        
-        # 如果所有重试都失败，返回零向量
-        print(f"获取嵌入向量失败，所有重试都失败")
-        return [0.0] * 3072  # text-embedding-3-large 的维度是3072
+        cache = EmbeddingCache(base_path) if base_path else None
+        cached = cache.get_many(self.model, chunks) if cache else [None] * len(chunks)
+        
+        # 相同内容的分块只请求一次
+        missing = list(dict.fromkeys(chunk for chunk, vector in zip(chunks, cached) if vector is None))
+        if missing:
+            fetched = await self.client.embed(missing, self.model)
+            if cache:
+                cache.put_many(self.model, missing, fetched)
+            by_text = dict(zip(missing, fetched))
+            cached = [by_text[chunk] if vector is None else vector for chunk, vector in zip(chunks, cached)]
+        return np.asarray(cached, dtype=np.float32)
     
     def _save_embeddings(self, file_id: str, base_path: str, chunks: List[str], 
                        embeddings: List[List[float]], line_ranges: List[Dict[str, int]],
@@ -417,38 +298,22 @@ class TextEmbedding:
         Returns:
             Dict: 保存结果
         """
-        # 创建embedding目录
-        embedding_dir = Path(base_path) / 'embeddings'
-        embedding_dir.mkdir(parents=True, exist_ok=True)
-        
-        # 创建文件ID特定目录
-        file_embed_dir = embedding_dir / file_id
-        file_embed_dir.mkdir(exist_ok=True)
-        
-        # 保存嵌入信息
-        embedding_data = {
-            'file_id': file_id,
+        metadata = {
             'created_at': int(time.time() * 1000),
             'model': self.model,
             'text_type': text_type,
             'line_length': line_length,
             'creativity_score': creativity_score,
-            'total_lines': total_lines,
-            'chunks': [
-                {
-                    'text': chunk,
-                    'embedding': embedding,
-                    'start_line': line_range['start_line'],
-                    'end_line': line_range['end_line']
-                }
-                for chunk, embedding, line_range in zip(chunks, embeddings, line_ranges)
-            ]
+            'total_lines': total_lines
         }
+        embedding_file = EmbeddingStore.save(
+            base_path, file_id, chunks, embeddings, line_ranges, metadata, dtype=self.EMBEDDING_DTYPE)
         
-        # 保存到文件
-        embedding_file = file_embed_dir / 'embeddings.json'
-        with open(str(embedding_file), 'w', encoding='utf-8') as f:
-            json.dump(embedding_data, f, ensure_ascii=False)
+        # 更新用户的跨文件向量索引，失败不影响单文件搜索
+        try:
+            UserVectorIndex(base_path).add_file(file_id, normalize_rows(embeddings), line_ranges)
+        except Exception as e:
+            print(f"更新用户向量索引失败: {str(e)}")
         
         return {
             'success': True,
@@ -467,69 +332,64 @@ class TextEmbedding:
             bool: 是否删除成功
         """
         try:
-            embedding_dir = Path(base_path) / 'embeddings' / file_id
-            if embedding_dir.exists():
-                # 删除目录及其内容
-                for item in embedding_dir.glob('*'):
-                    item.unlink()
-                embedding_dir.rmdir()
+            EmbeddingStore.delete(base_path, file_id)
+            UserVectorIndex(base_path).remove_file(file_id)
             return True
         except Exception as e:
             print(f"删除嵌入向量失败: {str(e)}")
             return False
     
-    async def search_text(self, query: str, base_path: str, file_id: str, 
+    async def search_text(self, query: Union[str, List[str]], base_path: str, file_id: str, 
                         top_k: int = 3) -> Dict[str, Any]:
         """
         使用嵌入向量搜索相关文本块
         
         Args:
-            query: 查询文本
+            query: 查询文本，或一组查询文本（一次请求生成全部查询向量，一次矩阵乘法计算全部相似度）
             base_path: 基础路径
             file_id: 文件ID
             top_k: 返回的最相关结果数量
             
         Returns:
-            Dict: 搜索结果
+            Dict: 搜索结果；query为列表时results是与查询一一对应的结果列表
         """
         try:
-            # 生成查询的嵌入向量
-            query_response = self.client.embeddings.create(
-                model=self.model,
-                input=query
-            )
-            query_embedding = query_response.data[0].embedding
+            queries = [query] if isinstance(query, str) else list(query)
             
-            # 加载文件嵌入向量
-            embedding_file = Path(base_path) / 'embeddings' / file_id / 'embeddings.json'
-            if not embedding_file.exists():
+            # 打开文件嵌入向量（mmap，不整体读入内存）
+            loaded = EmbeddingStore.load(base_path, file_id)
+            if loaded is None:
                 return {
                     'success': False,
-                    'error': f'找不到嵌入文件: {embedding_file}'
+                    'error': f'找不到嵌入文件: {EmbeddingStore.file_dir(base_path, file_id)}'
                 }
+            embedding_data, vectors = loaded
             
-            with open(str(embedding_file), 'r', encoding='utf-8') as f:
-                embedding_data = json.load(f)
+            # 生成查询的嵌入向量
+            query_embeddings = await self.client.embed(queries, self.model)
             
-            # 计算相似度并排序
-            results = []
-            for chunk in embedding_data['chunks']:
-                chunk_embedding = chunk['embedding']
-                similarity = self._calculate_similarity(query_embedding, chunk_embedding)
-                
-                results.append({
-                    'text': chunk['text'],
-                    'start_line': chunk['start_line'],
-                    'end_line': chunk['end_line'],
-                    'similarity': similarity
-                })
+            # 计算相似度并选出前top_k个
+            indices, scores = EmbeddingStore.score(vectors, query_embeddings, top_k)
             
-            # 按相似度降序排序
-            results.sort(key=lambda x: x['similarity'], reverse=True)
+            # 只读取返回结果的分块文本
+            needed = sorted(set(indices.ravel().tolist()))
+            texts = dict(zip(needed, EmbeddingStore.read_texts(base_path, file_id, embedding_data, needed)))
+            results = []
+            for row_indices, row_scores in zip(indices.tolist(), scores.tolist()):
+                row = []
+                for index, similarity in zip(row_indices, row_scores):
+                    chunk = embedding_data['chunks'][index]
+                    row.append({
+                        'text': texts[index],
+                        'start_line': chunk['start_line'],
+                        'end_line': chunk['end_line'],
+                        'similarity': similarity
+                    })
+                results.append(row)
             
             return {
                 'success': True,
-                'results': results[:top_k],
+                'results': results[0] if isinstance(query, str) else results,
                 'text_type': embedding_data.get('text_type'),
                 'line_length': embedding_data.get('line_length'),
                 'creativity_score': embedding_data.get('creativity_score')
@@ -541,6 +401,33 @@ class TextEmbedding:
                 'error': str(e)
             }
     
+    async def search_user_files(self, query: Union[str, List[str]], base_path: str,
+                                top_k: int = 5) -> Dict[str, Any]:
+        """
+        在用户的所有文本附件中搜索相关文本块（使用用户的跨文件向量索引）
+        
+        Args:
+            query: 查询文本，或一组查询文本
+            base_path: 用户目录
+            top_k: 返回的最相关结果数量
+            
+        Returns:
+            Dict: 搜索结果，每个结果包含file_id、start_line、end_line和score；query为列表时results与查询一一对应
+        """
+        try:
+            queries = [query] if isinstance(query, str) else list(query)
+            query_embeddings = await self.client.embed(queries, self.model)
+            results = UserVectorIndex(base_path).search(query_embeddings, top_k=top_k)
+            return {
+                'success': True,
+                'results': results[0] if isinstance(query, str) else results
+            }
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+    
     def _calculate_similarity(self, vec1: List[float], vec2: List[float]) -> float:
         """
         计算两个向量的余弦相似度
@@ -552,8 +439,8 @@ class TextEmbedding:
         Returns:
             float: 余弦相似度
         """
-        vec1_array = np.array(vec1)
-        vec2_array = np.array(vec2)
+        vec1_array = np.asarray(vec1, dtype=np.float32)
+        vec2_array = np.asarray(vec2, dtype=np.float32)
         
         dot_product = np.dot(vec1_array, vec2_array)
         norm1 = np.linalg.norm(vec1_array)
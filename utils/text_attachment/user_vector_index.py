@@ -0,0 +1,422 @@
+import os
+import json
+import fcntl
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from utils.logger import get_logger
+from utils.text_attachment.embedding_store import EmbeddingStore, normalize_rows, top_k_indices
+
+logger = get_logger(__name__)
+
+
+class _Segment:
+    """已加载的一个段：向量矩阵（mmap）和每行对应的文件、行号范围"""
+
+    def __init__(self, directory: Path, name: str):
+        with open(str(directory / f"{name}.json"), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.name = name
+        self.vectors = np.load(str(directory / f"{name}.npy"), mmap_mode='r')
+        self.files: List[str] = meta['files']
+        self.file_index = np.asarray(meta['file_index'], dtype=np.int32)
+        self.start_line = np.asarray(meta['start_line'], dtype=np.int32)
+        self.end_line = np.asarray(meta['end_line'], dtype=np.int32)
+        # 行按倒排列表排序时，list_offsets[i]:list_offsets[i+1] 是第i个列表的行
+        self.centroids_version = meta.get('centroids_version')
+        self.list_offsets = np.asarray(meta['list_offsets'], dtype=np.int64) if meta.get('list_offsets') else None
+
+
+class UserVectorIndex:
+    """
+    用户所有文本附件分块的IVF向量索引（保存在 <用户目录>/vector_index/）
+
+    - 向量按段保存：每次添加文件写一个新的小段；删除或替换文件只把 (段, 文件) 记录到清单的deleted中，
+      替换文件因此只追加一个小段，不重写已有的段
+    - 段数或已删除的行过多时合并段，在行数明显增长后用球面k-means重新训练聚类中心
+    - 合并后的段按最近的聚类中心排序，搜索时只计算nprobe个倒排列表中的行；未合并的小段直接全部计算
+    - 清单manifest.json最后原子替换，读取时不加锁；写入用文件锁在多个进程间互斥
+
+    向量在EmbeddingStore中已经归一化，这里以float16保存，相似度误差约1e-3。
+    """
+
+    DIR_NAME = 'vector_index'
+    MANIFEST = 'manifest.json'
+    DTYPE = np.float16
+
+    MAX_SEGMENTS = 16          # 超过后合并
+    MAX_DELETED_RATIO = 0.3    # 已删除行占比超过后合并
+    MIN_TRAIN_ROWS = 256       # 行数达到后才建立倒排列表
+    RETRAIN_GROWTH = 2.0       # 行数比上次训练时增长一倍后重新训练
+    MAX_LISTS = 1024
+    KMEANS_ITERATIONS = 10
+    DEFAULT_NPROBE = 8
+
+    # 进程内缓存：索引目录 -> (清单修改时间, 清单, 已加载的段, 聚类中心)
+    _cache: Dict[str, Any] = {}
+    _cache_lock = threading.Lock()
+
+    def __init__(self, user_dir: str):
+        self.root = Path(user_dir) / self.DIR_NAME
+
+    # ---------- 读取 ----------
+
+    def _read_manifest(self) -> Dict[str, Any]:
+        try:
+            with open(str(self.root / self.MANIFEST), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            # files: 文件 -> 有效行数；file_segments: 文件 -> 有效行所在的段；
+            # deleted: 段 -> {文件: 行数}，这些行已失效，合并该段时移除
+            return {'segments': [], 'files': {}, 'file_segments': {}, 'deleted': {}, 'next_segment': 0,
+                    'centroids_version': None, 'trained_rows': 0}
+
+    def _load_centroids(self, manifest: Dict[str, Any]) -> Optional[np.ndarray]:
+        if manifest.get('centroids_version') is None:
+            return None
+        return np.load(str(self.root / manifest['centroids_file'])).astype(np.float32)
+
+    def _load(self):
+        """返回 (清单, 段列表, 聚类中心)，清单未变化时使用进程内缓存"""
+        key = str(self.root)
+        try:
+            mtime = os.stat(str(self.root / self.MANIFEST)).st_mtime_ns
+        except FileNotFoundError:
+            return self._read_manifest(), [], None
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            if cached and cached[0] == mtime:
+                return cached[1:]
+        for attempt in range(3):
+            manifest = self._read_manifest()
+            try:
+                segments = [_Segment(self.root, name) for name in manifest['segments']]
+                centroids = self._load_centroids(manifest)
+                break
+            except FileNotFoundError:
+                # 读取清单后索引被合并，旧段已删除，重新读取清单
+                if attempt == 2:
+                    raise
+        with self._cache_lock:
+            self._cache[key] = (mtime, manifest, segments, centroids)
+        return manifest, segments, centroids
+
+    def search(self, queries, top_k: int = 5, nprobe: int = DEFAULT_NPROBE) -> List[List[Dict[str, Any]]]:
+        """
+        在用户的所有文件中搜索最相似的分块
+
+        Args:
+            queries: (查询数, 维度) 或 (维度,) 的查询向量
+            top_k: 每个查询返回的数量
+            nprobe: 搜索的倒排列表数，越大越准确、越慢
+
+        Returns:
+            每个查询一个列表，元素为 {'file_id', 'start_line', 'end_line', 'score'}，按score降序
+        """
+        queries = normalize_rows(np.atleast_2d(queries))
+        manifest, segments, centroids = self._load()
+        deleted = manifest.get('deleted', {})
+        dead_files = {segment.name: self._dead_files(segment, deleted.get(segment.name, {}))
+                      for segment in segments}
+        probes = None
+        if centroids is not None and len(centroids):
+            probes = top_k_indices(queries @ centroids.T, nprobe)
+
+        results = []
+        for qi, query in enumerate(queries):
+            scores, owners = [], []
+            for segment in segments:
+                rows = self._candidate_rows(segment, manifest, probes[qi] if probes is not None else None)
+                if rows is not None and len(rows) == 0:
+                    continue
+                vectors = segment.vectors if rows is None else segment.vectors[rows]
+                segment_scores = np.asarray(vectors, dtype=np.float32) @ query
+                row_ids = np.arange(len(segment.vectors)) if rows is None else rows
+                if segment.name in deleted:
+                    alive = ~dead_files[segment.name][segment.file_index[row_ids]]
+                    segment_scores, row_ids = segment_scores[alive], row_ids[alive]
+                if len(row_ids) > top_k:
+                    best = top_k_indices(segment_scores, top_k)
+                    segment_scores, row_ids = segment_scores[best], row_ids[best]
+                scores.append(segment_scores)
+                owners.extend((segment, int(row)) for row in row_ids)
+            if not owners:
+                results.append([])
+                continue
+            all_scores = np.concatenate(scores)
+            hits = []
+            for i in top_k_indices(all_scores, top_k):
+                segment, row = owners[i]
+                hits.append({
+                    'file_id': segment.files[segment.file_index[row]],
+                    'start_line': int(segment.start_line[row]),
+                    'end_line': int(segment.end_line[row]),
+                    'score': float(all_scores[i])
+                })
+            results.append(hits)
+        return results
+
+    @staticmethod
+    def _dead_files(segment: _Segment, deleted) -> np.ndarray:
+        """段中各文件是否已删除，deleted为该段中已失效的文件"""
+        return np.fromiter((name in deleted for name in segment.files), dtype=bool, count=len(segment.files))
+
+    @staticmethod
+    def _candidate_rows(segment: _Segment, manifest: Dict[str, Any], probe: Optional[np.ndarray]):
+        """段中需要计算的行，None表示整个段"""
+        if probe is None or segment.list_offsets is None or \
+                segment.centroids_version != manifest.get('centroids_version'):
+            return None
+        offsets = segment.list_offsets
+        ranges = [np.arange(offsets[i], offsets[i + 1]) for i in probe]
+        return np.concatenate(ranges) if ranges else np.empty(0, dtype=np.int64)
+
+    # ---------- 写入 ----------
+
+    @contextmanager
+    def _locked(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(str(self.root / '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write_json(self, path: Path, data: Dict[str, Any]) -> None:
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(str(tmp_path), 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(str(tmp_path), str(path))
+
+    def _write_segment(self, name: str, vectors: np.ndarray, files: List[str], file_index, start_line, end_line,
+                       list_offsets=None, centroids_version=None) -> None:
+        tmp_path = self.root / f"{name}.npy.tmp"
+        with open(str(tmp_path), 'wb') as f:
+            np.save(f, np.asarray(vectors, dtype=self.DTYPE))
+        os.replace(str(tmp_path), str(self.root / f"{name}.npy"))
+        self._write_json(self.root / f"{name}.json", {
+            'files': files,
+            'file_index': np.asarray(file_index).tolist(),
+            'start_line': np.asarray(start_line).tolist(),
+            'end_line': np.asarray(end_line).tolist(),
+            'list_offsets': None if list_offsets is None else np.asarray(list_offsets).tolist(),
+            'centroids_version': centroids_version
+        })
+
+    def _sort_by_list(self, vectors: np.ndarray, centroids: Optional[np.ndarray]):
+        """按最近的聚类中心排序，返回 (行顺序, 各列表的偏移)；没有聚类中心时返回 (None, None)"""
+        if centroids is None or len(vectors) == 0:
+            return None, None
+        assign = np.argmax(np.asarray(vectors, dtype=np.float32) @ centroids.T, axis=1)
+        order = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=len(centroids))
+        return order, np.concatenate([[0], np.cumsum(counts)])
+
+    @staticmethod
+    def _mark_deleted(manifest: Dict[str, Any], file_id: str) -> None:
+        """把文件当前的行标记为失效，并从有效文件中移除"""
+        rows = manifest['files'].pop(file_id)
+        segment = manifest['file_segments'].pop(file_id)
+        manifest['deleted'].setdefault(segment, {})[file_id] = rows
+
+    def add_file(self, file_id: str, vectors, line_ranges: List[Dict[str, int]]) -> None:
+        """添加（或替换）一个文件的分块向量，vectors应已归一化"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._locked():
+            manifest = self._read_manifest()
+            centroids = self._load_centroids(manifest)
+            # 替换同一文件时旧的行只标记为失效，由之后的合并移除
+            if file_id in manifest['files']:
+                self._mark_deleted(manifest, file_id)
+
+            start_line = np.asarray([r['start_line'] for r in line_ranges], dtype=np.int32)
+            end_line = np.asarray([r['end_line'] for r in line_ranges], dtype=np.int32)
+            order, offsets = self._sort_by_list(vectors, centroids)
+            if order is not None:
+                vectors, start_line, end_line = vectors[order], start_line[order], end_line[order]
+            name = f"seg-{manifest.get('next_segment', 0):06d}"
+            self._write_segment(name, vectors, [file_id], np.zeros(len(vectors), dtype=np.int32),
+                                start_line, end_line, offsets, manifest.get('centroids_version'))
+            manifest['segments'] = manifest['segments'] + [name]
+            manifest['next_segment'] = manifest.get('next_segment', 0) + 1
+            manifest['files'][file_id] = len(vectors)
+            manifest['file_segments'][file_id] = name
+            manifest['rows'] = sum(manifest['files'].values())
+            self._write_json(self.root / self.MANIFEST, manifest)
+            self._compact(manifest, centroids)
+
+    def remove_file(self, file_id: str) -> None:
+        """删除一个文件的分块（记录到deleted，合并时真正移除）"""
+        if not (self.root / self.MANIFEST).exists():
+            return
+        with self._locked():
+            manifest = self._read_manifest()
+            if file_id not in manifest['files']:
+                return
+            self._mark_deleted(manifest, file_id)
+            manifest['rows'] = sum(manifest['files'].values())
+            self._write_json(self.root / self.MANIFEST, manifest)
+            self._compact(manifest, self._load_centroids(manifest))
+
+    def _compact(self, manifest: Dict[str, Any], centroids: Optional[np.ndarray],
+                 force: bool = False) -> Optional[np.ndarray]:
+        """
+        段数或已删除的行过多时合并段（修改并写入manifest），返回当前的聚类中心；需要在文件锁内调用
+
+        通常只把小段合并为一个段，最大的段保持不变；小段的行数达到最大段的1/4、已删除的行过多
+        或需要重新训练聚类中心时，才合并全部段。这样每一行被重写的次数随总行数对数增长。
+        """
+        files = manifest['files']
+        deleted = manifest['deleted']
+        live_rows = sum(files.values())
+        deleted_rows = sum(sum(dead.values()) for dead in deleted.values())
+        total_rows = live_rows + deleted_rows
+        too_many_deleted = total_rows > 0 and deleted_rows / total_rows > self.MAX_DELETED_RATIO
+        if not force and len(manifest['segments']) <= self.MAX_SEGMENTS and not too_many_deleted:
+            return centroids
+
+        segments = {name: _Segment(self.root, name) for name in manifest['segments']}
+        base = max(segments, key=lambda name: len(segments[name].vectors)) if segments else None
+        base_rows = len(segments[base].vectors) if base else 0
+        small_rows = sum(len(segment.vectors) for name, segment in segments.items() if name != base)
+        trained_rows = manifest.get('trained_rows', 0)
+        retrain = live_rows >= self.MIN_TRAIN_ROWS and \
+            (centroids is None or live_rows >= trained_rows * self.RETRAIN_GROWTH)
+        full = force or too_many_deleted or retrain or small_rows * 4 >= base_rows or \
+            segments[base].centroids_version != manifest.get('centroids_version')
+        merge = list(segments) if full else [name for name in segments if name != base]
+
+        # 读取要合并的段中未删除的行
+        parts, live_files, file_index, start_line, end_line = [], [], [], [], []
+        for name in merge:
+            segment = segments[name]
+            dead = deleted.get(name, {})
+            alive = ~self._dead_files(segment, dead)[segment.file_index]
+            if not alive.any():
+                continue
+            remap = {}
+            for i, file_name in enumerate(segment.files):
+                if file_name not in dead:
+                    remap[i] = len(live_files)
+                    live_files.append(file_name)
+            parts.append(np.asarray(segment.vectors[alive], dtype=np.float32))
+            file_index.append(np.asarray([remap[i] for i in segment.file_index[alive]], dtype=np.int32))
+            start_line.append(segment.start_line[alive])
+            end_line.append(segment.end_line[alive])
+
+        dim = parts[0].shape[1] if parts else 0
+        vectors = np.concatenate(parts) if parts else np.empty((0, dim), dtype=np.float32)
+        file_index = np.concatenate(file_index) if file_index else np.empty(0, dtype=np.int32)
+        start_line = np.concatenate(start_line) if start_line else np.empty(0, dtype=np.int32)
+        end_line = np.concatenate(end_line) if end_line else np.empty(0, dtype=np.int32)
+
+        if full and retrain:
+            centroids = self.train_centroids(vectors)
+            version = (manifest.get('centroids_version') or 0) + 1
+            # 聚类中心按版本号保存，新版本只在新清单写入后生效
+            centroids_file = f"centroids-{version}.npy"
+            tmp_path = self.root / f"{centroids_file}.tmp"
+            with open(str(tmp_path), 'wb') as f:
+                np.save(f, centroids)
+            os.replace(str(tmp_path), str(self.root / centroids_file))
+            manifest['centroids_file'] = centroids_file
+            manifest['centroids_version'] = version
+            manifest['trained_rows'] = len(vectors)
+        elif full and live_rows < self.MIN_TRAIN_ROWS:
+            centroids = None
+            manifest['centroids_version'] = None
+            manifest['centroids_file'] = None
+
+        kept = [] if full else [base]
+        names = list(kept)
+        if len(vectors):
+            order, offsets = self._sort_by_list(vectors, centroids)
+            if order is not None:
+                vectors, file_index = vectors[order], file_index[order]
+                start_line, end_line = start_line[order], end_line[order]
+            name = f"seg-{manifest.get('next_segment', 0):06d}"
+            self._write_segment(name, vectors, live_files, file_index, start_line, end_line,
+                                offsets, manifest.get('centroids_version'))
+            manifest['next_segment'] = manifest.get('next_segment', 0) + 1
+            names.append(name)
+
+        # 未合并的最大段中的失效行继续保留在deleted中
+        manifest['segments'] = names
+        for file_name in live_files:
+            manifest['file_segments'][file_name] = names[-1]
+        manifest['rows'] = sum(files.values())
+        manifest['deleted'] = {base: deleted[base]} if kept and base in deleted else {}
+        self._write_json(self.root / self.MANIFEST, manifest)
+
+        # 删除合并掉的段和旧的聚类中心；正在读取旧段的搜索仍持有mmap，不受影响
+        stale = [f"{old}{suffix}" for old in merge for suffix in ('.npy', '.json')]
+        stale += [name for name in os.listdir(str(self.root))
+                  if name.startswith('centroids-') and name != manifest.get('centroids_file')]
+        for name in stale:
+            try:
+                os.remove(str(self.root / name))
+            except FileNotFoundError:
+                pass
+        logger.info("向量索引 %s 合并 %d 个段（%s），%d 行", self.root, len(merge),
+                    '全部' if full else '小段', len(vectors))
+        return centroids
+
+    @classmethod
+    def train_centroids(cls, vectors: np.ndarray, seed: int = 0) -> np.ndarray:
+        """球面k-means，列表数约为行数的平方根"""
+        n = len(vectors)
+        k = int(min(cls.MAX_LISTS, max(1, round(np.sqrt(n)))))
+        rng = np.random.default_rng(seed)
+        # 每个列表最多使用64行训练
+        sample = np.asarray(vectors[np.sort(rng.choice(n, size=min(n, 64 * k), replace=False))], dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), size=k, replace=False)].copy()
+        for _ in range(cls.KMEANS_ITERATIONS):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            counts = np.bincount(assign, minlength=k)
+            order = np.argsort(assign, kind='stable')
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            filled = counts > 0
+            sums = np.empty_like(centroids)
+            sums[filled] = np.add.reduceat(sample[order], starts[filled], axis=0)
+            # 空的列表用随机的行重新初始化
+            sums[~filled] = sample[rng.choice(len(sample), size=int((~filled).sum()))]
+            centroids = normalize_rows(sums)
+        return centroids
+
+    # ---------- 重建 ----------
+
+    def rebuild(self) -> int:
+        """从用户所有文件的嵌入重建索引（写成一个段后合并训练），返回文件数"""
+        embeddings_dir = self.root.parent / 'embeddings'
+        user_dir = str(self.root.parent)
+        files, parts, file_index, start_line, end_line = {}, [], [], [], []
+        if embeddings_dir.exists():
+            for entry in sorted(os.scandir(str(embeddings_dir)), key=lambda e: e.name):
+                loaded = EmbeddingStore.load(user_dir, entry.name) if entry.is_dir() else None
+                if loaded is None or len(loaded[1]) == 0:
+                    continue
+                meta, vectors = loaded
+                file_index.append(np.full(len(vectors), len(files), dtype=np.int32))
+                files[entry.name] = len(vectors)
+                parts.append(np.asarray(vectors, dtype=np.float32))
+                start_line.extend(chunk['start_line'] for chunk in meta['chunks'])
+                end_line.extend(chunk['end_line'] for chunk in meta['chunks'])
+
+        with self._locked():
+            for name in os.listdir(str(self.root)):
+                if name != '.lock':
+                    os.remove(str(self.root / name))
+            if not files:
+                return 0
+            self._write_segment('seg-000000', np.concatenate(parts), list(files), np.concatenate(file_index),
+                                start_line, end_line)
+            manifest = dict(self._read_manifest(), segments=['seg-000000'], next_segment=1, files=files,
+                            file_segments={f: 'seg-000000' for f in files}, rows=sum(files.values()))
+            self._write_json(self.root / self.MANIFEST, manifest)
+            self._compact(manifest, None, force=True)
+        return len(files)
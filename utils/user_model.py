@@ -1,6 +1,6 @@
 from initialization import db
 from werkzeug.security import generate_password_hash, check_password_hash
-from .price.usage_model import Usage
+from .price.usage_model import Usage, UsageRollup
 
 # 默认用户设置
 DEFAULT_USER_SETTINGS = {
@@ -33,6 +33,10 @@ class User(db.Model):
         """获取用户使用记录"""
         return Usage.get_user_usage(self.id, start_date, end_date)
 
+    def get_usage_summary(self, start_day=None, end_day=None, by_model=True):
+        """获取用户按日（和模型）汇总的用量"""
+        return UsageRollup.get_user_summary(self.id, start_day, end_day, by_model)
+
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
 
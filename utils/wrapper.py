@@ -1,7 +1,12 @@
-from flask import session, redirect, url_for
+from flask import session, redirect, url_for, jsonify
 from utils.user_model import User
 from functools import wraps
 
+try:
+    import config
+except ImportError:
+    config = None
+
 # 登录验证装饰器
 def login_required(f):
     @wraps(f)
@@ -18,3 +23,15 @@ def login_required(f):
             
         return f(*args, **kwargs)
     return decorated_function
+
+# 管理员验证装饰器：只允许config.ADMIN_EMAILS中的用户访问，未配置时所有人都无权访问
+def admin_required(f):
+    @wraps(f)
+    @login_required
+    def decorated_function(*args, **kwargs):
+        admin_emails = {email.lower() for email in getattr(config, 'ADMIN_EMAILS', ())}
+        user = User.query.get(session['user_id'])
+        if user.email.lower() not in admin_emails:
+            return jsonify({'error': '无权访问'}), 403
+        return f(*args, **kwargs)
+    return decorated_function